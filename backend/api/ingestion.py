@@ -0,0 +1,128 @@
+import datetime
+import gzip
+import json
+
+import pytz
+from dateutil import parser
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# longest single event we accept on the streaming endpoint, so a body with no
+# newlines can't make us buffer all of it
+MAX_EVENT_LINE_BYTES = 1024 * 1024
+EVENT_PAST_LIMIT = datetime.timedelta(days=30)
+EVENT_FUTURE_LIMIT = datetime.timedelta(days=1)
+
+
+class InvalidEvent(Exception):
+    def __init__(self, key, message):
+        super().__init__(message)
+        self.key = key
+        self.message = message
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def parse_time_created(value):
+    """Parse an event's time_created, assuming UTC if it has no timezone.
+
+    RFC 3339 timestamps, which is what all our SDKs send, go through
+    datetime.fromisoformat. Anything else is left to dateutil.
+    """
+    if not isinstance(value, str):
+        raise ValueError("time_created must be a string")
+    try:
+        if value[-1:] in ("Z", "z"):
+            tc = datetime.datetime.fromisoformat(value[:-1] + "+00:00")
+        else:
+            tc = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        tc = parser.parse(value)
+    if tc.tzinfo is None or tc.tzinfo.utcoffset(tc) is None:
+        tc = tc.replace(tzinfo=pytz.UTC)
+    return tc
+
+
+def ingest_event(data: dict, customer_id: str, organization_pk: int) -> None:
+    event_kwargs = {
+        "organization_id": organization_pk,
+        "cust_id": customer_id,
+        "customer_id": customer_id,
+        "event_name": data["event_name"],
+        "idempotency_id": data["idempotency_id"],
+        "time_created": data["time_created"],
+        "properties": {},
+    }
+    if "properties" in data:
+        event_kwargs["properties"] = data["properties"]
+    return event_kwargs
+
+
+def prepare_event(data, organization_pk, now):
+    """Validate a tracked event and turn it into the record we send to kafka.
+
+    Returns (idempotency_id, record), raises InvalidEvent with the key to report the
+    failure under otherwise.
+    """
+    if not isinstance(data, dict):
+        raise InvalidEvent("invalid_event", "Event must be a JSON object")
+    customer_id = data.get("customer_id")
+    idempotency_id = data.get("idempotency_id")
+    time_created = data.get("time_created")
+    if not idempotency_id:
+        raise InvalidEvent("no_idempotency_id", "No idempotency_id provided")
+    if not customer_id:
+        raise InvalidEvent(idempotency_id, "No customer_id provided")
+    if not time_created:
+        raise InvalidEvent(idempotency_id, "Invalid time_created")
+    try:
+        tc = parse_time_created(time_created)
+    except (ValueError, OverflowError):
+        raise InvalidEvent(idempotency_id, "Invalid time_created")
+    if not (now - EVENT_PAST_LIMIT <= tc <= now + EVENT_FUTURE_LIMIT):
+        raise InvalidEvent(
+            idempotency_id,
+            "Time created too far in the past or future. Events must be within 30 days before or 1 day ahead of current time.",
+        )
+    data["time_created"] = tc.isoformat()
+    try:
+        transformed_event = ingest_event(data, customer_id, organization_pk)
+    except Exception as e:
+        raise InvalidEvent(idempotency_id, str(e))
+    return idempotency_id, (
+        customer_id,
+        {
+            "organization_id": organization_pk,
+            "event": transformed_event,
+        },
+    )
+
+
+def iter_ndjson_lines(request):
+    """Yield the non-empty lines of a newline delimited JSON request body.
+
+    The body is read incrementally straight off the request, gunzipping it on the
+    fly if it was sent with Content-Encoding: gzip.
+    """
+    content_encoding = request.META.get("HTTP_CONTENT_ENCODING", "").lower()
+    if content_encoding == "gzip":
+        stream = gzip.GzipFile(fileobj=request, mode="rb")
+    elif content_encoding in ("", "identity"):
+        stream = request
+    else:
+        raise ValueError(f"Unsupported content encoding {content_encoding}")
+    while True:
+        line = stream.readline(MAX_EVENT_LINE_BYTES + 1)
+        if not line:
+            return
+        if len(line) > MAX_EVENT_LINE_BYTES:
+            raise ValueError(f"Events can be at most {MAX_EVENT_LINE_BYTES} bytes")
+        if line.strip():
+            yield line
@@ -13,12 +13,15 @@ from metering_billing.models import (
     SubscriptionRecord,
 )
 from metering_billing.serializers.serializer_utils import (
+    FeatureUUIDField,
     SlugRelatedFieldWithOrganization,
     SlugRelatedFieldWithOrganizationPK,
     TimezoneFieldMixin,
 )
 from rest_framework import serializers
 
+MAX_FEATURE_ACCESS_BATCH_CHECKS = 1000
+
 
 class AccessMethodsSubscriptionRecordSerializer(
     TimezoneFieldMixin, serializers.ModelSerializer
@@ -137,6 +140,48 @@ class FeatureAccessRequestSerializer(serializers.Serializer):
         return data
 
 
+class FeatureAccessBatchCheckSerializer(serializers.Serializer):
+    customer_id = serializers.CharField(
+        help_text="The customer_id of the customer you want to check access."
+    )
+    feature_id = FeatureUUIDField(
+        help_text="The feature_id of the feature you want to check access for."
+    )
+    subscription_filters = SubscriptionFilterSerializer(
+        many=True,
+        required=False,
+        help_text="The subscription filters that are applied to this plan's relationship with the customer. If your billing model does not have the ability multiple plans or subscriptions per customer, this is likely not relevant for you. ",
+    )
+
+
+class FeatureAccessBatchRequestSerializer(serializers.Serializer):
+    checks = FeatureAccessBatchCheckSerializer(
+        many=True,
+        help_text=f"The (customer, feature) pairs you want to check access for, at most {MAX_FEATURE_ACCESS_BATCH_CHECKS} at a time.",
+    )
+
+    def validate_checks(self, value):
+        if len(value) > MAX_FEATURE_ACCESS_BATCH_CHECKS:
+            raise serializers.ValidationError(
+                f"At most {MAX_FEATURE_ACCESS_BATCH_CHECKS} checks can be made at a time."
+            )
+        return value
+
+
+class FeatureAccessBatchResultSerializer(serializers.Serializer):
+    customer_id = serializers.CharField()
+    feature_id = FeatureUUIDField()
+    access = serializers.BooleanField(
+        help_text="Whether any of the customer's plans that match the subscription filters, if any were given, have access to this feature."
+    )
+
+
+class FeatureAccessBatchResponseSerializer(serializers.Serializer):
+    results = FeatureAccessBatchResultSerializer(
+        many=True, help_text="One result per check, in the order they were sent."
+    )
+
+
 class CustomerDeleteResponseSerializer(serializers.Serializer):
     customer_id = serializers.CharField()
     deleted = serializers.DateTimeField()
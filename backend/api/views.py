@@ -6,14 +6,13 @@ import logging
 import operator
 import re
 import uuid
+import zlib
 from decimal import Decimal
-from functools import reduce
+from functools import partial, reduce
 from itertools import chain
 from typing import Optional
 
 import posthog
-import pytz
-from dateutil import parser
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.db import transaction
@@ -54,6 +53,7 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from api.ingestion import InvalidEvent, iter_ndjson_lines, loads, prepare_event
 from api.serializers.model_serializers import (
     AddOnSubscriptionRecordCreateSerializer,
     AddOnSubscriptionRecordSerializer,
@@ -84,6 +84,8 @@ from api.serializers.model_serializers import (
     SubscriptionRecordUpdateSerializerOld,
     EstimatedPriceSerializer,
     FeatureSerializer,
+    LightweightCustomerSerializer,
+    LightweightMetricSerializer,
     MetricListFilterSerializer,
     SubscriptionRecordRenewSerializer,
     CalculateCostSerializer,
@@ -92,8 +94,11 @@ from api.serializers.model_serializers import (
     AddOnCategoryDetailSerializer,
 )
 from api.serializers.nonmodel_serializers import (
+    AccessMethodsSubscriptionRecordSerializer,
     ChangePrepaidUnitsSerializer,
     CustomerDeleteResponseSerializer,
+    FeatureAccessBatchRequestSerializer,
+    FeatureAccessBatchResponseSerializer,
     FeatureAccessRequestSerializer,
     FeatureAccessResponseSerializer,
     MetricAccessRequestSerializer,
@@ -115,7 +120,15 @@ from metering_billing.exceptions.exceptions import InvalidOperation, NotFoundExc
 from metering_billing.invoice import generate_invoice
 from metering_billing.invoice_pdf import get_invoice_presigned_url
 from metering_billing.kafka.producer import Producer
+from metering_billing.entitlements import (
+    get_billing_record_usage,
+    get_entitlement_snapshot,
+    get_entitlement_snapshots,
+    get_plan_version_features,
+    next_entitlement_change,
+)
 from metering_billing.models import (
+    BillingRecord,
     ComponentChargeRecord,
     Customer,
     CustomerBalanceAdjustment,
@@ -151,6 +164,7 @@ from metering_billing.serializers.serializer_utils import (
     AddOnUUIDField,
     AddOnVersionUUIDField,
     BalanceAdjustmentUUIDField,
+    FeatureUUIDField,
     InvoiceUUIDField,
     MetricUUIDField,
     OrganizationUUIDField,
@@ -173,6 +187,7 @@ from metering_billing.utils.enums import (
     CUSTOMER_BALANCE_ADJUSTMENT_STATUS,
     INVOICING_BEHAVIOR,
     METRIC_STATUS,
+    METRIC_TYPE,
     PLAN_CUSTOM_TYPE,
     SUBSCRIPTION_STATUS,
     USAGE_BEHAVIOR,
@@ -190,6 +205,8 @@ POSTHOG_PERSON = settings.POSTHOG_PERSON
 SVIX_CONNECTOR = settings.SVIX_CONNECTOR
 IDEMPOTENCY_ID_NAMESPACE = settings.IDEMPOTENCY_ID_NAMESPACE
 USE_KAFKA = settings.USE_KAFKA
+KAFKA_PRODUCER_WAIT_FOR_DELIVERY = settings.KAFKA_PRODUCER_WAIT_FOR_DELIVERY
+TRACK_STREAM_CHUNK_SIZE = settings.TRACK_STREAM_CHUNK_SIZE
 if USE_KAFKA:
     kafka_producer = Producer()
 else:
@@ -2444,7 +2461,6 @@ class MetricAccessView(APIView):
     )
     def get(self, request, format=None):
         result, success = fast_api_key_validation_and_cache(request)
-        now = now_utc()
         if not success:
             return result
         else:
@@ -2455,14 +2471,66 @@ class MetricAccessView(APIView):
         serializer.is_valid(raise_exception=True)
         customer = serializer.validated_data["customer"]
         metric = serializer.validated_data["metric"]
-        subscription_records = SubscriptionRecord.objects.active().filter(
-            organization_id=organization_pk,
-            customer=customer,
-        )
         subscription_filters_set = {
             (x["property_name"], x["value"])
             for x in serializer.validated_data.get("subscription_filters", [])
         }
+        snapshot = get_entitlement_snapshot(
+            "metric",
+            organization_pk,
+            customer.pk,
+            metric.pk,
+            subscription_filters_set,
+            lambda: self.build_snapshot(
+                organization_pk, customer, metric, subscription_filters_set
+            ),
+        )
+        access_per_subscription = []
+        access = []
+        for sr_snapshot in snapshot:
+            current_usage = 0
+            billing_record_pk = sr_snapshot["billing_record"]
+            if billing_record_pk is not None:
+                current_usage = get_billing_record_usage(
+                    billing_record_pk,
+                    lambda: self.get_current_usage(metric, billing_record_pk),
+                )
+            total_limit = sr_snapshot["metric_total_limit"]
+            if current_usage < (total_limit or Decimal("Infinity")):
+                access.append(True)
+            elif total_limit != 0:
+                access.append(False)
+            access_per_subscription.append(
+                {
+                    "subscription": sr_snapshot["subscription"],
+                    "metric_usage": _access_decimal(current_usage),
+                    "metric_free_limit": _access_decimal(
+                        sr_snapshot["metric_free_limit"]
+                    ),
+                    "metric_total_limit": _access_decimal(total_limit),
+                }
+            )
+        return_dict = {
+            "customer": LightweightCustomerSerializer(customer).data,
+            "access": any(access),
+            "metric": LightweightMetricSerializer(metric).data,
+            "access_per_subscription": access_per_subscription,
+        }
+        return Response(return_dict, status=status.HTTP_200_OK)
+
+    @staticmethod
+    def build_snapshot(organization_pk, customer, metric, subscription_filters_set):
+        """Everything about the customer's access to the metric, except the usage.
+
+        Returns the snapshot and the time until which it's accurate, which is when
+        the first of the subscriptions or billing records involved ends, or the
+        next one starts.
+        """
+        now = now_utc()
+        subscription_records = SubscriptionRecord.objects.active().filter(
+            organization_id=organization_pk,
+            customer=customer,
+        )
         subscription_records = subscription_records.prefetch_related(
             "billing_records",
             "addon_subscription_records",
@@ -2471,29 +2539,27 @@ class MetricAccessView(APIView):
             "billing_plan__plan_components__tiers",
             "billing_plan__plan",
         )
-        return_dict = {
-            "customer": customer,
-            "metric": metric,
-            "access": False,
-            "access_per_subscription": [],
-        }
+        snapshot = []
+        valid_until = next_entitlement_change(organization_pk, customer.pk, now)
         for sr in subscription_records.filter(billing_plan__addon_spec__isnull=True):
             if subscription_filters_set:
                 sr_filters_set = {tuple(x) for x in sr.subscription_filters}
                 if not subscription_filters_set.issubset(sr_filters_set):
                     continue
-            single_sr_dict = {
-                "subscription": sr,
-                "metric_usage": 0,
+            sr_snapshot = {
+                "subscription": dict(AccessMethodsSubscriptionRecordSerializer(sr).data),
+                "billing_record": None,
                 "metric_free_limit": 0,
                 "metric_total_limit": 0,
             }
+            valid_until = _earliest(valid_until, sr.end_date)
             matching_billing_records = sr.billing_records.filter(
                 start_date__lte=now,
                 end_date__gte=now,
                 component__billable_metric=metric,
             )
             for addon_sr in sr.addon_subscription_records.all():
+                valid_until = _earliest(valid_until, addon_sr.end_date)
                 matching_billing_records = (
                     matching_billing_records
                     | addon_sr.billing_records.filter(
@@ -2512,24 +2578,23 @@ class MetricAccessView(APIView):
                     else 0
                 )
                 total_limit = tiers[-1].range_end
-                current_usage = metric.get_billing_record_current_usage(billing_record)
-                single_sr_dict["metric_usage"] = current_usage
-                single_sr_dict["metric_free_limit"] = free_limit
-                single_sr_dict["metric_total_limit"] = total_limit
-            return_dict["access_per_subscription"].append(single_sr_dict)
-        access = []
-        for sr_dict in return_dict["access_per_subscription"]:
-            if sr_dict["metric_usage"] < (
-                sr_dict["metric_total_limit"] or Decimal("Infinity")
-            ):
-                access.append(True)
-            elif sr_dict["metric_total_limit"] == 0:
-                continue
-            else:
-                access.append(False)
-        return_dict["access"] = any(access)
-        serializer = MetricAccessResponseSerializer(return_dict)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+                sr_snapshot["billing_record"] = billing_record.pk
+                sr_snapshot["metric_free_limit"] = free_limit
+                sr_snapshot["metric_total_limit"] = total_limit
+                valid_until = _earliest(valid_until, billing_record.end_date)
+            snapshot.append(sr_snapshot)
+        return snapshot, valid_until
+
+    @staticmethod
+    def get_current_usage(metric, billing_record_pk):
+        billing_record = (
+            BillingRecord.objects.filter(pk=billing_record_pk)
+            .select_related("customer", "organization", "subscription")
+            .first()
+        )
+        if billing_record is None:
+            return 0
+        return metric.get_billing_record_current_usage(billing_record)
 
 
 class FeatureAccessView(APIView):
@@ -2554,48 +2619,196 @@ class FeatureAccessView(APIView):
         serializer.is_valid(raise_exception=True)
         customer = serializer.validated_data["customer"]
         feature = serializer.validated_data["feature"]
-        subscription_records = SubscriptionRecord.objects.active().filter(
-            organization_id=organization_pk,
-            customer=customer,
-        )
         subscription_filters_set = {
             (x["property_name"], x["value"])
             for x in serializer.validated_data.get("subscription_filters", [])
         }
+        snapshot = get_entitlement_snapshot(
+            "feature",
+            organization_pk,
+            customer.pk,
+            feature.pk,
+            subscription_filters_set,
+            lambda: self.build_snapshot(
+                organization_pk, customer, feature, subscription_filters_set
+            ),
+        )
+        return_dict = {
+            "customer": LightweightCustomerSerializer(customer).data,
+            "access": any(d["access"] for d in snapshot),
+            "feature": FeatureSerializer(feature).data,
+            "access_per_subscription": snapshot,
+        }
+        return Response(return_dict, status=status.HTTP_200_OK)
+
+    @staticmethod
+    def build_snapshot(organization_pk, customer, feature, subscription_filters_set):
+        subscription_records = SubscriptionRecord.objects.active().filter(
+            organization_id=organization_pk,
+            customer=customer,
+        )
         subscription_records = subscription_records.prefetch_related(
-            "billing_plan__features",
             "billing_plan__plan",
             "addon_subscription_records",
-            "addon_subscription_records__billing_plan__features",
-            "addon_subscription_records__billing_plan__plan",
         )
-        return_dict = {
-            "customer": customer,
-            "feature": feature,
-            "access": False,
-            "access_per_subscription": [],
-        }
+        snapshot = []
+        valid_until = next_entitlement_change(organization_pk, customer.pk)
         for sr in subscription_records.filter(billing_plan__addon_spec__isnull=True):
             if subscription_filters_set:
                 sr_filters_set = {tuple(x) for x in sr.subscription_filters}
                 if not subscription_filters_set.issubset(sr_filters_set):
                     continue
-            single_sr_dict = {
-                "subscription": sr,
-                "access": False,
+            valid_until = _earliest(valid_until, sr.end_date)
+            plan_version_pks = [sr.billing_plan_id]
+            for addon in sr.addon_subscription_records.all():
+                valid_until = _earliest(valid_until, addon.end_date)
+                plan_version_pks.append(addon.billing_plan_id)
+            plan_features = get_plan_version_features(
+                organization_pk, plan_version_pks
+            )
+            snapshot.append(
+                {
+                    "subscription": dict(
+                        AccessMethodsSubscriptionRecordSerializer(sr).data
+                    ),
+                    "access": any(
+                        feature.pk in plan_features[pk] for pk in plan_version_pks
+                    ),
+                }
+            )
+        return snapshot, valid_until
+
+
+class FeatureAccessBatchView(APIView):
+    permission_classes = []
+    authentication_classes = []
+
+    @extend_schema(
+        request=FeatureAccessBatchRequestSerializer,
+        responses={
+            200: FeatureAccessBatchResponseSerializer,
+        },
+    )
+    def post(self, request, format=None):
+        result, success = fast_api_key_validation_and_cache(request)
+        if not success:
+            return result
+        else:
+            organization_pk = result
+        serializer = FeatureAccessBatchRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        checks = serializer.validated_data["checks"]
+        customers = {
+            customer.customer_id: customer
+            for customer in Customer.objects.filter(
+                organization_id=organization_pk,
+                customer_id__in={check["customer_id"] for check in checks},
+            )
+        }
+        features = {
+            feature.feature_id: feature
+            for feature in Feature.objects.filter(
+                organization_id=organization_pk,
+                feature_id__in={check["feature_id"] for check in checks},
+            )
+        }
+        errors = {}
+        for i, check in enumerate(checks):
+            if check["customer_id"] not in customers:
+                errors[i] = {"customer_id": ["Customer not found."]}
+            elif check["feature_id"] not in features:
+                errors[i] = {"feature_id": ["Feature not found."]}
+        if errors:
+            raise ValidationError({"checks": errors})
+
+        # which plan versions each of the customers' subscriptions are made of,
+        # then what features those plan versions have, all from the cache when warm
+        subscriptions_by_customer = get_entitlement_snapshots(
+            "feature_plans",
+            organization_pk,
+            [customer.pk for customer in customers.values()],
+            None,
+            None,
+            partial(self.build_customer_plans, organization_pk),
+        )
+        plan_features = get_plan_version_features(
+            organization_pk,
+            {
+                pk
+                for subscriptions in subscriptions_by_customer.values()
+                for _, plan_version_pks in subscriptions
+                for pk in plan_version_pks
+            },
+        )
+        results = []
+        for check in checks:
+            customer = customers[check["customer_id"]]
+            feature = features[check["feature_id"]]
+            subscription_filters_set = {
+                (x["property_name"], x["value"])
+                for x in check.get("subscription_filters", [])
             }
-            all_billing_plan_features = sr.billing_plan.features.all()
+            access = False
+            for subscription_filters, plan_version_pks in subscriptions_by_customer[
+                customer.pk
+            ]:
+                if not subscription_filters_set.issubset(
+                    {tuple(x) for x in subscription_filters}
+                ):
+                    continue
+                if any(feature.pk in plan_features[pk] for pk in plan_version_pks):
+                    access = True
+                    break
+            results.append(
+                {
+                    "customer_id": customer.customer_id,
+                    "feature_id": FeatureUUIDField().to_representation(
+                        feature.feature_id
+                    ),
+                    "access": access,
+                }
+            )
+        return Response({"results": results}, status=status.HTTP_200_OK)
+
+    @staticmethod
+    def build_customer_plans(organization_pk, customer_pk):
+        subscription_records = (
+            SubscriptionRecord.objects.active()
+            .filter(
+                organization_id=organization_pk,
+                customer_id=customer_pk,
+                billing_plan__addon_spec__isnull=True,
+            )
+            .prefetch_related("addon_subscription_records")
+        )
+        subscriptions = []
+        valid_until = next_entitlement_change(organization_pk, customer_pk)
+        for sr in subscription_records:
+            valid_until = _earliest(valid_until, sr.end_date)
+            plan_version_pks = [sr.billing_plan_id]
             for addon in sr.addon_subscription_records.all():
-                all_billing_plan_features = (
-                    all_billing_plan_features | addon.billing_plan.features.all()
-                )
-            if feature in all_billing_plan_features.distinct():
-                single_sr_dict["access"] = True
-            return_dict["access_per_subscription"].append(single_sr_dict)
-        access = [d["access"] for d in return_dict["access_per_subscription"]]
-        return_dict["access"] = any(access)
-        serializer = FeatureAccessResponseSerializer(return_dict)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+                valid_until = _earliest(valid_until, addon.end_date)
+                plan_version_pks.append(addon.billing_plan_id)
+            subscriptions.append(
+                ([list(x) for x in sr.subscription_filters], plan_version_pks)
+            )
+        return subscriptions, valid_until
+
+
+def _earliest(current, date):
+    if date is None:
+        return current
+    return date if current is None else min(current, date)
+
+
+_ACCESS_DECIMAL_FIELD = serializers.DecimalField(max_digits=20, decimal_places=10)
+
+
+def _access_decimal(value):
+    # same representation the access response serializers give their decimals
+    if value is None:
+        return None
+    return _ACCESS_DECIMAL_FIELD.to_representation(value)
 
 
 class Ping(APIView):
@@ -2750,21 +2963,6 @@ def load_event(request: HttpRequest) -> Optional[dict]:
     return event_data
 
 
-def ingest_event(data: dict, customer_id: str, organization_pk: int) -> None:
-    event_kwargs = {
-        "organization_id": organization_pk,
-        "cust_id": customer_id,
-        "customer_id": customer_id,
-        "event_name": data["event_name"],
-        "idempotency_id": data["idempotency_id"],
-        "time_created": data["time_created"],
-        "properties": {},
-    }
-    if "properties" in data:
-        event_kwargs["properties"] = data["properties"]
-    return event_kwargs
-
-
 @csrf_exempt
 @extend_schema(
     request=inline_serializer(
@@ -2810,42 +3008,19 @@ def track_event(request):
             event_list = [event_list]
 
     bad_events = {}
+    stream_records = []
+    stream_idempotency_ids = []
     now = now_utc()
     for data in event_list:
-        customer_id = data.get("customer_id")
-        idempotency_id = data.get("idempotency_id")
-        time_created = data.get("time_created")
-        if not idempotency_id:
-            bad_events["no_idempotency_id"] = "No idempotency_id provided"
-            continue
-        if not customer_id:
-            bad_events[idempotency_id] = "No customer_id provided"
-            continue
-        if not time_created:
-            bad_events[idempotency_id] = "Invalid time_created"
-            continue
-        tc = parser.parse(time_created)
-        # Check if the datetime object is naive
-        if tc.tzinfo is None or tc.tzinfo.utcoffset(tc) is None:
-            # If the datetime object is naive, replace its tzinfo with UTC
-            tc = tc.replace(tzinfo=pytz.UTC)
-        if not (now - relativedelta(days=30) <= tc <= now + relativedelta(days=1)):
-            bad_events[
-                idempotency_id
-            ] = "Time created too far in the past or future. Events must be within 30 days before or 1 day ahead of current time."
-            continue
-        data["time_created"] = tc.isoformat()
         try:
-            transformed_event = ingest_event(data, customer_id, organization_pk)
-            stream_events = {
-                "organization_id": organization_pk,
-                "event": transformed_event,
-            }
-            if kafka_producer:
-                kafka_producer.produce(customer_id, stream_events)
-        except Exception as e:
-            bad_events[idempotency_id] = str(e)
+            idempotency_id, record = prepare_event(data, organization_pk, now)
+        except InvalidEvent as e:
+            bad_events[e.key] = e.message
             continue
+        stream_records.append(record)
+        stream_idempotency_ids.append(idempotency_id)
+
+    produce_events(stream_records, stream_idempotency_ids, bad_events)
 
     if len(bad_events) == len(event_list):
         return Response(
@@ -2861,6 +3036,115 @@ def track_event(request):
         return JsonResponse({"success": "all"}, status=status.HTTP_201_CREATED)
 
 
+def produce_events(records, idempotency_ids, bad_events):
+    """Send prepared events to kafka, adding the ones that failed to bad_events"""
+    if not kafka_producer or not records:
+        return 0
+    try:
+        failed = kafka_producer.produce_batch(
+            records, wait=KAFKA_PRODUCER_WAIT_FOR_DELIVERY
+        )
+    except Exception as e:
+        failed = {i: e for i in range(len(records))}
+    for i, e in failed.items():
+        bad_events[idempotency_ids[i]] = str(e)
+    return len(failed)
+
+
+@csrf_exempt
+@extend_schema(
+    request={"application/x-ndjson": EventSerializer},
+    responses={
+        201: inline_serializer(
+            name="TrackEventStreamSuccess",
+            fields={
+                "success": serializers.ChoiceField(choices=["all", "some"]),
+                "failed_events": serializers.DictField(),
+            },
+        ),
+        400: inline_serializer(
+            name="TrackEventStreamFailure",
+            fields={
+                "success": serializers.ChoiceField(choices=["none"]),
+                "failed_events": serializers.DictField(),
+            },
+        ),
+    },
+)
+@api_view(http_method_names=["POST"])
+@authentication_classes([])
+@permission_classes([])
+def track_event_stream(request):
+    """Track events sent as newline delimited JSON, one event per line.
+
+    The body can be gzipped (Content-Encoding: gzip). It's parsed as it's read and
+    events are sent to kafka every TRACK_STREAM_CHUNK_SIZE events, so large
+    backfills don't need to fit in memory all at once.
+    """
+    result, success = fast_api_key_validation_and_cache(request)
+    if not success:
+        return result
+    else:
+        organization_pk = result
+    if request.content_type.split(";")[0].strip() != "application/x-ndjson":
+        return Response(
+            {"detail": "Content type must be application/x-ndjson"},
+            status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+        )
+
+    bad_events = {}
+    num_events = 0
+    num_failed = 0
+    stream_records = []
+    stream_idempotency_ids = []
+    now = now_utc()
+    try:
+        for line in iter_ndjson_lines(request):
+            num_events += 1
+            try:
+                idempotency_id, record = prepare_event(
+                    loads(line), organization_pk, now
+                )
+            except InvalidEvent as e:
+                bad_events[e.key] = e.message
+                num_failed += 1
+                continue
+            except ValueError:
+                bad_events[f"line_{num_events}"] = "Invalid JSON"
+                num_failed += 1
+                continue
+            stream_records.append(record)
+            stream_idempotency_ids.append(idempotency_id)
+            if len(stream_records) >= TRACK_STREAM_CHUNK_SIZE:
+                num_failed += produce_events(
+                    stream_records, stream_idempotency_ids, bad_events
+                )
+                stream_records = []
+                stream_idempotency_ids = []
+    except (OSError, EOFError, zlib.error, ValueError) as e:
+        # the events before this point have already been sent, so report what
+        # happened to them rather than failing the whole request
+        bad_events["invalid_body"] = f"Could not read the rest of the body: {e}"
+        num_events += 1
+        num_failed += 1
+    num_failed += produce_events(stream_records, stream_idempotency_ids, bad_events)
+
+    if num_events == 0:
+        return HttpResponseBadRequest("No data provided")
+    if num_failed >= num_events:
+        return Response(
+            {"success": "none", "failed_events": bad_events},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    elif num_failed > 0:
+        return JsonResponse(
+            {"success": "some", "failed_events": bad_events},
+            status=status.HTTP_201_CREATED,
+        )
+    else:
+        return JsonResponse({"success": "all"}, status=status.HTTP_201_CREATED)
+
+
 ###### DEPRECATED ######
 class GetCustomerEventAccessRequestSerializer(serializers.Serializer):
     customer_id = SlugRelatedFieldWithOrganizationPK(
@@ -3157,9 +3441,14 @@ class GetCustomerEventAccessView(APIView):
                         start_date__lte=now_utc(),
                         end_date__gte=now_utc(),
                     ).first()
-                    current_usage = metric.get_billing_record_total_billable_usage(
-                        current_br
-                    )
+                    if metric.metric_type == METRIC_TYPE.COUNTER:
+                        current_usage = metric.get_billing_record_current_usage(
+                            current_br
+                        )
+                    else:
+                        current_usage = metric.get_billing_record_total_billable_usage(
+                            current_br
+                        )
                     unique_tup_dict = {
                         "event_name": metric.event_name,
                         "metric_name": metric_name,
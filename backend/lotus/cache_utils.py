@@ -1,8 +1,12 @@
 from __future__ import unicode_literals
 
 import logging
+import threading
+import time
+from collections import Counter, defaultdict
 
 import django
+from django.conf import settings
 from django.core import signals
 from django.core.cache.backends.base import BaseCache
 
@@ -28,6 +32,113 @@ def get_cache(backend, **kwargs):
     return cache
 
 
+class CircuitBreaker:
+    """Keeps track of whether the main cache is healthy enough to be called.
+
+    Closed: calls go to the main cache. After failure_threshold consecutive
+    failures the circuit opens and calls go straight to the fallback cache, without
+    waiting on the main one to time out. Every probe_interval seconds a single call
+    is let through as a probe (half open), if it succeeds the circuit closes again,
+    otherwise it stays open for another interval.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold, probe_interval):
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._state_since = time.monotonic()
+        self._time_in_state = defaultdict(float)
+        self._calls = Counter()
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        # called with the lock held
+        now = time.monotonic()
+        self._time_in_state[self.state] += now - self._state_since
+        self._state_since = now
+        previous_state, self.state = self.state, state
+        if state == self.OPEN:
+            self._opened_at = now
+        logger.warning(
+            f"Main cache circuit went from {previous_state} to {state}: {self._stats()}"
+        )
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if (
+                self.state == self.OPEN
+                and time.monotonic() - self._opened_at >= self.probe_interval
+            ):
+                self._transition(self.HALF_OPEN)
+                return True
+            # open, or half open with the probe still out
+            self._calls["short_circuited"] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._calls["main_succeeded"] += 1
+            self._consecutive_failures = 0
+            if self.state != self.CLOSED:
+                self._transition(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._calls["main_failed"] += 1
+            self._consecutive_failures += 1
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED
+                and self._consecutive_failures >= self.failure_threshold
+            ):
+                self._transition(self.OPEN)
+
+    def record_fallback(self):
+        with self._lock:
+            self._calls["fallback"] += 1
+
+    def _stats(self):
+        time_in_state = dict(self._time_in_state)
+        time_in_state[self.state] = time_in_state.get(self.state, 0) + (
+            time.monotonic() - self._state_since
+        )
+        total_calls = self._calls["main_succeeded"] + self._calls["main_failed"]
+        total_calls += self._calls["short_circuited"]
+        return {
+            "state": self.state,
+            "seconds_in_state": {
+                state: round(seconds, 3) for state, seconds in time_in_state.items()
+            },
+            "calls": dict(self._calls),
+            "fallback_rate": (
+                self._calls["fallback"] / total_calls if total_calls else 0.0
+            ),
+        }
+
+    def stats(self):
+        with self._lock:
+            return self._stats()
+
+
+# shared by every FallbackCache in the process, django creates one per thread
+MAIN_CACHE_CIRCUIT_BREAKER = CircuitBreaker(
+    failure_threshold=getattr(settings, "CACHE_CIRCUIT_FAILURE_THRESHOLD", 5),
+    probe_interval=getattr(settings, "CACHE_CIRCUIT_PROBE_INTERVAL", 5),
+)
+
+
+def cache_circuit_stats():
+    """State of the main cache circuit, time spent in each state and call counts"""
+    return MAIN_CACHE_CIRCUIT_BREAKER.stats()
+
+
 class FallbackCache(BaseCache):
     _cache = None
     _cache_fallback = None
@@ -45,11 +156,19 @@ class FallbackCache(BaseCache):
     def get(self, key, default=None, version=None):
         return self._call_with_fallback("get", key, default=default, version=version)
 
+    def get_many(self, keys, version=None):
+        return self._call_with_fallback("get_many", keys, version=version)
+
     def set(self, key, value, timeout=None, version=None, client=None):
         return self._call_with_fallback(
             "set", key, value, timeout=timeout, version=version
         )
 
+    def set_many(self, data, timeout=None, version=None):
+        return self._call_with_fallback(
+            "set_many", data, timeout=timeout, version=version
+        )
+
     def delete_pattern(self, pattern, version=None):
         return self._call_with_fallback(
             "delete_pattern", pattern, version=version, raise_err=False
@@ -69,20 +188,27 @@ class FallbackCache(BaseCache):
 
     def _call_with_fallback(self, method, *args, **kwargs):
         raise_err = kwargs.pop("raise_err", True)
-        try:
-            return self._call_main_cache(args, kwargs, method)
-        except Exception as e:
-            logger.warning("Switch to fallback cache")
-            logger.exception(e)
-            if raise_err:
-                return self._call_fallback_cache(args, kwargs, method)
+        breaker = MAIN_CACHE_CIRCUIT_BREAKER
+        if breaker.allow_request():
+            try:
+                result = self._call_main_cache(args, kwargs, method)
+            except Exception as e:
+                breaker.record_failure()
+                # no stack trace, the circuit logs when it opens
+                logger.warning(f"Main cache failed on {method}, using fallback: {e}")
             else:
-                try:
-                    return self._call_fallback_cache(args, kwargs, method)
-                except Exception as e:
-                    logger.warning("Fallback cache failed")
-                    logger.exception(e)
-                    return None
+                breaker.record_success()
+                return result
+        breaker.record_fallback()
+        if raise_err:
+            return self._call_fallback_cache(args, kwargs, method)
+        else:
+            try:
+                return self._call_fallback_cache(args, kwargs, method)
+            except Exception as e:
+                logger.warning("Fallback cache failed")
+                logger.exception(e)
+                return None
 
     def _call_main_cache(self, args, kwargs, method):
         return getattr(self._cache, method)(*args, **kwargs)
@@ -297,6 +297,11 @@ else:
             "PORT": POSTGRES_PORT,
         }
     }
+# metric usage queries are run as named prepared statements so Postgres can reuse
+# their plans. Turn off when going through a transaction pooler like pgbouncer
+METRIC_QUERY_PREPARED_STATEMENTS = config(
+    "METRIC_QUERY_PREPARED_STATEMENTS", default=True, cast=bool
+)
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -343,6 +348,48 @@ KAFKA_PAYMENT_TOPIC = KAFKA_PREFIX + config("PAYMENT_TOPIC", default="payment-te
 KAFKA_NUM_PARTITIONS = config("NUM_PARTITIONS", default=10, cast=int)
 KAFKA_REPLICATION_FACTOR = config("REPLICATION_FACTOR", default=1, cast=int)
 KAFKA_HOST = config("KAFKA_URL", default="127.0.0.1:9092")
+KAFKA_CONSUMER_GROUP = config("KAFKA_CONSUMER_GROUP", default="lotus-event-consumer")
+KAFKA_CONSUMER_MAX_BATCH_SIZE = config(
+    "KAFKA_CONSUMER_MAX_BATCH_SIZE", default=500, cast=int
+)
+KAFKA_CONSUMER_MAX_LINGER_MS = config(
+    "KAFKA_CONSUMER_MAX_LINGER_MS", default=1000, cast=int
+)
+KAFKA_CONSUMER_WORKERS = config("KAFKA_CONSUMER_WORKERS", default=1, cast=int)
+KAFKA_PRODUCER_LINGER_MS = config("KAFKA_PRODUCER_LINGER_MS", default=10, cast=int)
+KAFKA_PRODUCER_BATCH_SIZE = config(
+    "KAFKA_PRODUCER_BATCH_SIZE", default=256 * 1024, cast=int
+)
+# uncompressed unless set, eg. to gzip. Brokers and consumers have to support it
+KAFKA_PRODUCER_COMPRESSION_TYPE = (
+    config("KAFKA_PRODUCER_COMPRESSION_TYPE", default="") or None
+)
+KAFKA_PRODUCER_WAIT_FOR_DELIVERY = config(
+    "KAFKA_PRODUCER_WAIT_FOR_DELIVERY", default=False, cast=bool
+)
+KAFKA_PRODUCER_DELIVERY_TIMEOUT = config(
+    "KAFKA_PRODUCER_DELIVERY_TIMEOUT", default=5, cast=float
+)
+# the streaming track endpoint hands events to the producer this many at a time
+TRACK_STREAM_CHUNK_SIZE = config("TRACK_STREAM_CHUNK_SIZE", default=500, cast=int)
+# historical backfills are written to the db this many events per transaction
+EVENT_BACKFILL_CHUNK_SIZE = config("EVENT_BACKFILL_CHUNK_SIZE", default=10000, cast=int)
+# continuous aggregate rebuilds materialize the new aggregate this many days at a time
+CAGG_REBUILD_CHUNK_DAYS = config("CAGG_REBUILD_CHUNK_DAYS", default=7, cast=int)
+# rebuilding every aggregate of a large organization can take hours
+CAGG_REBUILD_TASK_TIME_LIMIT = config(
+    "CAGG_REBUILD_TASK_TIME_LIMIT", default=60 * 60 * 24, cast=int
+)
+# registers per hyperloglog sketch of unique metrics, about 1% error at the default.
+# Sketches of different sizes can't be merged, so changing it means rebuilding them
+UNIQUE_HYPERLOGLOG_BUCKETS = config(
+    "UNIQUE_HYPERLOGLOG_BUCKETS", default=8192, cast=int
+)
+# gauge usage is read from the latest checkpoint of its state onwards, new ones are
+# written once the last one is this many days old. 0 stops writing them
+GAUGE_CHECKPOINT_INTERVAL_DAYS = config(
+    "GAUGE_CHECKPOINT_INTERVAL_DAYS", default=7, cast=int
+)
 if KAFKA_HOST and USE_KAFKA:
     if "," not in KAFKA_HOST:
         KAFKA_HOST = KAFKA_HOST
@@ -354,7 +401,9 @@ if KAFKA_HOST and USE_KAFKA:
     producer_config = {
         "bootstrap_servers": KAFKA_HOST,
         "api_version": (2, 5, 0),
-        "linger_ms": 10,
+        "linger_ms": KAFKA_PRODUCER_LINGER_MS,
+        "batch_size": KAFKA_PRODUCER_BATCH_SIZE,
+        "compression_type": KAFKA_PRODUCER_COMPRESSION_TYPE,
     }
     consumer_config = {
         "bootstrap_servers": KAFKA_HOST,
@@ -362,6 +411,10 @@ if KAFKA_HOST and USE_KAFKA:
         "value_deserializer": value_deserializer,
         "key_deserializer": key_deserializer,
         "api_version": (2, 5, 0),
+        # offsets are committed by the consumer once a batch is flushed to the db
+        "group_id": KAFKA_CONSUMER_GROUP,
+        "enable_auto_commit": False,
+        "max_poll_records": KAFKA_CONSUMER_MAX_BATCH_SIZE,
     }
     admin_client_config = {
         "bootstrap_servers": KAFKA_HOST,
@@ -379,6 +432,7 @@ if KAFKA_HOST and USE_KAFKA:
             cfg["sasl_plain_password"] = KAFKA_SASL_PASSWORD
 
     PRODUCER_CONFIG = producer_config
+    CONSUMER_CONFIG = consumer_config
     CONSUMER = KafkaConsumer(KAFKA_EVENTS_TOPIC, **consumer_config)
     ADMIN_CLIENT = KafkaAdminClient(**admin_client_config)
 
@@ -424,6 +478,7 @@ if KAFKA_HOST and USE_KAFKA:
             pass
 else:
     PRODUCER_CONFIG = None
+    CONSUMER_CONFIG = None
     CONSUMER = None
 
 # redis settings
@@ -455,6 +510,66 @@ CELERY_ACCEPT_CONTENT = ["application/json"]
 CELERY_TASK_TIME_LIMIT = 300
 CELERY_TASK_SOFT_TIME_LIMIT = 240
 CELERY_WORKER_CONCURRENCY = 30
+# when enabled, the periodic invoicing run spreads due customers over at most
+# INVOICE_FANOUT_MAX_PARALLELISM celery tasks instead of invoicing them one by one
+INVOICE_FANOUT_ENABLED = config("INVOICE_FANOUT_ENABLED", default=False, cast=bool)
+INVOICE_FANOUT_MAX_PARALLELISM = config(
+    "INVOICE_FANOUT_MAX_PARALLELISM", default=8, cast=int
+)
+INVOICE_FANOUT_TASK_TIME_LIMIT = config(
+    "INVOICE_FANOUT_TASK_TIME_LIMIT", default=3600, cast=int
+)
+# how long invoice generation waits for another invoicing of the same customer to
+# finish before giving up
+INVOICE_LOCK_TIMEOUT = config("INVOICE_LOCK_TIMEOUT", default=60, cast=int)
+# entitlement snapshots served by the metric/feature access endpoints are cached
+# for at most ENTITLEMENT_CACHE_TTL seconds, the usage in them for
+# ENTITLEMENT_USAGE_TTL seconds
+ENTITLEMENT_CACHE_TTL = config("ENTITLEMENT_CACHE_TTL", default=300, cast=int)
+ENTITLEMENT_USAGE_TTL = config("ENTITLEMENT_USAGE_TTL", default=5, cast=int)
+# per billing record usage counters for counter metrics, incremented by the event
+# consumer and reconciled against the continuous aggregates every
+# USAGE_COUNTER_RECONCILE_INTERVAL seconds. Only events going through the consumer
+# are counted, so leave this off if events get written any other way.
+USAGE_COUNTERS_ENABLED = config("USAGE_COUNTERS_ENABLED", default=False, cast=bool)
+USAGE_COUNTER_RECONCILE_INTERVAL = config(
+    "USAGE_COUNTER_RECONCILE_INTERVAL", default=3600, cast=int
+)
+# the same for rate metrics: the current rate and the highest rate of the period
+# are kept in a ring of RATE_WINDOW_BUCKETS buckets per billing record. More
+# buckets track the sliding window more closely
+RATE_WINDOWS_ENABLED = config("RATE_WINDOWS_ENABLED", default=False, cast=bool)
+RATE_WINDOW_BUCKETS = config("RATE_WINDOW_BUCKETS", default=60, cast=int)
+# the usage of a billing record is stored once its period has been over for the 30
+# minute invoicing grace period plus this many seconds. Late events still drop it,
+# raise this if they're common enough that it keeps getting calculated again
+USAGE_RESULT_LATE_EVENT_TOLERANCE = config(
+    "USAGE_RESULT_LATE_EVENT_TOLERANCE", default=0, cast=int
+)
+# API keys are resolved to their organization from a per process cache for up to
+# API_KEY_LOCAL_CACHE_TTL seconds, invalid keys are remembered for
+# API_KEY_NEGATIVE_CACHE_TTL seconds, and revocations reach every process within
+# API_KEY_REVOCATION_CHECK_INTERVAL seconds
+API_KEY_LOCAL_CACHE_TTL = config("API_KEY_LOCAL_CACHE_TTL", default=30, cast=int)
+API_KEY_NEGATIVE_CACHE_TTL = config("API_KEY_NEGATIVE_CACHE_TTL", default=60, cast=int)
+API_KEY_REVOCATION_CHECK_INTERVAL = config(
+    "API_KEY_REVOCATION_CHECK_INTERVAL", default=1, cast=float
+)
+# compiled tier tables are kept per process for at most TIER_TABLE_CACHE_TTL
+# seconds, on top of being dropped everywhere when a price tier changes
+TIER_TABLE_CACHE_TTL = config("TIER_TABLE_CACHE_TTL", default=300, cast=int)
+
+# the cache stops calling redis after CACHE_CIRCUIT_FAILURE_THRESHOLD failures in a
+# row and uses its in-memory fallback, trying redis again every
+# CACHE_CIRCUIT_PROBE_INTERVAL seconds
+CACHE_CIRCUIT_FAILURE_THRESHOLD = config(
+    "CACHE_CIRCUIT_FAILURE_THRESHOLD", default=5, cast=int
+)
+CACHE_CIRCUIT_PROBE_INTERVAL = config(
+    "CACHE_CIRCUIT_PROBE_INTERVAL", default=5, cast=float
+)
+# so that a redis that's slow rather than down fails fast enough to trip the circuit
+REDIS_CACHE_SOCKET_TIMEOUT = config("REDIS_CACHE_SOCKET_TIMEOUT", default=1, cast=float)
 
 if not REDIS_USE_SENTINEL and REDIS_URL is not None:
     CACHES = {
@@ -466,6 +581,8 @@ if not REDIS_USE_SENTINEL and REDIS_URL is not None:
             "LOCATION": f"{REDIS_URL}/{CACHING_REDIS_DATABASE}",
             "OPTIONS": {
                 "CLIENT_CLASS": "django_redis.client.DefaultClient",
+                "SOCKET_CONNECT_TIMEOUT": REDIS_CACHE_SOCKET_TIMEOUT,
+                "SOCKET_TIMEOUT": REDIS_CACHE_SOCKET_TIMEOUT,
             },
         },
         "fallback_cache": {
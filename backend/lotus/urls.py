@@ -48,6 +48,8 @@ from metering_billing.views.model_views import (
 )
 from metering_billing.views.payment_processor_views import PaymentProcesorView
 from metering_billing.views.views import (
+    BackfillEventStatusView,
+    BackfillEventsView,
     ChangeUserOrganizationView,
     ImportCustomersView,
     ImportPaymentObjectsView,
@@ -119,6 +121,11 @@ urlpatterns = [
     path("api/", include((api_router.urls, "api"), namespace="api")),
     path("api/ping/", api_views.Ping.as_view(), name="ping"),
     path("api/healthcheck/", api_views.Healthcheck.as_view(), name="healthcheck"),
+    path(
+        "api/track/stream/",
+        api_views.track_event_stream,
+        name="track_event_stream",
+    ),
     path(
         "api/metric_access/",
         api_views.MetricAccessView.as_view(),
@@ -129,6 +136,11 @@ urlpatterns = [
         api_views.FeatureAccessView.as_view(),
         name="feature_access",
     ),
+    path(
+        "api/feature_access/batch/",
+        api_views.FeatureAccessBatchView.as_view(),
+        name="feature_access_batch",
+    ),
     path(
         "api/customer_metric_access/",
         api_views.GetCustomerEventAccessView.as_view(),
@@ -181,6 +193,16 @@ urlpatterns = [
         ImportCustomersView.as_view(),
         name="import_customers",
     ),
+    path(
+        "app/backfill_events/",
+        BackfillEventsView.as_view(),
+        name="backfill_events",
+    ),
+    path(
+        "app/backfill_events/<uuid:backfill_id>/",
+        BackfillEventStatusView.as_view(),
+        name="backfill_event_status",
+    ),
     path(
         "app/import_payment_objects/",
         ImportPaymentObjectsView.as_view(),
@@ -8,8 +8,12 @@ from .models import (
     APIToken,
     Backtest,
     BacktestSubstitution,
+    ContinuousAggregatePolicy,
+    ContinuousAggregateRebuild,
     Customer,
+    DeadLetterEvent,
     Event,
+    EventBackfill,
     Feature,
     Invoice,
     Metric,
@@ -45,6 +49,10 @@ admin.site.register(Invoice, SimpleHistoryAdmin)
 admin.site.register(TeamInviteToken)
 admin.site.unregister(APIKey)
 admin.site.register(BacktestSubstitution)
+admin.site.register(ContinuousAggregatePolicy)
+admin.site.register(ContinuousAggregateRebuild)
+admin.site.register(DeadLetterEvent)
+admin.site.register(EventBackfill)
 
 
 @admin.register(APIToken)
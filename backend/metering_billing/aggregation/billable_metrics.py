@@ -1,17 +1,17 @@
 import abc
 import datetime
+import json
 import logging
 import uuid
 from collections import namedtuple
 from decimal import Decimal
 from typing import Literal, Optional, TypedDict, Union
 
+import pytz
 import sqlparse
-from dateutil.relativedelta import relativedelta
 from django.apps import apps
 from django.conf import settings
 from django.db import connection
-from jinja2 import Template
 
 from metering_billing.exceptions import MetricValidationFailed
 from metering_billing.utils import (
@@ -27,16 +27,46 @@ from metering_billing.utils.enums import (
     METRIC_GRANULARITY,
     METRIC_TYPE,
     PLAN_DURATION,
+    UNIQUE_COUNT_METHOD,
 )
 
+from .cagg_policies import cagg_policy_injection_data
 from .counter_query_templates import COUNTER_TOTAL_PER_DAY
+from .gauge_checkpoints import invalidate_gauge_checkpoints
 from .gauge_query_templates import GAUGE_DELTA_TOTAL_PER_DAY, GAUGE_TOTAL_TOTAL_PER_DAY
 from .rate_query_templates import RATE_TOTAL_PER_DAY
+from .prepared_statements import execute_query
+from .template_registry import render_query, render_template
 
 EVENT_NAME_NAMESPACE = settings.EVENT_NAME_NAMESPACE
 
 logger = logging.getLogger("django.server")
 
+# the counter caggs, coarsest first. Events between the edges of a period and the
+# nearest minute are read from the hypertable, with this resolution
+COUNTER_CAGG_BUCKETS = [
+    ("day", datetime.timedelta(days=1)),
+    ("hour", datetime.timedelta(hours=1)),
+    ("minute", datetime.timedelta(minutes=1)),
+]
+COUNTER_RAW_RESOLUTION = datetime.timedelta(microseconds=1)
+# what the sketches of unique metrics need installed in the database
+UNIQUE_SKETCH_EXTENSIONS = {
+    UNIQUE_COUNT_METHOD.HYPERLOGLOG: "timescaledb_toolkit",
+    UNIQUE_COUNT_METHOD.BITMAP: "roaringbitmap",
+}
+UNIQUE_HYPERLOGLOG_BUCKETS = settings.UNIQUE_HYPERLOGLOG_BUCKETS
+_BUCKET_ORIGIN = datetime.datetime(1970, 1, 1, tzinfo=pytz.UTC)
+
+
+def _bucket_floor(time: datetime.datetime, width: datetime.timedelta):
+    """Start of the time_bucket of the given width that time falls in"""
+    origin = _BUCKET_ORIGIN
+    if time.tzinfo is None:
+        origin = origin.replace(tzinfo=None)
+    return origin + ((time - origin) // width) * width
+
+
 Metric = apps.get_app_config("metering_billing").get_model(model_name="Metric")
 Customer = apps.get_app_config("metering_billing").get_model(model_name="Customer")
 Event = apps.get_app_config("metering_billing").get_model(model_name="Event")
@@ -48,6 +78,14 @@ Organization = apps.get_app_config("metering_billing").get_model(
 )
 
 
+# a continuous aggregate a metric keeps: its name, the template that creates it, what
+# to render the template with, and whether it gets compressed
+ContinuousAggregateDefinition = namedtuple(
+    "ContinuousAggregateDefinition",
+    ["name", "template", "injection_data", "compress"],
+)
+
+
 class UsageRevenueSummary(TypedDict):
     revenue: Decimal
     usage_qty: Decimal
@@ -104,6 +142,18 @@ class MetricHandler(abc.ABC):
         """This method returns the total quantity of usage that a subscription record should be billed for. This is very straightforward and should simply return a number that will then be used to calculate the amount due."""
         pass
 
+    @classmethod
+    def get_total_billable_usage_bulk(
+        cls, metric: Metric, billing_records: list[BillingRecord]
+    ) -> dict[int, Decimal]:
+        """Same as get_billing_record_total_billable_usage, but for many billing records of the same metric at once. Returns a dictionary of billing record pk to usage. Handlers that can resolve all the records in a handful of queries should override this, the default just goes one by one."""
+        return {
+            billing_record.pk: cls.get_billing_record_total_billable_usage(
+                metric, billing_record
+            )
+            for billing_record in billing_records
+        }
+
     @staticmethod
     @abc.abstractmethod
     def get_billing_record_current_usage(
@@ -124,6 +174,18 @@ class MetricHandler(abc.ABC):
         """This method should return the same quantity as get_billing_record_total_billable_usage, but split up per day. This allows for calculations of the amount due per day, which is useful for prorating and accounting integrations."""
         pass
 
+    @staticmethod
+    def continuous_aggregate_names(metric: Metric) -> list[str]:
+        """Names of the continuous aggregates the metric's usage is read from"""
+        return []
+
+    @staticmethod
+    def continuous_aggregate_definitions(
+        metric: Metric,
+    ) -> list[ContinuousAggregateDefinition]:
+        """How to create each of the metric's continuous aggregates"""
+        return []
+
     @staticmethod
     @abc.abstractmethod
     def get_daily_total_usage(
@@ -176,9 +238,9 @@ class MetricHandler(abc.ABC):
             )
         )
         injection_dict["group_by"] = organization.subscription_filter_keys
-        query = Template(query_template).render(**injection_dict)
+        query, params = render_query(query_template, **injection_dict)
         with connection.cursor() as cursor:
-            cursor.execute(query)
+            execute_query(cursor, query, params)
             results = namedtuplefetchall(cursor)
         all_results = {}
         for result in results:
@@ -236,6 +298,64 @@ class CounterHandler(MetricHandler):
             injection_dict["filter_properties"][filter[0]] = [filter[1]]
         return injection_dict
 
+    @staticmethod
+    def _metric_filter_injection(metric: Metric) -> dict:
+        """Injection data for the queries that apply the metric's filters to events"""
+        return {
+            "property_name": metric.property_name,
+            "uuidv5_event_name": uuid.uuid5(EVENT_NAME_NAMESPACE, metric.event_name),
+            "organization_id": metric.organization_id,
+            "numeric_filters": [
+                (x.property_name, x.operator, x.comparison_value)
+                for x in metric.numeric_filters.all()
+            ],
+            "categorical_filters": [
+                (x.property_name, x.operator, x.comparison_value)
+                for x in metric.categorical_filters.all()
+            ],
+        }
+
+    @staticmethod
+    def _cagg_windows(
+        start: datetime.datetime,
+        end: datetime.datetime,
+        buckets: list[tuple[str, datetime.timedelta]] = COUNTER_CAGG_BUCKETS,
+    ) -> list[tuple[str, datetime.datetime, datetime.datetime]]:
+        """Split a period into the (cagg bucket size, start, end) windows to query.
+
+        Each piece of the period is read from the coarsest cagg whose buckets fit in
+        it entirely, so a period is at most its full days, the hours and minutes
+        around them and, on each side, the part of a minute no bucket fits in. Those
+        are read from the events themselves, with a bucket size of "raw". Both ends
+        of every window are inclusive, like the ends of the period.
+        """
+        if start.tzinfo is not None:
+            start = start.astimezone(pytz.UTC)
+            end = end.astimezone(pytz.UTC)
+        windows = []
+
+        def split(lo, hi, buckets):
+            # [lo, hi) still has to be covered, with buckets no coarser than these
+            if lo >= hi:
+                return
+            if len(buckets) == 0:
+                windows.append(("raw", lo, hi - COUNTER_RAW_RESOLUTION))
+                return
+            (bucket_size, width), *finer = buckets
+            first = _bucket_floor(lo, width)
+            if first < lo:
+                first += width
+            last = _bucket_floor(hi, width)
+            if first >= last:
+                split(lo, hi, finer)
+                return
+            split(lo, first, finer)
+            windows.append((bucket_size, first, last - width))
+            split(last, hi, finer)
+
+        split(start, end + COUNTER_RAW_RESOLUTION, buckets)
+        return windows
+
     @staticmethod
     def _get_total_usage_per_day_not_unique(
         metric: Metric,
@@ -244,6 +364,7 @@ class CounterHandler(MetricHandler):
     ) -> list[namedtuple]:
         from metering_billing.aggregation.counter_query_templates import (
             COUNTER_CAGG_TOTAL,
+            COUNTER_RAW_TOTAL,
         )
 
         organization = Organization.objects.get(id=metric.organization.id)
@@ -251,89 +372,67 @@ class CounterHandler(MetricHandler):
         injection_dict = CounterHandler._prepare_injection_dict(
             metric, billing_record, organization
         )
-        start = billing_record.start_date
-        end = billing_record.end_date
-        # there's 3 periods here.... the chunk between the start and the end of that day,
-        # the full days in between, and the chunk between the last full day and the end. There
-        # are scenarios where all 3 of them happen or don't independently of each other, so
-        # we check individually
-        # check for start to end of day condition:
-        start_to_eod = not (
-            start.hour == 0
-            and start.minute == 0
-            and start.second == 0
-            and start.microsecond == 0
-        )
-        # check for start of day to endcondition:
-        sod_to_end = not (
-            end.hour == 23
-            and end.minute == 59
-            and end.second == 59
-            and end.microsecond == 999999
+        base_name = (
+            ("org_" + organization.organization_id.hex)[:22]
+            + "___"
+            + ("metric_" + metric.metric_id.hex)[:22]
+            + "___"
         )
-        # check for full days in between condition:
-        if not start_to_eod:
-            full_days_btwn_start = start.date()
-        else:
-            full_days_btwn_start = (start + relativedelta(days=1)).date()
-        if not sod_to_end:
-            full_days_btwn_end = end.date()
-        else:
-            full_days_btwn_end = (end - relativedelta(days=1)).date()
-        full_days_between = (full_days_btwn_end - full_days_btwn_start).days > 0
         # now use our pre-prepared queries with the injectiosn to get the usage
         all_results = []
-        if start_to_eod:
-            injection_dict["start_date"] = start.replace(microsecond=0)
-            injection_dict["end_date"] = start.replace(
-                hour=23, minute=59, second=59, microsecond=999999
-            )
-            injection_dict["cagg_name"] = (
-                ("org_" + organization.organization_id.hex)[:22]
-                + "___"
-                + ("metric_" + metric.metric_id.hex)[:22]
-                + "___"
-                + "second"
-            )
-            query = Template(COUNTER_CAGG_TOTAL).render(**injection_dict)
-            with connection.cursor() as cursor:
-                cursor.execute(query)
-                results = namedtuplefetchall(cursor)
-            all_results.extend(results)
-        if full_days_between:
-            injection_dict["start_date"] = full_days_btwn_start
-            injection_dict["end_date"] = full_days_btwn_end
-            injection_dict["cagg_name"] = (
-                ("org_" + organization.organization_id.hex)[:22]
-                + "___"
-                + ("metric_" + metric.metric_id.hex)[:22]
-                + "___"
-                + "day"
-            )
-            query = Template(COUNTER_CAGG_TOTAL).render(**injection_dict)
-            with connection.cursor() as cursor:
-                cursor.execute(query)
-                results = namedtuplefetchall(cursor)
-            all_results.extend(results)
-        if sod_to_end:
-            injection_dict["start_date"] = end.replace(
-                hour=0, minute=0, second=0, microsecond=0
-            )
-            injection_dict["end_date"] = end.replace(microsecond=0)
-            injection_dict["cagg_name"] = (
-                ("org_" + organization.organization_id.hex)[:22]
-                + "___"
-                + ("metric_" + metric.metric_id.hex)[:22]
-                + "___"
-                + "second"
-            )
-            query = Template(COUNTER_CAGG_TOTAL).render(**injection_dict)
+        for bucket_size, window_start, window_end in CounterHandler._cagg_windows(
+            billing_record.start_date, billing_record.end_date
+        ):
+            injection_dict["start_date"] = window_start
+            injection_dict["end_date"] = window_end
+            if bucket_size == "raw":
+                query, params = render_query(
+                    COUNTER_RAW_TOTAL,
+                    **injection_dict,
+                    **CounterHandler._metric_filter_injection(metric),
+                )
+            else:
+                injection_dict["cagg_name"] = base_name + bucket_size
+                query, params = render_query(COUNTER_CAGG_TOTAL, **injection_dict)
             with connection.cursor() as cursor:
-                cursor.execute(query)
+                execute_query(cursor, query, params)
                 results = namedtuplefetchall(cursor)
             all_results.extend(results)
         return all_results
 
+    @staticmethod
+    def _get_unique_sketch_results(
+        metric: Metric,
+        billing_record: BillingRecord,
+        organization: Organization,
+        query_template: str,
+    ) -> list[namedtuple]:
+        """Run a query merging the per day sketches of a unique metric.
+
+        Full days come from the day cagg, the partial days at either end of the
+        billing record are sketched from the events.
+        """
+        injection_dict = CounterHandler._prepare_injection_dict(
+            metric, billing_record, organization
+        )
+        injection_dict.update(CounterHandler._metric_filter_injection(metric))
+        injection_dict["unique_sketch"] = metric.unique_count_method
+        injection_dict["hyperloglog_buckets"] = UNIQUE_HYPERLOGLOG_BUCKETS
+        (injection_dict["cagg_name"],) = CounterHandler.continuous_aggregate_names(
+            metric
+        )
+        injection_dict["windows"] = CounterHandler._cagg_windows(
+            billing_record.start_date,
+            billing_record.end_date,
+            COUNTER_CAGG_BUCKETS[:1],
+        )
+        if len(injection_dict["windows"]) == 0:
+            return []
+        query, params = render_query(query_template, **injection_dict)
+        with connection.cursor() as cursor:
+            execute_query(cursor, query, params)
+            return namedtuplefetchall(cursor)
+
     @staticmethod
     def get_billing_record_total_billable_usage(
         metric: Metric, billing_record: BillingRecord
@@ -348,6 +447,14 @@ class CounterHandler(MetricHandler):
             all_results = CounterHandler._get_total_usage_per_day_not_unique(
                 metric, billing_record, organization
             )
+        elif metric.unique_count_method != UNIQUE_COUNT_METHOD.EXACT:
+            from metering_billing.aggregation.counter_query_templates import (
+                COUNTER_UNIQUE_SKETCH_TOTAL,
+            )
+
+            all_results = CounterHandler._get_unique_sketch_results(
+                metric, billing_record, organization, COUNTER_UNIQUE_SKETCH_TOTAL
+            )
         else:
             start = billing_record.start_date
             end = billing_record.end_date
@@ -369,9 +476,9 @@ class CounterHandler(MetricHandler):
                 (x.property_name, x.operator, x.comparison_value)
                 for x in metric.categorical_filters.all()
             ]
-            query = Template(COUNTER_UNIQUE_TOTAL).render(**injection_dict)
+            query, params = render_query(COUNTER_UNIQUE_TOTAL, **injection_dict)
             with connection.cursor() as cursor:
-                cursor.execute(query)
+                execute_query(cursor, query, params)
                 results = namedtuplefetchall(cursor)
             all_results = results
         totals = {"usage_qty": 0, "num_events": 0}
@@ -389,10 +496,138 @@ class CounterHandler(MetricHandler):
             totals["usage_qty"] = totals["usage_qty"] / totals["num_events"]
         return totals["usage_qty"]
 
+    @staticmethod
+    def _bulk_window_fields(billing_record: BillingRecord, window_id: int) -> dict:
+        customer = billing_record.subscription.customer
+        uuidv5_customer_id = customer.uuidv5_customer_id
+        if uuidv5_customer_id is None:
+            uuidv5_customer_id = customer_id_uuidv5(customer.customer_id)
+            customer.uuidv5_customer_id = uuidv5_customer_id
+            customer.save()
+        filters = {
+            filter[0]: filter[1]
+            for filter in billing_record.subscription.subscription_filters or []
+        }
+        return {
+            "window_id": window_id,
+            "uuidv5_customer_id": uuidv5_customer_id,
+            "filters": json.dumps(filters),
+        }
+
+    @staticmethod
+    def get_total_billable_usage_bulk(
+        metric: Metric, billing_records: list[BillingRecord]
+    ) -> dict[int, Decimal]:
+        from metering_billing.aggregation.counter_query_templates import (
+            COUNTER_CAGG_TOTAL_BULK,
+            COUNTER_UNIQUE_TOTAL_BULK,
+        )
+
+        billing_records = list(billing_records)
+        if len(billing_records) == 0:
+            return {}
+        if (
+            metric.usage_aggregation_type == METRIC_AGGREGATION.UNIQUE
+            and metric.unique_count_method != UNIQUE_COUNT_METHOD.EXACT
+        ):
+            # merging a few sketches per record is already cheap
+            return {
+                billing_record.pk: CounterHandler.get_billing_record_total_billable_usage(
+                    metric, billing_record
+                )
+                for billing_record in billing_records
+            }
+        organization = Organization.objects.get(id=metric.organization.id)
+        windows = []
+        for window_id, billing_record in enumerate(billing_records):
+            window_fields = CounterHandler._bulk_window_fields(
+                billing_record, window_id
+            )
+            if metric.usage_aggregation_type == METRIC_AGGREGATION.UNIQUE:
+                windows.append(
+                    {
+                        **window_fields,
+                        "start_date": billing_record.start_date,
+                        "end_date": billing_record.end_date,
+                    }
+                )
+                continue
+            for bucket_size, start, end in CounterHandler._cagg_windows(
+                billing_record.start_date, billing_record.end_date
+            ):
+                windows.append(
+                    {
+                        **window_fields,
+                        "bucket_size": bucket_size,
+                        "start_date": start,
+                        "end_date": end,
+                    }
+                )
+        injection_dict = {
+            "query_type": metric.usage_aggregation_type,
+            "group_by": organization.subscription_filter_keys,
+            "windows": windows,
+            "include_raw": any(
+                window.get("bucket_size") == "raw" for window in windows
+            ),
+        }
+        if metric.usage_aggregation_type == METRIC_AGGREGATION.UNIQUE:
+            query_template = COUNTER_UNIQUE_TOTAL_BULK
+            injection_dict["property_name"] = metric.property_name
+            injection_dict["uuidv5_event_name"] = uuid.uuid5(
+                EVENT_NAME_NAMESPACE, metric.event_name
+            )
+            injection_dict["organization_id"] = organization.id
+            injection_dict["numeric_filters"] = [
+                (x.property_name, x.operator, x.comparison_value)
+                for x in metric.numeric_filters.all()
+            ]
+            injection_dict["categorical_filters"] = [
+                (x.property_name, x.operator, x.comparison_value)
+                for x in metric.categorical_filters.all()
+            ]
+        else:
+            query_template = COUNTER_CAGG_TOTAL_BULK
+            base_name = (
+                ("org_" + organization.organization_id.hex)[:22]
+                + "___"
+                + ("metric_" + metric.metric_id.hex)[:22]
+                + "___"
+            )
+            injection_dict["caggs"] = {
+                bucket_size: base_name + bucket_size
+                for bucket_size, _ in COUNTER_CAGG_BUCKETS
+            }
+            injection_dict.update(CounterHandler._metric_filter_injection(metric))
+        if len(windows) == 0:
+            results = []
+        else:
+            # the shape of this query changes with the number of windows, so there's
+            # no point in preparing it
+            query, params = render_query(query_template, **injection_dict)
+            with connection.cursor() as cursor:
+                execute_query(cursor, query, params, prepare=False)
+                results = namedtuplefetchall(cursor)
+        results_by_window = {result.window_id: result for result in results}
+        usage = {}
+        for window_id, billing_record in enumerate(billing_records):
+            result = results_by_window.get(window_id)
+            usage_qty = (result.usage_qty if result else None) or 0
+            num_events = (result.num_events if result else None) or 0
+            if metric.usage_aggregation_type == METRIC_AGGREGATION.AVERAGE:
+                usage_qty = usage_qty / num_events if num_events else 0
+            usage[billing_record.pk] = usage_qty
+        return usage
+
     @staticmethod
     def get_billing_record_current_usage(
         metric: Metric, billing_record: BillingRecord
     ) -> Decimal:
+        from metering_billing.aggregation.usage_counters import get_counter_usage
+
+        usage = get_counter_usage(metric, billing_record)
+        if usage is not None:
+            return usage
         return CounterHandler.get_billing_record_total_billable_usage(
             metric, billing_record
         )
@@ -452,6 +687,25 @@ class CounterHandler(MetricHandler):
                     else:
                         all_results[time]["usage_qty"] = 0
                 all_results[time] = all_results[time]["usage_qty"]
+        elif metric.unique_count_method != UNIQUE_COUNT_METHOD.EXACT:
+            from .counter_query_templates import (
+                COUNTER_UNIQUE_SKETCH_CUMULATIVE_PER_DAY,
+            )
+
+            results = CounterHandler._get_unique_sketch_results(
+                metric,
+                billing_record,
+                organization,
+                COUNTER_UNIQUE_SKETCH_CUMULATIVE_PER_DAY,
+            )
+            # a day's usage is the values first seen that day, in every group
+            previous = {}
+            for result in results:
+                group = result[:-2]
+                time = convert_to_date(result.bucket)
+                usage_qty = result.cumulative_usage_qty - previous.get(group, 0)
+                previous[group] = result.cumulative_usage_qty
+                all_results[time] = all_results.get(time, 0) + usage_qty
         else:
             start = billing_record.start_date
             end = billing_record.end_date
@@ -473,9 +727,9 @@ class CounterHandler(MetricHandler):
                 (x.property_name, x.operator, x.comparison_value)
                 for x in metric.categorical_filters.all()
             ]
-            query = Template(COUNTER_UNIQUE_PER_DAY).render(**injection_dict)
+            query, params = render_query(COUNTER_UNIQUE_PER_DAY, **injection_dict)
             with connection.cursor() as cursor:
-                cursor.execute(query)
+                execute_query(cursor, query, params)
                 results = namedtuplefetchall(cursor)
             all_results = results
         return all_results
@@ -495,6 +749,7 @@ class CounterHandler(MetricHandler):
         data.get("categorical_filters", None)
         property_name = data.get("property_name", None)
         proration = data.get("proration", None)
+        unique_count_method = data.get("unique_count_method", None)
 
         # now validate
         if metric_type != METRIC_TYPE.COUNTER:
@@ -538,18 +793,57 @@ class CounterHandler(MetricHandler):
         if proration:
             logger.info("[METRIC TYPE: COUNTER] Proration not allowed. Making null.")
             data.pop("proration", None)
+        if unique_count_method not in (None, UNIQUE_COUNT_METHOD.EXACT):
+            if usg_agg_type != METRIC_AGGREGATION.UNIQUE:
+                logger.info(
+                    "[METRIC TYPE: COUNTER] Unique count method only applies to UNIQUE aggregation. Ignoring."
+                )
+                data.pop("unique_count_method", None)
+            elif not CounterHandler._extension_installed(
+                UNIQUE_SKETCH_EXTENSIONS[unique_count_method]
+            ):
+                raise MetricValidationFailed(
+                    "[METRIC TYPE: COUNTER] Unique count method {} needs the {} extension, which isn't installed".format(
+                        unique_count_method,
+                        UNIQUE_SKETCH_EXTENSIONS[unique_count_method],
+                    )
+                )
         return data
 
     @staticmethod
-    def create_continuous_aggregate(metric: Metric, refresh=False):
-        # unfortunately there's no good way to make caggs for unique. We'll still
-        # make one for the total daily usage graph, but not for second
-        # if we're refreshing the matview, then we need to drop the last
-        # one and recreate it
+    def _extension_installed(extension: str) -> bool:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = %s", [extension])
+            return cursor.fetchone() is not None
+
+    @staticmethod
+    def continuous_aggregate_names(metric: Metric) -> list[str]:
+        base_name = (
+            ("org_" + metric.organization.organization_id.hex)[:22]
+            + "___"
+            + ("metric_" + metric.metric_id.hex)[:22]
+            + "___"
+        )
+        if metric.usage_aggregation_type == METRIC_AGGREGATION.UNIQUE:
+            return [base_name + "day"]
+        # finest first, every cagg is built on the one before it
+        return [
+            base_name + bucket_size for bucket_size, _ in reversed(COUNTER_CAGG_BUCKETS)
+        ]
+
+    @staticmethod
+    def continuous_aggregate_definitions(
+        metric: Metric,
+    ) -> list[ContinuousAggregateDefinition]:
+        # distinct counts don't roll up, so unique metrics only get a day cagg, for the
+        # total daily usage graph. Unless they keep sketches, billing them means
+        # going back to the events
         from metering_billing.models import Organization
 
-        from .common_query_templates import CAGG_COMPRESSION, CAGG_DROP, CAGG_REFRESH
-        from .counter_query_templates import COUNTER_CAGG_QUERY
+        from .counter_query_templates import (
+            COUNTER_CAGG_QUERY,
+            COUNTER_CAGG_ROLLUP_QUERY,
+        )
 
         organization = Organization.objects.get(id=metric.organization.id)
         groupby = organization.subscription_filter_keys
@@ -567,41 +861,82 @@ class CounterHandler(MetricHandler):
                 (x.property_name, x.operator, x.comparison_value)
                 for x in metric.categorical_filters.all()
             ],
+            **cagg_policy_injection_data(metric),
         }
-        base_name = (
-            ("org_" + organization.organization_id.hex)[:22]
-            + "___"
-            + ("metric_" + metric.metric_id.hex)[:22]
-            + "___"
-        )
-        sql_injection_data["cagg_name"] = base_name + "day"
-        sql_injection_data["bucket_size"] = "day"
-        day_query = Template(COUNTER_CAGG_QUERY).render(**sql_injection_data)
-        day_drop_query = Template(CAGG_DROP).render(**sql_injection_data)
-        day_refresh_query = Template(CAGG_REFRESH).render(**sql_injection_data)
-        sql_injection_data["cagg_name"] = base_name + "second"
-        sql_injection_data["bucket_size"] = "second"
-        second_query = Template(COUNTER_CAGG_QUERY).render(**sql_injection_data)
-        second_drop_query = Template(CAGG_DROP).render(**sql_injection_data)
-        second_refresh_query = Template(CAGG_REFRESH).render(**sql_injection_data)
-        second_compression_query = Template(CAGG_COMPRESSION).render(
-            **sql_injection_data
+        if metric.usage_aggregation_type == METRIC_AGGREGATION.UNIQUE:
+            (day_name,) = CounterHandler.continuous_aggregate_names(metric)
+            if metric.unique_count_method != UNIQUE_COUNT_METHOD.EXACT:
+                # per day sketches, merged into the total of any range of days
+                sql_injection_data["unique_sketch"] = metric.unique_count_method
+                sql_injection_data["hyperloglog_buckets"] = UNIQUE_HYPERLOGLOG_BUCKETS
+            return [
+                ContinuousAggregateDefinition(
+                    day_name,
+                    COUNTER_CAGG_QUERY,
+                    {**sql_injection_data, "cagg_name": day_name, "bucket_size": "day"},
+                    False,
+                )
+            ]
+        minute_name, hour_name, day_name = CounterHandler.continuous_aggregate_names(
+            metric
         )
-        with connection.cursor() as cursor:
-            # DAY QUERY FIRST
-            if refresh is True:
-                cursor.execute(day_drop_query)
-            cursor.execute(day_query)
-            cursor.execute(day_refresh_query)
-        if metric.usage_aggregation_type != METRIC_AGGREGATION.UNIQUE:
+        return [
+            ContinuousAggregateDefinition(
+                minute_name,
+                COUNTER_CAGG_QUERY,
+                {
+                    **sql_injection_data,
+                    "cagg_name": minute_name,
+                    "bucket_size": "minute",
+                },
+                True,
+            ),
+            ContinuousAggregateDefinition(
+                hour_name,
+                COUNTER_CAGG_ROLLUP_QUERY,
+                {
+                    **sql_injection_data,
+                    "cagg_name": hour_name,
+                    "source_cagg_name": minute_name,
+                    "bucket_size": "hour",
+                },
+                True,
+            ),
+            ContinuousAggregateDefinition(
+                day_name,
+                COUNTER_CAGG_ROLLUP_QUERY,
+                {
+                    **sql_injection_data,
+                    "cagg_name": day_name,
+                    "source_cagg_name": hour_name,
+                    "bucket_size": "day",
+                },
+                False,
+            ),
+        ]
+
+    @staticmethod
+    def create_continuous_aggregate(metric: Metric, refresh=False):
+        # if we're refreshing the matview, then we need to drop the last
+        # one and recreate it
+        from .common_query_templates import CAGG_COMPRESSION, CAGG_REFRESH
+
+        definitions = CounterHandler.continuous_aggregate_definitions(metric)
+        if refresh is True:
+            # the coarser caggs depend on the finer ones, so they go first
+            CounterHandler.archive_metric(metric)
+        # FINEST FIRST, EACH ONE IS BUILT ON THE PREVIOUS ONE
+        for definition in definitions:
+            sql_injection_data = definition.injection_data
             with connection.cursor() as cursor:
-                # SECOND QUERY SECOND
-                if refresh is True:
-                    cursor.execute(second_drop_query)
-                cursor.execute(second_query)
-                cursor.execute(second_refresh_query)
-                if not refresh:
-                    cursor.execute(second_compression_query)
+                cursor.execute(
+                    render_template(definition.template, **sql_injection_data)
+                )
+                cursor.execute(render_template(CAGG_REFRESH, **sql_injection_data))
+                if definition.compress and not refresh:
+                    cursor.execute(
+                        render_template(CAGG_COMPRESSION, **sql_injection_data)
+                    )
 
     @staticmethod
     def create_metric(validated_data: dict) -> Metric:
@@ -619,14 +954,11 @@ class CounterHandler(MetricHandler):
             + ("metric_" + metric.metric_id.hex)[:22]
             + "___"
         )
-        sql_injection_data = {"cagg_name": base_name + "day"}
-        day_drop_query = Template(CAGG_DROP).render(**sql_injection_data)
-        sql_injection_data = {"cagg_name": base_name + "second"}
-        second_drop_query = Template(CAGG_DROP).render(**sql_injection_data)
-        with connection.cursor() as cursor:
-            cursor.execute(day_drop_query)
-        with connection.cursor() as cursor:
-            cursor.execute(second_drop_query)
+        # coarsest first, then the per second cagg counters used to have
+        for bucket_size in [size for size, _ in COUNTER_CAGG_BUCKETS] + ["second"]:
+            sql_injection_data = {"cagg_name": base_name + bucket_size}
+            with connection.cursor() as cursor:
+                cursor.execute(render_template(CAGG_DROP, **sql_injection_data))
 
 
 class CustomHandler(MetricHandler):
@@ -640,7 +972,7 @@ class CustomHandler(MetricHandler):
         if custom_sql.lower().lstrip().startswith("with"):
             custom_sql = custom_sql.lower().replace("with", ",")
         combined_query += custom_sql
-        query = Template(combined_query).render(**injection_dict)
+        query = render_template(combined_query, **injection_dict)
         with connection.cursor() as cursor:
             cursor.execute(query)
             results = namedtuplefetchall(cursor)
@@ -949,18 +1281,29 @@ class GaugeHandler(MetricHandler):
         return metric
 
     @staticmethod
-    def create_continuous_aggregate(metric: Metric, refresh=False):
+    def continuous_aggregate_names(metric: Metric) -> list[str]:
+        return [
+            ("org_" + metric.organization.organization_id.hex)[:22]
+            + "___"
+            + ("metric_" + metric.metric_id.hex)[:22]
+            + "___"
+            + "cumsum"
+        ]
+
+    @staticmethod
+    def continuous_aggregate_definitions(
+        metric: Metric,
+    ) -> list[ContinuousAggregateDefinition]:
         from metering_billing.models import Organization
 
-        from .common_query_templates import CAGG_COMPRESSION, CAGG_DROP, CAGG_REFRESH
         from .gauge_query_templates import (
             GAUGE_DELTA_CUMULATIVE_SUM,
-            GAUGE_DELTA_DROP_OLD,
             GAUGE_TOTAL_CUMULATIVE_SUM,
         )
 
         organization = Organization.objects.get(id=metric.organization.id)
         groupby = organization.subscription_filter_keys
+        (cagg_name,) = GaugeHandler.continuous_aggregate_names(metric)
         sql_injection_data = {
             "property_name": metric.property_name,
             "group_by": groupby,
@@ -974,30 +1317,41 @@ class GaugeHandler(MetricHandler):
                 (x.property_name, x.operator, x.comparison_value)
                 for x in metric.categorical_filters.all()
             ],
+            "cagg_name": cagg_name,
+            **cagg_policy_injection_data(metric),
         }
-        sql_injection_data["cagg_name"] = (
-            ("org_" + organization.organization_id.hex)[:22]
-            + "___"
-            + ("metric_" + metric.metric_id.hex)[:22]
-            + "___"
-            + "cumsum"
-        )
         if metric.event_type == "delta":
-            query = Template(GAUGE_DELTA_CUMULATIVE_SUM).render(**sql_injection_data)
-            drop_old = Template(GAUGE_DELTA_DROP_OLD).render(**sql_injection_data)
+            template = GAUGE_DELTA_CUMULATIVE_SUM
         elif metric.event_type == "total":
-            query = Template(GAUGE_TOTAL_CUMULATIVE_SUM).render(**sql_injection_data)
-        refresh_query = Template(CAGG_REFRESH).render(**sql_injection_data)
-        compression_query = Template(CAGG_COMPRESSION).render(**sql_injection_data)
+            template = GAUGE_TOTAL_CUMULATIVE_SUM
+        return [
+            ContinuousAggregateDefinition(cagg_name, template, sql_injection_data, True)
+        ]
+
+    @staticmethod
+    def create_continuous_aggregate(metric: Metric, refresh=False):
+        from .common_query_templates import CAGG_COMPRESSION, CAGG_DROP, CAGG_REFRESH
+        from .gauge_query_templates import GAUGE_DELTA_DROP_OLD
+
+        (definition,) = GaugeHandler.continuous_aggregate_definitions(metric)
+        sql_injection_data = definition.injection_data
+        query = render_template(definition.template, **sql_injection_data)
+        if metric.event_type == "delta":
+            drop_old = render_template(GAUGE_DELTA_DROP_OLD, **sql_injection_data)
+        refresh_query = render_template(CAGG_REFRESH, **sql_injection_data)
+        compression_query = render_template(CAGG_COMPRESSION, **sql_injection_data)
         with connection.cursor() as cursor:
             if metric.event_type == "delta":
                 cursor.execute(drop_old)
             if refresh:
-                cursor.execute(Template(CAGG_DROP).render(**sql_injection_data))
+                cursor.execute(render_template(CAGG_DROP, **sql_injection_data))
             cursor.execute(query)
             cursor.execute(refresh_query)
             if not refresh:
                 cursor.execute(compression_query)
+        if refresh:
+            # the checkpoints were taken of the aggregate that was just replaced
+            invalidate_gauge_checkpoints(metric)
 
     @staticmethod
     def archive_metric(metric: Metric) -> Metric:
@@ -1014,9 +1368,9 @@ class GaugeHandler(MetricHandler):
                 + "cumsum"
             ),
         }
-        query = Template(CAGG_DROP).render(**sql_injection_data)
+        query = render_template(CAGG_DROP, **sql_injection_data)
         if metric.event_type == "delta":
-            trigger = Template(GAUGE_DELTA_DROP_OLD).render(**sql_injection_data)
+            trigger = render_template(GAUGE_DELTA_DROP_OLD, **sql_injection_data)
         with connection.cursor() as cursor:
             cursor.execute(query)
             if metric.event_type == "delta":
@@ -1080,19 +1434,23 @@ class GaugeHandler(MetricHandler):
                 for x in metric.categorical_filters.all()
             ],
             "property_name": metric.property_name,
+            "metric_id": metric.id,
+            "checkpoint_before": _bucket_floor(
+                billing_record.start_date, datetime.timedelta(days=1)
+            ),
         }
         for filter in billing_record.subscription.subscription_filters:
             injection_dict["filter_properties"][filter[0]] = [filter[1]]
         if metric.event_type == "delta":
-            query = Template(GAUGE_DELTA_GET_TOTAL_USAGE_WITH_PRORATION).render(
-                **injection_dict
+            query, params = render_query(
+                GAUGE_DELTA_GET_TOTAL_USAGE_WITH_PRORATION, **injection_dict
             )
         elif metric.event_type == "total":
-            query = Template(GAUGE_TOTAL_GET_TOTAL_USAGE_WITH_PRORATION).render(
-                **injection_dict
+            query, params = render_query(
+                GAUGE_TOTAL_GET_TOTAL_USAGE_WITH_PRORATION, **injection_dict
             )
         with connection.cursor() as cursor:
-            cursor.execute(query)
+            execute_query(cursor, query, params)
             result = namedtuplefetchall(cursor)
         if len(result) == 0:
             return Decimal(0)
@@ -1155,15 +1513,21 @@ class GaugeHandler(MetricHandler):
                 for x in metric.categorical_filters.all()
             ],
             "property_name": metric.property_name,
+            "metric_id": metric.id,
+            "checkpoint_before": _bucket_floor(now_utc(), datetime.timedelta(days=1)),
         }
         for filter in billing_record.subscription.subscription_filters:
             injection_dict["filter_properties"][filter[0]] = [filter[1]]
         if metric.event_type == "delta":
-            query = Template(GAUGE_DELTA_GET_CURRENT_USAGE).render(**injection_dict)
+            query, params = render_query(
+                GAUGE_DELTA_GET_CURRENT_USAGE, **injection_dict
+            )
         elif metric.event_type == "total":
-            query = Template(GAUGE_TOTAL_GET_CURRENT_USAGE).render(**injection_dict)
+            query, params = render_query(
+                GAUGE_TOTAL_GET_CURRENT_USAGE, **injection_dict
+            )
         with connection.cursor() as cursor:
-            cursor.execute(query)
+            execute_query(cursor, query, params)
             result = namedtuplefetchall(cursor)
         if len(result) == 0:
             return Decimal(0)
@@ -1226,19 +1590,23 @@ class GaugeHandler(MetricHandler):
                 for x in metric.categorical_filters.all()
             ],
             "property_name": metric.property_name,
+            "metric_id": metric.id,
+            "checkpoint_before": _bucket_floor(
+                billing_record.start_date, datetime.timedelta(days=1)
+            ),
         }
         for filter in billing_record.subscription.subscription_filters:
             injection_dict["filter_properties"][filter[0]] = [filter[1]]
         if metric.event_type == "delta":
-            query = Template(GAUGE_DELTA_GET_TOTAL_USAGE_WITH_PRORATION_PER_DAY).render(
-                **injection_dict
+            query, params = render_query(
+                GAUGE_DELTA_GET_TOTAL_USAGE_WITH_PRORATION_PER_DAY, **injection_dict
             )
         elif metric.event_type == "total":
-            query = Template(GAUGE_TOTAL_GET_TOTAL_USAGE_WITH_PRORATION_PER_DAY).render(
-                **injection_dict
+            query, params = render_query(
+                GAUGE_TOTAL_GET_TOTAL_USAGE_WITH_PRORATION_PER_DAY, **injection_dict
             )
         with connection.cursor() as cursor:
-            cursor.execute(query)
+            execute_query(cursor, query, params)
             result = namedtuplefetchall(cursor)
         results_dict = {}
         for row in result:
@@ -1354,12 +1722,24 @@ class RateHandler(MetricHandler):
         )
 
     @staticmethod
-    def create_continuous_aggregate(metric: Metric, refresh=False):
-        from .common_query_templates import CAGG_COMPRESSION, CAGG_DROP, CAGG_REFRESH
+    def continuous_aggregate_names(metric: Metric) -> list[str]:
+        return [
+            ("org_" + metric.organization.organization_id.hex)[:22]
+            + "___"
+            + ("metric_" + metric.metric_id.hex)[:22]
+            + "___"
+            + "rate_cagg"
+        ]
+
+    @staticmethod
+    def continuous_aggregate_definitions(
+        metric: Metric,
+    ) -> list[ContinuousAggregateDefinition]:
         from .rate_query_templates import RATE_CAGG_QUERY
 
         organization = Organization.objects.get(id=metric.organization.id)
         groupby = organization.subscription_filter_keys
+        (cagg_name,) = RateHandler.continuous_aggregate_names(metric)
         sql_injection_data = {
             "query_type": metric.usage_aggregation_type,
             "property_name": metric.property_name,
@@ -1376,20 +1756,27 @@ class RateHandler(MetricHandler):
             ],
             "lookback_qty": 1,
             "lookback_units": metric.granularity,
+            "cagg_name": cagg_name,
+            **cagg_policy_injection_data(metric),
         }
-        sql_injection_data["cagg_name"] = (
-            ("org_" + organization.organization_id.hex)[:22]
-            + "___"
-            + ("metric_" + metric.metric_id.hex)[:22]
-            + "___"
-            + "rate_cagg"
-        )
-        query = Template(RATE_CAGG_QUERY).render(**sql_injection_data)
-        refresh_query = Template(CAGG_REFRESH).render(**sql_injection_data)
-        compression_query = Template(CAGG_COMPRESSION).render(**sql_injection_data)
+        return [
+            ContinuousAggregateDefinition(
+                cagg_name, RATE_CAGG_QUERY, sql_injection_data, True
+            )
+        ]
+
+    @staticmethod
+    def create_continuous_aggregate(metric: Metric, refresh=False):
+        from .common_query_templates import CAGG_COMPRESSION, CAGG_DROP, CAGG_REFRESH
+
+        (definition,) = RateHandler.continuous_aggregate_definitions(metric)
+        sql_injection_data = definition.injection_data
+        query = render_template(definition.template, **sql_injection_data)
+        refresh_query = render_template(CAGG_REFRESH, **sql_injection_data)
+        compression_query = render_template(CAGG_COMPRESSION, **sql_injection_data)
         with connection.cursor() as cursor:
             if refresh:
-                cursor.execute(Template(CAGG_DROP).render(**sql_injection_data))
+                cursor.execute(render_template(CAGG_DROP, **sql_injection_data))
             cursor.execute(query)
             cursor.execute(refresh_query)
             if not refresh:
@@ -1411,7 +1798,7 @@ class RateHandler(MetricHandler):
                 + "rate_cagg"
             ),
         }
-        query = Template(CAGG_DROP).render(**sql_injection_data)
+        query = render_template(CAGG_DROP, **sql_injection_data)
         with connection.cursor() as cursor:
             cursor.execute(query)
         return metric
@@ -1444,9 +1831,9 @@ class RateHandler(MetricHandler):
         injection_dict["group_by"] = organization.subscription_filter_keys
         for filter in billing_record.subscription.subscription_filters:
             injection_dict["filter_properties"][filter[0]] = [filter[1]]
-        query = Template(RATE_CAGG_TOTAL).render(**injection_dict)
+        query, params = render_query(RATE_CAGG_TOTAL, **injection_dict)
         with connection.cursor() as cursor:
-            cursor.execute(query)
+            execute_query(cursor, query, params)
             results = namedtuplefetchall(cursor)
         return results
 
@@ -1454,6 +1841,14 @@ class RateHandler(MetricHandler):
     def get_billing_record_total_billable_usage(
         metric: Metric, billing_record: BillingRecord
     ) -> Decimal:
+        from metering_billing.aggregation.usage_counters import get_rate_window_usage
+
+        # the rate window only tracks the highest rate closely enough for periods
+        # that are still running, ended ones get the exact value for their invoice
+        if billing_record.end_date > now_utc():
+            usage = get_rate_window_usage(metric, billing_record)
+            if usage is not None:
+                return usage.max_usage
         results = RateHandler._rate_cagg_total_results(metric, billing_record)
         if len(results) == 0:
             return Decimal(0)
@@ -1467,8 +1862,12 @@ class RateHandler(MetricHandler):
         from metering_billing.aggregation.rate_query_templates import (
             RATE_GET_CURRENT_USAGE,
         )
+        from metering_billing.aggregation.usage_counters import get_rate_window_usage
         from metering_billing.models import Organization
 
+        usage = get_rate_window_usage(metric, billing_record)
+        if usage is not None:
+            return usage.current_usage
         organization = Organization.objects.get(id=metric.organization.id)
         start = billing_record.start_date
         end = billing_record.end_date
@@ -1501,9 +1900,9 @@ class RateHandler(MetricHandler):
         injection_dict["group_by"] = organization.subscription_filter_keys
         for filter in billing_record.subscription.subscription_filters:
             injection_dict["filter_properties"][filter[0]] = [filter[1]]
-        query = Template(RATE_GET_CURRENT_USAGE).render(**injection_dict)
+        query, params = render_query(RATE_GET_CURRENT_USAGE, **injection_dict)
         with connection.cursor() as cursor:
-            cursor.execute(query)
+            execute_query(cursor, query, params)
             results = namedtuplefetchall(cursor)
         if len(results) == 0:
             return Decimal(0)
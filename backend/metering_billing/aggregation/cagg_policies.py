@@ -0,0 +1,303 @@
+import datetime
+import json
+import logging
+from collections import namedtuple
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_save
+
+from api.ingestion import EVENT_PAST_LIMIT
+from metering_billing.utils.enums import METRIC_STATUS
+
+from .common_query_templates import CAGG_COMPRESSION, CAGG_REFRESH
+from .template_registry import render_template
+
+logger = logging.getLogger("django.server")
+
+# what every continuous aggregate got before policies were configurable
+DEFAULT_REFRESH_START_OFFSET = datetime.timedelta(days=32)
+DEFAULT_REFRESH_END_OFFSET = datetime.timedelta(days=1)
+DEFAULT_REFRESH_SCHEDULE_INTERVAL = datetime.timedelta(minutes=30)
+DEFAULT_COMPRESS_AFTER = datetime.timedelta(days=33)
+# timescale refuses refresh windows that don't cover at least two buckets, and
+# the coarsest buckets we have are a day wide
+MIN_REFRESH_WINDOW = datetime.timedelta(days=2)
+# the oldest events we accept have to still be in the refresh window by the time
+# the next refresh runs, give or take how long that takes
+MIN_LATE_EVENT_REFRESH_MARGIN = datetime.timedelta(days=1)
+
+CaggPolicy = namedtuple(
+    "CaggPolicy",
+    [
+        "refresh_start_offset",
+        "refresh_end_offset",
+        "refresh_schedule_interval",
+        "compress_after",
+    ],
+)
+
+DEFAULT_CAGG_POLICY = CaggPolicy(
+    refresh_start_offset=DEFAULT_REFRESH_START_OFFSET,
+    refresh_end_offset=DEFAULT_REFRESH_END_OFFSET,
+    refresh_schedule_interval=DEFAULT_REFRESH_SCHEDULE_INTERVAL,
+    compress_after=DEFAULT_COMPRESS_AFTER,
+)
+
+CAGG_EXISTS = """
+SELECT
+    1
+FROM
+    timescaledb_information.continuous_aggregates
+WHERE
+    view_name = %s
+"""
+
+CAGG_POLICY_JOBS = """
+SELECT
+    jobs.job_id,
+    jobs.proc_name,
+    jobs.schedule_interval,
+    (jobs.config->>'start_offset')::interval,
+    (jobs.config->>'end_offset')::interval,
+    (jobs.config->>'compress_after')::interval
+FROM
+    timescaledb_information.jobs AS jobs
+    INNER JOIN timescaledb_information.continuous_aggregates AS caggs
+        ON jobs.hypertable_schema = caggs.materialization_hypertable_schema
+        AND jobs.hypertable_name = caggs.materialization_hypertable_name
+WHERE
+    caggs.view_name = %s
+    AND jobs.proc_name IN (
+        'policy_refresh_continuous_aggregate',
+        'policy_compression'
+    )
+"""
+
+# alter_job replaces the whole config, so the new settings are merged into it
+ALTER_JOB = """
+SELECT alter_job(
+    %(job_id)s,
+    schedule_interval => %(schedule_interval)s::interval,
+    config => (
+        SELECT config FROM timescaledb_information.jobs WHERE job_id = %(job_id)s
+    ) || %(config)s::jsonb
+)
+"""
+
+
+def get_cagg_policy(organization_id, metric_id=None, override=None):
+    """The policy a metric's continuous aggregates should have.
+
+    Each field comes from the metric's own policy if it sets it, then from the
+    organization's, then from the defaults. override is a ContinuousAggregatePolicy
+    that hasn't been saved yet, used in place of the stored one at its level.
+    """
+    from metering_billing.models import ContinuousAggregatePolicy
+
+    levels = {None: None, metric_id: None}
+    for policy in ContinuousAggregatePolicy.objects.filter(
+        Q(metric__isnull=True) | Q(metric_id=metric_id),
+        organization_id=organization_id,
+    ):
+        levels[policy.metric_id] = policy
+    if override is not None:
+        levels[override.metric_id] = override
+    ordered = [levels[metric_id], levels[None]] if metric_id else [levels[None]]
+    fields = {}
+    for field in CaggPolicy._fields:
+        fields[field] = getattr(DEFAULT_CAGG_POLICY, field)
+        for policy in ordered:
+            if policy is not None and getattr(policy, field) is not None:
+                fields[field] = getattr(policy, field)
+                break
+    return CaggPolicy(**fields)
+
+
+def validate_cagg_policy(policy):
+    """Raise ValueError if timescale wouldn't accept the policy or it'd lose data"""
+    if policy.refresh_end_offset < datetime.timedelta(0):
+        raise ValueError("refresh_end_offset can't be negative")
+    if policy.refresh_start_offset - policy.refresh_end_offset < MIN_REFRESH_WINDOW:
+        raise ValueError(
+            "refresh_start_offset must be at least 2 days before refresh_end_offset"
+        )
+    if policy.refresh_schedule_interval <= datetime.timedelta(0):
+        raise ValueError("refresh_schedule_interval must be positive")
+    late_event_margin = max(
+        policy.refresh_schedule_interval, MIN_LATE_EVENT_REFRESH_MARGIN
+    )
+    if (
+        policy.refresh_start_offset
+        < EVENT_PAST_LIMIT + policy.refresh_end_offset + late_event_margin
+    ):
+        raise ValueError(
+            f"refresh_start_offset must be at least {EVENT_PAST_LIMIT.days} days, "
+            "plus a day or refresh_schedule_interval if that's longer, before "
+            "refresh_end_offset, or late events would never be materialized"
+        )
+    # late events can only be refreshed into chunks that aren't compressed yet
+    if policy.compress_after <= policy.refresh_start_offset:
+        raise ValueError("compress_after must be longer than refresh_start_offset")
+
+
+def validate_cagg_policy_change(policy):
+    """Raise ValueError if saving the ContinuousAggregatePolicy would leave any metric
+    with a policy validate_cagg_policy doesn't accept.
+    """
+    from metering_billing.models import ContinuousAggregatePolicy
+
+    validate_cagg_policy(
+        get_cagg_policy(policy.organization_id, policy.metric_id, policy)
+    )
+    if policy.metric_id is not None:
+        return
+    # the metrics' own policies fall back to this one for what they don't set
+    for metric_id in ContinuousAggregatePolicy.objects.filter(
+        organization_id=policy.organization_id, metric__isnull=False
+    ).values_list("metric_id", flat=True):
+        try:
+            validate_cagg_policy(
+                get_cagg_policy(policy.organization_id, metric_id, policy)
+            )
+        except ValueError as e:
+            raise ValueError(f"{e} (with the policy of metric {metric_id})")
+
+
+def _interval(duration):
+    return f"{int(duration.total_seconds())} seconds"
+
+
+def cagg_policy_injection_data(metric):
+    """Values CAGG_REFRESH and CAGG_COMPRESSION need to set up a metric's policies"""
+    policy = get_cagg_policy(metric.organization_id, metric.id)
+    return {field: _interval(value) for field, value in policy._asdict().items()}
+
+
+def _same(interval, duration):
+    return interval is not None and int(interval.total_seconds()) == int(
+        duration.total_seconds()
+    )
+
+
+def apply_cagg_policy(cagg_name, policy, compress, dry_run=False):
+    """Make the refresh and compression jobs of a cagg match the policy.
+
+    Missing jobs are added, jobs with different settings are altered in place.
+    Returns descriptions of what was (or, with dry_run, would be) changed.
+    """
+    changes = []
+    with connection.cursor() as cursor:
+        cursor.execute(CAGG_EXISTS, [cagg_name])
+        if cursor.fetchone() is None:
+            return changes
+        cursor.execute(CAGG_POLICY_JOBS, [cagg_name])
+        jobs = {}
+        for job_id, proc_name, schedule_interval, start, end, after in cursor:
+            jobs[proc_name] = (job_id, schedule_interval, start, end, after)
+    injection_data = {
+        "cagg_name": cagg_name,
+        **{field: _interval(value) for field, value in policy._asdict().items()},
+    }
+    statements = []
+    refresh_job = jobs.get("policy_refresh_continuous_aggregate")
+    if refresh_job is None:
+        changes.append(f"{cagg_name}: add refresh policy")
+        statements.append((render_template(CAGG_REFRESH, **injection_data), None))
+    else:
+        job_id, schedule_interval, start, end, _ = refresh_job
+        if not (
+            _same(schedule_interval, policy.refresh_schedule_interval)
+            and _same(start, policy.refresh_start_offset)
+            and _same(end, policy.refresh_end_offset)
+        ):
+            changes.append(f"{cagg_name}: alter refresh policy (job {job_id})")
+            statements.append(
+                (
+                    ALTER_JOB,
+                    {
+                        "job_id": job_id,
+                        "schedule_interval": injection_data[
+                            "refresh_schedule_interval"
+                        ],
+                        "config": json.dumps(
+                            {
+                                "start_offset": injection_data["refresh_start_offset"],
+                                "end_offset": injection_data["refresh_end_offset"],
+                            }
+                        ),
+                    },
+                )
+            )
+    if compress:
+        compression_job = jobs.get("policy_compression")
+        if compression_job is None:
+            changes.append(f"{cagg_name}: add compression policy")
+            statements.append(
+                (render_template(CAGG_COMPRESSION, **injection_data), None)
+            )
+        else:
+            job_id, schedule_interval, _, _, after = compression_job
+            if not _same(after, policy.compress_after):
+                changes.append(f"{cagg_name}: alter compression policy (job {job_id})")
+                statements.append(
+                    (
+                        ALTER_JOB,
+                        {
+                            "job_id": job_id,
+                            "schedule_interval": schedule_interval,
+                            "config": json.dumps(
+                                {"compress_after": injection_data["compress_after"]}
+                            ),
+                        },
+                    )
+                )
+    if not dry_run:
+        with connection.cursor() as cursor:
+            for sql, params in statements:
+                cursor.execute(sql, params)
+    return changes
+
+
+def reconcile_cagg_policies(metric, dry_run=False):
+    """Bring every continuous aggregate of a metric in line with its policy"""
+    from metering_billing.aggregation.billable_metrics import METRIC_HANDLER_MAP
+
+    handler = METRIC_HANDLER_MAP[metric.metric_type]
+    policy = get_cagg_policy(metric.organization_id, metric.id)
+    changes = []
+    for definition in handler.continuous_aggregate_definitions(metric):
+        changes.extend(
+            apply_cagg_policy(definition.name, policy, definition.compress, dry_run)
+        )
+    return changes
+
+
+def _validate_cagg_policy(sender, instance, **kwargs):
+    # the jobs are altered to match it as soon as it's saved, clean() or not
+    instance.clean()
+
+
+def _reapply_cagg_policy(sender, instance, **kwargs):
+    from metering_billing.models import Metric
+
+    metrics = Metric.objects.filter(
+        organization_id=instance.organization_id, status=METRIC_STATUS.ACTIVE
+    )
+    if instance.metric_id is not None:
+        metrics = metrics.filter(id=instance.metric_id)
+    for metric in metrics:
+        try:
+            # a savepoint, so a failure doesn't break the transaction we're called in
+            with transaction.atomic():
+                reconcile_cagg_policies(metric)
+        except Exception as e:
+            logger.error(f"Could not apply cagg policy to {metric}: {e}")
+
+
+def connect_cagg_policy_signals():
+    from metering_billing.models import ContinuousAggregatePolicy
+
+    pre_save.connect(_validate_cagg_policy, sender=ContinuousAggregatePolicy)
+    post_save.connect(_reapply_cagg_policy, sender=ContinuousAggregatePolicy)
+    post_delete.connect(_reapply_cagg_policy, sender=ContinuousAggregatePolicy)
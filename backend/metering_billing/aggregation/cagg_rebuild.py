@@ -0,0 +1,211 @@
+import datetime
+import logging
+
+import pytz
+from django.conf import settings
+from django.db import connection, transaction
+
+from metering_billing.utils import event_name_uuidv5, now_utc
+from metering_billing.utils.enums import CAGG_REBUILD_STATUS, METRIC_STATUS
+
+from .common_query_templates import (
+    CAGG_COMPRESSION,
+    CAGG_DROP,
+    CAGG_REFRESH,
+    CAGG_REFRESH_WINDOW,
+    CAGG_RENAME,
+)
+from .gauge_checkpoints import invalidate_gauge_checkpoints
+from .template_registry import render_template
+
+logger = logging.getLogger("django.server")
+
+CAGG_REBUILD_CHUNK_DAYS = settings.CAGG_REBUILD_CHUNK_DAYS
+
+# Rebuilding a continuous aggregate by dropping it and creating it again leaves
+# the metric without one until the new one has materialized all of its history,
+# which for big organizations takes hours. Instead, the new version is created
+# empty under a shadow name and materialized a few days at a time, while the old
+# one keeps serving queries. When every aggregate of the organization is done
+# they're all swapped in with renames, in one transaction, and the old ones dropped.
+# Both suffixes keep the longest cagg names within postgres' 63 characters.
+SHADOW_SUFFIX = "_new"
+RETIRED_SUFFIX = "_old"
+
+FIRST_EVENT_TIME = """
+SELECT
+    MIN(time_created)
+FROM
+    metering_billing_usageevent
+WHERE
+    organization_id = %s
+    AND uuidv5_event_name = %s
+"""
+
+
+def _refresh_windows(metric):
+    """Day aligned windows covering every event the metric could have seen"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            FIRST_EVENT_TIME,
+            [metric.organization_id, str(event_name_uuidv5(metric.event_name))],
+        )
+        (first_event_time,) = cursor.fetchone()
+    if first_event_time is None:
+        return []
+    start = first_event_time.astimezone(pytz.UTC).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    end = now_utc().replace(
+        hour=0, minute=0, second=0, microsecond=0
+    ) + datetime.timedelta(days=1)
+    step = datetime.timedelta(days=CAGG_REBUILD_CHUNK_DAYS)
+    windows = []
+    while start < end:
+        windows.append((start, min(start + step, end)))
+        start += step
+    return windows
+
+
+def _drop_shadows(definitions):
+    # caggs built on other caggs have to go before the ones they're built on
+    for definition in reversed(definitions):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    render_template(
+                        CAGG_DROP, cagg_name=definition.name + SHADOW_SUFFIX
+                    )
+                )
+        except Exception as e:
+            logger.error(f"Could not drop {definition.name + SHADOW_SUFFIX}: {e}")
+
+
+def _build_shadows(metric, definitions, rebuild, subscription_filter_keys):
+    windows = _refresh_windows(metric)
+    rebuild.chunks_total = len(windows) * len(definitions)
+    rebuild.save(update_fields=["chunks_total"])
+    for definition in definitions:
+        shadow_name = definition.name + SHADOW_SUFFIX
+        sql_injection_data = {
+            **definition.injection_data,
+            "cagg_name": shadow_name,
+            "group_by": subscription_filter_keys,
+        }
+        if "source_cagg_name" in sql_injection_data:
+            # build it on the new version of the cagg below it
+            sql_injection_data["source_cagg_name"] += SHADOW_SUFFIX
+        with connection.cursor() as cursor:
+            # leftovers of a rebuild that didn't finish
+            cursor.execute(render_template(CAGG_DROP, **sql_injection_data))
+            cursor.execute(
+                render_template(definition.template, **sql_injection_data)
+                + "\nWITH NO DATA"
+            )
+        for start, end in windows:
+            with connection.cursor() as cursor:
+                cursor.execute(CAGG_REFRESH_WINDOW, [shadow_name, start, end])
+            rebuild.chunks_done += 1
+            rebuild.save(update_fields=["chunks_done"])
+        logger.info(
+            f"Materialized {shadow_name}, {rebuild.chunks_done}/{rebuild.chunks_total} chunks done"
+        )
+
+
+def _swap_in_shadows(definitions):
+    with connection.cursor() as cursor:
+        # retired aggregates a previous rebuild couldn't drop would block the renames
+        for definition in reversed(definitions):
+            cursor.execute(
+                render_template(CAGG_DROP, cagg_name=definition.name + RETIRED_SUFFIX)
+            )
+        for definition in definitions:
+            cursor.execute(
+                render_template(
+                    CAGG_RENAME,
+                    cagg_name=definition.name,
+                    new_cagg_name=definition.name + RETIRED_SUFFIX,
+                )
+            )
+            cursor.execute(
+                render_template(
+                    CAGG_RENAME,
+                    cagg_name=definition.name + SHADOW_SUFFIX,
+                    new_cagg_name=definition.name,
+                )
+            )
+
+
+def _finish(metric, definitions, rebuild):
+    rebuild.status = CAGG_REBUILD_STATUS.COMPLETED
+    try:
+        for definition in definitions:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    render_template(CAGG_REFRESH, **definition.injection_data)
+                )
+                if definition.compress:
+                    cursor.execute(
+                        render_template(CAGG_COMPRESSION, **definition.injection_data)
+                    )
+        for definition in reversed(definitions):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    render_template(
+                        CAGG_DROP, cagg_name=definition.name + RETIRED_SUFFIX
+                    )
+                )
+    except Exception as e:
+        # the new aggregates are already serving queries, this only needs a look
+        logger.error(f"Could not finish setting up rebuilt aggregates of {metric}: {e}")
+        rebuild.error = str(e)
+    rebuild.finished_at = now_utc()
+    rebuild.save()
+
+
+def rebuild_continuous_aggregates(organization, subscription_filter_keys):
+    """Rebuild the continuous aggregates of an organization's metrics without taking
+    them offline, grouped by new subscription filter keys.
+
+    The keys are written to the organization in the transaction that swaps the
+    rebuilt aggregates in, so queries always group by the columns the live ones
+    have. Progress is recorded in a ContinuousAggregateRebuild per metric, which
+    are returned. If anything goes wrong the half built aggregates are dropped, the
+    old ones and the keys are left untouched and the exception is raised. Can't run
+    inside a transaction.
+    """
+    from metering_billing.aggregation.billable_metrics import METRIC_HANDLER_MAP
+    from metering_billing.models import ContinuousAggregateRebuild, Organization
+
+    rebuilds = []
+    try:
+        # archived metrics had their caggs dropped, there's nothing to rebuild
+        for metric in organization.metrics.filter(status=METRIC_STATUS.ACTIVE):
+            handler = METRIC_HANDLER_MAP[metric.metric_type]
+            definitions = handler.continuous_aggregate_definitions(metric)
+            if len(definitions) == 0:
+                continue
+            rebuild = ContinuousAggregateRebuild.objects.create(
+                organization_id=metric.organization_id, metric=metric
+            )
+            rebuilds.append((metric, definitions, rebuild))
+            _build_shadows(metric, definitions, rebuild, subscription_filter_keys)
+        with transaction.atomic():
+            for metric, definitions, _ in rebuilds:
+                _swap_in_shadows(definitions)
+                # checkpoints were taken of the old aggregates
+                invalidate_gauge_checkpoints(metric)
+            Organization.objects.filter(pk=organization.pk).update(
+                subscription_filter_keys=subscription_filter_keys
+            )
+    except Exception as e:
+        for _, definitions, rebuild in rebuilds:
+            _drop_shadows(definitions)
+            rebuild.status = CAGG_REBUILD_STATUS.FAILED
+            rebuild.error = str(e)
+            rebuild.finished_at = now_utc()
+            rebuild.save()
+        raise
+    for metric, definitions, rebuild in rebuilds:
+        _finish(metric, definitions, rebuild)
+    return [rebuild for _, _, rebuild in rebuilds]
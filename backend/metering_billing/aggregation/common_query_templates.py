@@ -1,8 +1,8 @@
 CAGG_REFRESH = """
 SELECT add_continuous_aggregate_policy('{{ cagg_name }}',
-    start_offset => INTERVAL '32 days',
-    end_offset => INTERVAL '1 day',
-    schedule_interval => INTERVAL '30 minutes',
+    start_offset => INTERVAL '{{ refresh_start_offset }}',
+    end_offset => INTERVAL '{{ refresh_end_offset }}',
+    schedule_interval => INTERVAL '{{ refresh_schedule_interval }}',
     if_not_exists => TRUE);
 """
 
@@ -10,11 +10,21 @@ CAGG_DROP = """
 DROP MATERIALIZED VIEW IF EXISTS {{ cagg_name }};
 """
 
+CAGG_RENAME = """
+ALTER MATERIALIZED VIEW IF EXISTS {{ cagg_name }} RENAME TO {{ new_cagg_name }};
+"""
+
+# not a template, takes the cagg name and the start and end of the window as
+# parameters. Can't run inside a transaction.
+CAGG_REFRESH_WINDOW = """
+CALL refresh_continuous_aggregate(%s, %s::timestamptz, %s::timestamptz);
+"""
+
 CAGG_COMPRESSION = """
 ALTER MATERIALIZED VIEW {{ cagg_name }} set (timescaledb.compress = true);
 SELECT add_compression_policy(
     '{{ cagg_name }}',
-    compress_after=>'33 days'::interval,
+    compress_after=>'{{ compress_after }}'::interval,
     if_not_exists=>true
 );
 """
@@ -24,6 +24,16 @@ SELECT
         ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
     )
     {%- endif %} AS usage_qty
+    {%- if unique_sketch == "hyperloglog" %}
+    , hyperloglog(
+        {{ hyperloglog_buckets }}
+        , "metering_billing_usageevent"."properties" ->> '{{ property_name }}'
+    ) AS sketch
+    {%- elif unique_sketch == "bitmap" %}
+    , rb_build_agg(
+        hashtext("metering_billing_usageevent"."properties" ->> '{{ property_name }}')
+    ) AS sketch
+    {%- endif %}
     {%- for group_by_field in group_by %}
     , "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}' AS {{ group_by_field }}
     {%- endfor %}
@@ -68,6 +78,36 @@ GROUP BY
     {%- endfor %}
 """
 
+# minute buckets are materialized straight from the events, coarser ones are rolled
+# up from the next finer cagg (a cagg on a cagg), so each refresh only has to read
+# the rows of the level below rather than every event again
+COUNTER_CAGG_ROLLUP_QUERY = """
+CREATE MATERIALIZED VIEW IF NOT EXISTS {{ cagg_name }}
+WITH ( timescaledb.continuous ) AS
+SELECT
+    uuidv5_customer_id
+    , time_bucket('1 {{ bucket_size }}', bucket) AS bucket
+    , SUM(num_events) AS num_events
+    , {%- if query_type == "average" -%}
+    SUM(usage_qty * num_events) / SUM(num_events)
+    {%- elif query_type == "max" -%}
+    MAX(usage_qty)
+    {%- else -%}
+    SUM(usage_qty)
+    {%- endif %} AS usage_qty
+    {%- for group_by_field in group_by %}
+    , {{ group_by_field }}
+    {%- endfor %}
+FROM
+    {{ source_cagg_name }}
+GROUP BY
+    uuidv5_customer_id
+    , time_bucket('1 {{ bucket_size }}', bucket)
+    {%- for group_by_field in group_by %}
+    , {{ group_by_field }}
+    {%- endfor %}
+"""
+
 # this query is used to get all the usage aggregated over the entire time period using the
 COUNTER_CAGG_TOTAL = """
 SELECT
@@ -89,15 +129,15 @@ SELECT
 FROM
     {{ cagg_name }}
 WHERE
-    uuidv5_customer_id = '{{ uuidv5_customer_id }}'
-    AND bucket >= '{{ start_date }}'::timestamptz
-    AND bucket <= '{{ end_date }}'::timestamptz
+    uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
+    AND bucket >= {{ bind(start_date, "timestamptz") }}
+    AND bucket <= {{ bind(end_date, "timestamptz") }}
     AND bucket <= NOW()
     {%- for property_name, property_values in filter_properties.items() %}
     AND {{ property_name }}
         IN (
             {%- for pval in property_values %}
-            '{{ pval }}'
+            {{ bind(pval, "text") }}
             {%- if not loop.last %},{% endif %}
             {%- endfor %}
         )
@@ -111,6 +151,84 @@ GROUP BY
 """
 
 
+# same output as COUNTER_CAGG_TOTAL, read straight from the events. Only used for the
+# sub-minute edges of a period, which no cagg bucket fits in
+COUNTER_RAW_TOTAL = """
+SELECT
+    "metering_billing_usageevent"."uuidv5_customer_id" AS uuidv5_customer_id
+    {%- for group_by_field in group_by %}
+    , "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}' AS {{ group_by_field }}
+    {%- endfor %}
+    , COUNT( * ) AS num_events
+    , {%- if query_type == "count" -%}
+    COUNT( * )
+    {%- elif query_type == "sum" -%}
+    SUM(
+        ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+    )
+    {%- elif query_type == "average" -%}
+    AVG(
+        ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+    )
+    {%- elif query_type == "max" -%}
+    MAX(
+        ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+    )
+    {%- endif %} AS usage_qty
+    , time_bucket('1 minute', "metering_billing_usageevent"."time_created") AS bucket
+FROM
+    "metering_billing_usageevent"
+WHERE
+    "metering_billing_usageevent"."uuidv5_event_name" = {{ bind(uuidv5_event_name, "uuid") }}
+    AND "metering_billing_usageevent"."organization_id" = {{ bind(organization_id, "integer") }}
+    AND "metering_billing_usageevent"."uuidv5_customer_id" = {{ bind(uuidv5_customer_id, "uuid") }}
+    AND "metering_billing_usageevent"."time_created" >= {{ bind(start_date, "timestamptz") }}
+    AND "metering_billing_usageevent"."time_created" <= {{ bind(end_date, "timestamptz") }}
+    AND "metering_billing_usageevent"."time_created" <= NOW()
+    {%- for property_name, property_values in filter_properties.items() %}
+    AND "metering_billing_usageevent"."properties" ->> '{{ property_name }}'
+        IN (
+            {%- for pval in property_values %}
+            {{ bind(pval, "text") }}
+            {%- if not loop.last %},{% endif %}
+            {%- endfor %}
+        )
+    {%- endfor %}
+    {%- for property_name, operator, comparison in numeric_filters %}
+    AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+        {% if operator == "gt" %}
+        >
+        {% elif operator == "gte" %}
+        >=
+        {% elif operator == "lt" %}
+        <
+        {% elif operator == "lte" %}
+        <=
+        {% elif operator == "eq" %}
+        =
+        {% endif %}
+        {{ bind(comparison, "numeric") }}
+    {%- endfor %}
+    {%- for property_name, operator, comparison in categorical_filters %}
+    AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
+        {% if operator == "isnotin" %}
+        NOT
+        {% endif %}
+        IN (
+            {%- for pval in comparison %}
+            {{ bind(pval, "text") }}
+            {%- if not loop.last %},{% endif %}
+            {%- endfor %}
+        )
+    {%- endfor %}
+GROUP BY
+    "metering_billing_usageevent"."uuidv5_customer_id"
+    {%- for group_by_field in group_by %}
+    , "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}'
+    {%- endfor %}
+    , time_bucket('1 minute', "metering_billing_usageevent"."time_created")
+"""
+
 COUNTER_UNIQUE_TOTAL = """
 SELECT
     "metering_billing_usageevent"."uuidv5_customer_id" AS uuidv5_customer_id
@@ -122,19 +240,19 @@ SELECT
 FROM
     "metering_billing_usageevent"
 WHERE
-    "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
-    AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
+    "metering_billing_usageevent"."uuidv5_event_name" = {{ bind(uuidv5_event_name, "uuid") }}
+    AND "metering_billing_usageevent"."organization_id" = {{ bind(organization_id, "integer") }}
     AND "metering_billing_usageevent"."time_created" <= NOW()
-    AND "metering_billing_usageevent"."time_created" >= '{{ start_date }}'::timestamptz
-    AND "metering_billing_usageevent"."time_created" <= '{{ end_date }}'::timestamptz
+    AND "metering_billing_usageevent"."time_created" >= {{ bind(start_date, "timestamptz") }}
+    AND "metering_billing_usageevent"."time_created" <= {{ bind(end_date, "timestamptz") }}
     {%- if uuidv5_customer_id is not none %}
-    AND "metering_billing_usageevent"."uuidv5_customer_id" = '{{ uuidv5_customer_id }}'
+    AND "metering_billing_usageevent"."uuidv5_customer_id" = {{ bind(uuidv5_customer_id, "uuid") }}
     {% endif %}
     {%- for property_name, property_values in filter_properties.items() %}
     AND {{ property_name }}
         IN (
             {%- for pval in property_values %}
-            '{{ pval }}'
+            {{ bind(pval, "text") }}
             {%- if not loop.last %},{% endif %}
             {%- endfor %}
         )
@@ -152,7 +270,7 @@ WHERE
         {% elif operator == "eq" %}
         =
         {% endif %}
-        {{ comparison }}
+        {{ bind(comparison, "numeric") }}
     {%- endfor %}
     {%- for property_name, operator, comparison in categorical_filters %}
     AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
@@ -161,7 +279,7 @@ WHERE
         {% endif %}
         IN (
             {%- for pval in comparison %}
-            '{{ pval }}'
+            {{ bind(pval, "text") }}
             {%- if not loop.last %},{% endif %}
             {%- endfor %}
         )
@@ -174,6 +292,199 @@ GROUP BY
 """
 
 
+# the pieces of a period the sketches of a unique metric are merged from: the per day
+# sketches of the cagg for its full days, and sketches built on the spot from the
+# events of its partial days. Sketches are mergeable, so this is exact for bitmaps
+# and as good as a single sketch of the whole period for hyperloglog
+_UNIQUE_SKETCH_PARTS = """
+    {%- for bucket_size, start_date, end_date in windows %}
+    {%- if bucket_size == "day" %}
+    SELECT
+        {%- for group_by_field in group_by %}
+        {{ group_by_field }},
+        {%- endfor %}
+        bucket
+        , num_events
+        , sketch
+    FROM
+        {{ cagg_name }}
+    WHERE
+        uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
+        AND bucket >= {{ bind(start_date, "timestamptz") }}
+        AND bucket <= {{ bind(end_date, "timestamptz") }}
+        AND bucket <= NOW()
+        {%- for property_name, property_values in filter_properties.items() %}
+        AND {{ property_name }}
+            IN (
+                {%- for pval in property_values %}
+                {{ bind(pval, "text") }}
+                {%- if not loop.last %},{% endif %}
+                {%- endfor %}
+            )
+        {%- endfor %}
+    {%- else %}
+    SELECT
+        {%- for group_by_field in group_by %}
+        "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}' AS {{ group_by_field }},
+        {%- endfor %}
+        time_bucket('1 day', "metering_billing_usageevent"."time_created") AS bucket
+        , COUNT( * ) AS num_events
+        , {%- if unique_sketch == "hyperloglog" -%}
+        hyperloglog(
+            {{ hyperloglog_buckets }}
+            , "metering_billing_usageevent"."properties" ->> '{{ property_name }}'
+        )
+        {%- else -%}
+        rb_build_agg(
+            hashtext("metering_billing_usageevent"."properties" ->> '{{ property_name }}')
+        )
+        {%- endif %} AS sketch
+    FROM
+        "metering_billing_usageevent"
+    WHERE
+        "metering_billing_usageevent"."uuidv5_event_name" = {{ bind(uuidv5_event_name, "uuid") }}
+        AND "metering_billing_usageevent"."organization_id" = {{ bind(organization_id, "integer") }}
+        AND "metering_billing_usageevent"."uuidv5_customer_id" = {{ bind(uuidv5_customer_id, "uuid") }}
+        AND "metering_billing_usageevent"."time_created" >= {{ bind(start_date, "timestamptz") }}
+        AND "metering_billing_usageevent"."time_created" <= {{ bind(end_date, "timestamptz") }}
+        AND "metering_billing_usageevent"."time_created" <= NOW()
+        {%- for property_name, property_values in filter_properties.items() %}
+        AND "metering_billing_usageevent"."properties" ->> '{{ property_name }}'
+            IN (
+                {%- for pval in property_values %}
+                {{ bind(pval, "text") }}
+                {%- if not loop.last %},{% endif %}
+                {%- endfor %}
+            )
+        {%- endfor %}
+        {%- for property_name, operator, comparison in numeric_filters %}
+        AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+            {% if operator == "gt" %}
+            >
+            {% elif operator == "gte" %}
+            >=
+            {% elif operator == "lt" %}
+            <
+            {% elif operator == "lte" %}
+            <=
+            {% elif operator == "eq" %}
+            =
+            {% endif %}
+            {{ bind(comparison, "numeric") }}
+        {%- endfor %}
+        {%- for property_name, operator, comparison in categorical_filters %}
+        AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
+            {% if operator == "isnotin" %}
+            NOT
+            {% endif %}
+            IN (
+                {%- for pval in comparison %}
+                {{ bind(pval, "text") }}
+                {%- if not loop.last %},{% endif %}
+                {%- endfor %}
+            )
+        {%- endfor %}
+    GROUP BY
+        {%- for group_by_field in group_by %}
+        "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}',
+        {%- endfor %}
+        time_bucket('1 day', "metering_billing_usageevent"."time_created")
+    {%- endif %}
+    {%- if not loop.last %}
+    UNION ALL
+    {%- endif %}
+    {%- endfor %}
+"""
+
+_UNIQUE_SKETCH_MERGE = """
+    {%- if unique_sketch == "hyperloglog" -%}
+    distinct_count(rollup(parts.sketch))
+    {%- else -%}
+    rb_cardinality(rb_or_agg(parts.sketch))
+    {%- endif -%}
+"""
+
+# COUNTER_UNIQUE_TOTAL for unique metrics that keep sketches
+COUNTER_UNIQUE_SKETCH_TOTAL = (
+    """
+WITH parts AS ("""
+    + _UNIQUE_SKETCH_PARTS
+    + """
+)
+SELECT
+    {%- for group_by_field in group_by %}
+    parts.{{ group_by_field }},
+    {%- endfor %}
+    """
+    + _UNIQUE_SKETCH_MERGE
+    + """ AS usage_qty
+    , SUM(parts.num_events) AS num_events
+FROM
+    parts
+{%- if group_by %}
+GROUP BY
+    {%- for group_by_field in group_by %}
+    parts.{{ group_by_field }}
+    {%- if not loop.last %},{% endif %}
+    {%- endfor %}
+{%- endif %}
+"""
+)
+
+# the running count of distinct values at the end of every day of a period, for unique
+# metrics that keep sketches. The values first seen on a day are the difference with
+# the day before
+COUNTER_UNIQUE_SKETCH_CUMULATIVE_PER_DAY = (
+    """
+WITH parts AS ("""
+    + _UNIQUE_SKETCH_PARTS
+    + """
+), per_day AS (
+    SELECT
+        {%- for group_by_field in group_by %}
+        parts.{{ group_by_field }},
+        {%- endfor %}
+        parts.bucket
+        , {%- if unique_sketch == "hyperloglog" -%}
+        rollup(parts.sketch)
+        {%- else -%}
+        rb_or_agg(parts.sketch)
+        {%- endif %} AS sketch
+    FROM
+        parts
+    GROUP BY
+        {%- for group_by_field in group_by %}
+        parts.{{ group_by_field }},
+        {%- endfor %}
+        parts.bucket
+)
+SELECT
+    {%- for group_by_field in group_by %}
+    {{ group_by_field }},
+    {%- endfor %}
+    bucket
+    , {%- if unique_sketch == "hyperloglog" -%}
+    distinct_count(rollup(sketch) OVER running)
+    {%- else -%}
+    rb_cardinality(rb_or_agg(sketch) OVER running)
+    {%- endif %} AS cumulative_usage_qty
+FROM
+    per_day
+WINDOW running AS (
+    {%- if group_by %}
+    PARTITION BY
+        {%- for group_by_field in group_by %}
+        {{ group_by_field }}
+        {%- if not loop.last %},{% endif %}
+        {%- endfor %}
+    {%- endif %}
+    ORDER BY bucket
+)
+ORDER BY
+    bucket
+"""
+)
+
 COUNTER_UNIQUE_PER_DAY = """
 SELECT DISTINCT ON (
     "metering_billing_usageevent"."uuidv5_customer_id",
@@ -191,13 +502,13 @@ SELECT DISTINCT ON (
 FROM
     "metering_billing_usageevent"
 WHERE
-    "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
-    AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
+    "metering_billing_usageevent"."uuidv5_event_name" = {{ bind(uuidv5_event_name, "uuid") }}
+    AND "metering_billing_usageevent"."organization_id" = {{ bind(organization_id, "integer") }}
     AND "metering_billing_usageevent"."time_created" <= NOW()
-    AND "metering_billing_usageevent"."time_created" >= '{{ start_date }}'::timestamptz
-    AND "metering_billing_usageevent"."time_created" <= '{{ end_date }}'::timestamptz
+    AND "metering_billing_usageevent"."time_created" >= {{ bind(start_date, "timestamptz") }}
+    AND "metering_billing_usageevent"."time_created" <= {{ bind(end_date, "timestamptz") }}
     {%- if uuidv5_customer_id is not none %}
-    AND "metering_billing_usageevent"."uuidv5_customer_id" = '{{ uuidv5_customer_id }}'
+    AND "metering_billing_usageevent"."uuidv5_customer_id" = {{ bind(uuidv5_customer_id, "uuid") }}
     {% endif %}
 ORDER BY
     "metering_billing_usageevent"."uuidv5_customer_id"
@@ -220,10 +531,10 @@ WITH per_customer AS (
     WHERE
         bucket <= NOW()
         {% if uuidv5_customer_id is not none %}
-        AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        AND uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {% endif %}
-        AND bucket >= '{{ start_date }}'::timestamptz
-        AND bucket <=  '{{ end_date }}'::timestamptz
+        AND bucket >= {{ bind(start_date, "timestamptz") }}
+        AND bucket <=  {{ bind(end_date, "timestamptz") }}
     GROUP BY
         uuidv5_customer_id
         , time_bucket
@@ -255,3 +566,238 @@ GROUP BY
     COALESCE(top_n.uuidv5_customer_id, uuid_nil())
     , per_customer.time_bucket
 """
+
+
+# same as COUNTER_CAGG_TOTAL but for many (customer, subscription filters, start, end)
+# windows at once. Each window says which cagg it should be read from, or 'raw' for
+# the events themselves, so every piece of every billing record is resolved in a
+# single query
+COUNTER_CAGG_TOTAL_BULK = """
+WITH windows (
+    window_id
+    , uuidv5_customer_id
+    , start_date
+    , end_date
+    , bucket_size
+    , filters
+) AS (
+    VALUES
+    {%- for window in windows %}
+    (
+        {{ bind(window.window_id, "integer") }}
+        , {{ bind(window.uuidv5_customer_id, "uuid") }}
+        , {{ bind(window.start_date, "timestamptz") }}
+        , {{ bind(window.end_date, "timestamptz") }}
+        , {{ bind(window.bucket_size, "text") }}
+        , {{ bind(window.filters, "jsonb") }}
+    )
+    {%- if not loop.last %},{% endif %}
+    {%- endfor %}
+), per_window AS (
+    {%- for bucket_size, cagg_name in caggs.items() %}
+    SELECT
+        windows.window_id
+        , SUM(cagg.num_events) AS num_events
+        , {%- if query_type == "count" -%}
+        SUM(cagg.num_events)
+        {%- elif query_type == "sum" -%}
+        SUM(cagg.usage_qty)
+        {%- elif query_type == "average" -%}
+        SUM(cagg.usage_qty * cagg.num_events)
+        {%- elif query_type == "max" -%}
+        MAX(cagg.usage_qty)
+        {%- endif %} AS usage_qty
+    FROM
+        windows
+    INNER JOIN
+        {{ cagg_name }} AS cagg
+    ON
+        cagg.uuidv5_customer_id = windows.uuidv5_customer_id
+        AND cagg.bucket >= windows.start_date
+        AND cagg.bucket <= windows.end_date
+        {%- for group_by_field in group_by %}
+        AND (
+            windows.filters ->> '{{ group_by_field }}' IS NULL
+            OR cagg.{{ group_by_field }} = windows.filters ->> '{{ group_by_field }}'
+        )
+        {%- endfor %}
+    WHERE
+        windows.bucket_size = '{{ bucket_size }}'
+        AND cagg.bucket <= NOW()
+    GROUP BY
+        windows.window_id
+    {%- if not loop.last or include_raw %}
+    UNION ALL
+    {%- endif %}
+    {%- endfor %}
+    {%- if include_raw %}
+    SELECT
+        windows.window_id
+        , COUNT( * ) AS num_events
+        , {%- if query_type == "count" -%}
+        COUNT( * )
+        {%- elif query_type == "sum" -%}
+        SUM(
+            ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+        )
+        {%- elif query_type == "average" -%}
+        SUM(
+            ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+        )
+        {%- elif query_type == "max" -%}
+        MAX(
+            ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+        )
+        {%- endif %} AS usage_qty
+    FROM
+        windows
+    INNER JOIN
+        "metering_billing_usageevent"
+    ON
+        "metering_billing_usageevent"."uuidv5_customer_id" = windows.uuidv5_customer_id
+        AND "metering_billing_usageevent"."time_created" >= windows.start_date
+        AND "metering_billing_usageevent"."time_created" <= windows.end_date
+        {%- for group_by_field in group_by %}
+        AND (
+            windows.filters ->> '{{ group_by_field }}' IS NULL
+            OR "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}' = windows.filters ->> '{{ group_by_field }}'
+        )
+        {%- endfor %}
+    WHERE
+        windows.bucket_size = 'raw'
+        AND "metering_billing_usageevent"."uuidv5_event_name" = {{ bind(uuidv5_event_name, "uuid") }}
+        AND "metering_billing_usageevent"."organization_id" = {{ bind(organization_id, "integer") }}
+        AND "metering_billing_usageevent"."time_created" <= NOW()
+        {%- for property_name, operator, comparison in numeric_filters %}
+        AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+            {% if operator == "gt" %}
+            >
+            {% elif operator == "gte" %}
+            >=
+            {% elif operator == "lt" %}
+            <
+            {% elif operator == "lte" %}
+            <=
+            {% elif operator == "eq" %}
+            =
+            {% endif %}
+            {{ bind(comparison, "numeric") }}
+        {%- endfor %}
+        {%- for property_name, operator, comparison in categorical_filters %}
+        AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
+            {% if operator == "isnotin" %}
+            NOT
+            {% endif %}
+            IN (
+                {%- for pval in comparison %}
+                {{ bind(pval, "text") }}
+                {%- if not loop.last %},{% endif %}
+                {%- endfor %}
+            )
+        {%- endfor %}
+    GROUP BY
+        windows.window_id
+    {%- endif %}
+)
+SELECT
+    window_id
+    , SUM(num_events) AS num_events
+    , {%- if query_type == "max" -%}
+    MAX(usage_qty)
+    {%- else -%}
+    SUM(usage_qty)
+    {%- endif %} AS usage_qty
+FROM
+    per_window
+GROUP BY
+    window_id
+"""
+
+
+COUNTER_UNIQUE_TOTAL_BULK = """
+WITH windows (
+    window_id
+    , uuidv5_customer_id
+    , start_date
+    , end_date
+    , filters
+) AS (
+    VALUES
+    {%- for window in windows %}
+    (
+        {{ bind(window.window_id, "integer") }}
+        , {{ bind(window.uuidv5_customer_id, "uuid") }}
+        , {{ bind(window.start_date, "timestamptz") }}
+        , {{ bind(window.end_date, "timestamptz") }}
+        , {{ bind(window.filters, "jsonb") }}
+    )
+    {%- if not loop.last %},{% endif %}
+    {%- endfor %}
+), per_group AS (
+    SELECT
+        windows.window_id
+        {%- for group_by_field in group_by %}
+        , "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}' AS {{ group_by_field }}
+        {%- endfor %}
+        , COUNT( DISTINCT "metering_billing_usageevent"."properties" ->> '{{ property_name }}' ) AS usage_qty
+        , COUNT( * ) AS num_events
+    FROM
+        windows
+    INNER JOIN
+        "metering_billing_usageevent"
+    ON
+        "metering_billing_usageevent"."uuidv5_customer_id" = windows.uuidv5_customer_id
+        AND "metering_billing_usageevent"."time_created" >= windows.start_date
+        AND "metering_billing_usageevent"."time_created" <= windows.end_date
+        {%- for group_by_field in group_by %}
+        AND (
+            windows.filters ->> '{{ group_by_field }}' IS NULL
+            OR "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}' = windows.filters ->> '{{ group_by_field }}'
+        )
+        {%- endfor %}
+    WHERE
+        "metering_billing_usageevent"."uuidv5_event_name" = {{ bind(uuidv5_event_name, "uuid") }}
+        AND "metering_billing_usageevent"."organization_id" = {{ bind(organization_id, "integer") }}
+        AND "metering_billing_usageevent"."time_created" <= NOW()
+        {%- for property_name, operator, comparison in numeric_filters %}
+        AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+            {% if operator == "gt" %}
+            >
+            {% elif operator == "gte" %}
+            >=
+            {% elif operator == "lt" %}
+            <
+            {% elif operator == "lte" %}
+            <=
+            {% elif operator == "eq" %}
+            =
+            {% endif %}
+            {{ bind(comparison, "numeric") }}
+        {%- endfor %}
+        {%- for property_name, operator, comparison in categorical_filters %}
+        AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
+            {% if operator == "isnotin" %}
+            NOT
+            {% endif %}
+            IN (
+                {%- for pval in comparison %}
+                {{ bind(pval, "text") }}
+                {%- if not loop.last %},{% endif %}
+                {%- endfor %}
+            )
+        {%- endfor %}
+    GROUP BY
+        windows.window_id
+        {%- for group_by_field in group_by %}
+        , "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}'
+        {%- endfor %}
+)
+SELECT
+    window_id
+    , SUM(num_events) AS num_events
+    , SUM(usage_qty) AS usage_qty
+FROM
+    per_group
+GROUP BY
+    window_id
+"""
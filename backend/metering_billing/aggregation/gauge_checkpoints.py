@@ -0,0 +1,103 @@
+import datetime
+import logging
+
+import pytz
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+
+from metering_billing.utils import now_utc
+from metering_billing.utils.enums import METRIC_STATUS, METRIC_TYPE
+
+from .cagg_policies import get_cagg_policy
+from .gauge_query_templates import GAUGE_WRITE_CHECKPOINT
+from .prepared_statements import execute_query
+from .template_registry import render_query
+
+logger = logging.getLogger("django.server")
+
+GAUGE_CHECKPOINT_INTERVAL_DAYS = settings.GAUGE_CHECKPOINT_INTERVAL_DAYS
+
+# The usage of a gauge depends on its state at the start of the period, which is
+# the sum (delta gauges) or the last value (total gauges) of everything the
+# customer ever sent. Reading that from the cagg means going through its whole
+# history on every usage query. Instead, the state of every customer is written
+# down every GAUGE_CHECKPOINT_INTERVAL_DAYS days in a GaugeCheckpoint, and usage
+# queries only read the cagg from the latest checkpoint before the period onwards.
+# Checkpoints are only taken of days the refresh policy of the cagg doesn't cover
+# anymore, so late events can't change them. Anything that changes those days
+# anyway (backfills, rebuilding the cagg) has to invalidate them.
+
+
+def _checkpoint_horizon(metric, now):
+    """Start of the earliest day the cagg refresh policy still refreshes"""
+    policy = get_cagg_policy(metric.organization_id, metric.id)
+    refresh_start = (now - policy.refresh_start_offset).astimezone(pytz.UTC)
+    return refresh_start.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def write_gauge_checkpoint(metric, now=None):
+    """Checkpoint the state of a gauge metric, if its last checkpoint is old enough.
+
+    Returns the state_at of the new checkpoint, or None if none was written.
+    """
+    from metering_billing.aggregation.billable_metrics import METRIC_HANDLER_MAP
+    from metering_billing.models import GaugeCheckpoint
+
+    if GAUGE_CHECKPOINT_INTERVAL_DAYS <= 0 or metric.metric_type != METRIC_TYPE.GAUGE:
+        return None
+    state_at = _checkpoint_horizon(metric, now or now_utc())
+    previous_state_at = GaugeCheckpoint.objects.filter(metric=metric).aggregate(
+        Max("state_at")
+    )["state_at__max"]
+    if previous_state_at is not None and state_at - previous_state_at < (
+        datetime.timedelta(days=GAUGE_CHECKPOINT_INTERVAL_DAYS)
+    ):
+        return None
+    (cagg_name,) = METRIC_HANDLER_MAP[metric.metric_type].continuous_aggregate_names(
+        metric
+    )
+    query, params = render_query(
+        GAUGE_WRITE_CHECKPOINT,
+        organization_id=metric.organization_id,
+        metric_id=metric.id,
+        event_type=metric.event_type,
+        group_by=metric.organization.subscription_filter_keys,
+        cumsum_cagg=cagg_name,
+        state_at=state_at,
+        previous_state_at=previous_state_at,
+    )
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            execute_query(cursor, query, params)
+    return state_at
+
+
+def write_all_gauge_checkpoints(now=None):
+    """Checkpoint the active gauge metrics that are due, returns how many were"""
+    from metering_billing.models import Metric
+
+    num_written = 0
+    for metric in Metric.objects.filter(
+        metric_type=METRIC_TYPE.GAUGE, status=METRIC_STATUS.ACTIVE
+    ).select_related("organization"):
+        try:
+            if write_gauge_checkpoint(metric, now) is not None:
+                num_written += 1
+        except Exception as e:
+            # the queries fall back to the previous checkpoint, or to the whole cagg
+            logger.error(f"Could not write gauge checkpoint of {metric}: {e}")
+    return num_written
+
+
+def invalidate_gauge_checkpoints(metric, since=None):
+    """Delete the checkpoints of a metric that include anything after since.
+
+    Without since, all of them are deleted, for when the cagg itself changed.
+    """
+    from metering_billing.models import GaugeCheckpoint
+
+    checkpoints = GaugeCheckpoint.objects.filter(metric=metric)
+    if since is not None:
+        checkpoints = checkpoints.filter(state_at__gt=since)
+    checkpoints.delete()
@@ -1,5 +1,138 @@
 ### INFRASTRUCTURE TABLES
 
+# Where the state of a customer before some point in time is read from: the days of
+# the cagg, except that everything before the latest GaugeCheckpoint at or before
+# checkpoint_before is replaced by the checkpointed state. Sums and last values over
+# it come out the same as over the whole cagg, without reading all of its history.
+# The checkpoint rows get a time_bucket just before the state they stand for, so
+# they land on the same side of the queries' time filters as the days they replace
+_GAUGE_CHECKPOINT_STATE = """
+        WITH checkpoint AS (
+            SELECT
+                MAX(state_at) AS state_at
+            FROM
+                "metering_billing_gaugecheckpoint"
+            WHERE
+                metric_id = {{ bind(metric_id, "integer") }}
+                AND uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
+                AND state_at <= {{ bind(checkpoint_before, "timestamptz") }}
+        )
+        SELECT
+            uuidv5_customer_id
+            {%- for group_by_field in group_by %}
+            , group_values ->> '{{ group_by_field }}' AS {{ group_by_field }}
+            {%- endfor %}
+"""
+
+_GAUGE_CHECKPOINT_SINCE = """
+        FROM
+            "metering_billing_gaugecheckpoint"
+        WHERE
+            metric_id = {{ bind(metric_id, "integer") }}
+            AND uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
+            AND state_at = (SELECT state_at FROM checkpoint)
+        UNION ALL
+        SELECT
+            uuidv5_customer_id
+            {%- for group_by_field in group_by %}
+            , {{ group_by_field }}
+            {%- endfor %}
+"""
+
+_GAUGE_CHECKPOINT_CAGG = """
+        FROM
+            {{ cumsum_cagg }}
+        WHERE
+            uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
+            AND time_bucket >= COALESCE(
+                (SELECT state_at FROM checkpoint), '-infinity'::timestamptz
+            )
+    ) AS cumsum_cagg"""
+
+_GAUGE_DELTA_STATE_SINCE_CHECKPOINT = (
+    "("
+    + _GAUGE_CHECKPOINT_STATE
+    + """            , state_at - INTERVAL '1 day' AS time_bucket
+            , usage_qty AS day_net_state_change"""
+    + _GAUGE_CHECKPOINT_SINCE
+    + """            , time_bucket
+            , day_net_state_change"""
+    + _GAUGE_CHECKPOINT_CAGG
+)
+
+_GAUGE_TOTAL_STATE_SINCE_CHECKPOINT = (
+    "("
+    + _GAUGE_CHECKPOINT_STATE
+    + """            , state_at - INTERVAL '1 microsecond' AS time_bucket
+            , usage_qty AS cumulative_usage_qty"""
+    + _GAUGE_CHECKPOINT_SINCE
+    + """            , time_bucket
+            , cumulative_usage_qty"""
+    + _GAUGE_CHECKPOINT_CAGG
+)
+
+# the state of every customer and group of a metric just before state_at: the state
+# at the previous checkpoint, if there is one, moved forward by the days of the cagg
+# in between
+GAUGE_WRITE_CHECKPOINT = """
+INSERT INTO "metering_billing_gaugecheckpoint" (
+    organization_id
+    , metric_id
+    , uuidv5_customer_id
+    , group_values
+    , state_at
+    , usage_qty
+)
+SELECT
+    {{ bind(organization_id, "integer") }}
+    , {{ bind(metric_id, "integer") }}
+    , uuidv5_customer_id
+    , group_values
+    , {{ bind(state_at, "timestamptz") }}
+    {%- if event_type == "delta" %}
+    , SUM(usage_qty)
+    {%- else %}
+    , last(usage_qty, time_bucket)
+    {%- endif %}
+FROM (
+    SELECT
+        uuidv5_customer_id
+        , group_values
+        , state_at - INTERVAL '1 microsecond' AS time_bucket
+        , usage_qty
+    FROM
+        "metering_billing_gaugecheckpoint"
+    WHERE
+        metric_id = {{ bind(metric_id, "integer") }}
+        AND state_at = {{ bind(previous_state_at, "timestamptz") }}
+    UNION ALL
+    SELECT
+        uuidv5_customer_id
+        , jsonb_build_object(
+            {%- for group_by_field in group_by %}
+            '{{ group_by_field }}', {{ group_by_field }}
+            {%- if not loop.last %},{% endif %}
+            {%- endfor %}
+        ) AS group_values
+        , time_bucket
+        {%- if event_type == "delta" %}
+        , day_net_state_change AS usage_qty
+        {%- else %}
+        , cumulative_usage_qty AS usage_qty
+        {%- endif %}
+    FROM
+        {{ cumsum_cagg }}
+    WHERE
+        time_bucket >= COALESCE(
+            {{ bind(previous_state_at, "timestamptz") }}, '-infinity'::timestamptz
+        )
+        AND time_bucket < {{ bind(state_at, "timestamptz") }}
+) AS state
+GROUP BY
+    uuidv5_customer_id
+    , group_values
+"""
+
 ### FIRST ALL DELTA QUERIES
 GAUGE_DELTA_CUMULATIVE_SUM = """
 CREATE MATERIALIZED VIEW IF NOT EXISTS {{ cagg_name }}
@@ -58,7 +191,8 @@ GROUP BY
 # current day sum: more delta sums from same day, but not from cagg and before now
 # prev_value: the "starting point" for the query
 # cumulative_sum_per_event: get cumsum for each event in the time range
-GAUGE_DELTA_GET_TOTAL_USAGE_WITH_PRORATION = """
+GAUGE_DELTA_GET_TOTAL_USAGE_WITH_PRORATION = (
+    """
 WITH cumsum_cagg_daily AS (
     SELECT
         uuidv5_customer_id
@@ -67,19 +201,21 @@ WITH cumsum_cagg_daily AS (
         {%- endfor %}
         , SUM(day_net_state_change) AS prev_days_usage_qty
     FROM
-        {{ cumsum_cagg }}
+        """
+    + _GAUGE_DELTA_STATE_SINCE_CHECKPOINT
+    + """
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {%- for property_name, property_values in filter_properties.items() %}
         AND {{ property_name }}
             IN (
                 {%- for pval in property_values %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
         {%- endfor %}
-        AND time_bucket < date_trunc('day', '{{ start_date }}'::timestamptz)
+        AND time_bucket < date_trunc('day', {{ bind(start_date, "timestamptz") }})
         AND time_bucket <= CURRENT_DATE
     GROUP BY
         uuidv5_customer_id
@@ -98,11 +234,11 @@ WITH cumsum_cagg_daily AS (
     FROM
         "metering_billing_usageevent"
     WHERE
-        "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
-        AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
+        "metering_billing_usageevent"."uuidv5_event_name" = {{ bind(uuidv5_event_name, "uuid") }}
+        AND "metering_billing_usageevent"."organization_id" = {{ bind(organization_id, "integer") }}
         AND "metering_billing_usageevent"."time_created" <= NOW()
-        AND "metering_billing_usageevent"."time_created" < '{{ start_date }}'::timestamptz
-        AND date_trunc('day', "metering_billing_usageevent"."time_created") = date_trunc('day', '{{ start_date }}'::timestamptz)
+        AND "metering_billing_usageevent"."time_created" < {{ bind(start_date, "timestamptz") }}
+        AND date_trunc('day', "metering_billing_usageevent"."time_created") = date_trunc('day', {{ bind(start_date, "timestamptz") }})
         {%- for property_name, operator, comparison in numeric_filters %}
         AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
             {% if operator == "gt" %}
@@ -116,7 +252,7 @@ WITH cumsum_cagg_daily AS (
             {% elif operator == "eq" %}
             =
             {% endif %}
-            {{ comparison }}
+            {{ bind(comparison, "numeric") }}
         {%- endfor %}
         {%- for property_name, operator, comparison in categorical_filters %}
         AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
@@ -125,7 +261,7 @@ WITH cumsum_cagg_daily AS (
             {% endif %}
             IN (
                 {%- for pval in comparison %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
@@ -169,11 +305,11 @@ cumulative_sum_per_event AS (
     LEFT JOIN prev_value
         ON event_table.uuidv5_customer_id = prev_value.uuidv5_customer_id
     WHERE
-       event_table.uuidv5_event_name = '{{ uuidv5_event_name }}'
-        AND event_table.organization_id = {{ organization_id }}
+       event_table.uuidv5_event_name = {{ bind(uuidv5_event_name, "uuid") }}
+        AND event_table.organization_id = {{ bind(organization_id, "integer") }}
         AND event_table.time_created <= NOW()
-        AND event_table.time_created >= '{{ start_date }}'::timestamptz
-        AND event_table.time_created <= '{{ end_date }}'::timestamptz
+        AND event_table.time_created >= {{ bind(start_date, "timestamptz") }}
+        AND event_table.time_created <= {{ bind(end_date, "timestamptz") }}
         {%- for property_name, operator, comparison in numeric_filters %}
         AND (event_table.properties ->> '{{ property_name }}')::text::decimal
             {% if operator == "gt" %}
@@ -187,7 +323,7 @@ cumulative_sum_per_event AS (
             {% elif operator == "eq" %}
             =
             {% endif %}
-            {{ comparison }}
+            {{ bind(comparison, "numeric") }}
         {%- endfor %}
         {%- for property_name, operator, comparison in categorical_filters %}
         AND (event_table.properties ->> '{{ property_name }}')
@@ -196,7 +332,7 @@ cumulative_sum_per_event AS (
             {% endif %}
             IN (
                 {%- for pval in comparison %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
@@ -210,7 +346,7 @@ proration_level_query AS (
         {%- endfor %}
         {%- if proration_units is none %}
         , MAX(cumulative_usage_qty) AS usage_qty
-        , '{{ start_date }}'::timestamptz AS time
+        , {{ bind(start_date, "timestamptz") }} AS time
         {%- else %}
         , time_bucket_gapfill('1 {{ proration_units }}', time_bucket) AS time
         , locf(
@@ -226,19 +362,19 @@ proration_level_query AS (
     FROM
         cumulative_sum_per_event
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {%- for property_name, property_values in filter_properties.items() %}
         AND {{ property_name }}
             IN (
                 {%- for pval in property_values %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
         {%- endfor %}
         AND time_bucket <= NOW()
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= {{ bind(start_date, "timestamptz") }}
+        AND time_bucket <= {{ bind(end_date, "timestamptz") }}
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -250,21 +386,21 @@ normalized_query AS (
 SELECT
     {%- if proration_units is not none %}
     CASE
-    WHEN time < '{{ start_date }}'::timestamptz
+    WHEN time < {{ bind(start_date, "timestamptz") }}
         THEN
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
-                EXTRACT( EPOCH FROM '{{ start_date }}'::timestamptz)
+                EXTRACT( EPOCH FROM {{ bind(start_date, "timestamptz") }})
             )
             /
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
                 EXTRACT( EPOCH FROM time)
             )
-    WHEN time > '{{ end_date }}'::timestamptz
+    WHEN time > {{ bind(end_date, "timestamptz") }}
         THEN
             (
-                EXTRACT( EPOCH FROM '{{ end_date }}'::timestamptz) -
+                EXTRACT( EPOCH FROM {{ bind(end_date, "timestamptz") }}) -
                 EXTRACT( EPOCH FROM time)
             )
             /
@@ -296,9 +432,11 @@ SELECT
         )
     ) AS usage_qty
 """
+)
 
 
-GAUGE_DELTA_GET_TOTAL_USAGE_WITH_PRORATION_PER_DAY = """
+GAUGE_DELTA_GET_TOTAL_USAGE_WITH_PRORATION_PER_DAY = (
+    """
 WITH cumsum_cagg_daily AS (
     SELECT
         uuidv5_customer_id
@@ -307,19 +445,21 @@ WITH cumsum_cagg_daily AS (
         {%- endfor %}
         , SUM(day_net_state_change) AS prev_days_usage_qty
     FROM
-        {{ cumsum_cagg }}
+        """
+    + _GAUGE_DELTA_STATE_SINCE_CHECKPOINT
+    + """
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {%- for property_name, property_values in filter_properties.items() %}
         AND {{ property_name }}
             IN (
                 {%- for pval in property_values %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
         {%- endfor %}
-        AND time_bucket < date_trunc('day', '{{ start_date }}'::timestamptz)
+        AND time_bucket < date_trunc('day', {{ bind(start_date, "timestamptz") }})
         AND time_bucket <= CURRENT_DATE
     GROUP BY
         uuidv5_customer_id
@@ -338,11 +478,11 @@ WITH cumsum_cagg_daily AS (
     FROM
         "metering_billing_usageevent"
     WHERE
-        "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
-        AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
+        "metering_billing_usageevent"."uuidv5_event_name" = {{ bind(uuidv5_event_name, "uuid") }}
+        AND "metering_billing_usageevent"."organization_id" = {{ bind(organization_id, "integer") }}
         AND "metering_billing_usageevent"."time_created" <= NOW()
-        AND "metering_billing_usageevent"."time_created" < '{{ start_date }}'::timestamptz
-        AND date_trunc('day', "metering_billing_usageevent"."time_created") = date_trunc('day', '{{ start_date }}'::timestamptz)
+        AND "metering_billing_usageevent"."time_created" < {{ bind(start_date, "timestamptz") }}
+        AND date_trunc('day', "metering_billing_usageevent"."time_created") = date_trunc('day', {{ bind(start_date, "timestamptz") }})
         {%- for property_name, operator, comparison in numeric_filters %}
         AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
             {% if operator == "gt" %}
@@ -356,7 +496,7 @@ WITH cumsum_cagg_daily AS (
             {% elif operator == "eq" %}
             =
             {% endif %}
-            {{ comparison }}
+            {{ bind(comparison, "numeric") }}
         {%- endfor %}
         {%- for property_name, operator, comparison in categorical_filters %}
         AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
@@ -365,7 +505,7 @@ WITH cumsum_cagg_daily AS (
             {% endif %}
             IN (
                 {%- for pval in comparison %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
@@ -409,11 +549,11 @@ cumulative_sum_per_event AS (
     LEFT JOIN prev_value
         ON event_table.uuidv5_customer_id = prev_value.uuidv5_customer_id
     WHERE
-       event_table.uuidv5_event_name = '{{ uuidv5_event_name }}'
-        AND event_table.organization_id = {{ organization_id }}
+       event_table.uuidv5_event_name = {{ bind(uuidv5_event_name, "uuid") }}
+        AND event_table.organization_id = {{ bind(organization_id, "integer") }}
         AND event_table.time_created <= NOW()
-        AND event_table.time_created >= '{{ start_date }}'::timestamptz
-        AND event_table.time_created <= '{{ end_date }}'::timestamptz
+        AND event_table.time_created >= {{ bind(start_date, "timestamptz") }}
+        AND event_table.time_created <= {{ bind(end_date, "timestamptz") }}
         {%- for property_name, operator, comparison in numeric_filters %}
         AND (event_table.properties ->> '{{ property_name }}')::text::decimal
             {% if operator == "gt" %}
@@ -427,7 +567,7 @@ cumulative_sum_per_event AS (
             {% elif operator == "eq" %}
             =
             {% endif %}
-            {{ comparison }}
+            {{ bind(comparison, "numeric") }}
         {%- endfor %}
         {%- for property_name, operator, comparison in categorical_filters %}
         AND (event_table.properties ->> '{{ property_name }}')
@@ -436,7 +576,7 @@ cumulative_sum_per_event AS (
             {% endif %}
             IN (
                 {%- for pval in comparison %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
@@ -450,7 +590,7 @@ proration_level_query AS (
         {%- endfor %}
         {%- if proration_units is none %}
         , MAX(cumulative_usage_qty) AS usage_qty
-        , '{{ start_date }}'::timestamptz AS time
+        , {{ bind(start_date, "timestamptz") }} AS time
         {%- else %}
         , time_bucket_gapfill('1 {{ proration_units }}', time_bucket) AS time
         , locf(
@@ -466,19 +606,19 @@ proration_level_query AS (
     FROM
         cumulative_sum_per_event
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {%- for property_name, property_values in filter_properties.items() %}
         AND {{ property_name }}
             IN (
                 {%- for pval in property_values %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
         {%- endfor %}
         AND time_bucket <= NOW()
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= {{ bind(start_date, "timestamptz") }}
+        AND time_bucket <= {{ bind(end_date, "timestamptz") }}
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -490,21 +630,21 @@ normalized_query AS (
 SELECT
     {%- if proration_units is not none %}
     CASE
-    WHEN time < '{{ start_date }}'::timestamptz
+    WHEN time < {{ bind(start_date, "timestamptz") }}
         THEN
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
-                EXTRACT( EPOCH FROM '{{ start_date }}'::timestamptz)
+                EXTRACT( EPOCH FROM {{ bind(start_date, "timestamptz") }})
             )
             /
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
                 EXTRACT( EPOCH FROM time)
             )
-    WHEN time > '{{ end_date }}'::timestamptz
+    WHEN time > {{ bind(end_date, "timestamptz") }}
         THEN
             (
-                EXTRACT( EPOCH FROM '{{ end_date }}'::timestamptz) -
+                EXTRACT( EPOCH FROM {{ bind(end_date, "timestamptz") }}) -
                 EXTRACT( EPOCH FROM time)
             )
             /
@@ -528,6 +668,7 @@ SELECT
 FROM
     normalized_query
 """
+)
 
 
 GAUGE_DELTA_DROP_OLD = """
@@ -538,7 +679,8 @@ DROP TRIGGER IF EXISTS tg_{{ cagg_name }}_delete ON "metering_billing_usageevent
 DROP FUNCTION IF EXISTS tg_refresh_{{ cagg_name }};
 """
 
-GAUGE_DELTA_GET_CURRENT_USAGE = """
+GAUGE_DELTA_GET_CURRENT_USAGE = (
+    """
 WITH cumsum_cagg_daily AS (
     SELECT
         uuidv5_customer_id
@@ -547,14 +689,16 @@ WITH cumsum_cagg_daily AS (
         {%- endfor %}
         , SUM(day_net_state_change) AS prev_days_usage_qty
     FROM
-        {{ cumsum_cagg }}
+        """
+    + _GAUGE_DELTA_STATE_SINCE_CHECKPOINT
+    + """
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {%- for property_name, property_values in filter_properties.items() %}
         AND {{ property_name }}
             IN (
                 {%- for pval in property_values %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
@@ -578,8 +722,8 @@ WITH cumsum_cagg_daily AS (
     FROM
         "metering_billing_usageevent"
     WHERE
-        "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
-        AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
+        "metering_billing_usageevent"."uuidv5_event_name" = {{ bind(uuidv5_event_name, "uuid") }}
+        AND "metering_billing_usageevent"."organization_id" = {{ bind(organization_id, "integer") }}
         AND "metering_billing_usageevent"."time_created" <= NOW()
         AND date_trunc("day", "metering_billing_usageevent"."time_created") = CURRENT_DATE
         {%- for property_name, operator, comparison in numeric_filters %}
@@ -595,7 +739,7 @@ WITH cumsum_cagg_daily AS (
             {% elif operator == "eq" %}
             =
             {% endif %}
-            {{ comparison }}
+            {{ bind(comparison, "numeric") }}
         {%- endfor %}
         {%- for property_name, operator, comparison in categorical_filters %}
         AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
@@ -604,7 +748,7 @@ WITH cumsum_cagg_daily AS (
             {% endif %}
             IN (
                 {%- for pval in comparison %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
@@ -627,6 +771,7 @@ FULL OUTER JOIN
     current_day_sum
 USING (uuidv5_customer_id {%- for group_by_field in group_by %}, {{ group_by_field }}{% endfor %});
 """
+)
 
 GAUGE_DELTA_TOTAL_PER_DAY = """
 WITH prev_value AS (
@@ -641,9 +786,9 @@ WITH prev_value AS (
     WHERE
         time_bucket <= CURRENT_DATE
         {% if uuidv5_customer_id is not none %}
-        AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        AND uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {% endif %}
-        AND time_bucket < '{{ start_date }}'::timestamptz
+        AND time_bucket < {{ bind(start_date, "timestamptz") }}
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -674,11 +819,11 @@ WITH prev_value AS (
         AND event_table.properties ->> '{{ group_by_field }}' = prev_value.{{ group_by_field }}
         {%- endfor %}
     WHERE
-        event_table.uuidv5_event_name = '{{ uuidv5_event_name }}'
-        AND event_table.organization_id = {{ organization_id }}
+        event_table.uuidv5_event_name = {{ bind(uuidv5_event_name, "uuid") }}
+        AND event_table.organization_id = {{ bind(organization_id, "integer") }}
         AND event_table.time_created <= NOW()
-        AND event_table.time_created >= '{{ start_date }}'::timestamptz
-        AND event_table.time_created <= '{{ end_date }}'::timestamptz
+        AND event_table.time_created >= {{ bind(start_date, "timestamptz") }}
+        AND event_table.time_created <= {{ bind(end_date, "timestamptz") }}
         {%- for property_name, operator, comparison in numeric_filters %}
         AND (event_table.properties ->> '{{ property_name }}')::text::decimal
             {% if operator == "gt" %}
@@ -692,7 +837,7 @@ WITH prev_value AS (
             {% elif operator == "eq" %}
             =
             {% endif %}
-            {{ comparison }}
+            {{ bind(comparison, "numeric") }}
         {%- endfor %}
         {%- for property_name, operator, comparison in categorical_filters %}
         AND (event_table.properties ->> '{{ property_name }}')
@@ -701,7 +846,7 @@ WITH prev_value AS (
             {% endif %}
             IN (
                 {%- for pval in comparison %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
@@ -727,16 +872,16 @@ WITH prev_value AS (
         cumulative_sum_per_event
     WHERE
         time_bucket <= NOW()
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= {{ bind(start_date, "timestamptz") }}
+        AND time_bucket <= {{ bind(end_date, "timestamptz") }}
         {%- if uuidv5_customer_id is not none %}
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {%- endif %}
         {%- for property_name, property_values in filter_properties.items() %}
         AND {{ property_name }}
             IN (
                 {%- for pval in property_values %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
@@ -758,10 +903,10 @@ WITH prev_value AS (
     WHERE
         time_bucket <= NOW()
         {% if uuidv5_customer_id is not none %}
-        AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        AND uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {% endif %}
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= {{ bind(start_date, "timestamptz") }}
+        AND time_bucket <= {{ bind(end_date, "timestamptz") }}
     GROUP BY
         uuidv5_customer_id
         , time_bucket
@@ -848,7 +993,8 @@ GROUP BY
     , time_bucket
 """
 
-GAUGE_TOTAL_GET_CURRENT_USAGE = """
+GAUGE_TOTAL_GET_CURRENT_USAGE = (
+    """
 SELECT
     uuidv5_customer_id
     {%- for group_by_field in group_by %}
@@ -856,14 +1002,16 @@ SELECT
     {%- endfor %}
     , last(cumulative_usage_qty, time_bucket) AS usage_qty
 FROM
-    {{ cumsum_cagg }}
+    """
+    + _GAUGE_TOTAL_STATE_SINCE_CHECKPOINT
+    + """
 WHERE
-    uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+    uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
     {%- for property_name, property_values in filter_properties.items() %}
     AND {{ property_name }}
         IN (
             {%- for pval in property_values %}
-            '{{ pval }}'
+            {{ bind(pval, "text") }}
             {%- if not loop.last %},{% endif %}
             {%- endfor %}
         )
@@ -875,8 +1023,10 @@ GROUP BY
     , {{ group_by_field }}
     {%- endfor %}
 """
+)
 
-GAUGE_TOTAL_GET_TOTAL_USAGE_WITH_PRORATION = """
+GAUGE_TOTAL_GET_TOTAL_USAGE_WITH_PRORATION = (
+    """
 WITH prev_state AS (
     SELECT
         uuidv5_customer_id
@@ -885,19 +1035,21 @@ WITH prev_state AS (
         {%- endfor %}
         , last(cumulative_usage_qty, time_bucket) AS prev_usage_qty
     FROM
-        {{ cumsum_cagg }}
+        """
+    + _GAUGE_TOTAL_STATE_SINCE_CHECKPOINT
+    + """
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {%- for property_name, property_values in filter_properties.items() %}
         AND {{ property_name }}
             IN (
                 {%- for pval in property_values %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
         {%- endfor %}
-        AND time_bucket < '{{ start_date }}'::timestamptz
+        AND time_bucket < {{ bind(start_date, "timestamptz") }}
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -922,7 +1074,7 @@ proration_level_query AS (
         {%- endfor %}
         {%- if proration_units is none %}
         , MAX(cumulative_usage_qty) AS usage_qty
-        , '{{ start_date }}'::timestamptz AS time
+        , {{ bind(start_date, "timestamptz") }} AS time
         {%- else %}
         , time_bucket_gapfill('1 {{ proration_units }}', time_bucket) AS time
         , locf(
@@ -938,19 +1090,19 @@ proration_level_query AS (
     FROM
         {{ cumsum_cagg }}
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {%- for property_name, property_values in filter_properties.items() %}
         AND {{ property_name }}
             IN (
                 {%- for pval in property_values %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
         {%- endfor %}
         AND time_bucket <= NOW()
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= {{ bind(start_date, "timestamptz") }}
+        AND time_bucket <= {{ bind(end_date, "timestamptz") }}
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -962,21 +1114,21 @@ normalized_query AS (
 SELECT
     {%- if proration_units is not none %}
     CASE
-    WHEN time < '{{ start_date }}'::timestamptz
+    WHEN time < {{ bind(start_date, "timestamptz") }}
         THEN
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
-                EXTRACT( EPOCH FROM '{{ start_date }}'::timestamptz)
+                EXTRACT( EPOCH FROM {{ bind(start_date, "timestamptz") }})
             )
             /
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
                 EXTRACT( EPOCH FROM time)
             )
-    WHEN time > '{{ end_date }}'::timestamptz
+    WHEN time > {{ bind(end_date, "timestamptz") }}
         THEN
             (
-                EXTRACT( EPOCH FROM '{{ end_date }}'::timestamptz) -
+                EXTRACT( EPOCH FROM {{ bind(end_date, "timestamptz") }}) -
                 EXTRACT( EPOCH FROM time)
             )
             /
@@ -1008,8 +1160,10 @@ SELECT
         )
     ) AS usage_qty
 """
+)
 
-GAUGE_TOTAL_GET_TOTAL_USAGE_WITH_PRORATION_PER_DAY = """
+GAUGE_TOTAL_GET_TOTAL_USAGE_WITH_PRORATION_PER_DAY = (
+    """
 WITH prev_state AS (
     SELECT
         uuidv5_customer_id
@@ -1018,19 +1172,21 @@ WITH prev_state AS (
         {%- endfor %}
         , last(cumulative_usage_qty, time_bucket) AS prev_usage_qty
     FROM
-        {{ cumsum_cagg }}
+        """
+    + _GAUGE_TOTAL_STATE_SINCE_CHECKPOINT
+    + """
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {%- for property_name, property_values in filter_properties.items() %}
         AND {{ property_name }}
             IN (
                 {%- for pval in property_values %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
         {%- endfor %}
-        AND time_bucket < '{{ start_date }}'::timestamptz
+        AND time_bucket < {{ bind(start_date, "timestamptz") }}
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -1055,7 +1211,7 @@ proration_level_query AS (
         {%- endfor %}
         {%- if proration_units is none %}
         , MAX(cumulative_usage_qty) AS usage_qty
-        , '{{ start_date }}'::timestamptz AS time
+        , {{ bind(start_date, "timestamptz") }} AS time
         {%- else %}
         , time_bucket_gapfill('1 {{ proration_units }}', time_bucket) AS time
         , locf(
@@ -1071,19 +1227,19 @@ proration_level_query AS (
     FROM
         {{ cumsum_cagg }}
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {%- for property_name, property_values in filter_properties.items() %}
         AND {{ property_name }}
             IN (
                 {%- for pval in property_values %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
         {%- endfor %}
         AND time_bucket <= NOW()
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= {{ bind(start_date, "timestamptz") }}
+        AND time_bucket <= {{ bind(end_date, "timestamptz") }}
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -1095,21 +1251,21 @@ normalized_query AS (
 SELECT
     {%- if proration_units is not none %}
     CASE
-    WHEN time < '{{ start_date }}'::timestamptz
+    WHEN time < {{ bind(start_date, "timestamptz") }}
         THEN
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
-                EXTRACT( EPOCH FROM '{{ start_date }}'::timestamptz)
+                EXTRACT( EPOCH FROM {{ bind(start_date, "timestamptz") }})
             )
             /
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
                 EXTRACT( EPOCH FROM time)
             )
-    WHEN time > '{{ end_date }}'::timestamptz
+    WHEN time > {{ bind(end_date, "timestamptz") }}
         THEN
             (
-                EXTRACT( EPOCH FROM '{{ end_date }}'::timestamptz) -
+                EXTRACT( EPOCH FROM {{ bind(end_date, "timestamptz") }}) -
                 EXTRACT( EPOCH FROM time)
             )
             /
@@ -1133,6 +1289,7 @@ SELECT
 FROM
     normalized_query
 """
+)
 
 GAUGE_TOTAL_TOTAL_PER_DAY = """
 WITH prev_value AS (
@@ -1147,9 +1304,9 @@ WITH prev_value AS (
     WHERE
         time_bucket <= CURRENT_DATE
         {% if uuidv5_customer_id is not none %}
-        AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        AND uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {% endif %}
-        AND time_bucket < '{{ start_date }}'::timestamptz
+        AND time_bucket < {{ bind(start_date, "timestamptz") }}
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -1187,16 +1344,16 @@ WITH prev_value AS (
         {{ cagg_name }}
     WHERE
         time_bucket <= NOW()
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= {{ bind(start_date, "timestamptz") }}
+        AND time_bucket <= {{ bind(end_date, "timestamptz") }}
         {% if uuidv5_customer_id is not none %}
-        AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        AND uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {%- endif %}
         {%- for property_name, property_values in filter_properties.items() %}
         AND {{ property_name }}
             IN (
                 {%- for pval in property_values %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
@@ -1218,10 +1375,10 @@ WITH prev_value AS (
     WHERE
         time_bucket <= NOW()
         {% if uuidv5_customer_id is not none %}
-        AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        AND uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {% endif %}
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= {{ bind(start_date, "timestamptz") }}
+        AND time_bucket <= {{ bind(end_date, "timestamptz") }}
     GROUP BY
         uuidv5_customer_id
         , time_bucket
@@ -0,0 +1,77 @@
+import hashlib
+import re
+from collections import OrderedDict
+
+from django.conf import settings
+
+METRIC_QUERY_PREPARED_STATEMENTS = settings.METRIC_QUERY_PREPARED_STATEMENTS
+MAX_PREPARED_STATEMENTS_PER_CONNECTION = 256
+
+PLACEHOLDER_REGEX = re.compile(r"%\((\w+)\)s")
+
+
+def execute_query(cursor, query, params, prepare=True):
+    """Run a query rendered by render_query.
+
+    By default the query is prepared once per db connection and then run with
+    EXECUTE, so the plan is reused across customers and billing records. Queries
+    using time_bucket_gapfill are sent as plain parametrized queries instead, since
+    timescale needs to see their start/end as constants to infer the gapfill range.
+    """
+    if not params:
+        cursor.execute(query)
+    elif (
+        not prepare
+        or not METRIC_QUERY_PREPARED_STATEMENTS
+        or "time_bucket_gapfill" in query.lower()
+    ):
+        cursor.execute(query, params)
+    else:
+        statement_name, param_order = _prepare(cursor, query)
+        placeholders = ", ".join(["%s"] * len(param_order))
+        cursor.execute(
+            f"EXECUTE {statement_name} ({placeholders})",
+            [params[name] for name in param_order],
+        )
+
+
+def _to_positional(query):
+    param_order = []
+    positions = {}
+
+    def replace(match):
+        name = match.group(1)
+        if name not in positions:
+            param_order.append(name)
+            positions[name] = len(param_order)
+        return f"${positions[name]}"
+
+    return PLACEHOLDER_REGEX.sub(replace, query).replace("%%", "%"), param_order
+
+
+def _prepared_statements(db):
+    # prepared statements live and die with the underlying connection, so forget
+    # about them whenever django has reconnected
+    state = getattr(db, "_prepared_metric_queries", None)
+    if state is None or state[0] is not db.connection:
+        state = (db.connection, OrderedDict())
+        db._prepared_metric_queries = state
+    return state[1]
+
+
+def _prepare(cursor, query):
+    statements = _prepared_statements(cursor.db)
+    prepared = statements.get(query)
+    if prepared is not None:
+        statements.move_to_end(query)
+        return prepared
+    positional_query, param_order = _to_positional(query)
+    statement_name = (
+        "metric_query_" + hashlib.sha1(positional_query.encode("utf-8")).hexdigest()
+    )
+    cursor.execute(f"PREPARE {statement_name} AS {positional_query}")
+    statements[query] = (statement_name, param_order)
+    if len(statements) > MAX_PREPARED_STATEMENTS_PER_CONNECTION:
+        _, (oldest_name, _) = statements.popitem(last=False)
+        cursor.execute(f"DEALLOCATE {oldest_name}")
+    return statement_name, param_order
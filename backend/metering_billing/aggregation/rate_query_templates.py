@@ -29,8 +29,8 @@ SELECT
 FROM
     "metering_billing_usageevent"
 WHERE
-    "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
-    AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
+    "metering_billing_usageevent"."uuidv5_event_name" = {{ bind(uuidv5_event_name, "uuid") }}
+    AND "metering_billing_usageevent"."organization_id" = {{ bind(organization_id, "integer") }}
     AND "metering_billing_usageevent"."time_created" <= NOW()
     {%- for property_name, operator, comparison in numeric_filters %}
     AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
@@ -45,7 +45,7 @@ WHERE
         {% elif operator == "eq" %}
         =
         {% endif %}
-        {{ comparison }}
+        {{ bind(comparison, "numeric") }}
     {%- endfor %}
     {%- for property_name, operator, comparison in categorical_filters %}
     AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')
@@ -54,19 +54,19 @@ WHERE
         {% endif %}
         IN (
             {%- for pval in comparison %}
-            '{{ pval }}'
+            {{ bind(pval, "text") }}
             {%- if not loop.last %},{% endif %}
             {%- endfor %}
         )
     {%- endfor %}
-    AND "metering_billing_usageevent"."uuidv5_customer_id" = '{{ uuidv5_customer_id }}'
-    AND "metering_billing_usageevent"."time_created" <= '{{ reference_time }}'::timestamp
-    AND "metering_billing_usageevent"."time_created" >= '{{ reference_time }}'::timestamp + INTERVAL '-1 {{ lookback_units }}' * {{ lookback_qty }}
+    AND "metering_billing_usageevent"."uuidv5_customer_id" = {{ bind(uuidv5_customer_id, "uuid") }}
+    AND "metering_billing_usageevent"."time_created" <= {{ bind(reference_time, "timestamp") }}
+    AND "metering_billing_usageevent"."time_created" >= {{ bind(reference_time, "timestamp") }} + INTERVAL '-1 {{ lookback_units }}' * {{ lookback_qty }}
     {%- for property_name, property_values in filter_properties.items() %}
     AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')
         IN (
             {%- for pval in property_values %}
-            '{{ pval }}'
+            {{ bind(pval, "text") }}
             {%- if not loop.last %},{% endif %}
             {%- endfor %}
         )
@@ -180,15 +180,15 @@ WITH rate_per_bucket AS (
     FROM
         {{ cagg_name }}
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
-        AND bucket >= '{{ start_date }}'::timestamptz - INTERVAL '{{ lookback_qty }} {{ lookback_units }}'
-        AND bucket <= '{{ end_date }}'::timestamptz
+        uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
+        AND bucket >= {{ bind(start_date, "timestamptz") }} - INTERVAL '{{ lookback_qty }} {{ lookback_units }}'
+        AND bucket <= {{ bind(end_date, "timestamptz") }}
         AND bucket <= NOW()
         {%- for property_name, property_values in filter_properties.items() %}
         AND {{ property_name }}
             IN (
                 {%- for pval in property_values %}
-                '{{ pval }}'
+                {{ bind(pval, "text") }}
                 {%- if not loop.last %},{% endif %}
                 {%- endfor %}
             )
@@ -209,15 +209,15 @@ WITH rate_per_bucket AS (
 FROM
     rate_per_bucket
 WHERE
-    uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+    uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
     AND bucket <= NOW()
-    AND bucket >= '{{ start_date }}'::timestamptz
-    AND bucket <= '{{ end_date }}'::timestamptz
+    AND bucket >= {{ bind(start_date, "timestamptz") }}
+    AND bucket <= {{ bind(end_date, "timestamptz") }}
     {%- for property_name, property_values in filter_properties.items() %}
     AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')
         IN (
             {%- for pval in property_values %}
-            '{{ pval }}'
+            {{ bind(pval, "text") }}
             {%- if not loop.last %},{% endif %}
             {%- endfor %}
         )
@@ -259,11 +259,11 @@ WITH rate_per_bucket AS (
     FROM
         {{ cagg_name }}
     WHERE
-        bucket >= '{{ start_date }}'::timestamptz - INTERVAL '{{ lookback_qty }} {{ lookback_units }}'
-        AND bucket <= '{{ end_date }}'::timestamptz
+        bucket >= {{ bind(start_date, "timestamptz") }} - INTERVAL '{{ lookback_qty }} {{ lookback_units }}'
+        AND bucket <= {{ bind(end_date, "timestamptz") }}
         AND bucket <= NOW()
         {% if uuidv5_customer_id is not none %}
-        AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        AND uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {% endif %}
 )
 , per_groupby AS (   
@@ -279,10 +279,10 @@ WITH rate_per_bucket AS (
     WHERE
         time_bucket <= NOW()
         {% if uuidv5_customer_id is not none %}
-            AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+            AND uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {% endif %}
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= {{ bind(start_date, "timestamptz") }}
+        AND time_bucket <= {{ bind(end_date, "timestamptz") }}
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -300,10 +300,10 @@ WITH rate_per_bucket AS (
     WHERE
         time_bucket <= NOW()
         {% if uuidv5_customer_id is not none %}
-        AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        AND uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
         {% endif %}
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <=  '{{ end_date }}'::timestamptz
+        AND time_bucket >= {{ bind(start_date, "timestamptz") }}
+        AND time_bucket <=  {{ bind(end_date, "timestamptz") }}
     GROUP BY
         uuidv5_customer_id
         , time_bucket_gapfill('1 day', time_bucket)
@@ -336,3 +336,37 @@ GROUP BY
     COALESCE(top_n.uuidv5_customer_id, uuid_nil())
     , per_customer.time_bucket
 """
+
+# the usage of a customer in the rate window buckets between start_date and
+# end_date, from the per second cagg. Buckets are numbered by how many of them fit
+# between the epoch and their start, like RateWindow.buckets
+RATE_WINDOW_BUCKET_USAGE = """
+SELECT
+    floor(
+        extract(epoch FROM bucket) / {{ bind(bucket_seconds, "integer") }}
+    )::bigint AS bucket_index
+    {%- if query_type == "average" %}
+    , SUM(second_usage * num_events) AS usage_total
+    {%- else %}
+    , SUM(second_usage) AS usage_total
+    {%- endif %}
+    , SUM(num_events) AS num_events
+    , MAX(second_usage) AS usage_max
+FROM
+    {{ cagg_name }}
+WHERE
+    uuidv5_customer_id = {{ bind(uuidv5_customer_id, "uuid") }}
+    AND bucket >= {{ bind(start_date, "timestamptz") }}
+    AND bucket <= {{ bind(end_date, "timestamptz") }}
+    {%- for property_name, property_values in filter_properties.items() %}
+    AND {{ property_name }}
+        IN (
+            {%- for pval in property_values %}
+            {{ bind(pval, "text") }}
+            {%- if not loop.last %},{% endif %}
+            {%- endfor %}
+        )
+    {%- endfor %}
+GROUP BY
+    bucket_index
+"""
@@ -0,0 +1,128 @@
+import threading
+from collections import OrderedDict
+from uuid import UUID
+
+from jinja2 import Template
+
+from . import (
+    common_query_templates,
+    counter_query_templates,
+    custom_query_templates,
+    gauge_query_templates,
+    rate_query_templates,
+)
+
+# custom metrics build their template out of user provided sql, so the compiled
+# cache can't just be the fixed set of templates we ship
+MAX_COMPILED_TEMPLATES = 512
+
+
+class TemplateRegistry:
+    """Compiles each SQL template once.
+
+    Rendering itself is cheap next to compiling, and the values of a query change
+    on almost every call, so rendered queries aren't kept: bind parameters are
+    collected afresh every time.
+    """
+
+    def __init__(self, max_compiled=MAX_COMPILED_TEMPLATES):
+        self.max_compiled = max_compiled
+        self._compiled = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.compilations = 0
+
+    def register(self, source):
+        return self.get_template(source)
+
+    def register_module(self, module):
+        for name in dir(module):
+            value = getattr(module, name)
+            if name.isupper() and isinstance(value, str):
+                self.register(value)
+
+    def get_template(self, source):
+        with self._lock:
+            template = self._compiled.get(source)
+            if template is not None:
+                self.hits += 1
+                self._compiled.move_to_end(source)
+                return template
+        template = Template(source)
+        with self._lock:
+            self.compilations += 1
+            self._compiled[source] = template
+            if len(self._compiled) > self.max_compiled:
+                self._compiled.popitem(last=False)
+        return template
+
+    def render(self, source, **params):
+        return self.get_template(source).render(**params)
+
+    def render_query(self, source, **params):
+        """Render a template whose values go through the bind() helper.
+
+        Returns the SQL, which only depends on the shape of the query (filters,
+        group by keys...), together with the dict of bind parameters for it.
+        """
+        bind_params = BindParams()
+        query = self.get_template(source).render(bind=bind_params.bind, **params)
+        return query, bind_params.values
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "compilations": self.compilations,
+                "compiled_templates": len(self._compiled),
+            }
+
+
+class BindParams:
+    """Collects the values of a query and hands back placeholders for them.
+
+    Placeholders are numbered in order of first appearance and equal values share
+    one, so two queries with the same shape always render to the same SQL text.
+    Every placeholder carries an explicit cast, which lets Postgres type the
+    parameters of a prepared statement without having to guess.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self._names = {}
+
+    def bind(self, value, sql_type="text"):
+        if value is None:
+            return "NULL"
+        if isinstance(value, UUID):
+            value = str(value)
+        key = (sql_type, type(value), value)
+        name = self._names.get(key)
+        if name is None:
+            name = f"p{len(self._names)}"
+            self._names[key] = name
+            self.values[name] = value
+        return f"%({name})s::{sql_type}"
+
+
+TEMPLATE_REGISTRY = TemplateRegistry()
+for _module in (
+    common_query_templates,
+    counter_query_templates,
+    custom_query_templates,
+    gauge_query_templates,
+    rate_query_templates,
+):
+    TEMPLATE_REGISTRY.register_module(_module)
+
+
+def render_template(source, **params):
+    return TEMPLATE_REGISTRY.render(source, **params)
+
+
+def render_query(source, **params):
+    return TEMPLATE_REGISTRY.render_query(source, **params)
+
+
+def template_stats():
+    return TEMPLATE_REGISTRY.stats()
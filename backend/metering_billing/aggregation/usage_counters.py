@@ -0,0 +1,610 @@
+import datetime
+import json
+import logging
+from collections import defaultdict, namedtuple
+from decimal import Decimal, InvalidOperation
+
+import pytz
+from django.conf import settings
+from django.db import connection, transaction
+from psycopg2.extras import execute_values
+
+from metering_billing.utils import convert_to_decimal, namedtuplefetchall, now_utc
+from metering_billing.utils.enums import (
+    CATEGORICAL_FILTER_OPERATORS,
+    METRIC_AGGREGATION,
+    METRIC_GRANULARITY,
+    METRIC_STATUS,
+    METRIC_TYPE,
+    NUMERIC_FILTER_OPERATORS,
+)
+
+from .prepared_statements import execute_query
+from .template_registry import render_query
+
+logger = logging.getLogger("django.server")
+
+USAGE_COUNTERS_ENABLED = settings.USAGE_COUNTERS_ENABLED
+USAGE_COUNTER_RECONCILE_INTERVAL = settings.USAGE_COUNTER_RECONCILE_INTERVAL
+RATE_WINDOWS_ENABLED = settings.RATE_WINDOWS_ENABLED
+RATE_WINDOW_BUCKETS = settings.RATE_WINDOW_BUCKETS
+
+# Per billing record running totals of counter metrics. The consumer adds the
+# events it writes to them, in the same transaction, so reading the current usage
+# of a billing record is a single row lookup. Counters are created and reconciled
+# against the caggs by a periodic task, for the billing records that are running,
+# every USAGE_COUNTER_RECONCILE_INTERVAL seconds to catch anything they missed
+# (late events, filter changes, events not written by the consumer). Reads never
+# write: a counter that doesn't exist yet or missed its reconciliation is ignored,
+# and the usage calculated from the caggs. Invoicing never reads them, the caggs
+# stay the source of truth.
+
+ADDITIVE_AGGREGATIONS = (METRIC_AGGREGATION.COUNT, METRIC_AGGREGATION.SUM)
+
+INCREMENT_USAGE_COUNTERS = """
+UPDATE metering_billing_usagecounter AS counter
+SET value = counter.value + increment.delta
+FROM (VALUES %s) AS increment (id, delta)
+WHERE counter.id = increment.id
+"""
+
+
+def supports_usage_counter(metric):
+    return (
+        USAGE_COUNTERS_ENABLED
+        and metric.metric_type == METRIC_TYPE.COUNTER
+        and metric.usage_aggregation_type in ADDITIVE_AGGREGATIONS
+    )
+
+
+def _property_text(properties, property_name):
+    # what properties ->> property_name evaluates to in postgres
+    value = properties.get(property_name)
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float, Decimal)):
+        # jsonb numbers are numerics, which never print with an exponent
+        number = Decimal(repr(value)) if isinstance(value, float) else Decimal(value)
+        return format(number, "f")
+    return json.dumps(value)
+
+
+def _property_decimal(properties, property_name):
+    value = _property_text(properties, property_name)
+    if value is None:
+        return None
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        return None
+
+
+def _passes_numeric_filter(properties, property_name, operator, comparison):
+    value = _property_decimal(properties, property_name)
+    if value is None:
+        return False
+    comparison = Decimal(str(comparison))
+    if operator == NUMERIC_FILTER_OPERATORS.GTE:
+        return value >= comparison
+    elif operator == NUMERIC_FILTER_OPERATORS.GT:
+        return value > comparison
+    elif operator == NUMERIC_FILTER_OPERATORS.EQ:
+        return value == comparison
+    elif operator == NUMERIC_FILTER_OPERATORS.LT:
+        return value < comparison
+    elif operator == NUMERIC_FILTER_OPERATORS.LTE:
+        return value <= comparison
+    return False
+
+
+def _passes_categorical_filter(properties, property_name, operator, comparison):
+    value = _property_text(properties, property_name) or ""
+    if operator == CATEGORICAL_FILTER_OPERATORS.ISIN:
+        return value in comparison
+    return value not in comparison
+
+
+class _CounterMatcher:
+    """Decides which events a counter counts, the same way the counter caggs do.
+
+    lookback extends the period backwards, for rate windows whose first window
+    reaches into the previous period.
+    """
+
+    __slots__ = (
+        "counter",
+        "period_start",
+        "aggregation",
+        "property_name",
+        "subscription_filters",
+        "numeric_filters",
+        "categorical_filters",
+    )
+
+    def __init__(self, counter, lookback=datetime.timedelta(0)):
+        metric = counter.metric
+        self.counter = counter
+        self.period_start = counter.period_start - lookback
+        self.aggregation = metric.usage_aggregation_type
+        self.property_name = metric.property_name
+        self.subscription_filters = [
+            (key, value)
+            for key, value in counter.billing_record.subscription.subscription_filters
+        ]
+        self.numeric_filters = [
+            (x.property_name, x.operator, x.comparison_value)
+            for x in metric.numeric_filters.all()
+        ]
+        self.categorical_filters = [
+            (x.property_name, x.operator, [str(v) for v in x.comparison_value])
+            for x in metric.categorical_filters.all()
+        ]
+
+    def delta(self, properties, time_created):
+        """How much an event adds to the counter, None if it doesn't count"""
+        counter = self.counter
+        if not self.period_start <= time_created <= counter.period_end:
+            return None
+        for key, value in self.subscription_filters:
+            if _property_text(properties, key) != value:
+                return None
+        for filter in self.numeric_filters:
+            if not _passes_numeric_filter(properties, *filter):
+                return None
+        for filter in self.categorical_filters:
+            if not _passes_categorical_filter(properties, *filter):
+                return None
+        if self.aggregation == METRIC_AGGREGATION.COUNT:
+            return Decimal(1)
+        return _property_decimal(properties, self.property_name)
+
+
+def increment_usage_counters(events):
+    """Add freshly written events to the usage counters they count towards.
+
+    events are (organization_pk, cust_id, event_name, properties, time_created)
+    tuples for the events that were actually inserted. Call it in the transaction
+    that inserted them, so that the counters and the events commit together.
+    Returns the number of counters that were updated.
+    """
+    from metering_billing.models import UsageCounter
+
+    if not USAGE_COUNTERS_ENABLED:
+        return 0
+    now = now_utc()
+    # like the caggs, don't count events from the future until they've happened,
+    # reconciliation picks them up then
+    events = [event for event in events if event[4] <= now]
+    if len(events) == 0:
+        return 0
+    counters = (
+        UsageCounter.objects.filter(
+            organization_id__in={event[0] for event in events},
+            customer__customer_id__in={event[1] for event in events},
+            metric__event_name__in={event[2] for event in events},
+            metric__metric_type=METRIC_TYPE.COUNTER,
+            metric__usage_aggregation_type__in=ADDITIVE_AGGREGATIONS,
+            period_start__lte=max(event[4] for event in events),
+            period_end__gte=min(event[4] for event in events),
+        )
+        .select_related("metric", "customer", "billing_record__subscription")
+        .prefetch_related("metric__numeric_filters", "metric__categorical_filters")
+    )
+    matchers = defaultdict(list)
+    for counter in counters:
+        key = (
+            counter.organization_id,
+            counter.customer.customer_id,
+            counter.metric.event_name,
+        )
+        matchers[key].append(_CounterMatcher(counter))
+    if len(matchers) == 0:
+        return 0
+    deltas = defaultdict(Decimal)
+    for organization_pk, cust_id, event_name, properties, time_created in events:
+        for matcher in matchers.get((organization_pk, cust_id, event_name), []):
+            delta = matcher.delta(properties, time_created)
+            if delta is not None:
+                deltas[matcher.counter.pk] += delta
+    deltas = {pk: delta for pk, delta in deltas.items() if delta != 0}
+    if len(deltas) == 0:
+        return 0
+    with connection.cursor() as cursor:
+        # sorted so concurrent consumers lock the counter rows in the same order
+        execute_values(
+            cursor.cursor,
+            INCREMENT_USAGE_COUNTERS,
+            sorted(deltas.items()),
+            template="(%s::bigint, %s::numeric)",
+            page_size=len(deltas),
+        )
+    return len(deltas)
+
+
+def reconcile_usage_counter(metric, billing_record):
+    """Recalculate a billing record's counter from the continuous aggregates.
+
+    Creates the counter if it doesn't exist yet. The row stays locked while the
+    usage is recalculated, so increments from events being written at the same time
+    wait for it and land on top of the new value. Only called from the periodic
+    task, never when reading the usage.
+    """
+    from metering_billing.aggregation.billable_metrics import CounterHandler
+    from metering_billing.models import UsageCounter
+
+    with transaction.atomic():
+        counter, _ = UsageCounter.objects.get_or_create(
+            billing_record=billing_record,
+            defaults={
+                "organization_id": billing_record.organization_id,
+                "metric": metric,
+                "customer_id": billing_record.customer_id,
+                "period_start": billing_record.start_date,
+                "period_end": billing_record.end_date,
+            },
+        )
+        counter = UsageCounter.objects.select_for_update().get(pk=counter.pk)
+        usage = CounterHandler.get_billing_record_total_billable_usage(
+            metric, billing_record
+        )
+        counter.metric = metric
+        counter.customer_id = billing_record.customer_id
+        counter.period_start = billing_record.start_date
+        counter.period_end = billing_record.end_date
+        counter.value = convert_to_decimal(usage)
+        counter.reconciled_at = now_utc()
+        counter.save()
+    return usage
+
+
+def _is_fresh(counter, metric, billing_record, intervals=1):
+    """Whether the counter was reconciled in the last intervals reconcile intervals.
+
+    The task reconciles counters older than one interval. Reads accept two, so a
+    counter isn't dropped while it waits for the next run of the task.
+    """
+    if counter.reconciled_at is None:
+        return False
+    if (
+        counter.metric_id != metric.pk
+        or counter.period_start != billing_record.start_date
+        or counter.period_end != billing_record.end_date
+    ):
+        return False
+    interval = datetime.timedelta(seconds=USAGE_COUNTER_RECONCILE_INTERVAL)
+    return now_utc() - counter.reconciled_at < interval * intervals
+
+
+def get_counter_usage(metric, billing_record):
+    """Current usage of a billing record, read from its counter.
+
+    Returns None if the metric doesn't keep counters, or the billing record's
+    counter isn't there or reconciled yet, in which case the usage has to be
+    calculated from the caggs as usual.
+    """
+    from metering_billing.models import UsageCounter
+
+    if not supports_usage_counter(metric):
+        return None
+    counter = UsageCounter.objects.filter(billing_record=billing_record).first()
+    if counter is not None and _is_fresh(counter, metric, billing_record, 2):
+        return counter.value
+    return None
+
+
+# Rate windows do for the current usage of rate metrics what counters do for
+# counter metrics. The lookback window of the metric is split into
+# RATE_WINDOW_BUCKETS buckets, and a RateWindow keeps a ring of the usage in the
+# latest of them, one more than the window needs. The rate at any point in time is
+# read off the ring like a sliding window counter: the buckets entirely in the
+# window, plus the part of the oldest one that still is, pro rata (MAX counts all of
+# it). The highest rate of the period is updated at every event, which is when the
+# rate goes up. Both can be off by the events of one bucket at the edge of the
+# window, so they only serve periods that are still running. Invoices are made
+# from the caggs once the period is over.
+
+# rate windows need a fixed length lookback, months and longer don't have one
+RATE_WINDOW_SECONDS = {
+    METRIC_GRANULARITY.SECOND: 1,
+    METRIC_GRANULARITY.MINUTE: 60,
+    METRIC_GRANULARITY.HOUR: 60 * 60,
+    METRIC_GRANULARITY.DAY: 60 * 60 * 24,
+}
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.UTC)
+
+RateWindowUsage = namedtuple("RateWindowUsage", ["current_usage", "max_usage"])
+
+
+def supports_rate_window(metric):
+    return (
+        RATE_WINDOWS_ENABLED
+        and metric.metric_type == METRIC_TYPE.RATE
+        and metric.granularity in RATE_WINDOW_SECONDS
+    )
+
+
+def _rate_window_bucket_seconds(metric):
+    # the cagg has one second buckets, so nothing finer can be reconciled
+    return max(RATE_WINDOW_SECONDS[metric.granularity] // RATE_WINDOW_BUCKETS, 1)
+
+
+def _ring_size(window_seconds, bucket_seconds):
+    # a window that doesn't start on a bucket boundary touches one more bucket
+    return -(-window_seconds // bucket_seconds) + 1
+
+
+def _bucket_index(time, bucket_seconds):
+    return int((time - _EPOCH).total_seconds() // bucket_seconds)
+
+
+def _add_to_ring(ring, index, value):
+    """Add an event's value to its bucket. False if the ring has moved past it"""
+    position = index % len(ring)
+    slot = ring[position]
+    if slot is not None and slot[0] > index:
+        return False
+    if slot is None or slot[0] < index:
+        slot = [index, "0", 0, None]
+    maximum = value if slot[3] is None else max(Decimal(slot[3]), value)
+    ring[position] = [index, str(Decimal(slot[1]) + value), slot[2] + 1, str(maximum)]
+    return True
+
+
+def _window_usage(ring, aggregation, window_seconds, bucket_seconds, time):
+    """The usage over the lookback window that ends at time"""
+    window_start = (time - _EPOCH).total_seconds() - window_seconds
+    oldest = int(window_start // bucket_seconds)
+    newest = _bucket_index(time, bucket_seconds)
+    total = Decimal(0)
+    num_events = Decimal(0)
+    maximum = None
+    for index in range(oldest, newest + 1):
+        slot = ring[index % len(ring)]
+        if slot is None or slot[0] != index:
+            continue
+        weight = Decimal(1)
+        if index == oldest:
+            inside = (oldest + 1) * bucket_seconds - window_start
+            weight = Decimal(str(round(inside / bucket_seconds, 6)))
+        total += Decimal(slot[1]) * weight
+        num_events += slot[2] * weight
+        if slot[3] is not None and (maximum is None or Decimal(slot[3]) > maximum):
+            maximum = Decimal(slot[3])
+    if aggregation == METRIC_AGGREGATION.MAX:
+        return maximum or Decimal(0)
+    if aggregation == METRIC_AGGREGATION.AVERAGE:
+        return total / num_events if num_events else Decimal(0)
+    return total
+
+
+def increment_rate_windows(events):
+    """Add freshly written events to the rate windows they count towards.
+
+    Takes the same events as increment_usage_counters, and has to be called in the
+    transaction that inserted them too. Returns the number of windows updated.
+    """
+    from metering_billing.models import RateWindow
+
+    if not RATE_WINDOWS_ENABLED:
+        return 0
+    now = now_utc()
+    events = sorted(
+        (event for event in events if event[4] <= now), key=lambda event: event[4]
+    )
+    if len(events) == 0:
+        return 0
+    # a window that starts in the previous period can count its last events
+    lookback = datetime.timedelta(seconds=max(RATE_WINDOW_SECONDS.values()))
+    windows = (
+        RateWindow.objects.select_for_update(of=("self",))
+        .filter(
+            organization_id__in={event[0] for event in events},
+            customer__customer_id__in={event[1] for event in events},
+            metric__event_name__in={event[2] for event in events},
+            metric__metric_type=METRIC_TYPE.RATE,
+            period_start__lte=events[-1][4] + lookback,
+            period_end__gte=events[0][4],
+        )
+        .select_related("metric", "customer", "billing_record__subscription")
+        .prefetch_related("metric__numeric_filters", "metric__categorical_filters")
+        # locked in the same order by concurrent consumers
+        .order_by("pk")
+    )
+    matchers = defaultdict(list)
+    for window in windows:
+        if window.metric.granularity not in RATE_WINDOW_SECONDS:
+            continue
+        window_seconds = RATE_WINDOW_SECONDS[window.metric.granularity]
+        if len(window.buckets) != _ring_size(window_seconds, window.bucket_seconds):
+            continue
+        key = (
+            window.organization_id,
+            window.customer.customer_id,
+            window.metric.event_name,
+        )
+        matcher = _CounterMatcher(window, datetime.timedelta(seconds=window_seconds))
+        matchers[key].append((matcher, window_seconds))
+    changed = {}
+    for organization_pk, cust_id, event_name, properties, time_created in events:
+        for matcher, window_seconds in matchers.get(
+            (organization_pk, cust_id, event_name), []
+        ):
+            value = matcher.delta(properties, time_created)
+            if value is None:
+                continue
+            window = matcher.counter
+            changed[window.pk] = window
+            index = _bucket_index(time_created, window.bucket_seconds)
+            if not _add_to_ring(window.buckets, index, value):
+                # too late for the ring, the next read reconciles it
+                window.reconciled_at = None
+                continue
+            if time_created < window.period_start:
+                continue
+            usage = _window_usage(
+                window.buckets,
+                window.metric.usage_aggregation_type,
+                window_seconds,
+                window.bucket_seconds,
+                time_created,
+            )
+            if usage > window.max_usage:
+                window.max_usage = usage
+    if len(changed) == 0:
+        return 0
+    RateWindow.objects.bulk_update(
+        changed.values(), ["buckets", "max_usage", "reconciled_at"]
+    )
+    return len(changed)
+
+
+def reconcile_rate_window(metric, billing_record):
+    """Rebuild a billing record's rate window from the continuous aggregate.
+
+    Creates the window if it doesn't exist yet, and keeps it locked while it's
+    rebuilt, like reconcile_usage_counter. Only called from the periodic task too.
+    """
+    from metering_billing.aggregation.billable_metrics import RateHandler
+    from metering_billing.models import RateWindow
+
+    from .rate_query_templates import RATE_WINDOW_BUCKET_USAGE
+
+    window_seconds = RATE_WINDOW_SECONDS[metric.granularity]
+    bucket_seconds = _rate_window_bucket_seconds(metric)
+    size = _ring_size(window_seconds, bucket_seconds)
+    with transaction.atomic():
+        window, _ = RateWindow.objects.get_or_create(
+            billing_record=billing_record,
+            defaults={
+                "organization_id": billing_record.organization_id,
+                "metric": metric,
+                "customer_id": billing_record.customer_id,
+                "period_start": billing_record.start_date,
+                "period_end": billing_record.end_date,
+                "bucket_seconds": bucket_seconds,
+            },
+        )
+        window = RateWindow.objects.select_for_update().get(pk=window.pk)
+        now = now_utc()
+        newest = _bucket_index(now, bucket_seconds)
+        injection_dict = {
+            "query_type": metric.usage_aggregation_type,
+            "cagg_name": RateHandler.continuous_aggregate_names(metric)[0],
+            "uuidv5_customer_id": billing_record.customer.uuidv5_customer_id,
+            "bucket_seconds": bucket_seconds,
+            "start_date": _EPOCH
+            + datetime.timedelta(seconds=(newest - size + 1) * bucket_seconds),
+            "end_date": now,
+            "filter_properties": {},
+        }
+        for filter in billing_record.subscription.subscription_filters:
+            injection_dict["filter_properties"][filter[0]] = [filter[1]]
+        query, params = render_query(RATE_WINDOW_BUCKET_USAGE, **injection_dict)
+        with connection.cursor() as cursor:
+            execute_query(cursor, query, params)
+            rows = namedtuplefetchall(cursor)
+        ring = [None] * size
+        for row in rows:
+            ring[row.bucket_index % size] = [
+                row.bucket_index,
+                str(convert_to_decimal(row.usage_total or 0)),
+                int(row.num_events),
+                None if row.usage_max is None else str(row.usage_max),
+            ]
+        results = RateHandler._rate_cagg_total_results(metric, billing_record)
+        window.metric = metric
+        window.customer_id = billing_record.customer_id
+        window.period_start = billing_record.start_date
+        window.period_end = billing_record.end_date
+        window.bucket_seconds = bucket_seconds
+        window.buckets = ring
+        window.max_usage = convert_to_decimal(
+            (results[0].usage_qty if results else None) or 0
+        )
+        window.reconciled_at = now
+        window.save()
+    return window
+
+
+def get_rate_window_usage(metric, billing_record):
+    """Current and highest rate of a billing record, read from its rate window.
+
+    Returns None if the metric doesn't keep rate windows, or the billing record's
+    window isn't there or reconciled yet, in which case the usage has to be
+    calculated from the events and the cagg as usual.
+    """
+    from metering_billing.models import RateWindow
+
+    if not supports_rate_window(metric):
+        return None
+    window = RateWindow.objects.filter(billing_record=billing_record).first()
+    if (
+        window is None
+        or not _is_fresh(window, metric, billing_record, 2)
+        or window.bucket_seconds != _rate_window_bucket_seconds(metric)
+    ):
+        return None
+    current_usage = _window_usage(
+        window.buckets,
+        metric.usage_aggregation_type,
+        RATE_WINDOW_SECONDS[metric.granularity],
+        window.bucket_seconds,
+        now_utc(),
+    )
+    return RateWindowUsage(current_usage, window.max_usage)
+
+
+def reconcile_all_usage_counters(now=None):
+    """Reconcile the counters and rate windows of running billing records that are due.
+
+    Creates the ones that don't exist yet too. Returns how many were reconciled.
+    """
+    from metering_billing.models import BillingRecord, RateWindow, UsageCounter
+
+    if not USAGE_COUNTERS_ENABLED and not RATE_WINDOWS_ENABLED:
+        return 0
+    now = now or now_utc()
+    billing_records = BillingRecord.objects.filter(
+        start_date__lte=now,
+        end_date__gte=now,
+        component__billable_metric__metric_type__in=[
+            METRIC_TYPE.COUNTER,
+            METRIC_TYPE.RATE,
+        ],
+        component__billable_metric__status=METRIC_STATUS.ACTIVE,
+    ).select_related(
+        "component__billable_metric", "customer", "organization", "subscription"
+    )
+    counters = {
+        counter.billing_record_id: counter
+        for counter in UsageCounter.objects.filter(billing_record__in=billing_records)
+    }
+    windows = {
+        window.billing_record_id: window
+        for window in RateWindow.objects.filter(billing_record__in=billing_records)
+    }
+    num_reconciled = 0
+    for billing_record in billing_records:
+        metric = billing_record.component.billable_metric
+        try:
+            if supports_usage_counter(metric):
+                counter = counters.get(billing_record.pk)
+                if counter is None or not _is_fresh(counter, metric, billing_record):
+                    reconcile_usage_counter(metric, billing_record)
+                    num_reconciled += 1
+            elif supports_rate_window(metric):
+                window = windows.get(billing_record.pk)
+                if (
+                    window is None
+                    or not _is_fresh(window, metric, billing_record)
+                    or window.bucket_seconds != _rate_window_bucket_seconds(metric)
+                ):
+                    reconcile_rate_window(metric, billing_record)
+                    num_reconciled += 1
+        except Exception as e:
+            # the usage is calculated from the caggs until the next try
+            logger.error(f"Could not reconcile usage counter of {billing_record}: {e}")
+    return num_reconciled
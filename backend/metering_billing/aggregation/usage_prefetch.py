@@ -0,0 +1,67 @@
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import sentry_sdk
+
+logger = logging.getLogger("django.server")
+
+_prefetched_usage = ContextVar("prefetched_billable_usage", default=None)
+
+
+def _usage_key(metric, billing_record):
+    # the dates are part of the key so that a billing record that gets its period
+    # changed after the prefetch goes back to being calculated on its own
+    return (
+        metric.pk,
+        billing_record.pk,
+        billing_record.start_date,
+        billing_record.end_date,
+    )
+
+
+@contextmanager
+def prefetch_billable_usage(billing_records):
+    """Calculate the billable usage of many billing records up front.
+
+    Records are grouped by metric and each metric resolves all of its records with
+    get_total_billable_usage_bulk. While the context is active,
+    Metric.get_billing_record_total_billable_usage answers from these results
+    instead of querying each billing record on its own.
+    """
+    records_by_metric = defaultdict(list)
+    metrics = {}
+    for billing_record in billing_records:
+        if billing_record.component is None:
+            continue
+        metric = billing_record.component.billable_metric
+        metrics[metric.pk] = metric
+        records_by_metric[metric.pk].append(billing_record)
+    usage = {}
+    for metric_pk, metric_billing_records in records_by_metric.items():
+        metric = metrics[metric_pk]
+        try:
+            metric_usage = metric.get_total_billable_usage_bulk(metric_billing_records)
+        except Exception as e:
+            # not fatal, these records will just be calculated one by one
+            sentry_sdk.capture_exception(e)
+            logger.error(f"Could not prefetch usage for metric {metric}: {e}")
+            continue
+        for billing_record in metric_billing_records:
+            if billing_record.pk in metric_usage:
+                usage[_usage_key(metric, billing_record)] = metric_usage[
+                    billing_record.pk
+                ]
+    token = _prefetched_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _prefetched_usage.reset(token)
+
+
+def get_prefetched_billable_usage(metric, billing_record):
+    usage = _prefetched_usage.get()
+    if not usage:
+        return None
+    return usage.get(_usage_key(metric, billing_record))
@@ -0,0 +1,288 @@
+import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+
+from metering_billing.utils import now_utc
+from metering_billing.utils.enums import METRIC_STATUS, METRIC_TYPE
+
+# Once the period of a billing record is over and it has been invoiced, its usage
+# can't change anymore unless events are backfilled, but it is calculated from the
+# aggregates again every time an invoice, a report or the customer's usage page
+# asks for it. Instead, it is stored in a UsageResult the first time it's
+# calculated after the period is final, and read from there afterwards. Results
+# are keyed on USAGE_RESULT_VERSION: bump it whenever a change to the handlers
+# would give a different usage for the same events, and the old results are
+# ignored. Anything that writes events into closed periods has to invalidate them:
+# backfills, once they've refreshed the aggregates, and the event consumer for late
+# events from the track endpoints. Those can be below the materialization watermark
+# of the aggregates until their next refresh, so the consumer also marks them as
+# pending, and no result overlapping them is stored until the refresh jobs have run.
+USAGE_RESULT_VERSION = 1
+
+# same grace period _get_subscription_records_to_invoice gives late events
+INVOICE_GRACE_PERIOD = datetime.timedelta(minutes=30)
+USAGE_RESULT_LATE_EVENT_TOLERANCE = datetime.timedelta(
+    seconds=settings.USAGE_RESULT_LATE_EVENT_TOLERANCE
+)
+# a refresh has to start this long after late events were marked to be sure the
+# transaction that wrote them had committed
+LATE_EVENT_COMMIT_MARGIN = datetime.timedelta(minutes=1)
+
+# when each cagg's refresh job last started a run that went through
+CAGG_LAST_REFRESHES = """
+SELECT
+    caggs.view_name,
+    stats.last_run_started_at
+FROM
+    timescaledb_information.jobs AS jobs
+    INNER JOIN timescaledb_information.continuous_aggregates AS caggs
+        ON jobs.hypertable_schema = caggs.materialization_hypertable_schema
+        AND jobs.hypertable_name = caggs.materialization_hypertable_name
+    INNER JOIN timescaledb_information.job_stats AS stats
+        ON stats.job_id = jobs.job_id
+WHERE
+    caggs.view_name = ANY(%s)
+    AND jobs.proc_name = 'policy_refresh_continuous_aggregate'
+    AND stats.last_run_status = 'Success'
+"""
+
+
+def usage_is_final(billing_record, now=None):
+    """Whether the period of the billing record is over, invoicing grace included"""
+    now = now or now_utc()
+    return (
+        billing_record.end_date
+        + INVOICE_GRACE_PERIOD
+        + USAGE_RESULT_LATE_EVENT_TOLERANCE
+        < now
+    )
+
+
+def _usage_results(metric, billing_records):
+    from metering_billing.models import UsageResult
+
+    return UsageResult.objects.filter(
+        metric=metric,
+        billing_record__in=billing_records,
+        computation_version=USAGE_RESULT_VERSION,
+    )
+
+
+def _matches_period(usage_result, billing_record):
+    # a billing record whose period changed afterwards is calculated again
+    return (
+        usage_result.period_start == billing_record.start_date
+        and usage_result.period_end == billing_record.end_date
+    )
+
+
+def get_cached_total_usages(metric, billing_records):
+    """Stored total usage of the billing records that have one, keyed by their pk"""
+    billing_records = {
+        billing_record.pk: billing_record
+        for billing_record in billing_records
+        if usage_is_final(billing_record)
+    }
+    if len(billing_records) == 0:
+        return {}
+    usage = {}
+    for usage_result in _usage_results(metric, list(billing_records)).exclude(
+        usage_qty__isnull=True
+    ):
+        billing_record = billing_records[usage_result.billing_record_id]
+        if _matches_period(usage_result, billing_record):
+            usage[billing_record.pk] = usage_result.usage_qty
+    return usage
+
+
+def get_cached_total_usage(metric, billing_record):
+    return get_cached_total_usages(metric, [billing_record]).get(billing_record.pk)
+
+
+def get_cached_daily_usage(metric, billing_record):
+    if not usage_is_final(billing_record):
+        return None
+    usage_result = (
+        _usage_results(metric, [billing_record])
+        .exclude(daily_usage__isnull=True)
+        .first()
+    )
+    if usage_result is None or not _matches_period(usage_result, billing_record):
+        return None
+    return {
+        datetime.date.fromisoformat(date): Decimal(usage_qty)
+        for date, usage_qty in usage_result.daily_usage.items()
+    }
+
+
+def _has_pending_late_events(metric, billing_record):
+    from metering_billing.models import PendingLateEvents
+
+    return PendingLateEvents.objects.filter(
+        organization_id=metric.organization_id,
+        cust_id=billing_record.customer.customer_id,
+        event_name=metric.event_name,
+        start__lte=billing_record.end_date,
+        end__gte=billing_record.start_date,
+    ).exists()
+
+
+def _store(metric, billing_record, **fields):
+    from metering_billing.models import UsageResult
+
+    if metric.metric_type == METRIC_TYPE.CUSTOM or not usage_is_final(billing_record):
+        # custom metrics can read anything, there's nothing telling when they change
+        return
+    if _has_pending_late_events(metric, billing_record):
+        # the usage may not include them yet
+        return
+    try:
+        with transaction.atomic():
+            UsageResult.objects.update_or_create(
+                billing_record=billing_record,
+                metric=metric,
+                computation_version=USAGE_RESULT_VERSION,
+                defaults={
+                    "organization_id": metric.organization_id,
+                    "period_start": billing_record.start_date,
+                    "period_end": billing_record.end_date,
+                    **fields,
+                },
+            )
+    except IntegrityError:
+        # stored concurrently, from the same events
+        pass
+
+
+def store_total_usage(metric, billing_record, usage_qty):
+    if usage_qty is None:
+        return
+    _store(metric, billing_record, usage_qty=usage_qty)
+
+
+def store_daily_usage(metric, billing_record, daily_usage):
+    _store(
+        metric,
+        billing_record,
+        daily_usage={
+            date.isoformat(): str(usage_qty) for date, usage_qty in daily_usage.items()
+        },
+    )
+
+
+def invalidate_usage_results(organization, event_name=None, start=None, end=None):
+    """Delete the stored usage of periods that overlap start to end.
+
+    Without event_name, the results of every metric of the organization are
+    deleted. Returns how many were.
+    """
+    from metering_billing.models import UsageResult
+
+    usage_results = UsageResult.objects.filter(organization=organization)
+    if event_name is not None:
+        usage_results = usage_results.filter(metric__event_name=event_name)
+    if start is not None:
+        usage_results = usage_results.filter(period_end__gte=start)
+    if end is not None:
+        usage_results = usage_results.filter(period_start__lte=end)
+    num_deleted, _ = usage_results.delete()
+    return num_deleted
+
+
+def invalidate_late_event_usage_results(events):
+    """Delete the stored usage of the final periods freshly written events fall in.
+
+    The events are marked as pending too, until the aggregates have been refreshed.
+    events are (organization_pk, cust_id, event_name, properties, time_created)
+    tuples, like for increment_usage_counters. Call it in the transaction that
+    wrote them. Returns how many results were deleted.
+    """
+    from metering_billing.models import PendingLateEvents, UsageResult
+
+    # an event newer than this can't be in a final period, which leaves out
+    # everything but the stragglers
+    final_before = now_utc() - INVOICE_GRACE_PERIOD - USAGE_RESULT_LATE_EVENT_TOLERANCE
+    time_ranges = {}
+    for organization_pk, cust_id, event_name, _, time_created in events:
+        if time_created >= final_before:
+            continue
+        key = (organization_pk, cust_id, event_name)
+        if key in time_ranges:
+            start, end = time_ranges[key]
+            time_ranges[key] = (min(start, time_created), max(end, time_created))
+        else:
+            time_ranges[key] = (time_created, time_created)
+    if len(time_ranges) == 0:
+        return 0
+    PendingLateEvents.objects.bulk_create(
+        [
+            PendingLateEvents(
+                organization_id=key[0],
+                cust_id=key[1],
+                event_name=key[2],
+                start=start,
+                end=end,
+            )
+            for key, (start, end) in time_ranges.items()
+        ]
+    )
+    overlapping = Q()
+    for (organization_pk, cust_id, event_name), (start, end) in time_ranges.items():
+        overlapping |= Q(
+            organization_id=organization_pk,
+            billing_record__customer__customer_id=cust_id,
+            metric__event_name=event_name,
+            period_start__lte=end,
+            period_end__gte=start,
+        )
+    num_deleted, _ = UsageResult.objects.filter(overlapping).delete()
+    return num_deleted
+
+
+def _last_refreshes(cagg_names):
+    with connection.cursor() as cursor:
+        cursor.execute(CAGG_LAST_REFRESHES, [list(cagg_names)])
+        return dict(cursor.fetchall())
+
+
+def clear_materialized_late_events():
+    """Drop the pending late events the aggregates have been refreshed with since.
+
+    That's once the refresh job of every continuous aggregate of the metrics on
+    their event name has started a successful run after they were marked. Returns
+    how many were dropped.
+    """
+    from metering_billing.aggregation.billable_metrics import METRIC_HANDLER_MAP
+    from metering_billing.models import Metric, PendingLateEvents
+
+    pending = list(PendingLateEvents.objects.all())
+    if len(pending) == 0:
+        return 0
+    cagg_names = {}
+    for metric in Metric.objects.filter(
+        organization_id__in={x.organization_id for x in pending},
+        event_name__in={x.event_name for x in pending},
+        status=METRIC_STATUS.ACTIVE,
+    ).exclude(metric_type=METRIC_TYPE.CUSTOM):
+        handler = METRIC_HANDLER_MAP[metric.metric_type]
+        cagg_names.setdefault((metric.organization_id, metric.event_name), []).extend(
+            handler.continuous_aggregate_names(metric)
+        )
+    last_refreshes = _last_refreshes(
+        {name for names in cagg_names.values() for name in names}
+    )
+    materialized = []
+    for late_events in pending:
+        refreshed_after = late_events.marked_at + LATE_EVENT_COMMIT_MARGIN
+        if all(
+            name in last_refreshes and last_refreshes[name] > refreshed_after
+            for name in cagg_names.get(
+                (late_events.organization_id, late_events.event_name), []
+            )
+        ):
+            materialized.append(late_events.pk)
+    PendingLateEvents.objects.filter(pk__in=materialized).delete()
+    return len(materialized)
@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import sentry_sdk
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+
+from metering_billing.utils import now_utc
+
+logger = logging.getLogger("django.server")
+
+API_KEY_LOCAL_CACHE_TTL = settings.API_KEY_LOCAL_CACHE_TTL
+API_KEY_NEGATIVE_CACHE_TTL = settings.API_KEY_NEGATIVE_CACHE_TTL
+API_KEY_REVOCATION_CHECK_INTERVAL = settings.API_KEY_REVOCATION_CHECK_INTERVAL
+MAX_LOCAL_API_KEYS = 10000
+
+# API key -> organization pk resolution goes through three layers: a small LRU in
+# each process, the shared cache, and finally the database, where checking the key
+# means hashing it. Keys that turn out not to be valid are remembered too, in both
+# caches, so that a flood of bad keys doesn't turn into a flood of hashing.
+#
+# Revoking or deleting a key clears it from the shared cache and bumps a revocation
+# version there. Every process compares that version with the one it last saw at
+# most every API_KEY_REVOCATION_CHECK_INTERVAL seconds, and drops its local entries
+# when it changed.
+
+REVOCATION_VERSION_KEY = "api_key_revocation_version"
+
+
+def _default_timeout(expiry_date):
+    if expiry_date is None:
+        return 60 * 60 * 24
+    return (expiry_date - now_utc()).total_seconds()
+
+
+def _invalid_key_cache_key(key):
+    return "invalid_api_key_" + hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class LocalAPIKeyCache:
+    """Per process LRU of API key -> organization pk, None for invalid keys"""
+
+    def __init__(self, max_size=MAX_LOCAL_API_KEYS):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._revocation_version = None
+        self._next_revocation_check = 0
+
+    def get(self, key):
+        """Returns (found, organization pk)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            organization_pk, expires_at = entry
+            if expires_at <= now:
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, organization_pk
+
+    def set(self, key, organization_pk, timeout):
+        timeout = min(timeout, API_KEY_LOCAL_CACHE_TTL)
+        if timeout <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (organization_pk, time.monotonic() + timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                del self._entries[key]
+
+    def check_revocations(self):
+        now = time.monotonic()
+        if now < self._next_revocation_check:
+            return
+        self._next_revocation_check = now + API_KEY_REVOCATION_CHECK_INTERVAL
+        try:
+            version = cache.get(REVOCATION_VERSION_KEY)
+        except Exception as e:
+            # can't tell whether anything was revoked, so don't trust anything
+            logger.error(f"Could not check API key revocations: {e}")
+            version = uuid.uuid4().hex
+        with self._lock:
+            if version != self._revocation_version:
+                self._entries.clear()
+                self._revocation_version = version
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+LOCAL_API_KEY_CACHE = LocalAPIKeyCache()
+
+
+def get_organization_pk_from_key(key):
+    """Organization pk of the organization an API key belongs to, None if invalid"""
+    from metering_billing.models import APIToken
+
+    LOCAL_API_KEY_CACHE.check_revocations()
+    found, organization_pk = LOCAL_API_KEY_CACHE.get(key)
+    if found:
+        return organization_pk
+    invalid_key = _invalid_key_cache_key(key)
+    cached = cache.get_many([key, invalid_key])
+    if cached.get(key):
+        organization_pk = cached[key]
+        LOCAL_API_KEY_CACHE.set(key, organization_pk, API_KEY_LOCAL_CACHE_TTL)
+        return organization_pk
+    if cached.get(invalid_key):
+        LOCAL_API_KEY_CACHE.set(key, None, API_KEY_NEGATIVE_CACHE_TTL)
+        return None
+    try:
+        api_token = APIToken.objects.get_from_key(key)
+    except APIToken.DoesNotExist:
+        cache.set(invalid_key, True, API_KEY_NEGATIVE_CACHE_TTL)
+        LOCAL_API_KEY_CACHE.set(key, None, API_KEY_NEGATIVE_CACHE_TTL)
+        return None
+    except Exception as e:
+        # not necessarily the key's fault, so don't remember it as invalid
+        logger.error(f"Could not validate API key starting with {key[:5]}: {e}")
+        return None
+    if api_token.has_expired:
+        # get_from_key only leaves out revoked keys
+        cache.set(invalid_key, True, API_KEY_NEGATIVE_CACHE_TTL)
+        LOCAL_API_KEY_CACHE.set(key, None, API_KEY_NEGATIVE_CACHE_TTL)
+        return None
+    organization_pk = api_token.organization_id
+    timeout = _default_timeout(api_token.expiry_date)
+    cache.set(key, organization_pk, timeout)
+    LOCAL_API_KEY_CACHE.set(key, organization_pk, timeout)
+    return organization_pk
+
+
+def cache_api_key(key, api_token):
+    """Warm the shared cache with a key that was just created"""
+    cache.set(key, api_token.organization_id, _default_timeout(api_token.expiry_date))
+
+
+def invalidate_api_key(prefix):
+    """Forget every cached key with this prefix, in this process and all others"""
+    try:
+        cache.delete_pattern(f"{prefix}*")
+    except Exception as e:
+        logger.error("Error deleting cache using delete pattern")
+        sentry_sdk.capture_exception(e)
+        keys_to_delete = []
+        for key in cache.keys(f"{prefix}*"):
+            keys_to_delete.append(key)
+        cache.delete_many(keys_to_delete)
+    cache.set(REVOCATION_VERSION_KEY, uuid.uuid4().hex, None)
+    LOCAL_API_KEY_CACHE.discard_prefix(prefix)
+
+
+def _invalidate_api_token(sender, instance, **kwargs):
+    if kwargs.get("signal") is post_save and not instance.revoked:
+        return
+    try:
+        invalidate_api_key(instance.prefix)
+    except Exception as e:
+        # the shared cache entries expire on their own eventually, but this is
+        # worth knowing about
+        sentry_sdk.capture_exception(e)
+        logger.error(f"Could not invalidate cached API key {instance.prefix}: {e}")
+
+
+def connect_api_key_signals():
+    from metering_billing.models import APIToken
+
+    post_save.connect(_invalidate_api_token, sender=APIToken)
+    post_delete.connect(_invalidate_api_token, sender=APIToken)
@@ -14,3 +14,17 @@ class MeteringBillingConfig(AppConfig):
         registry.register(self.get_model("Plan"))
         registry.register(self.get_model("SubscriptionRecord"))
         registry.register(self.get_model("Metric"))
+
+        from metering_billing.entitlements import connect_entitlement_signals
+
+        connect_entitlement_signals()
+
+        from metering_billing.api_keys import connect_api_key_signals
+
+        connect_api_key_signals()
+
+        from metering_billing.aggregation.cagg_policies import (
+            connect_cagg_policy_signals,
+        )
+
+        connect_cagg_policy_signals()
@@ -1,8 +1,8 @@
-from django.core.cache import cache
 from django.http import HttpResponseBadRequest
 from django.utils.translation import gettext_lazy as _
 from drf_spectacular.extensions import OpenApiAuthenticationExtension
 
+from metering_billing.api_keys import get_organization_pk_from_key
 from metering_billing.exceptions import (
     NoMatchingAPIKey,
     OrganizationMismatch,
@@ -10,7 +10,6 @@ from metering_billing.exceptions import (
 )
 from metering_billing.models import APIToken
 from metering_billing.permissions import HasUserAPIKey
-from metering_billing.utils import now_utc
 
 
 # AUTH METHODS
@@ -72,20 +71,9 @@ def fast_api_key_validation_and_cache(request):
             key = meta_dict["http_x_api_key"]
         else:
             return HttpResponseBadRequest("No API key found in request"), False
-    organization_pk = cache.get(key)
-    if not organization_pk:
-        try:
-            api_key = APIToken.objects.get_from_key(key)
-        except Exception:
-            return HttpResponseBadRequest("Invalid API key"), False
-        organization_pk = api_key.organization.pk
-        expiry_date = api_key.expiry_date
-        timeout = (
-            60 * 60 * 24
-            if expiry_date is None
-            else (expiry_date - now_utc()).total_seconds()
-        )
-        cache.set(key, organization_pk, timeout)
+    organization_pk = get_organization_pk_from_key(key)
+    if organization_pk is None:
+        return HttpResponseBadRequest("Invalid API key"), False
     return organization_pk, True
 
 
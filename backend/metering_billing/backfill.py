@@ -0,0 +1,506 @@
+import csv
+import datetime
+import gzip
+import io
+import json
+import logging
+from dataclasses import dataclass, field
+
+import pytz
+from api.ingestion import MAX_EVENT_LINE_BYTES, loads, parse_time_created
+from django.conf import settings
+from django.db import connection, transaction
+
+from metering_billing.aggregation.usage_results import invalidate_usage_results
+from metering_billing.exceptions import InvalidEventFile
+from metering_billing.utils import (
+    customer_id_uuidv5,
+    event_name_uuidv5,
+    idempotency_id_uuidv5,
+    now_utc,
+)
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+logger = logging.getLogger("django.server")
+
+EVENT_BACKFILL_CHUNK_SIZE = settings.EVENT_BACKFILL_CHUNK_SIZE
+BACKFILL_FORMATS = ("ndjson", "csv", "parquet")
+MAX_REPORTED_INVALID_EVENTS = 100
+CSV_EVENT_COLUMNS = (
+    "customer_id",
+    "cust_id",
+    "event_name",
+    "idempotency_id",
+    "time_created",
+)
+
+# Historical imports skip kafka and the 30 day window of the track endpoint. The
+# file is read incrementally, and every chunk of it is COPYed into a temporary
+# staging table and moved into the hypertable with a single statement, which
+# dedupes against the idempotence guard table the same way the consumer does. The
+# guard table only goes back 33 days, so older events are also checked against
+# the hypertable itself. Once everything is in, only the continuous aggregates of
+# the metrics that track the imported events are refreshed, and only over the
+# days that got events, since the refresh policies never look that far back.
+
+CREATE_STAGING_TABLE = """
+CREATE TEMPORARY TABLE backfill_events_staging (
+    cust_id text NOT NULL,
+    uuidv5_customer_id uuid NOT NULL,
+    event_name text NOT NULL,
+    uuidv5_event_name uuid NOT NULL,
+    idempotency_id text NOT NULL,
+    uuidv5_idempotency_id uuid NOT NULL,
+    properties jsonb NOT NULL,
+    time_created timestamptz NOT NULL
+) ON COMMIT DROP
+"""
+
+COPY_STAGING_TABLE = """
+COPY backfill_events_staging (
+    cust_id,
+    uuidv5_customer_id,
+    event_name,
+    uuidv5_event_name,
+    idempotency_id,
+    uuidv5_idempotency_id,
+    properties,
+    time_created
+) FROM STDIN WITH (FORMAT csv)
+"""
+
+INSERT_STAGED_EVENTS = """
+WITH guarded AS (
+    INSERT INTO metering_billing_idempotencecheck (
+        organization_id,
+        time_created,
+        uuidv5_idempotency_id
+    )
+    SELECT
+        %(organization_id)s,
+        staging.time_created,
+        staging.uuidv5_idempotency_id
+    FROM
+        backfill_events_staging AS staging
+    WHERE NOT EXISTS (
+        SELECT
+            1
+        FROM
+            metering_billing_usageevent AS event
+        WHERE
+            event.organization_id = %(organization_id)s
+            AND event.time_created = staging.time_created
+            AND event.uuidv5_idempotency_id = staging.uuidv5_idempotency_id
+    )
+    ON CONFLICT DO NOTHING
+    RETURNING uuidv5_idempotency_id
+), inserted AS (
+    INSERT INTO metering_billing_usageevent (
+        organization_id,
+        cust_id,
+        uuidv5_customer_id,
+        event_name,
+        uuidv5_event_name,
+        idempotency_id,
+        uuidv5_idempotency_id,
+        properties,
+        time_created,
+        inserted_at
+    )
+    SELECT
+        %(organization_id)s,
+        staging.cust_id,
+        staging.uuidv5_customer_id,
+        staging.event_name,
+        staging.uuidv5_event_name,
+        staging.idempotency_id,
+        staging.uuidv5_idempotency_id,
+        staging.properties,
+        staging.time_created,
+        CURRENT_TIMESTAMP
+    FROM
+        backfill_events_staging AS staging
+    INNER JOIN
+        guarded
+    USING (uuidv5_idempotency_id)
+    ORDER BY
+        staging.time_created
+    RETURNING
+        event_name,
+        time_created
+)
+SELECT
+    event_name,
+    MIN(time_created),
+    MAX(time_created),
+    COUNT(*)
+FROM
+    inserted
+GROUP BY
+    event_name
+"""
+
+
+@dataclass
+class BackfillResult:
+    events_read: int = 0
+    events_inserted: int = 0
+    duplicate_events: int = 0
+    invalid_events: int = 0
+    # (line or row number, idempotency id, reason), for the first few invalid events
+    invalid_event_details: list = field(default_factory=list)
+    refreshed_aggregates: list = field(default_factory=list)
+    failed_aggregates: list = field(default_factory=list)
+    # event name -> [earliest, latest] time_created of the events that got inserted
+    time_ranges: dict = field(default_factory=dict)
+
+    def add_invalid(self, position, idempotency_id, reason):
+        self.invalid_events += 1
+        if len(self.invalid_event_details) < MAX_REPORTED_INVALID_EVENTS:
+            self.invalid_event_details.append((position, idempotency_id, reason))
+
+    def add_time_range(self, event_name, start, end):
+        if event_name in self.time_ranges:
+            current_start, current_end = self.time_ranges[event_name]
+            start, end = min(start, current_start), max(end, current_end)
+        self.time_ranges[event_name] = [start, end]
+
+    def as_dict(self):
+        return {
+            "events_read": self.events_read,
+            "events_inserted": self.events_inserted,
+            "duplicate_events": self.duplicate_events,
+            "invalid_events": self.invalid_events,
+            "invalid_event_details": [
+                {
+                    "position": position,
+                    "idempotency_id": idempotency_id,
+                    "reason": reason,
+                }
+                for position, idempotency_id, reason in self.invalid_event_details
+            ],
+            "refreshed_aggregates": self.refreshed_aggregates,
+            "failed_aggregates": [cagg_name for cagg_name, _ in self.failed_aggregates],
+        }
+
+
+def event_file_format(name):
+    """Guess (format, gzipped) from a file name like events.ndjson.gz"""
+    name = name.lower()
+    gzipped = name.endswith(".gz")
+    if gzipped:
+        name = name[: -len(".gz")]
+    if name.endswith(".csv"):
+        return "csv", gzipped
+    if name.endswith(".parquet"):
+        return "parquet", gzipped
+    if name.endswith((".ndjson", ".jsonl", ".json")):
+        return "ndjson", gzipped
+    return None, gzipped
+
+
+def _iter_ndjson(file):
+    line_number = 0
+    while True:
+        line = file.readline(MAX_EVENT_LINE_BYTES + 1)
+        if not line:
+            return
+        line_number += 1
+        if len(line) > MAX_EVENT_LINE_BYTES:
+            raise InvalidEventFile(f"Line {line_number} is too long")
+        if not line.strip():
+            continue
+        try:
+            yield line_number, loads(line)
+        except ValueError:
+            yield line_number, None
+
+
+def _iter_csv(file):
+    # the core fields are columns of their own, properties can either be a json
+    # column or be spread over any number of extra columns
+    reader = csv.DictReader(io.TextIOWrapper(file, encoding="utf-8", newline=""))
+    for row_number, row in enumerate(reader, start=2):
+        event = {}
+        properties = {}
+        for column, value in row.items():
+            if column is None or value is None:
+                continue
+            if column == "properties":
+                if value:
+                    try:
+                        properties.update(json.loads(value))
+                    except (ValueError, TypeError):
+                        yield row_number, None
+                        break
+            elif column in CSV_EVENT_COLUMNS:
+                event[column] = value
+            elif value != "":
+                properties[column] = value
+        else:
+            event["properties"] = properties
+            yield row_number, event
+
+
+def _iter_parquet(file, chunk_size):
+    if pq is None:
+        raise InvalidEventFile("Parquet files can't be imported, pyarrow is missing")
+    try:
+        parquet_file = pq.ParquetFile(file)
+    except Exception as e:
+        raise InvalidEventFile(f"Could not read parquet file: {e}")
+    row_number = 0
+    for batch in parquet_file.iter_batches(batch_size=chunk_size):
+        for event in batch.to_pylist():
+            row_number += 1
+            properties = event.get("properties")
+            if isinstance(properties, str):
+                try:
+                    event["properties"] = json.loads(properties)
+                except ValueError:
+                    yield row_number, None
+                    continue
+            yield row_number, event
+
+
+def iter_event_file(file, file_format, chunk_size=EVENT_BACKFILL_CHUNK_SIZE):
+    """Yield (line or row number, event dict) for every event in a binary file.
+
+    The event is None if it couldn't be decoded at all.
+    """
+    if file_format == "ndjson":
+        return _iter_ndjson(file)
+    elif file_format == "csv":
+        return _iter_csv(file)
+    elif file_format == "parquet":
+        return _iter_parquet(file, chunk_size)
+    raise InvalidEventFile(
+        f"Unsupported format {file_format}, must be one of {', '.join(BACKFILL_FORMATS)}"
+    )
+
+
+def _staging_row(event):
+    """Validate an event and turn it into a row of the staging table"""
+    if event is None:
+        raise ValueError("Could not decode event")
+    if not isinstance(event, dict):
+        raise ValueError("Event must be an object")
+    idempotency_id = event.get("idempotency_id")
+    customer_id = event.get("customer_id") or event.get("cust_id")
+    event_name = event.get("event_name")
+    time_created = event.get("time_created")
+    properties = event.get("properties") or {}
+    if not idempotency_id:
+        raise ValueError("No idempotency_id provided")
+    if not customer_id:
+        raise ValueError("No customer_id provided")
+    if not event_name:
+        raise ValueError("No event_name provided")
+    if not isinstance(properties, dict):
+        raise ValueError("properties must be an object")
+    if isinstance(time_created, datetime.datetime):
+        if time_created.tzinfo is None:
+            time_created = time_created.replace(tzinfo=pytz.UTC)
+    else:
+        try:
+            time_created = parse_time_created(time_created)
+        except (ValueError, OverflowError):
+            raise ValueError("Invalid time_created")
+    idempotency_id, customer_id, event_name = (
+        str(idempotency_id),
+        str(customer_id),
+        str(event_name),
+    )
+    return (
+        customer_id,
+        customer_id_uuidv5(customer_id),
+        event_name,
+        event_name_uuidv5(event_name),
+        idempotency_id,
+        idempotency_id_uuidv5(idempotency_id),
+        json.dumps(properties),
+        time_created,
+    )
+
+
+def write_backfill_chunk(organization, rows):
+    """COPY a chunk of staging rows into the hypertable, skipping duplicates.
+
+    Returns {event name: (earliest, latest, count)} for the events inserted.
+    """
+    rows = sorted(rows, key=lambda row: row[7])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row[:7] + (row[7].isoformat(),))
+    buffer.seek(0)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(CREATE_STAGING_TABLE)
+            cursor.copy_expert(COPY_STAGING_TABLE, buffer)
+            cursor.execute(INSERT_STAGED_EVENTS, {"organization_id": organization.id})
+            return {
+                event_name: (start, end, count)
+                for event_name, start, end, count in cursor.fetchall()
+            }
+
+
+def refresh_backfilled_aggregates(organization, time_ranges, result):
+    """Refresh the caggs of the metrics on the imported events, where they changed"""
+    from metering_billing.aggregation.billable_metrics import METRIC_HANDLER_MAP
+    from metering_billing.aggregation.common_query_templates import (
+        CAGG_REFRESH_WINDOW,
+    )
+    from metering_billing.aggregation.gauge_checkpoints import (
+        invalidate_gauge_checkpoints,
+    )
+    from metering_billing.models import Metric
+    from metering_billing.utils.enums import METRIC_STATUS
+
+    metrics = Metric.objects.filter(
+        organization=organization,
+        event_name__in=list(time_ranges),
+        status=METRIC_STATUS.ACTIVE,
+    ).select_related("organization")
+    for metric in metrics:
+        start, end = time_ranges[metric.event_name]
+        # caggs only get refreshed for buckets that fit entirely in the window
+        start = start.astimezone(pytz.UTC).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        end = end.astimezone(pytz.UTC).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        ) + datetime.timedelta(days=1)
+        # gauge checkpoints of the days after the first imported event are stale
+        invalidate_gauge_checkpoints(metric, start)
+        handler = METRIC_HANDLER_MAP[metric.metric_type]
+        for cagg_name in handler.continuous_aggregate_names(metric):
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(CAGG_REFRESH_WINDOW, [cagg_name, start, end])
+            except Exception as e:
+                logger.error(f"Could not refresh {cagg_name} after backfill: {e}")
+                result.failed_aggregates.append((cagg_name, str(e)))
+            else:
+                result.refreshed_aggregates.append(cagg_name)
+
+
+def _invalidate_usage_counters(organization, time_ranges):
+    from metering_billing.models import UsageCounter
+
+    for event_name, (start, end) in time_ranges.items():
+        UsageCounter.objects.filter(
+            organization=organization,
+            metric__event_name=event_name,
+            period_start__lte=end,
+            period_end__gte=start,
+        ).update(reconciled_at=None)
+
+
+def backfill_events(organization, file, file_format, gzipped=False, chunk_size=None):
+    """Import a file of historical events for an organization.
+
+    file is a binary file object holding ndjson, csv or parquet events, with the
+    same fields as the track endpoint. Events that are invalid or that were already
+    ingested are skipped and counted. Returns a BackfillResult.
+    """
+    chunk_size = chunk_size or EVENT_BACKFILL_CHUNK_SIZE
+    if gzipped:
+        file = gzip.GzipFile(fileobj=file, mode="rb")
+    result = BackfillResult()
+    rows = []
+    seen = set()
+
+    def flush():
+        inserted = write_backfill_chunk(organization, rows)
+        for event_name, (start, end, count) in inserted.items():
+            result.events_inserted += count
+            result.add_time_range(event_name, start, end)
+        result.duplicate_events += len(rows) - sum(x[2] for x in inserted.values())
+        rows.clear()
+        seen.clear()
+
+    try:
+        for position, event in iter_event_file(file, file_format, chunk_size):
+            result.events_read += 1
+            try:
+                row = _staging_row(event)
+            except ValueError as e:
+                idempotency_id = None
+                if isinstance(event, dict):
+                    idempotency_id = event.get("idempotency_id")
+                result.add_invalid(position, idempotency_id, str(e))
+                continue
+            # dedupe within the chunk, the insert dedupes across chunks
+            if row[5] in seen:
+                result.duplicate_events += 1
+                continue
+            seen.add(row[5])
+            rows.append(row)
+            if len(rows) >= chunk_size:
+                flush()
+        if len(rows) > 0:
+            flush()
+    except (OSError, EOFError, UnicodeDecodeError, csv.Error) as e:
+        read_error = e
+    else:
+        read_error = None
+    # whatever made it in before a bad file was noticed stays in, so the aggregates
+    # still have to catch up with it. Importing the file again is safe.
+    if len(result.time_ranges) > 0:
+        refresh_backfilled_aggregates(organization, result.time_ranges, result)
+        # only once the aggregates have the events, or the usage could be
+        # calculated and stored again from the aggregates without them
+        _invalidate_usage_counters(organization, result.time_ranges)
+        for event_name, (start, end) in result.time_ranges.items():
+            # invoiced periods the events fall in have to be calculated again
+            invalidate_usage_results(organization, event_name, start, end)
+    logger.info(
+        f"Backfilled {result.events_inserted} of {result.events_read} events for {organization}"
+    )
+    if read_error is not None:
+        raise InvalidEventFile(
+            f"Could not read events file after {result.events_read} events, "
+            f"{result.events_inserted} were imported: {read_error}"
+        )
+    return result
+
+
+def import_event_backfill(backfill_pk):
+    """Import the file of an EventBackfill uploaded through the admin endpoint.
+
+    Does nothing unless it's still pending, so a redelivered task doesn't import
+    it twice. The result or the error is recorded on it, and the file deleted.
+    """
+    from metering_billing.models import EventBackfill
+
+    claimed = EventBackfill.objects.filter(
+        pk=backfill_pk, status=EventBackfill.Status.PENDING
+    ).update(status=EventBackfill.Status.RUNNING, started_at=now_utc())
+    if not claimed:
+        return
+    event_backfill = EventBackfill.objects.select_related("organization").get(
+        pk=backfill_pk
+    )
+    try:
+        with event_backfill.file.open("rb") as file:
+            result = backfill_events(
+                event_backfill.organization,
+                file,
+                event_backfill.file_format,
+                gzipped=event_backfill.gzipped,
+            )
+    except Exception as e:
+        logger.error(f"Event backfill {event_backfill.backfill_id} failed: {e}")
+        event_backfill.status = EventBackfill.Status.FAILED
+        event_backfill.error = str(e)
+    else:
+        event_backfill.status = EventBackfill.Status.SUCCEEDED
+        event_backfill.result = result.as_dict()
+    event_backfill.finished_at = now_utc()
+    event_backfill.save()
+    event_backfill.file.delete(save=True)
@@ -0,0 +1,294 @@
+import hashlib
+import json
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Min
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from metering_billing.utils import now_utc
+
+logger = logging.getLogger("django.server")
+
+ENTITLEMENT_CACHE_TTL = settings.ENTITLEMENT_CACHE_TTL
+ENTITLEMENT_USAGE_TTL = settings.ENTITLEMENT_USAGE_TTL
+MAX_CACHED_PLAN_VERSION_FEATURES = 4096
+
+# Snapshots of what a customer is entitled to, used by the metric and feature access
+# endpoints. Snapshot keys embed a version for the organization (plans, components,
+# tiers, features) and one for the customer (subscriptions, billing records).
+# Changing any of those bumps the matching version, so only the snapshots it could
+# affect get rebuilt, lazily, the next time they're asked for. Old ones just expire.
+# Versions are bumped once when the change is made and again when it commits, so a
+# snapshot built from the old rows in between doesn't outlive the transaction.
+
+
+def _organization_version_key(organization_pk):
+    return f"entitlements_org_version_{organization_pk}"
+
+
+def _customer_version_key(customer_pk):
+    return f"entitlements_customer_version_{customer_pk}"
+
+
+def _get_version_values(keys):
+    versions = cache.get_many(keys)
+    for key in keys:
+        if versions.get(key) is None:
+            version = uuid.uuid4().hex
+            # someone else may have just set one, if so use theirs
+            if not cache.add(key, version, None):
+                version = cache.get(key) or version
+            versions[key] = version
+    return [versions[key] for key in keys]
+
+
+def _bump_versions(keys):
+    try:
+        cache.set_many({key: uuid.uuid4().hex for key in keys}, None)
+    except Exception as e:
+        # never fail a write because of the cache, the snapshots will expire anyway
+        logger.error(f"Could not bump entitlement versions {keys}: {e}")
+
+
+def _invalidate(keys):
+    _bump_versions(keys)
+    transaction.on_commit(lambda: _bump_versions(keys))
+
+
+def invalidate_organization_entitlements(organization_pk):
+    if organization_pk is None:
+        return
+    _invalidate([_organization_version_key(organization_pk)])
+
+
+def invalidate_customer_entitlements(customer_pk):
+    if customer_pk is None:
+        return
+    invalidate_customers_entitlements([customer_pk])
+
+
+def invalidate_customers_entitlements(customer_pks):
+    keys = [_customer_version_key(pk) for pk in set(customer_pks) if pk is not None]
+    if len(keys) > 0:
+        _invalidate(keys)
+
+
+def next_entitlement_change(organization_pk, customer_pk, now=None):
+    """When the customer's next subscription or billing record starts, or None.
+
+    Snapshots only look at what's active, so they have to be rebuilt then.
+    """
+    from metering_billing.models import BillingRecord, SubscriptionRecord
+
+    now = now or now_utc()
+    subscription_start = (
+        SubscriptionRecord.objects.not_started(now)
+        .filter(organization_id=organization_pk, customer_id=customer_pk)
+        .aggregate(start=Min("start_date"))["start"]
+    )
+    billing_record_start = BillingRecord.objects.filter(
+        organization_id=organization_pk,
+        customer_id=customer_pk,
+        start_date__gt=now,
+    ).aggregate(start=Min("start_date"))["start"]
+    starts = [x for x in (subscription_start, billing_record_start) if x is not None]
+    return min(starts) if starts else None
+
+
+def _filters_hash(subscription_filters):
+    if not subscription_filters:
+        return ""
+    filters = json.dumps(sorted([list(x) for x in subscription_filters]))
+    return hashlib.md5(filters.encode("utf-8")).hexdigest()[:16]
+
+
+def get_entitlement_snapshot(
+    kind, organization_pk, customer_pk, obj_pk, subscription_filters, build
+):
+    """Get the snapshot of a customer's access to a metric or feature.
+
+    On a miss the snapshot is built with build(), which returns the snapshot along
+    with the time after which it stops being accurate (eg. when a billing record
+    ends or the next subscription starts), or None. It's cached until then, for
+    ENTITLEMENT_CACHE_TTL at most.
+    """
+    snapshots = get_entitlement_snapshots(
+        kind,
+        organization_pk,
+        [customer_pk],
+        obj_pk,
+        subscription_filters,
+        lambda _: build(),
+    )
+    return snapshots[customer_pk]
+
+
+def get_entitlement_snapshots(
+    kind, organization_pk, customer_pks, obj_pk, subscription_filters, build
+):
+    """get_entitlement_snapshot for several customers, keyed by customer pk.
+
+    The versions and then the snapshots are read with one cache.get_many each,
+    and only the missing snapshots are built, with build(customer_pk).
+    """
+    customer_pks = list(dict.fromkeys(customer_pks))
+    organization_version, *customer_versions = _get_version_values(
+        [_organization_version_key(organization_pk)]
+        + [_customer_version_key(pk) for pk in customer_pks]
+    )
+    filters_hash = _filters_hash(subscription_filters)
+    keys = {
+        customer_pk: (
+            f"entitlements_{kind}_{organization_pk}_{customer_pk}_{obj_pk}_"
+            f"{filters_hash}_{organization_version}_{customer_version}"
+        )
+        for customer_pk, customer_version in zip(customer_pks, customer_versions)
+    }
+    cached = cache.get_many(list(keys.values()))
+    snapshots = {}
+    for customer_pk, key in keys.items():
+        snapshot = cached.get(key)
+        if snapshot is None:
+            snapshot, valid_until = build(customer_pk)
+            timeout = ENTITLEMENT_CACHE_TTL
+            if valid_until is not None:
+                timeout = min(timeout, (valid_until - now_utc()).total_seconds())
+            if timeout >= 1:
+                cache.set(key, snapshot, timeout)
+        snapshots[customer_pk] = snapshot
+    return snapshots
+
+
+def get_billing_record_usage(billing_record_pk, calculate):
+    """Current usage of a billing record, recalculated every ENTITLEMENT_USAGE_TTL"""
+    key = f"entitlements_usage_{billing_record_pk}"
+    usage = cache.get(key)
+    if usage is None:
+        usage = calculate()
+        cache.set(key, usage, ENTITLEMENT_USAGE_TTL)
+    return usage
+
+
+class PlanVersionFeatureCache:
+    """Process wide cache of the set of feature pks each plan version gives access to.
+
+    Entries are keyed by the organization's entitlement version, so anything that
+    invalidates the organization's entitlements also makes these stale entries
+    unreachable, in every process. Misses fall through to the shared cache and
+    then to a single query for all the plan versions still missing.
+    """
+
+    def __init__(self, max_size=MAX_CACHED_PLAN_VERSION_FEATURES):
+        self.max_size = max_size
+        self._features = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, organization_pk, plan_version_pks):
+        from metering_billing.models import PlanVersion
+
+        (organization_version,) = _get_version_values(
+            [_organization_version_key(organization_pk)]
+        )
+        features = {}
+        missing = []
+        with self._lock:
+            for pk in set(plan_version_pks):
+                key = (pk, organization_version)
+                feature_set = self._features.get(key)
+                if feature_set is None:
+                    missing.append(pk)
+                else:
+                    self._features.move_to_end(key)
+                    features[pk] = feature_set
+        if len(missing) == 0:
+            return features
+        cache_keys = {
+            f"entitlements_plan_features_{pk}_{organization_version}": pk
+            for pk in missing
+        }
+        for cache_key, feature_pks in cache.get_many(list(cache_keys)).items():
+            features[cache_keys[cache_key]] = frozenset(feature_pks)
+        missing = [pk for pk in missing if pk not in features]
+        if len(missing) > 0:
+            fetched = {pk: set() for pk in missing}
+            plan_version_features = PlanVersion.features.through.objects.filter(
+                planversion_id__in=missing
+            ).values_list("planversion_id", "feature_id")
+            for plan_version_pk, feature_pk in plan_version_features:
+                fetched[plan_version_pk].add(feature_pk)
+            cache.set_many(
+                {
+                    f"entitlements_plan_features_{pk}_{organization_version}": list(
+                        feature_pks
+                    )
+                    for pk, feature_pks in fetched.items()
+                },
+                ENTITLEMENT_CACHE_TTL,
+            )
+            for pk, feature_pks in fetched.items():
+                features[pk] = frozenset(feature_pks)
+        with self._lock:
+            for pk in plan_version_pks:
+                self._features[(pk, organization_version)] = features[pk]
+            while len(self._features) > self.max_size:
+                self._features.popitem(last=False)
+        return features
+
+    def clear(self):
+        with self._lock:
+            self._features.clear()
+
+
+PLAN_VERSION_FEATURE_CACHE = PlanVersionFeatureCache()
+
+
+def get_plan_version_features(organization_pk, plan_version_pks):
+    """Map each plan version pk to the frozenset of the feature pks it includes"""
+    return PLAN_VERSION_FEATURE_CACHE.get_many(organization_pk, plan_version_pks)
+
+
+def _invalidate_customer(sender, instance, **kwargs):
+    try:
+        invalidate_customer_entitlements(instance.customer_id)
+    except Exception as e:
+        # never fail a write because of the cache, the snapshot will expire anyway
+        logger.error(f"Could not invalidate entitlements of {instance}: {e}")
+
+
+def _invalidate_organization(sender, instance, **kwargs):
+    action = kwargs.get("action")
+    if action is not None and not action.startswith("post_"):
+        return
+    try:
+        organization_pk = instance.organization_id
+        if organization_pk is None and getattr(instance, "plan_component_id", None):
+            # tiers don't always have the organization filled in
+            organization_pk = instance.plan_component.organization_id
+        invalidate_organization_entitlements(organization_pk)
+    except Exception as e:
+        logger.error(f"Could not invalidate entitlements of {instance}: {e}")
+
+
+def connect_entitlement_signals():
+    from metering_billing.models import (
+        BillingRecord,
+        Feature,
+        PlanComponent,
+        PlanVersion,
+        PriceTier,
+        SubscriptionRecord,
+    )
+
+    for model in (SubscriptionRecord, BillingRecord):
+        post_save.connect(_invalidate_customer, sender=model)
+        post_delete.connect(_invalidate_customer, sender=model)
+    for model in (PlanVersion, PlanComponent, PriceTier, Feature):
+        post_save.connect(_invalidate_organization, sender=model)
+        post_delete.connect(_invalidate_organization, sender=model)
+    m2m_changed.connect(_invalidate_organization, sender=PlanVersion.features.through)
@@ -205,3 +205,15 @@ class IntermediateBillingEngineFailure(APIException):
     status_code = 500
     default_detail = "Intermediate billing engine ran into an unexpected state"
     default_code = "intermediate_billing_engine_failure"
+
+
+class InvoicingInProgress(APIException):
+    status_code = 409
+    default_detail = "This customer is already being invoiced, try again later"
+    default_code = "invoicing_in_progress"
+
+
+class InvalidEventFile(APIException):
+    status_code = 400
+    default_detail = "Could not read the events file"
+    default_code = "invalid_event_file"
@@ -1,14 +1,19 @@
 import logging
+import uuid
 from collections.abc import Iterable
 from decimal import Decimal
+from functools import partial
 
 import sentry_sdk
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Q, Sum
 from django.db.models.query import QuerySet
 
+from metering_billing.exceptions import InvoicingInProgress
 from metering_billing.kafka.producer import Producer
+from metering_billing.locks import CUSTOMER_INVOICING_LOCK, advisory_lock
 from metering_billing.payment_processors import PAYMENT_PROCESSOR_MAP
 from metering_billing.taxes import get_lotus_tax_rates, get_taxjar_tax_rates
 from metering_billing.utils import (
@@ -30,6 +35,7 @@ logger = logging.getLogger("django.server")
 POSTHOG_PERSON = settings.POSTHOG_PERSON
 META = settings.META
 DEBUG = settings.DEBUG
+INVOICE_LOCK_TIMEOUT = settings.INVOICE_LOCK_TIMEOUT
 USE_KAFKA = settings.USE_KAFKA
 if USE_KAFKA:
     kafka_producer = Producer()
@@ -43,23 +49,83 @@ def generate_invoice(
     charge_next_plan=False,
     generate_next_subscription_record=False,
     issue_date=None,
+    run_id=None,
 ):
     """
     Generate an invoice for a subscription.
 
     IMPORTANT: addons must be passed explicitly as part of subscription_records, otherwise they will not be charged.
+
+    Real (non draft) invoices are generated while holding the customer's invoicing
+    lock and inside a single transaction, so concurrent invoicing of the same
+    customer is serialized and a failure leaves nothing half billed behind. The
+    external payment object is only created once the transaction has committed.
+    Passing a run_id makes the call idempotent: if invoices were already generated
+    for the customer under that run_id, those are returned instead of billing again.
+    That only covers replays of the same run, every periodic run gets a new
+    run_id. Across runs it's the committed invoicing state of the billing and
+    subscription records that keeps them from being billed twice.
     """
-    from metering_billing.models import Invoice, PricingUnit
-    from metering_billing.tasks import generate_invoice_pdf_async
+    from metering_billing.models import Invoice
 
-    if not issue_date:
-        issue_date = now_utc()
     if not isinstance(subscription_records, (QuerySet, Iterable)):
         subscription_records = [subscription_records]
 
     if len(subscription_records) == 0:
         return None
 
+    if draft:
+        return _generate_invoice(
+            subscription_records,
+            draft=draft,
+            charge_next_plan=charge_next_plan,
+            generate_next_subscription_record=generate_next_subscription_record,
+            issue_date=issue_date,
+        )
+
+    customer = subscription_records[0].customer
+    with advisory_lock(
+        CUSTOMER_INVOICING_LOCK, customer.pk, timeout=INVOICE_LOCK_TIMEOUT
+    ) as acquired:
+        if not acquired:
+            raise InvoicingInProgress
+        if run_id is None:
+            run_id = uuid.uuid4()
+        else:
+            existing_invoices = list(
+                Invoice.objects.filter(customer=customer, run_id=run_id).exclude(
+                    payment_status=Invoice.PaymentStatus.DRAFT
+                )
+            )
+            if len(existing_invoices) > 0:
+                logger.info(
+                    f"Invoices for customer {customer.pk} were already generated in run {run_id}, not billing again"
+                )
+                return existing_invoices
+        with transaction.atomic():
+            return _generate_invoice(
+                subscription_records,
+                draft=draft,
+                charge_next_plan=charge_next_plan,
+                generate_next_subscription_record=generate_next_subscription_record,
+                issue_date=issue_date,
+                run_id=run_id,
+            )
+
+
+def _generate_invoice(
+    subscription_records,
+    draft=False,
+    charge_next_plan=False,
+    generate_next_subscription_record=False,
+    issue_date=None,
+    run_id=None,
+):
+    from metering_billing.models import Invoice, PricingUnit
+
+    if not issue_date:
+        issue_date = now_utc()
+
     try:
         customers = subscription_records.values("customer").distinct().count()
     except AttributeError:
@@ -100,6 +166,7 @@ def generate_invoice(
             else Invoice.PaymentStatus.UNPAID,
             "currency": currency,
             "due_date": due_date,
+            "run_id": run_id,
         }
         # Create the invoice
         invoice = Invoice.objects.create(**invoice_kwargs)
@@ -143,25 +210,40 @@ def generate_invoice(
         finalize_invoice_amount(invoice, draft)
 
         if not draft:
-            new_inv = generate_external_payment_obj(invoice)
-            if new_inv:
-                invoice = new_inv
             for subscription_record in subscription_records:
                 if subscription_record.end_date <= now_utc():
                     subscription_record.fully_billed = True
                     subscription_record.save()
-            try:
-                generate_invoice_pdf_async.delay(invoice.pk)
-            except Exception as e:
-                sentry_sdk.capture_exception(e)
-
-            invoice_created_webhook(invoice, organization)
-            if kafka_producer:
-                kafka_producer.produce_invoice(invoice)
+            # nobody should hear about the invoice before it's committed, payment
+            # processors included: a rollback can't take back what they created
+            transaction.on_commit(partial(_publish_invoice, invoice, organization))
         return_list.append(invoice)
     return return_list
 
 
+def _publish_invoice(invoice, organization):
+    from metering_billing.tasks import generate_invoice_pdf_async
+
+    try:
+        # updates the invoice in place when a payment object is created
+        generate_external_payment_obj(invoice)
+    except Exception as e:
+        # the invoice is already committed, so it stays without one rather than
+        # failing the run and leaving the customer unnotified
+        sentry_sdk.capture_exception(e)
+        logger.error(
+            f"Could not create external payment object for invoice {invoice.invoice_id}: {e}"
+        )
+    try:
+        generate_invoice_pdf_async.delay(invoice.pk)
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+
+    invoice_created_webhook(invoice, organization)
+    if kafka_producer:
+        kafka_producer.produce_invoice(invoice)
+
+
 def calculate_subscription_record_flat_fees(
     subscription_record,
     invoice,
@@ -1,69 +1,458 @@
+import datetime
+import json
 import logging
+import re
+import time
 from dataclasses import dataclass
 
 import sentry_sdk
 from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from kafka import ConsumerRebalanceListener, TopicPartition
+from psycopg2.extras import execute_values
 
-from metering_billing.models import Event
-from metering_billing.utils import now_utc
+from api.ingestion import parse_time_created
+from metering_billing.aggregation.usage_counters import (
+    increment_rate_windows,
+    increment_usage_counters,
+)
+from metering_billing.aggregation.usage_results import (
+    invalidate_late_event_usage_results,
+)
+from metering_billing.utils import (
+    customer_id_uuidv5,
+    event_name_uuidv5,
+    idempotency_id_uuidv5,
+)
 
 from .singleton import Singleton
 
 POSTHOG_PERSON = settings.POSTHOG_PERSON
 KAFKA_HOST = settings.KAFKA_HOST
 KAFKA_EVENTS_TOPIC = settings.KAFKA_EVENTS_TOPIC
+KAFKA_CONSUMER_MAX_BATCH_SIZE = settings.KAFKA_CONSUMER_MAX_BATCH_SIZE
+KAFKA_CONSUMER_MAX_LINGER_MS = settings.KAFKA_CONSUMER_MAX_LINGER_MS
 CONSUMER = settings.CONSUMER
 
 logger = logging.getLogger("django.server")
 
+# same semantics as the insert_metric() function, but for a whole batch in one
+# round trip: rows only make it into the hypertable if their idempotency id was
+# not already present in the guard table
+BATCH_INSERT_EVENTS = """
+WITH batch (
+    organization_id,
+    cust_id,
+    uuidv5_customer_id,
+    event_name,
+    uuidv5_event_name,
+    idempotency_id,
+    uuidv5_idempotency_id,
+    properties,
+    time_created
+) AS (
+    VALUES %s
+), guarded AS (
+    INSERT INTO metering_billing_idempotencecheck (
+        organization_id,
+        time_created,
+        uuidv5_idempotency_id
+    )
+    SELECT
+        organization_id,
+        time_created,
+        uuidv5_idempotency_id
+    FROM
+        batch
+    ON CONFLICT DO NOTHING
+    RETURNING uuidv5_idempotency_id
+)
+INSERT INTO metering_billing_usageevent (
+    organization_id,
+    cust_id,
+    uuidv5_customer_id,
+    event_name,
+    uuidv5_event_name,
+    idempotency_id,
+    uuidv5_idempotency_id,
+    properties,
+    time_created,
+    inserted_at
+)
+SELECT
+    batch.organization_id,
+    batch.cust_id,
+    batch.uuidv5_customer_id,
+    batch.event_name,
+    batch.uuidv5_event_name,
+    batch.idempotency_id,
+    batch.uuidv5_idempotency_id,
+    batch.properties,
+    batch.time_created,
+    CURRENT_TIMESTAMP
+FROM
+    batch
+INNER JOIN
+    guarded
+USING (uuidv5_idempotency_id)
+RETURNING
+    organization_id,
+    cust_id,
+    event_name,
+    properties,
+    time_created
+"""
+
+# remember which (customer, event name) pairs got new events, for the ones that
+# some usage alert cares about, so that only their alerts get re-evaluated
+MARK_PENDING_ALERT_REFRESHES = """
+INSERT INTO metering_billing_pendingusagealertrefresh (
+    organization_id,
+    cust_id,
+    event_name,
+    marked_at
+)
+SELECT
+    batch.organization_id,
+    batch.cust_id,
+    batch.event_name,
+    CURRENT_TIMESTAMP
+FROM
+    (VALUES %s) AS batch (organization_id, cust_id, event_name)
+WHERE EXISTS (
+    SELECT
+        1
+    FROM
+        metering_billing_usagealert AS alert
+    INNER JOIN
+        metering_billing_metric AS metric
+    ON
+        metric.id = alert.metric_id
+    WHERE
+        alert.organization_id = batch.organization_id
+        AND metric.event_name = batch.event_name
+)
+ON CONFLICT (organization_id, cust_id, event_name) DO NOTHING
+"""
+
+BATCH_INSERT_EVENTS_ROW_TEMPLATE = (
+    "(%s::integer, %s::text, %s::uuid, %s::text, %s::uuid,"
+    " %s::text, %s::uuid, %s::jsonb, %s::timestamptz)"
+)
+
 
 @dataclass
 class ConsumerConfig:
     bootstrap_servers = [KAFKA_HOST]
     topic = KAFKA_EVENTS_TOPIC
     auto_offset_reset = "earliest"
+    max_batch_size = KAFKA_CONSUMER_MAX_BATCH_SIZE
+    max_linger_ms = KAFKA_CONSUMER_MAX_LINGER_MS
+
+
+class RebalanceListener(ConsumerRebalanceListener):
+    """Keeps track of partitions taken away from the consumer mid-batch"""
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+
+    def on_partitions_revoked(self, revoked):
+        self.consumer.revoked_partitions.update(
+            (tp.topic, tp.partition) for tp in revoked
+        )
+
+    def on_partitions_assigned(self, assigned):
+        logger.info(
+            f"Assigned partitions {sorted(tp.partition for tp in assigned)} of topic: {self.consumer.topic}"
+        )
 
 
 class Consumer(metaclass=Singleton):
     __connection = None
-    buffer = {}
-    buffer_size = 0
 
-    def __init__(self):
-        self.__connection = CONSUMER
+    def __init__(self, max_batch_size=None, max_linger_ms=None, connection=None):
+        self.__connection = connection or CONSUMER
         self.config = ConsumerConfig()
         self.topic = self.config.topic
+        self.max_batch_size = max_batch_size or self.config.max_batch_size
+        self.max_linger_ms = max_linger_ms or self.config.max_linger_ms
+        self.revoked_partitions = set()
+        self.records_consumed = 0
+        self.events_inserted = 0
 
     def consume(self):
-        """Consume messages from a Redpanda topic"""
+        """Consume messages from a Redpanda topic, flushing them to the db in batches"""
         try:
-            for msg in self.__connection:
-                if msg is None or msg.value is None or msg.key is None:
-                    continue
-
-                logger.info(f"Consumed record. key={msg.key}, value={msg.value}")
-                try:
-                    event = msg.value["event"]
-                    organization_pk = msg.value["organization_id"]
-                    write_batch_events_to_db({organization_pk: [event]})
-                except Exception as e:
-                    sentry_sdk.capture_exception(e)
-                    logger.info(
-                        f"Could not consume from topic: {self.topic}. Excpetionmessage: {e}"
-                    )
-                    continue
+            while True:
+                self.consume_batch()
         except Exception:
             logger.info(f"Could not consume from topic: {self.topic}")
             raise
 
+    def rebalance_listener(self):
+        return RebalanceListener(self)
+
+    def poll_batch(self):
+        """Poll until we have max_batch_size records or max_linger_ms has elapsed"""
+        batch = []
+        deadline = time.monotonic() + self.max_linger_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining_ms = int((deadline - time.monotonic()) * 1000)
+            if remaining_ms <= 0:
+                break
+            records = self.__connection.poll(
+                timeout_ms=remaining_ms,
+                max_records=self.max_batch_size - len(batch),
+            )
+            if self.revoked_partitions:
+                # a rebalance happened during this poll. Whoever owns these partitions
+                # now will start from the last committed offset, so drop what we have
+                batch = [
+                    msg
+                    for msg in batch
+                    if (msg.topic, msg.partition) not in self.revoked_partitions
+                ]
+                self.revoked_partitions = set()
+            for msgs in records.values():
+                batch.extend(msgs)
+        return batch
+
+    def lag(self):
+        """Number of records between our position and the end of our partitions"""
+        total_lag = 0
+        for tp in self.__connection.assignment():
+            highwater = self.__connection.highwater(tp)
+            if highwater is None:
+                continue
+            total_lag += max(highwater - self.__connection.position(tp), 0)
+        return total_lag
+
+    def consume_batch(self):
+        """Poll a single batch, write it to the db and commit the offsets.
+
+        Offsets are only committed once the batch has been flushed. Records that
+        can't be written are dead lettered as part of the flush, so they don't hold
+        up the partition. If the flush fails anyway, eg. because the database is
+        down, we rewind to the first offset of the batch in every partition so the
+        same records are retried on the next poll.
+        """
+        batch = self.poll_batch()
+        if len(batch) == 0:
+            return 0
+        buffer = {}
+        dead_letters = []
+        for msg in batch:
+            if msg is None or msg.value is None or msg.key is None:
+                continue
+            try:
+                event = msg.value["event"]
+                organization_pk = msg.value["organization_id"]
+                buffer.setdefault(organization_pk, []).append(event)
+            except Exception as e:
+                sentry_sdk.capture_exception(e)
+                logger.info(
+                    f"Could not consume record from topic: {self.topic}. Exception message: {e}"
+                )
+                dead_letters.append(_dead_letter(msg.value, e))
+        try:
+            num_inserted = write_batch_events_to_db(buffer, dead_letters)
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            logger.info(
+                f"Could not write batch of {len(batch)} records from topic: {self.topic}. Exception message: {e}"
+            )
+            self._rewind(batch)
+            return 0
+        self.__connection.commit()
+        self.records_consumed += len(batch)
+        self.events_inserted += num_inserted
+        logger.info(
+            f"Consumed batch of {len(batch)} records, inserted {num_inserted} events"
+        )
+        return len(batch)
+
+    def _rewind(self, batch):
+        first_offsets = {}
+        for msg in batch:
+            tp = (msg.topic, msg.partition)
+            if tp not in first_offsets or msg.offset < first_offsets[tp]:
+                first_offsets[tp] = msg.offset
+        for (topic, partition), offset in first_offsets.items():
+            self.__connection.seek(TopicPartition(topic, partition), offset)
+
+
+# json.dumps escapes NUL characters, but jsonb doesn't take them escaped either. An
+# odd number of backslashes in front means it's a literal "\\u0000" in the text
+ESCAPED_NUL = re.compile(r"(?<!\\)(?:\\\\)*\\u0000")
+
+
+class InvalidEventRecord(ValueError):
+    pass
 
-def write_batch_events_to_db(buffer):
-    now = now_utc()
+
+def _text(value, key):
+    if not isinstance(value, str) or value == "":
+        raise InvalidEventRecord(f"{key} must be a non empty string")
+    if "\x00" in value:
+        # postgres text can't hold NUL characters
+        raise InvalidEventRecord(f"{key} contains a NUL character")
+    return value
+
+
+def _event_to_row(organization_pk, event):
+    """Validate an event and cast it to a row of BATCH_INSERT_EVENTS.
+
+    Raises InvalidEventRecord for anything the insert would choke on, so that a
+    single bad event can't fail the whole batch.
+    """
+    if not isinstance(event, dict):
+        raise InvalidEventRecord("event must be an object")
+    if isinstance(organization_pk, bool):
+        raise InvalidEventRecord("organization_id must be an integer")
+    try:
+        organization_pk = int(organization_pk)
+    except (TypeError, ValueError):
+        raise InvalidEventRecord("organization_id must be an integer")
+    cust_id = _text(event.get("cust_id") or event.get("customer_id"), "cust_id")
+    event_name = _text(event.get("event_name"), "event_name")
+    idempotency_id = _text(event.get("idempotency_id"), "idempotency_id")
+    properties = event.get("properties") or {}
+    if not isinstance(properties, dict):
+        raise InvalidEventRecord("properties must be an object")
+    try:
+        # jsonb has no NaN or infinity
+        properties = json.dumps(properties, allow_nan=False)
+    except (TypeError, ValueError) as e:
+        raise InvalidEventRecord(f"properties can't be stored: {e}")
+    if ESCAPED_NUL.search(properties):
+        raise InvalidEventRecord("properties contain a NUL character")
+    time_created = event.get("time_created")
+    if not isinstance(time_created, datetime.datetime):
+        try:
+            time_created = parse_time_created(time_created)
+        except (ValueError, OverflowError):
+            raise InvalidEventRecord("time_created must be a valid timestamp")
+    return (
+        organization_pk,
+        cust_id,
+        str(customer_id_uuidv5(cust_id)),
+        event_name,
+        str(event_name_uuidv5(event_name)),
+        idempotency_id,
+        str(idempotency_id_uuidv5(idempotency_id)),
+        properties,
+        time_created,
+    )
+
+
+def _insert_rows(cursor, rows):
+    return execute_values(
+        cursor.cursor,
+        BATCH_INSERT_EVENTS,
+        rows,
+        template=BATCH_INSERT_EVENTS_ROW_TEMPLATE,
+        page_size=len(rows),
+        fetch=True,
+    )
+
+
+def _insert_rows_one_by_one(cursor, rows, dead_letters):
+    """Insert rows in their own savepoints, dead lettering the ones that fail"""
+    inserted = []
+    for row in rows:
+        try:
+            with transaction.atomic():
+                inserted.extend(_insert_rows(cursor, [row]))
+        except DatabaseError as e:
+            dead_letters.append(
+                _dead_letter(
+                    {
+                        "organization_id": row[0],
+                        "event": {
+                            "cust_id": row[1],
+                            "event_name": row[3],
+                            "idempotency_id": row[5],
+                            "properties": row[7],
+                            "time_created": row[8].isoformat(),
+                        },
+                    },
+                    e,
+                )
+            )
+    return inserted
+
+
+def _dead_letter(record, error):
+    from metering_billing.models import DeadLetterEvent
+
+    logger.info(f"Dead lettering event record {record}. Error was {error}")
+    return DeadLetterEvent(
+        record=json.dumps(record, default=str), error=str(error)[:1000]
+    )
+
+
+def write_batch_events_to_db(buffer, dead_letters=None):
+    """Write a {organization_pk: [event, ...]} buffer in a single statement.
+
+    Returns the number of events that were actually inserted, ie. that were not
+    filtered out by the idempotence guard table. The inserted events are added to
+    the usage counters and rate windows in the same transaction, the stored usage
+    of closed periods they fall in is dropped, and the customers that got them are
+    marked for their usage alerts to be re-evaluated.
+
+    Events that can't be written are stored as DeadLetterEvents in the same
+    transaction instead of failing the batch: the ones that don't validate right
+    away, and, if the batch insert fails anyway, the ones that fail when the batch
+    is retried one event at a time. dead_letters are more DeadLetterEvents to
+    store along with them.
+    """
+    from metering_billing.models import DeadLetterEvent
+
+    dead_letters = list(dead_letters or [])
+    rows = []
+    seen = set()
     for org_pk, events_list in buffer.items():
-        ### Match Customer pk with customer_id amd fill in customer pk
-        events_to_insert = []
         for event in events_list:
-            event["cust_id"] = event.pop("customer_id")
-            events_to_insert.append(Event(**{**event, "inserted_at": now}))
-        ## now insert events
-        Event.objects.bulk_create(events_to_insert, ignore_conflicts=True)
+            try:
+                row = _event_to_row(org_pk, event)
+            except InvalidEventRecord as e:
+                dead_letters.append(
+                    _dead_letter({"organization_id": org_pk, "event": event}, e)
+                )
+                continue
+            # dedupe within the batch, the guard table only dedupes across batches
+            if row[6] in seen:
+                continue
+            seen.add(row[6])
+            rows.append(row)
+    with transaction.atomic():
+        inserted = []
+        if len(rows) > 0:
+            with connection.cursor() as cursor:
+                try:
+                    with transaction.atomic():
+                        inserted = _insert_rows(cursor, rows)
+                except DatabaseError as e:
+                    sentry_sdk.capture_exception(e)
+                    logger.info(
+                        f"Could not write batch of {len(rows)} events, retrying them one by one. Exception message: {e}"
+                    )
+                    inserted = _insert_rows_one_by_one(cursor, rows, dead_letters)
+                pending_alert_refreshes = sorted(
+                    {(row[0], row[1], row[2]) for row in inserted}
+                )
+                if len(pending_alert_refreshes) > 0:
+                    execute_values(
+                        cursor.cursor,
+                        MARK_PENDING_ALERT_REFRESHES,
+                        pending_alert_refreshes,
+                        template="(%s::integer, %s::text, %s::text)",
+                        page_size=len(pending_alert_refreshes),
+                    )
+        if len(dead_letters) > 0:
+            DeadLetterEvent.objects.bulk_create(dead_letters)
+        if len(inserted) > 0:
+            increment_usage_counters(inserted)
+            increment_rate_windows(inserted)
+            invalidate_late_event_usage_results(inserted)
+    return len(inserted)
@@ -1,5 +1,6 @@
 import json
 import logging
+import time
 from datetime import date, datetime
 from decimal import Decimal
 
@@ -13,6 +14,7 @@ from .singleton import Singleton
 KAFKA_EVENTS_TOPIC = settings.KAFKA_EVENTS_TOPIC
 KAFKA_INVOICE_TOPIC = settings.KAFKA_INVOICE_TOPIC
 KAFKA_PAYMENT_TOPIC = settings.KAFKA_PAYMENT_TOPIC
+KAFKA_PRODUCER_DELIVERY_TIMEOUT = settings.KAFKA_PRODUCER_DELIVERY_TIMEOUT
 producer_config = settings.PRODUCER_CONFIG
 
 logger = logging.getLogger("django.server")
@@ -35,13 +37,58 @@ class Producer(metaclass=Singleton):
         self.__connection = KafkaProducer(**producer_config)
 
     def produce(self, customer_id, stream_events):
-        logger.info(f"Producing record. key={customer_id}, value={stream_events}")
-        self.__connection.send(
-            topic=KAFKA_EVENTS_TOPIC,
-            key=customer_id.encode("utf-8"),
-            value=json.dumps(stream_events).encode("utf-8"),
+        failed = self.produce_batch([(customer_id, stream_events)])
+        if failed:
+            raise failed[0]
+
+    def produce_batch(self, records, wait=False, timeout=None):
+        """Send a list of (customer_id, stream_events) records to the events topic.
+
+        All the records are encoded up front and handed to the producer without
+        blocking, so they are shipped together in as few requests as the
+        linger/batch size settings allow. If wait is True we flush and wait for all
+        of the delivery futures at once. Returns a {index: exception} dict with the
+        records that could not be sent.
+        """
+        encoder = json.JSONEncoder()
+        failed = {}
+        encoded = {}
+        for i, (customer_id, value) in enumerate(records):
+            try:
+                encoded[i] = (
+                    customer_id.encode("utf-8"),
+                    encoder.encode(value).encode("utf-8"),
+                )
+            except Exception as e:
+                failed[i] = e
+        futures = {}
+        for i, (key, value) in encoded.items():
+            try:
+                futures[i] = self.__connection.send(
+                    topic=KAFKA_EVENTS_TOPIC, key=key, value=value
+                )
+            except Exception as e:
+                failed[i] = e
+        if wait and futures:
+            failed.update(self.wait_for_delivery(futures, timeout=timeout))
+        logger.debug(
+            f"Produced {len(records) - len(failed)} of {len(records)} records to topic {KAFKA_EVENTS_TOPIC}"
         )
-        logger.info(f"Produced record to topic {KAFKA_EVENTS_TOPIC}")
+        return failed
+
+    def wait_for_delivery(self, futures, timeout=None):
+        """Wait on a {index: future} dict in bulk, returning {index: exception}"""
+        if timeout is None:
+            timeout = KAFKA_PRODUCER_DELIVERY_TIMEOUT
+        deadline = time.monotonic() + timeout
+        self.__connection.flush(timeout=timeout)
+        failed = {}
+        for i, future in futures.items():
+            try:
+                future.get(timeout=max(deadline - time.monotonic(), 0))
+            except Exception as e:
+                failed[i] = e
+        return failed
 
     def produce_invoice(self, invoice: Invoice):
         from api.serializers.model_serializers import InvoiceSerializer
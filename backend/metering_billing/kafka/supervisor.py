@@ -0,0 +1,173 @@
+import logging
+import multiprocessing
+import signal
+import time
+
+from django.conf import settings
+from django.db import connections
+from kafka import KafkaConsumer
+
+from .consumer import Consumer
+
+KAFKA_EVENTS_TOPIC = settings.KAFKA_EVENTS_TOPIC
+KAFKA_NUM_PARTITIONS = settings.KAFKA_NUM_PARTITIONS
+CONSUMER_CONFIG = settings.CONSUMER_CONFIG
+
+logger = logging.getLogger("django.server")
+
+# layout of the shared stats block each worker writes into
+STAT_RECORDS_CONSUMED = 0
+STAT_EVENTS_INSERTED = 1
+STAT_LAG = 2
+STAT_LAST_BATCH_AT = 3
+NUM_STATS = 4
+
+
+def run_consumer_worker(worker_id, stats, stop_event, max_batch_size, max_linger_ms):
+    """Entry point of a forked consumer worker.
+
+    Every worker joins the same consumer group with its own KafkaConsumer, so the
+    brokers split the topic partitions between them and move them around when a
+    worker comes or goes.
+    """
+    # never reuse the db connection inherited from the supervisor
+    connections.close_all()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *args: stop_event.set())
+
+    kafka_consumer = KafkaConsumer(
+        **CONSUMER_CONFIG, client_id=f"lotus-event-consumer-{worker_id}"
+    )
+    consumer = Consumer(
+        max_batch_size=max_batch_size,
+        max_linger_ms=max_linger_ms,
+        connection=kafka_consumer,
+    )
+    kafka_consumer.subscribe(
+        [KAFKA_EVENTS_TOPIC], listener=consumer.rebalance_listener()
+    )
+    try:
+        while not stop_event.is_set():
+            consumer.consume_batch()
+            stats[STAT_RECORDS_CONSUMED] = consumer.records_consumed
+            stats[STAT_EVENTS_INSERTED] = consumer.events_inserted
+            stats[STAT_LAG] = consumer.lag()
+            stats[STAT_LAST_BATCH_AT] = time.time()
+    finally:
+        # leaving the group cleanly lets the other workers pick up our partitions
+        # straight away instead of waiting for the session to time out
+        kafka_consumer.close()
+        connections.close_all()
+
+
+class ConsumerSupervisor:
+    """Forks and babysits a pool of consumer workers sharing one consumer group"""
+
+    def __init__(
+        self, num_workers, max_batch_size=None, max_linger_ms=None, stats_interval=30
+    ):
+        if num_workers > KAFKA_NUM_PARTITIONS:
+            logger.warning(
+                f"Requested {num_workers} consumer workers but topic {KAFKA_EVENTS_TOPIC} only has {KAFKA_NUM_PARTITIONS} partitions, extra workers would sit idle"
+            )
+            num_workers = KAFKA_NUM_PARTITIONS
+        self.num_workers = max(num_workers, 1)
+        self.max_batch_size = max_batch_size
+        self.max_linger_ms = max_linger_ms
+        self.stats_interval = stats_interval
+        self.ctx = multiprocessing.get_context("fork")
+        self.stop_event = self.ctx.Event()
+        self.workers = {}
+        self.stats_blocks = {
+            worker_id: self.ctx.Array("d", NUM_STATS)
+            for worker_id in range(self.num_workers)
+        }
+        self._last_report = {}
+
+    def _spawn(self, worker_id):
+        process = self.ctx.Process(
+            target=run_consumer_worker,
+            args=(
+                worker_id,
+                self.stats_blocks[worker_id],
+                self.stop_event,
+                self.max_batch_size,
+                self.max_linger_ms,
+            ),
+            name=f"event-consumer-{worker_id}",
+            daemon=False,
+        )
+        process.start()
+        self.workers[worker_id] = process
+        logger.info(f"Started consumer worker {worker_id} with pid {process.pid}")
+
+    def _handle_signal(self, signum, frame):
+        logger.info(f"Received signal {signum}, shutting down consumer workers")
+        self.stop_event.set()
+
+    def stats(self):
+        """Per-worker counters, throughput is measured since the previous call"""
+        now = time.monotonic()
+        result = {}
+        for worker_id, block in self.stats_blocks.items():
+            records = block[STAT_RECORDS_CONSUMED]
+            prev_records, prev_time = self._last_report.get(worker_id, (0, None))
+            if prev_time is None or now <= prev_time:
+                throughput = 0
+            else:
+                throughput = (records - prev_records) / (now - prev_time)
+            self._last_report[worker_id] = (records, now)
+            process = self.workers.get(worker_id)
+            result[worker_id] = {
+                "pid": process.pid if process else None,
+                "alive": process.is_alive() if process else False,
+                "records_consumed": int(records),
+                "events_inserted": int(block[STAT_EVENTS_INSERTED]),
+                "lag": int(block[STAT_LAG]),
+                "records_per_second": throughput,
+                "last_batch_at": block[STAT_LAST_BATCH_AT] or None,
+            }
+        return result
+
+    def log_stats(self):
+        for worker_id, worker_stats in self.stats().items():
+            logger.info(
+                f"Consumer worker {worker_id}: {worker_stats['records_per_second']:.1f} records/s, lag {worker_stats['lag']}, {worker_stats['records_consumed']} records consumed, {worker_stats['events_inserted']} events inserted"
+            )
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        # workers open their own connections, don't hand ours down
+        connections.close_all()
+        for worker_id in range(self.num_workers):
+            self._spawn(worker_id)
+        next_report = time.monotonic() + self.stats_interval
+        try:
+            while not self.stop_event.is_set():
+                for worker_id, process in list(self.workers.items()):
+                    if not process.is_alive():
+                        logger.warning(
+                            f"Consumer worker {worker_id} exited with code {process.exitcode}, restarting it"
+                        )
+                        self._spawn(worker_id)
+                if time.monotonic() >= next_report:
+                    self.log_stats()
+                    next_report = time.monotonic() + self.stats_interval
+                self.stop_event.wait(1)
+        finally:
+            self.shutdown()
+
+    def shutdown(self, timeout=30):
+        self.stop_event.set()
+        deadline = time.monotonic() + timeout
+        for process in self.workers.values():
+            process.join(max(deadline - time.monotonic(), 0))
+        for worker_id, process in self.workers.items():
+            if process.is_alive():
+                logger.warning(
+                    f"Consumer worker {worker_id} did not stop in time, terminating it"
+                )
+                process.terminate()
+                process.join()
+        self.log_stats()
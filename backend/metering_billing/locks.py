@@ -0,0 +1,64 @@
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+# first key of the two-key form of the postgres advisory lock functions, so locks
+# taken for different purposes never collide
+CUSTOMER_INVOICING_LOCK = 1
+BILLING_RECORD_INVOICING_LOCK = 2
+USAGE_ALERT_REFRESH_LOCK = 3
+
+LOCK_POLL_INTERVAL = 0.1
+
+
+def _try_lock(namespace, key):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_try_advisory_lock(%s, hashtext(%s))", [namespace, str(key)]
+        )
+        return cursor.fetchone()[0]
+
+
+@contextmanager
+def advisory_lock(namespace, key, timeout=None):
+    """Take a session level postgres advisory lock.
+
+    Yields whether the lock was acquired. Without a timeout this never blocks,
+    otherwise it waits up to timeout seconds for whoever holds the lock. The lock
+    is released on exit, or by postgres itself if the connection goes away. The
+    key can be anything with a stable string representation, it gets hashed down
+    to the int postgres wants.
+
+    Session locks are reentrant, so code holding a lock can call into code that
+    takes the same one again.
+    """
+    acquired = _try_lock(namespace, key)
+    if not acquired and timeout:
+        # polling instead of pg_advisory_lock so that we never wait on postgres
+        # with no way of giving up
+        deadline = time.monotonic() + timeout
+        while not acquired and time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            acquired = _try_lock(namespace, key)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT pg_advisory_unlock(%s, hashtext(%s))",
+                    [namespace, str(key)],
+                )
+
+
+def advisory_xact_lock(namespace, key):
+    """Block on a transaction level advisory lock, released at commit or rollback.
+
+    Must be called inside transaction.atomic(), otherwise the lock is released as
+    soon as the statement's implicit transaction ends.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_advisory_xact_lock(%s, hashtext(%s))", [namespace, str(key)]
+        )
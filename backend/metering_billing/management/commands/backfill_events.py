@@ -0,0 +1,66 @@
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from metering_billing.backfill import (
+    BACKFILL_FORMATS,
+    backfill_events,
+    event_file_format,
+)
+from metering_billing.exceptions import InvalidEventFile
+from metering_billing.models import Organization
+
+
+class Command(BaseCommand):
+    "Django command to import a file of historical events into an organization"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "organization_id",
+            help="organization_id of the organization the events belong to",
+        )
+        parser.add_argument(
+            "path",
+            help="ndjson, csv or parquet file of events, optionally gzipped",
+        )
+        parser.add_argument(
+            "--format",
+            choices=BACKFILL_FORMATS,
+            help="format of the file, guessed from its extension by default",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            help="number of events written per transaction",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            organization_id = uuid.UUID(options["organization_id"].replace("org_", ""))
+            organization = Organization.objects.get(organization_id=organization_id)
+        except (ValueError, Organization.DoesNotExist):
+            raise CommandError(f"No organization {options['organization_id']}")
+        file_format, gzipped = event_file_format(options["path"])
+        file_format = options["format"] or file_format
+        if file_format is None:
+            raise CommandError("Could not tell the format of the file, use --format")
+        with open(options["path"], "rb") as f:
+            try:
+                result = backfill_events(
+                    organization,
+                    f,
+                    file_format,
+                    gzipped=gzipped,
+                    chunk_size=options["chunk_size"],
+                )
+            except InvalidEventFile as e:
+                raise CommandError(str(e.detail))
+        self.stdout.write(
+            f"Read {result.events_read} events: {result.events_inserted} imported, "
+            f"{result.duplicate_events} duplicates, {result.invalid_events} invalid"
+        )
+        for position, idempotency_id, reason in result.invalid_event_details:
+            self.stdout.write(f"  {position} ({idempotency_id}): {reason}")
+        for cagg_name, error in result.failed_aggregates:
+            self.stderr.write(f"Could not refresh {cagg_name}: {error}")
+        self.stdout.write(f"Refreshed {len(result.refreshed_aggregates)} aggregates")
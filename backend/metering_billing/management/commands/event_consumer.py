@@ -1,12 +1,46 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
 
 from metering_billing.kafka.consumer import Consumer
 
 
 class Command(BaseCommand):
-    "Django command to pause execution until the database is available"
+    "Django command to consume events from kafka and write them to the db in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-batch-size",
+            type=int,
+            default=None,
+            help="Maximum number of records flushed to the db at once",
+        )
+        parser.add_argument(
+            "--max-linger-ms",
+            type=int,
+            default=None,
+            help="Maximum time to wait for a batch to fill up before flushing it",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.KAFKA_CONSUMER_WORKERS,
+            help="Number of consumer processes to fork, each owning a share of the partitions",
+        )
 
     def handle(self, *args, **options):
-        consumer = Consumer()
+        if options["workers"] > 1:
+            from metering_billing.kafka.supervisor import ConsumerSupervisor
+
+            supervisor = ConsumerSupervisor(
+                num_workers=options["workers"],
+                max_batch_size=options["max_batch_size"],
+                max_linger_ms=options["max_linger_ms"],
+            )
+            supervisor.run()
+            return
+        consumer = Consumer(
+            max_batch_size=options["max_batch_size"],
+            max_linger_ms=options["max_linger_ms"],
+        )
         while True:
             consumer.consume()
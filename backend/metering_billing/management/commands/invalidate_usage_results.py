@@ -0,0 +1,49 @@
+import datetime
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from metering_billing.aggregation.usage_results import invalidate_usage_results
+from metering_billing.models import Organization
+from metering_billing.utils import date_as_max_dt, date_as_min_dt
+
+
+class Command(BaseCommand):
+    "Django command to drop the stored usage of closed billing periods, so it's calculated again from the events"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "organization_id",
+            help="organization_id of the organization whose usage changed",
+        )
+        parser.add_argument(
+            "--event-name",
+            help="only drop the usage of metrics on this event",
+        )
+        parser.add_argument(
+            "--since",
+            type=datetime.date.fromisoformat,
+            help="only drop the usage of periods ending on or after this date",
+        )
+        parser.add_argument(
+            "--until",
+            type=datetime.date.fromisoformat,
+            help="only drop the usage of periods starting on or before this date",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            organization_id = uuid.UUID(options["organization_id"].replace("org_", ""))
+            organization = Organization.objects.get(organization_id=organization_id)
+        except (ValueError, Organization.DoesNotExist):
+            raise CommandError(f"No organization {options['organization_id']}")
+        timezone = organization.timezone
+        start = end = None
+        if options["since"]:
+            start = date_as_min_dt(options["since"], timezone)
+        if options["until"]:
+            end = date_as_max_dt(options["until"], timezone)
+        num_deleted = invalidate_usage_results(
+            organization, event_name=options["event_name"], start=start, end=end
+        )
+        self.stdout.write(f"Dropped {num_deleted} usage results")
@@ -0,0 +1,44 @@
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from metering_billing.aggregation.cagg_policies import reconcile_cagg_policies
+from metering_billing.models import Metric, Organization
+from metering_billing.utils.enums import METRIC_STATUS
+
+
+class Command(BaseCommand):
+    "Django command to bring existing continuous aggregates in line with their configured refresh and compression policies"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--organization",
+            help="organization_id of the only organization to reconcile",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="only print what would change",
+        )
+
+    def handle(self, *args, **options):
+        metrics = Metric.objects.filter(status=METRIC_STATUS.ACTIVE)
+        if options["organization"]:
+            try:
+                organization_id = uuid.UUID(options["organization"].replace("org_", ""))
+                organization = Organization.objects.get(organization_id=organization_id)
+            except (ValueError, Organization.DoesNotExist):
+                raise CommandError(f"No organization {options['organization']}")
+            metrics = metrics.filter(organization=organization)
+        n_changes = 0
+        for metric in metrics.order_by("organization_id", "id"):
+            try:
+                changes = reconcile_cagg_policies(metric, dry_run=options["dry_run"])
+            except Exception as e:
+                self.stderr.write(f"Could not reconcile {metric}: {e}")
+                continue
+            for change in changes:
+                self.stdout.write(change)
+            n_changes += len(changes)
+        verb = "Would make" if options["dry_run"] else "Made"
+        self.stdout.write(f"{verb} {n_changes} changes")
@@ -20,9 +20,9 @@ class Command(BaseCommand):
             every=5,
             period=IntervalSchedule.MINUTES,
         )
-        every_3_minutes, _ = IntervalSchedule.objects.get_or_create(
-            every=3,
-            period=IntervalSchedule.MINUTES,
+        every_10_seconds, _ = IntervalSchedule.objects.get_or_create(
+            every=10,
+            period=IntervalSchedule.SECONDS,
         )
 
         # create tasks
@@ -38,10 +38,18 @@ class Command(BaseCommand):
             defaults={"interval": every_15_mins, "crontab": None},
         )
 
+        # alerts are evaluated as events come in, the full refresh is only there
+        # to catch anything that wasn't written through the event consumer
         PeriodicTask.objects.update_or_create(
             name="Run Alert Refreshes",
             task="metering_billing.tasks.refresh_alerts",
-            defaults={"interval": every_3_minutes, "crontab": None},
+            defaults={"interval": every_hour, "crontab": None},
+        )
+
+        PeriodicTask.objects.update_or_create(
+            name="Run Pending Alert Refreshes",
+            task="metering_billing.tasks.refresh_pending_alerts",
+            defaults={"interval": every_10_seconds, "crontab": None},
         )
 
         PeriodicTask.objects.update_or_create(
@@ -56,6 +64,30 @@ class Command(BaseCommand):
             defaults={"interval": every_15_mins, "crontab": None},
         )
 
+        # a new checkpoint is only written once the last one is old enough, this
+        # just has to come round often enough to notice
+        PeriodicTask.objects.update_or_create(
+            name="Write Gauge Checkpoints",
+            task="metering_billing.tasks.write_gauge_checkpoints",
+            defaults={"interval": every_hour, "crontab": None},
+        )
+
+        # usage counters and rate windows due for reconciliation, reads only use
+        # them once they're reconciled and fall back to the caggs otherwise
+        PeriodicTask.objects.update_or_create(
+            name="Reconcile Usage Counters",
+            task="metering_billing.tasks.reconcile_usage_counters",
+            defaults={"interval": every_5_mins, "crontab": None},
+        )
+
+        # stored usage can't be written for periods with late events in them until
+        # the caggs have been refreshed with those
+        PeriodicTask.objects.update_or_create(
+            name="Clear Materialized Late Events",
+            task="metering_billing.tasks.clear_materialized_late_events",
+            defaults={"interval": every_5_mins, "crontab": None},
+        )
+
         PeriodicTask.objects.update_or_create(
             name="Invoices past due",
             task="metering_billing.tasks.check_past_due_invoices",
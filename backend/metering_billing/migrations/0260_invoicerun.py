@@ -0,0 +1,37 @@
+# Generated by Django 4.0.5 on 2026-10-18 10:00
+
+import uuid
+
+from django.db import migrations, models
+
+import metering_billing.utils.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metering_billing', '0259_remove_subscriptionrecord_stripe_subscription_id_xor_billing_plan_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoiceRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='running', max_length=40)),
+                ('fanout', models.BooleanField(default=False)),
+                ('started_at', models.DateTimeField(default=metering_billing.utils.utils.now_utc)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('num_customers', models.PositiveIntegerField(default=0)),
+                ('num_succeeded', models.PositiveIntegerField(default=0)),
+                ('num_failed', models.PositiveIntegerField(default=0)),
+                ('num_skipped', models.PositiveIntegerField(default=0)),
+                ('failures', models.JSONField(blank=True, default=list)),
+                ('timings', models.JSONField(blank=True, default=dict)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['started_at'], name='metering_bi_started_7b66ac_idx')],
+            },
+        ),
+    ]
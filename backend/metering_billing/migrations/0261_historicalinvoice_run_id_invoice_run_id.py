@@ -0,0 +1,23 @@
+# Generated by Django 4.0.5 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metering_billing', '0260_invoicerun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalinvoice',
+            name='run_id',
+            field=models.UUIDField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='run_id',
+            field=models.UUIDField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.0.5 on 2026-10-18 16:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+import metering_billing.utils.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metering_billing', '0262_usagecounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingUsageAlertRefresh',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cust_id', models.TextField()),
+                ('event_name', models.TextField()),
+                ('marked_at', models.DateTimeField(default=metering_billing.utils.utils.now_utc)),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='metering_billing.organization')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='pendingusagealertrefresh',
+            constraint=models.UniqueConstraint(fields=('organization', 'cust_id', 'event_name'), name='unique_pending_usage_alert_refresh'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.0.5 on 2026-10-18 18:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+import metering_billing.utils.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metering_billing', '0263_pendingusagealertrefresh'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContinuousAggregateRebuild',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='running', max_length=40)),
+                ('chunks_total', models.PositiveIntegerField(default=0)),
+                ('chunks_done', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField(default=metering_billing.utils.utils.now_utc)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('metric', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='metering_billing.metric')),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='metering_billing.organization')),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.5 on 2026-10-18 19:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metering_billing', '0264_continuousaggregaterebuild'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContinuousAggregatePolicy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('refresh_start_offset', models.DurationField(blank=True, null=True)),
+                ('refresh_end_offset', models.DurationField(blank=True, null=True)),
+                ('refresh_schedule_interval', models.DurationField(blank=True, null=True)),
+                ('compress_after', models.DurationField(blank=True, null=True)),
+                ('metric', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='metering_billing.metric')),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cagg_policies', to='metering_billing.organization')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='continuousaggregatepolicy',
+            constraint=models.UniqueConstraint(condition=models.Q(('metric__isnull', True)), fields=('organization',), name='unique_organization_cagg_policy'),
+        ),
+        migrations.AddConstraint(
+            model_name='continuousaggregatepolicy',
+            constraint=models.UniqueConstraint(condition=models.Q(('metric__isnull', False)), fields=('organization', 'metric'), name='unique_metric_cagg_policy'),
+        ),
+    ]
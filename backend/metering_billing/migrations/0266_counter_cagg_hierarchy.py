@@ -0,0 +1,38 @@
+# Generated by Django 4.0.5 on 2026-10-18 20:00
+
+from django.db import migrations
+
+
+def replace_second_caggs(apps, schema_editor):
+    Metric = apps.get_model("metering_billing", "Metric")
+
+    # the per second caggs are replaced by per minute and per hour ones, which get
+    # created along with any missing day cagg the next time the metric is provisioned
+    for metric in Metric.objects.filter(metric_type="counter").exclude(
+        usage_aggregation_type="unique"
+    ):
+        cagg_name = (
+            ("org_" + metric.organization.organization_id.hex)[:22]
+            + "___"
+            + ("metric_" + metric.metric_id.hex)[:22]
+            + "___"
+            + "second"
+        )
+        schema_editor.execute(f"DROP MATERIALIZED VIEW IF EXISTS {cagg_name};")
+        if metric.status == "active":
+            metric.mat_views_provisioned = False
+            metric.save()
+
+        ## INITADMIN WILL TAKE CARE OF PROVISIONING THE VIEWS
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("metering_billing", "0265_continuousaggregatepolicy"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            replace_second_caggs, reverse_code=migrations.RunPython.noop
+        ),
+    ]
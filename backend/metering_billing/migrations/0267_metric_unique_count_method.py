@@ -0,0 +1,23 @@
+# Generated by Django 4.0.5 on 2026-10-18 21:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metering_billing', '0266_counter_cagg_hierarchy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalmetric',
+            name='unique_count_method',
+            field=models.CharField(choices=[('exact', 'Exact'), ('hyperloglog', 'HyperLogLog'), ('bitmap', 'Bitmap')], default='exact', help_text="How distinct values are counted. Only applies to metrics of type 'counter' with an aggregation of unique. 'exact' counts them from the events, 'hyperloglog' and 'bitmap' merge sketches kept per day, approximately and exactly up to 32 bit hash collisions respectively.", max_length=20),
+        ),
+        migrations.AddField(
+            model_name='metric',
+            name='unique_count_method',
+            field=models.CharField(choices=[('exact', 'Exact'), ('hyperloglog', 'HyperLogLog'), ('bitmap', 'Bitmap')], default='exact', help_text="How distinct values are counted. Only applies to metrics of type 'counter' with an aggregation of unique. 'exact' counts them from the events, 'hyperloglog' and 'bitmap' merge sketches kept per day, approximately and exactly up to 32 bit hash collisions respectively.", max_length=20),
+        ),
+    ]
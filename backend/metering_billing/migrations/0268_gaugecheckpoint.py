@@ -0,0 +1,29 @@
+# Generated by Django 4.0.5 on 2026-10-18 22:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metering_billing', '0267_metric_unique_count_method'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GaugeCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uuidv5_customer_id', models.UUIDField()),
+                ('group_values', models.JSONField(blank=True, default=dict)),
+                ('state_at', models.DateTimeField()),
+                ('usage_qty', models.DecimalField(decimal_places=10, max_digits=30)),
+                ('metric', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='metering_billing.metric')),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='metering_billing.organization')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['metric', 'uuidv5_customer_id', 'state_at'], name='metering_bi_metric__dd4665_idx')],
+            },
+        ),
+    ]
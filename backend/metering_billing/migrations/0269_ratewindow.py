@@ -0,0 +1,35 @@
+# Generated by Django 4.0.5 on 2026-10-18 23:00
+
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metering_billing', '0268_gaugecheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateWindow',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period_start', models.DateTimeField()),
+                ('period_end', models.DateTimeField()),
+                ('bucket_seconds', models.PositiveIntegerField()),
+                ('buckets', models.JSONField(blank=True, default=list)),
+                ('max_usage', models.DecimalField(decimal_places=10, default=Decimal('0'), max_digits=30)),
+                ('reconciled_at', models.DateTimeField(blank=True, null=True)),
+                ('billing_record', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='rate_window', to='metering_billing.billingrecord')),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rate_windows', to='metering_billing.customer')),
+                ('metric', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='metering_billing.metric')),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rate_windows', to='metering_billing.organization')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['organization', 'customer', 'period_end'], name='metering_bi_organiz_357d41_idx')],
+            },
+        ),
+    ]
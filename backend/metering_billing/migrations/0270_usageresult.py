@@ -0,0 +1,35 @@
+# Generated by Django 4.0.5 on 2026-10-18 23:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+import metering_billing.utils.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metering_billing', '0269_ratewindow'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('computation_version', models.PositiveSmallIntegerField()),
+                ('period_start', models.DateTimeField()),
+                ('period_end', models.DateTimeField()),
+                ('usage_qty', models.DecimalField(blank=True, decimal_places=10, max_digits=30, null=True)),
+                ('daily_usage', models.JSONField(blank=True, null=True)),
+                ('created', models.DateTimeField(default=metering_billing.utils.utils.now_utc)),
+                ('billing_record', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_results', to='metering_billing.billingrecord')),
+                ('metric', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='metering_billing.metric')),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='metering_billing.organization')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='usageresult',
+            constraint=models.UniqueConstraint(fields=('billing_record', 'metric', 'computation_version'), name='unique_usage_result'),
+        ),
+    ]
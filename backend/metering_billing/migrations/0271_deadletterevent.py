@@ -0,0 +1,24 @@
+# Generated by Django 4.0.5 on 2026-10-18 23:45
+
+from django.db import migrations, models
+
+import metering_billing.utils.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metering_billing', '0270_usageresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeadLetterEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('record', models.TextField()),
+                ('error', models.TextField()),
+                ('created', models.DateTimeField(default=metering_billing.utils.utils.now_utc)),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.0.5 on 2026-10-18 23:58
+
+import uuid
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+import metering_billing.utils.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metering_billing', '0271_deadletterevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventBackfill',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('backfill_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('file', models.FileField(blank=True, upload_to='event_backfills/')),
+                ('file_format', models.CharField(max_length=20)),
+                ('gzipped', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='pending', max_length=40)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created', models.DateTimeField(default=metering_billing.utils.utils.now_utc)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='event_backfills', to='metering_billing.organization')),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.0.5 on 2026-10-18 23:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+import metering_billing.utils.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metering_billing', '0272_eventbackfill'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingLateEvents',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cust_id', models.TextField()),
+                ('event_name', models.TextField()),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('marked_at', models.DateTimeField(default=metering_billing.utils.utils.now_utc)),
+                ('organization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='metering_billing.organization')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['organization', 'cust_id', 'event_name'], name='metering_bi_organiz_ea38ff_idx')],
+            },
+        ),
+    ]
@@ -26,6 +26,7 @@ from django.db.models import Count, F, FloatField, Q, Sum
 from django.db.models.constraints import CheckConstraint, UniqueConstraint
 from django.db.models.functions import Cast, Coalesce
 from django.utils.translation import gettext_lazy as _
+from metering_billing.entitlements import invalidate_customers_entitlements
 from metering_billing.exceptions.exceptions import (
     ExternalConnectionFailure,
     NotEditable,
@@ -34,6 +35,7 @@ from metering_billing.exceptions.exceptions import (
     SubscriptionAlreadyEnded,
 )
 from metering_billing.payment_processors import PAYMENT_PROCESSOR_MAP
+from metering_billing.pricing import get_tier_table, invalidate_tier_table
 from metering_billing.utils import (
     calculate_end_date,
     convert_to_date,
@@ -48,6 +50,7 @@ from metering_billing.utils import (
 from metering_billing.utils.enums import (
     ACCOUNTS_RECEIVABLE_TRANSACTION_TYPES,
     ANALYSIS_KPI,
+    CAGG_REBUILD_STATUS,
     CATEGORICAL_FILTER_OPERATORS,
     CHARGEABLE_ITEM_TYPE,
     CUSTOMER_BALANCE_ADJUSTMENT_STATUS,
@@ -69,6 +72,7 @@ from metering_billing.utils.enums import (
     SUPPORTED_CURRENCIES_VERSION,
     TAG_GROUP,
     TAX_PROVIDER,
+    UNIQUE_COUNT_METHOD,
     WEBHOOK_TRIGGER_EVENTS,
 )
 from metering_billing.webhooks import invoice_paid_webhook, usage_alert_webhook
@@ -310,7 +314,9 @@ class Organization(models.Model):
         return self.organization_name
 
     def save(self, *args, **kwargs):
-        from metering_billing.aggregation.billable_metrics import METRIC_HANDLER_MAP
+        from metering_billing.aggregation.cagg_rebuild import (
+            rebuild_continuous_aggregates,
+        )
 
         new = self._state.adding is True
         # self._state.adding represents whether creating new instance or updating
@@ -328,19 +334,30 @@ class Organization(models.Model):
             self.team = Team.objects.create(name=self.organization_name)
         if self.subscription_filter_keys is None:
             self.subscription_filter_keys = []
-        self.subscription_filter_keys = sorted(
+        subscription_filter_keys = sorted(
             list(
                 set(self.subscription_filter_keys).union(
                     set(self.__original_subscription_filter_keys)
                 )
             )
         )
+        if new:
+            self.subscription_filter_keys = subscription_filter_keys
+        else:
+            # the keys are only written along with the caggs grouped by them, so a
+            # stale copy of the organization can't write the old ones back
+            update_fields = kwargs.get("update_fields") or [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key
+            ]
+            kwargs["update_fields"] = [
+                field for field in update_fields if field != "subscription_filter_keys"
+            ]
         super(Organization, self).save(*args, **kwargs)
-        if self.subscription_filter_keys != self.__original_subscription_filter_keys:
-            for metric in self.metrics.all():
-                METRIC_HANDLER_MAP[metric.metric_type].create_continuous_aggregate(
-                    metric, refresh=True
-                )
+        if subscription_filter_keys != self.__original_subscription_filter_keys:
+            rebuild_continuous_aggregates(self, subscription_filter_keys)
+        self.subscription_filter_keys = subscription_filter_keys
         self.__original_timezone = self.timezone
         self.__original_subscription_filter_keys = self.subscription_filter_keys
         if new:
@@ -1211,6 +1228,12 @@ class Metric(models.Model):
         default=False,
         help_text="Whether or not this metric is a cost metric (used to track costs to your business).",
     )
+    unique_count_method = models.CharField(
+        choices=UNIQUE_COUNT_METHOD.choices,
+        default=UNIQUE_COUNT_METHOD.EXACT,
+        max_length=20,
+        help_text="How distinct values are counted. Only applies to metrics of type 'counter' with an aggregation of unique. 'exact' counts them from the events, 'hyperloglog' and 'bitmap' merge sketches kept per day, approximately and exactly up to 32 bit hash collisions respectively.",
+    )
     custom_sql = models.TextField(
         blank=True,
         null=True,
@@ -1321,23 +1344,73 @@ class Metric(models.Model):
 
     def get_billing_record_total_billable_usage(self, billing_record):
         from metering_billing.aggregation.billable_metrics import METRIC_HANDLER_MAP
+        from metering_billing.aggregation.usage_prefetch import (
+            get_prefetched_billable_usage,
+        )
+        from metering_billing.aggregation.usage_results import (
+            get_cached_total_usage,
+            store_total_usage,
+        )
+
+        usage = get_prefetched_billable_usage(self, billing_record)
+        if usage is not None:
+            return usage
+        usage = get_cached_total_usage(self, billing_record)
+        if usage is not None:
+            return usage
 
         if self.status == METRIC_STATUS.ACTIVE and not self.mat_views_provisioned:
             self.provision_materialized_views()
 
         handler = METRIC_HANDLER_MAP[self.metric_type]
         usage = handler.get_billing_record_total_billable_usage(self, billing_record)
+        store_total_usage(self, billing_record, usage)
+
+        return usage
+
+    def get_total_billable_usage_bulk(self, billing_records):
+        from metering_billing.aggregation.billable_metrics import METRIC_HANDLER_MAP
+        from metering_billing.aggregation.usage_results import (
+            get_cached_total_usages,
+            store_total_usage,
+        )
+
+        usage = get_cached_total_usages(self, billing_records)
+        billing_records = [br for br in billing_records if br.pk not in usage]
+        if len(billing_records) == 0:
+            return usage
+
+        if self.status == METRIC_STATUS.ACTIVE and not self.mat_views_provisioned:
+            self.provision_materialized_views()
+
+        handler = METRIC_HANDLER_MAP[self.metric_type]
+        calculated_usage = handler.get_total_billable_usage_bulk(self, billing_records)
+        for billing_record in billing_records:
+            if billing_record.pk in calculated_usage:
+                store_total_usage(
+                    self, billing_record, calculated_usage[billing_record.pk]
+                )
+        usage.update(calculated_usage)
 
         return usage
 
     def get_billing_record_daily_billable_usage(self, billing_record):
         from metering_billing.aggregation.billable_metrics import METRIC_HANDLER_MAP
+        from metering_billing.aggregation.usage_results import (
+            get_cached_daily_usage,
+            store_daily_usage,
+        )
+
+        usage = get_cached_daily_usage(self, billing_record)
+        if usage is not None:
+            return usage
 
         if self.status == METRIC_STATUS.ACTIVE and not self.mat_views_provisioned:
             self.provision_materialized_views()
 
         handler = METRIC_HANDLER_MAP[self.metric_type]
         usage = handler.get_billing_record_daily_billable_usage(self, billing_record)
+        store_daily_usage(self, billing_record, usage)
 
         return usage
 
@@ -1485,6 +1558,13 @@ class PriceTier(models.Model):
                 if end is None:
                     raise ValidationError("Only last tier can be open ended")
         super().save(*args, **kwargs)
+        invalidate_tier_table(self.plan_component_id)
+
+    def delete(self, *args, **kwargs):
+        plan_component_id = self.plan_component_id
+        result = super().delete(*args, **kwargs)
+        invalidate_tier_table(plan_component_id)
+        return result
 
     def calculate_revenue(
         self, usage: float, prev_tier_end=False, bulk_pricing_enabled=False
@@ -1768,25 +1848,13 @@ class PlanComponent(models.Model):
             revenue = max(revenue - revenue_from_prepaid_units, 0)
         return {"revenue": revenue, "usage_qty": usage_qty}
 
+    def get_tier_table(self):
+        return get_tier_table(self)
+
     def tier_rating_function(self, usage_qty):
-        revenue = 0
-        tiers = self.tiers.all()
-        for i, tier in enumerate(tiers):
-            if i > 0:
-                # this is for determining whether this is a continuous or discontinuous range
-                prev_tier_end = tiers[i - 1].range_end
-                tier_revenue = tier.calculate_revenue(
-                    usage_qty,
-                    prev_tier_end=prev_tier_end,
-                    bulk_pricing_enabled=self.bulk_pricing_enabled,
-                )
-            else:
-                tier_revenue = tier.calculate_revenue(
-                    usage_qty, bulk_pricing_enabled=self.bulk_pricing_enabled
-                )
-            revenue += tier_revenue
-        revenue = convert_to_decimal(revenue)
-        return revenue
+        return self.get_tier_table().rate(
+            usage_qty, bulk_pricing_enabled=self.bulk_pricing_enabled
+        )
 
     def calculate_revenue_per_day(
         self, billing_record
@@ -1803,23 +1871,19 @@ class PlanComponent(models.Model):
             period = convert_to_date(period)
             results[period] = {"revenue": Decimal(0), "usage_qty": Decimal(0)}
 
-        running_total_revenue = Decimal(0)
+        daily_usage = []
+        cumulative_usage = []
         running_total_usage = Decimal(0)
         for date, usage_qty in usage_per_day.items():
             date = convert_to_date(date)
             usage_qty = convert_to_decimal(usage_qty)
             running_total_usage += usage_qty
-            revenue = Decimal(0)
-            tiers = self.tiers.all()
-            for i, tier in enumerate(tiers):
-                if i > 0:
-                    prev_tier_end = tiers[i - 1].range_end
-                    tier_revenue = tier.calculate_revenue(
-                        running_total_usage, prev_tier_end=prev_tier_end
-                    )
-                else:
-                    tier_revenue = tier.calculate_revenue(running_total_usage)
-                revenue += convert_to_decimal(tier_revenue)
+            daily_usage.append((date, usage_qty))
+            cumulative_usage.append(running_total_usage)
+        # rate every day's running total at once, then take the daily differences
+        cumulative_revenue = self.get_tier_table().rate_cumulative(cumulative_usage)
+        running_total_revenue = Decimal(0)
+        for (date, usage_qty), revenue in zip(daily_usage, cumulative_revenue):
             date_revenue = revenue - running_total_revenue
             running_total_revenue += date_revenue
             if date in results:
@@ -1887,6 +1951,9 @@ class Invoice(models.Model):
         "SubscriptionRecord", related_name="invoices"
     )
     invoice_past_due_webhook_sent = models.BooleanField(default=False)
+    # the invoicing run that generated this invoice, so a retried run can tell
+    # what it already billed
+    run_id = models.UUIDField(null=True, blank=True, db_index=True)
     history = HistoricalRecords()
     __original_payment_status = None
 
@@ -2754,12 +2821,29 @@ class ExternalPlanLink(models.Model):
         ]
 
 
-class StripeSubscriptionRecordManager(models.Manager):
+class CustomerEntitlementsQuerySet(models.QuerySet):
+    """Invalidates the entitlements of the customers whose rows get updated.
+
+    Saves and deletes do it through signals, which .update() doesn't send.
+    """
+
+    def update(self, **kwargs):
+        customer_pks = set(self.values_list("customer_id", flat=True))
+        num_updated = super().update(**kwargs)
+        invalidate_customers_entitlements(customer_pks)
+        return num_updated
+
+
+class StripeSubscriptionRecordManager(
+    models.Manager.from_queryset(CustomerEntitlementsQuerySet)
+):
     def get_queryset(self):
         return super().get_queryset().filter(stripe_subscription_id__isnull=False)
 
 
-class SubscriptionRecordManager(models.Manager):
+class SubscriptionRecordManager(
+    models.Manager.from_queryset(CustomerEntitlementsQuerySet)
+):
     def get_queryset(self):
         return super().get_queryset().filter(stripe_subscription_id__isnull=True)
 
@@ -3445,6 +3529,8 @@ class BillingRecord(models.Model):
     next_invoicing_date = models.DateTimeField()
     fully_billed = models.BooleanField(default=False)
 
+    objects = CustomerEntitlementsQuerySet.as_manager()
+
     class Meta:
         constraints = [
             models.CheckConstraint(
@@ -3529,21 +3615,33 @@ class BillingRecord(models.Model):
                 return full_amount
 
     def handle_invoicing(self, invoice_date):
-        if self.next_invoicing_date < invoice_date:
-            found_next = False
-            for invoicing_date in sorted(self.invoicing_dates):
-                if invoicing_date > self.next_invoicing_date:
-                    self.next_invoicing_date = invoicing_date
+        from metering_billing.locks import (
+            BILLING_RECORD_INVOICING_LOCK,
+            advisory_xact_lock,
+        )
+
+        with transaction.atomic():
+            # work off the latest state, another invoicing of this billing record
+            # may have moved it forward since we loaded it
+            advisory_xact_lock(BILLING_RECORD_INVOICING_LOCK, self.pk)
+            self.refresh_from_db(
+                fields=["next_invoicing_date", "fully_billed", "invoicing_dates"]
+            )
+            if self.next_invoicing_date < invoice_date:
+                found_next = False
+                for invoicing_date in sorted(self.invoicing_dates):
+                    if invoicing_date > self.next_invoicing_date:
+                        self.next_invoicing_date = invoicing_date
+                        self.save()
+                        found_next = True
+                        break
+                if not found_next:
+                    self.fully_billed = True
+                    self.next_invoicing_date = self.invoicing_dates[-1]
                     self.save()
-                    found_next = True
-                    break
-            if not found_next:
-                self.fully_billed = True
-                self.next_invoicing_date = self.invoicing_dates[-1]
-                self.save()
-        else:
-            # do nothing, we have an invociing date coming up. This invoice was likely from attaching a subscription or something
-            pass
+            else:
+                # do nothing, we have an invociing date coming up. This invoice was likely from attaching a subscription or something
+                pass
 
     def calculate_earned_revenue_per_day(self) -> dict:
         dates = dates_bwn_two_dts(self.start_date, self.end_date)
@@ -3700,6 +3798,189 @@ class ComponentChargeRecord(models.Model):
         super().save(*args, **kwargs)
 
 
+class InvoiceRun(models.Model):
+    """
+    Summary of a periodic invoicing run: which customers were invoiced, which failed and how long it took.
+    """
+
+    class Status(models.TextChoices):
+        RUNNING = ("running", _("Running"))
+        COMPLETED = ("completed", _("Completed"))
+        FAILED = ("failed", _("Failed"))
+
+    run_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    status = models.CharField(
+        choices=Status.choices, default=Status.RUNNING, max_length=40
+    )
+    fanout = models.BooleanField(default=False)
+    started_at = models.DateTimeField(default=now_utc)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    num_customers = models.PositiveIntegerField(default=0)
+    num_succeeded = models.PositiveIntegerField(default=0)
+    num_failed = models.PositiveIntegerField(default=0)
+    num_skipped = models.PositiveIntegerField(default=0)
+    failures = models.JSONField(default=list, blank=True)
+    timings = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["started_at"]),
+        ]
+
+    def __str__(self):
+        return f"Invoice run {self.run_id} - {self.status}"
+
+    def record_results(self, results):
+        """Fill in the summary from a list of per customer results.
+
+        Each result is a dict with customer_id, organization_id, status (one of
+        succeeded, failed or skipped), seconds and, for failures, error.
+        """
+        results = [result for result in results if result]
+        durations = [result["seconds"] for result in results]
+        self.num_customers = len(results)
+        self.num_succeeded = sum(1 for r in results if r["status"] == "succeeded")
+        self.num_failed = sum(1 for r in results if r["status"] == "failed")
+        self.num_skipped = sum(1 for r in results if r["status"] == "skipped")
+        self.failures = [
+            {
+                "customer_id": r["customer_id"],
+                "organization_id": r["organization_id"],
+                "error": r.get("error"),
+            }
+            for r in results
+            if r["status"] == "failed"
+        ]
+        self.finished_at = now_utc()
+        slowest = sorted(results, key=lambda r: r["seconds"], reverse=True)[:10]
+        self.timings = {
+            "total_seconds": (self.finished_at - self.started_at).total_seconds(),
+            "customer_seconds": sum(durations),
+            "max_customer_seconds": max(durations, default=0),
+            "slowest_customers": [
+                {"customer_id": r["customer_id"], "seconds": r["seconds"]}
+                for r in slowest
+            ],
+        }
+        self.status = self.Status.COMPLETED
+        self.save()
+
+
+class UsageCounter(models.Model):
+    """
+    Running total of a counter metric's usage over a billing record, incremented by the event consumer as it writes events. It's periodically reconciled against the continuous aggregates, which stay the source of truth for invoicing.
+    """
+
+    organization = models.ForeignKey(
+        Organization, on_delete=models.CASCADE, related_name="usage_counters"
+    )
+    billing_record = models.OneToOneField(
+        "BillingRecord", on_delete=models.CASCADE, related_name="usage_counter"
+    )
+    metric = models.ForeignKey(Metric, on_delete=models.CASCADE, related_name="+")
+    customer = models.ForeignKey(
+        Customer, on_delete=models.CASCADE, related_name="usage_counters"
+    )
+    period_start = models.DateTimeField()
+    period_end = models.DateTimeField()
+    value = models.DecimalField(max_digits=30, decimal_places=10, default=Decimal(0))
+    reconciled_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["organization", "customer", "period_end"]),
+        ]
+
+    def __str__(self):
+        return f"Usage counter for {self.billing_record_id}: {self.value}"
+
+
+class RateWindow(models.Model):
+    """
+    Sliding window state of a rate metric over a billing record: a ring of the usage in the buckets the metric's lookback window is split into, and the highest rate of the period so far. Fed by the event consumer like a UsageCounter and reconciled against the continuous aggregate the same way.
+    """
+
+    organization = models.ForeignKey(
+        Organization, on_delete=models.CASCADE, related_name="rate_windows"
+    )
+    billing_record = models.OneToOneField(
+        "BillingRecord", on_delete=models.CASCADE, related_name="rate_window"
+    )
+    metric = models.ForeignKey(Metric, on_delete=models.CASCADE, related_name="+")
+    customer = models.ForeignKey(
+        Customer, on_delete=models.CASCADE, related_name="rate_windows"
+    )
+    period_start = models.DateTimeField()
+    period_end = models.DateTimeField()
+    bucket_seconds = models.PositiveIntegerField()
+    buckets = models.JSONField(default=list, blank=True)
+    max_usage = models.DecimalField(
+        max_digits=30, decimal_places=10, default=Decimal(0)
+    )
+    reconciled_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["organization", "customer", "period_end"]),
+        ]
+
+    def __str__(self):
+        return f"Rate window for {self.billing_record_id}: {self.max_usage}"
+
+
+class UsageResult(models.Model):
+    """
+    Usage of a billing record, kept once its period is over and no more events can arrive for it, so that it isn't calculated from the aggregates again. Results of an older computation_version are ignored.
+    """
+
+    organization = models.ForeignKey(
+        Organization, on_delete=models.CASCADE, related_name="+"
+    )
+    billing_record = models.ForeignKey(
+        "BillingRecord", on_delete=models.CASCADE, related_name="usage_results"
+    )
+    metric = models.ForeignKey(Metric, on_delete=models.CASCADE, related_name="+")
+    computation_version = models.PositiveSmallIntegerField()
+    period_start = models.DateTimeField()
+    period_end = models.DateTimeField()
+    usage_qty = models.DecimalField(
+        max_digits=30, decimal_places=10, null=True, blank=True
+    )
+    daily_usage = models.JSONField(null=True, blank=True)
+    created = models.DateTimeField(default=now_utc)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(
+                fields=["billing_record", "metric", "computation_version"],
+                name="unique_usage_result",
+            ),
+        ]
+
+    def __str__(self):
+        return f"Usage result for {self.billing_record_id}: {self.usage_qty}"
+
+
+class PendingLateEvents(models.Model):
+    """
+    Late events the event consumer wrote into a customer's periods that are already over, between start and end. They can sit below the continuous aggregates' materialization watermark until the next refresh, so no usage result overlapping them is stored until clear_materialized_late_events sees that every refresh job of the event's metrics has run since marked_at.
+    """
+
+    organization = models.ForeignKey(
+        Organization, on_delete=models.CASCADE, related_name="+"
+    )
+    cust_id = models.TextField()
+    event_name = models.TextField()
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    marked_at = models.DateTimeField(default=now_utc)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["organization", "cust_id", "event_name"]),
+        ]
+
+
 class Analysis(models.Model):
     organization = models.ForeignKey(
         Organization, on_delete=models.CASCADE, related_name="historical_analyses"
@@ -3952,14 +4233,23 @@ class UsageAlertResult(models.Model):
             end_date__gt=now,
             component__billable_metric=metric,
         ).first()
-        new_value = metric.get_billing_record_total_billable_usage(billing_record)
+        if metric.metric_type == METRIC_TYPE.COUNTER:
+            # running total, read from the usage counter when there is one
+            new_value = metric.get_billing_record_current_usage(billing_record)
+        else:
+            new_value = metric.get_billing_record_total_billable_usage(billing_record)
+        self.record_value(new_value, now)
+
+    def record_value(self, new_value, now):
+        # send the alert if the new value crosses the threshold, then save it as
+        # the last run value
         if (
             new_value >= self.alert.threshold
             and self.last_run_value < self.alert.threshold
         ):
             # send alert
             usage_alert_webhook(
-                self.alert, self, subscription_record, self.organization
+                self.alert, self, self.subscription_record, self.organization
             )
             self.triggered_count = self.triggered_count + 1
         self.last_run_value = new_value
@@ -3967,6 +4257,164 @@ class UsageAlertResult(models.Model):
         self.save()
 
 
+class PendingUsageAlertRefresh(models.Model):
+    """
+    A customer that got new events for an event name some usage alert's metric is based on. The event consumer marks them as it writes events, refresh_pending_alerts evaluates the customer's alerts for that event name and clears the mark.
+    """
+
+    organization = models.ForeignKey(
+        Organization, on_delete=models.CASCADE, related_name="+"
+    )
+    cust_id = models.TextField()
+    event_name = models.TextField()
+    marked_at = models.DateTimeField(default=now_utc)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(
+                fields=["organization", "cust_id", "event_name"],
+                name="unique_pending_usage_alert_refresh",
+            ),
+        ]
+
+
+class DeadLetterEvent(models.Model):
+    """
+    An event record the event consumer couldn't write, kept here instead of holding up its partition. record is the record as consumed, serialized as JSON, and error is why it was rejected.
+    """
+
+    record = models.TextField()
+    error = models.TextField()
+    created = models.DateTimeField(default=now_utc)
+
+    def __str__(self):
+        return f"Dead letter event {self.pk}: {self.error}"
+
+
+class EventBackfill(models.Model):
+    """
+    A file of historical events uploaded through the admin backfill endpoint, imported by a celery task. Clients poll it for the status, and the counts in result once it's done. The file goes to the default file storage, which the workers have to be able to read, and is deleted once it's been imported.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = ("pending", _("Pending"))
+        RUNNING = ("running", _("Running"))
+        SUCCEEDED = ("succeeded", _("Succeeded"))
+        FAILED = ("failed", _("Failed"))
+
+    organization = models.ForeignKey(
+        Organization, on_delete=models.CASCADE, related_name="event_backfills"
+    )
+    backfill_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    file = models.FileField(upload_to="event_backfills/", blank=True)
+    file_format = models.CharField(max_length=20)
+    gzipped = models.BooleanField(default=False)
+    status = models.CharField(
+        choices=Status.choices, default=Status.PENDING, max_length=40
+    )
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(default=now_utc)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Event backfill {self.backfill_id} - {self.status}"
+
+
+class ContinuousAggregateRebuild(models.Model):
+    """
+    A rebuild of a metric's continuous aggregates, eg. after the organization's subscription filter keys changed. The new aggregates are built next to the old ones and swapped in when they're complete, the chunk counts track how far along that is.
+    """
+
+    organization = models.ForeignKey(
+        Organization, on_delete=models.CASCADE, related_name="+"
+    )
+    metric = models.ForeignKey(Metric, on_delete=models.CASCADE, related_name="+")
+    status = models.CharField(
+        max_length=40,
+        choices=CAGG_REBUILD_STATUS.choices,
+        default=CAGG_REBUILD_STATUS.RUNNING,
+    )
+    chunks_total = models.PositiveIntegerField(default=0)
+    chunks_done = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(default=now_utc)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.metric} rebuild {self.chunks_done}/{self.chunks_total}"
+
+
+class ContinuousAggregatePolicy(models.Model):
+    """
+    How often an organization's continuous aggregates are refreshed, over which window, and after how long they're compressed. With a metric, it overrides the organization's policy for that metric's aggregates only. Empty fields fall back to the organization's policy, then to the defaults.
+    """
+
+    organization = models.ForeignKey(
+        Organization, on_delete=models.CASCADE, related_name="cagg_policies"
+    )
+    metric = models.ForeignKey(
+        Metric, on_delete=models.CASCADE, related_name="+", null=True, blank=True
+    )
+    refresh_start_offset = models.DurationField(null=True, blank=True)
+    refresh_end_offset = models.DurationField(null=True, blank=True)
+    refresh_schedule_interval = models.DurationField(null=True, blank=True)
+    compress_after = models.DurationField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(
+                fields=["organization"],
+                condition=Q(metric__isnull=True),
+                name="unique_organization_cagg_policy",
+            ),
+            UniqueConstraint(
+                fields=["organization", "metric"],
+                condition=Q(metric__isnull=False),
+                name="unique_metric_cagg_policy",
+            ),
+        ]
+
+    def __str__(self):
+        if self.metric_id is None:
+            return f"{self.organization} cagg policy"
+        return f"{self.metric} cagg policy"
+
+    def clean(self):
+        from metering_billing.aggregation.cagg_policies import (
+            validate_cagg_policy_change,
+        )
+
+        try:
+            validate_cagg_policy_change(self)
+        except ValueError as e:
+            raise ValidationError(str(e))
+
+
+class GaugeCheckpoint(models.Model):
+    """
+    State of a gauge metric for a customer and group of subscription filter values, as of just before state_at. Usage queries start from the latest checkpoint instead of replaying the whole history of the continuous aggregate. Only written for days the aggregate won't refresh anymore, and deleted when those days change anyway.
+    """
+
+    organization = models.ForeignKey(
+        Organization, on_delete=models.CASCADE, related_name="+"
+    )
+    metric = models.ForeignKey(Metric, on_delete=models.CASCADE, related_name="+")
+    uuidv5_customer_id = models.UUIDField()
+    group_values = models.JSONField(default=dict, blank=True)
+    state_at = models.DateTimeField()
+    usage_qty = models.DecimalField(max_digits=30, decimal_places=10)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["metric", "uuidv5_customer_id", "state_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.metric} checkpoint at {self.state_at}"
+
+
 class StripeCustomerIntegration(models.Model):
     organization = models.ForeignKey(
         Organization, on_delete=models.CASCADE, related_name="stripe_customer_links"
@@ -1,12 +1,11 @@
 import logging
 
-from django.core.cache import cache
 from rest_framework import permissions
 from rest_framework_api_key.permissions import BaseHasAPIKey
 
+from metering_billing.api_keys import get_organization_pk_from_key
 from metering_billing.exceptions import NoAPIKeyProvided
 from metering_billing.models import APIToken, Organization
-from metering_billing.utils import now_utc
 
 logger = logging.getLogger("django.server")
 
@@ -30,24 +29,10 @@ class APIKey:
 
     @property
     def organization(self):
-        organization_pk = cache.get(self.api_key)
-        if organization_pk:
-            return Organization.objects.get(pk=organization_pk)
-
-        try:
-            api_token = APIToken.objects.get_from_key(self.api_key)
-        except APIToken.DoesNotExist:
+        organization_pk = get_organization_pk_from_key(self.api_key)
+        if organization_pk is None:
             return None
-
-        organization_pk = api_token.organization.pk
-        expiry_date = api_token.expiry_date
-        timeout = (
-            60 * 60 * 24
-            if expiry_date is None
-            else (expiry_date - now_utc()).total_seconds()
-        )
-        cache.set(self.api_key, organization_pk, timeout)
-        return api_token.organization
+        return Organization.objects.get(pk=organization_pk)
 
 
 class HasUserAPIKey(BaseHasAPIKey):
@@ -56,6 +41,14 @@ class HasUserAPIKey(BaseHasAPIKey):
     def get_key(self, request):
         return APIKey.from_request(request).api_key
 
+    def has_permission(self, request, view):
+        # same check as BaseHasAPIKey, but going through the API key caches
+        # instead of hashing the key on every request
+        key = self.get_key(request)
+        if not key:
+            return False
+        return get_organization_pk_from_key(key) is not None
+
 
 class ValidOrganization(permissions.BasePermission):
     """
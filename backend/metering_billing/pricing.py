@@ -0,0 +1,418 @@
+import logging
+import math
+import threading
+import time
+import uuid
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from decimal import ROUND_UP as DECIMAL_ROUND_UP
+from decimal import Decimal
+from typing import NamedTuple, Optional
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from metering_billing.utils import convert_to_decimal
+
+logger = logging.getLogger("django.server")
+
+MAX_CACHED_TIER_TABLES = 2048
+TIER_TABLE_CACHE_TTL = settings.TIER_TABLE_CACHE_TTL
+# bumped in the shared cache whenever a price tier changes. Every process compares
+# it with the one its tables were built under before using them
+TIER_TABLE_VERSION_KEY = "tier_table_version"
+
+# revenue is kept with 10 decimal places everywhere, same as convert_to_decimal
+REVENUE_DECIMAL_PLACES = 10
+REVENUE_QUANTUM = Decimal(".0000000001")
+# the vectorized path does everything in int64, anything that could get close to
+# overflowing it goes through Decimal instead
+MAX_SCALED_INT = 2**62
+
+# mirrors PriceTier.PriceTierType and PriceTier.BatchRoundingType, kept as plain
+# ints here so the rating loop never touches the model classes
+FLAT = 1
+PER_UNIT = 2
+ROUND_UP = 1
+ROUND_DOWN = 2
+ROUND_NEAREST = 3
+
+
+class CompiledTier(NamedTuple):
+    type: int
+    range_start: Decimal
+    range_end: Optional[Decimal]
+    cost_per_batch: Optional[Decimal]
+    metric_units_per_batch: Optional[Decimal]
+    batch_rounding_type: Optional[int]
+    # whether there's a gap of 1 between the end of the previous tier and this one
+    discontinuous: bool
+
+    def revenue(self, usage, bulk_pricing_enabled=False):
+        """Same result as PriceTier.calculate_revenue, for an already converted usage"""
+        if bulk_pricing_enabled:
+            if self.range_end is not None and self.range_end < usage:
+                return 0
+            in_range = self.range_start < usage
+        elif self.discontinuous:
+            in_range = self.range_start <= usage + 1
+        else:
+            in_range = self.range_start < usage or self.range_start == 0
+        if not in_range:
+            return 0
+        if self.type == FLAT:
+            return 0 + self.cost_per_batch
+        if self.type != PER_UNIT:
+            return 0
+        if bulk_pricing_enabled:
+            billable_units = usage
+        elif self.range_end is not None:
+            billable_units = min(
+                usage - self.range_start, self.range_end - self.range_start
+            )
+        else:
+            billable_units = usage - self.range_start
+        if self.discontinuous:
+            billable_units += 1
+        billable_batches = billable_units / self.metric_units_per_batch
+        if self.batch_rounding_type == ROUND_UP:
+            billable_batches = math.ceil(billable_batches)
+        elif self.batch_rounding_type == ROUND_DOWN:
+            billable_batches = math.floor(billable_batches)
+        elif self.batch_rounding_type == ROUND_NEAREST:
+            billable_batches = round(billable_batches)
+        return 0 + self.cost_per_batch * billable_batches
+
+
+class TierTable:
+    """Immutable, sorted pricing table of a plan component.
+
+    Tiers that end below the usage being rated always contribute the same amount,
+    so their revenue is accumulated up front. Rating a usage is then a couple of
+    binary searches, plus evaluating the one or two tiers the usage falls into.
+    """
+
+    __slots__ = (
+        "tiers",
+        "starts",
+        "ends",
+        "cumulative_revenue",
+        "cumulative_rounded_revenue",
+    )
+
+    def __init__(self, tiers):
+        tiers = tuple(tiers)
+        # tiers that end below a usage are always a prefix of the table, which
+        # only holds if the ends are ordered too. The last tier can be open ended.
+        ends = tuple(t.range_end for t in tiers if t.range_end is not None)
+        assert list(ends) == sorted(ends), "Tier ranges must not overlap"
+        cumulative_revenue = [0]
+        cumulative_rounded_revenue = [Decimal(0)]
+        for tier in tiers:
+            if tier.range_end is None:
+                break
+            full_revenue = tier.revenue(tier.range_end + 1)
+            cumulative_revenue.append(cumulative_revenue[-1] + full_revenue)
+            cumulative_rounded_revenue.append(
+                cumulative_rounded_revenue[-1] + convert_to_decimal(full_revenue)
+            )
+        object.__setattr__(self, "tiers", tiers)
+        object.__setattr__(self, "starts", tuple(t.range_start for t in tiers))
+        object.__setattr__(self, "ends", ends)
+        object.__setattr__(self, "cumulative_revenue", tuple(cumulative_revenue))
+        object.__setattr__(
+            self, "cumulative_rounded_revenue", tuple(cumulative_rounded_revenue)
+        )
+
+    def __setattr__(self, name, value):
+        raise AttributeError("TierTable is immutable")
+
+    def __len__(self):
+        return len(self.tiers)
+
+    @classmethod
+    def from_tiers(cls, price_tiers):
+        price_tiers = sorted(price_tiers, key=lambda x: x.range_start)
+        compiled = []
+        prev_tier_end = False
+        for tier in price_tiers:
+            compiled.append(
+                CompiledTier(
+                    type=tier.type,
+                    range_start=tier.range_start,
+                    range_end=tier.range_end,
+                    cost_per_batch=tier.cost_per_batch,
+                    metric_units_per_batch=tier.metric_units_per_batch,
+                    batch_rounding_type=tier.batch_rounding_type,
+                    discontinuous=(
+                        prev_tier_end != tier.range_start and prev_tier_end is not None
+                    ),
+                )
+            )
+            prev_tier_end = tier.range_end
+        return cls(compiled)
+
+    def rate(self, usage_qty, bulk_pricing_enabled=False):
+        """Revenue for usage_qty, equivalent to summing PriceTier.calculate_revenue"""
+        return convert_to_decimal(self._rate(usage_qty, bulk_pricing_enabled, False))
+
+    def rate_rounded_per_tier(self, usage_qty):
+        """Like rate, but rounding each tier's revenue before adding them up"""
+        return self._rate(usage_qty, False, True)
+
+    def rate_cumulative(self, cumulative_usages):
+        """rate_rounded_per_tier for each of a sequence of cumulative usages.
+
+        Usually evaluated for all of them at once with NumPy, on integers scaled
+        to the number of decimal places actually in use. Tier tables or usages
+        that can't be represented exactly that way are rated one by one in
+        Decimal, only re-rating when the usage changes.
+        """
+        usages = [_to_revenue_decimal(x) for x in cumulative_usages]
+        if len(usages) == 0:
+            return []
+        revenues = self._rate_cumulative_vectorized(usages)
+        if revenues is not None:
+            return revenues
+        revenues = []
+        prev_usage = prev_revenue = None
+        for usage in usages:
+            if prev_revenue is None or usage != prev_usage:
+                prev_usage = usage
+                prev_revenue = self.rate_rounded_per_tier(usage)
+            revenues.append(prev_revenue)
+        return revenues
+
+    def _rate_cumulative_vectorized(self, usages):
+        # every tier has to be a linear function of the usage with an exact
+        # Decimal result, which rules out dividing by the units per batch
+        for tier in self.tiers:
+            if tier.type == FLAT and tier.cost_per_batch is None:
+                return None
+            if tier.type == PER_UNIT and (
+                tier.cost_per_batch is None or tier.metric_units_per_batch != 1
+            ):
+                return None
+        boundaries = [t.range_start for t in self.tiers] + list(self.ends)
+        # usages come in with 10 decimal places, but are usually whole numbers. Use
+        # as few places as possible to leave room for multiplying by the costs.
+        scaled_usages = [int(x.scaleb(REVENUE_DECIMAL_PLACES)) for x in usages]
+        scaled_boundaries = [
+            int(x.scaleb(REVENUE_DECIMAL_PLACES)) for x in boundaries
+        ]
+        usage_places = _decimal_places(scaled_usages + scaled_boundaries)
+        divisor = 10 ** (REVENUE_DECIMAL_PLACES - usage_places)
+        scaled_usages = [x // divisor for x in scaled_usages]
+        costs = [t.cost_per_batch for t in self.tiers if t.cost_per_batch is not None]
+        cost_places = _decimal_places(
+            [int(x.scaleb(REVENUE_DECIMAL_PLACES)) for x in costs]
+        )
+        usage_scale = 10**usage_places
+        max_units = max(abs(x) for x in scaled_usages)
+        max_units += max([abs(x) // divisor for x in scaled_boundaries] + [0])
+        max_units += usage_scale
+        total_bound = 0
+        for tier in self.tiers:
+            if tier.type not in (FLAT, PER_UNIT):
+                continue
+            scaled_cost = abs(int(tier.cost_per_batch.scaleb(cost_places)))
+            if tier.type == FLAT:
+                bound, places = scaled_cost, cost_places
+            elif tier.batch_rounding_type in (ROUND_UP, ROUND_DOWN, ROUND_NEAREST):
+                bound = scaled_cost * (max_units // usage_scale + 1)
+                places = cost_places
+            else:
+                bound, places = scaled_cost * max_units, usage_places + cost_places
+            # largest of the value before and after rescaling it to revenue
+            total_bound += bound * 10 ** max(REVENUE_DECIMAL_PLACES - places, 0)
+        if max_units >= MAX_SCALED_INT or total_bound >= MAX_SCALED_INT:
+            return None
+
+        u = np.array(scaled_usages, dtype=np.int64)
+        total = np.zeros(len(usages), dtype=np.int64)
+        for tier in self.tiers:
+            if tier.type not in (FLAT, PER_UNIT):
+                continue
+            start = int(tier.range_start.scaleb(usage_places))
+            if tier.discontinuous:
+                in_range = start <= u + usage_scale
+            else:
+                in_range = (start < u) | (start == 0)
+            scaled_cost = int(tier.cost_per_batch.scaleb(cost_places))
+            if tier.type == FLAT:
+                revenue = np.where(in_range, scaled_cost, 0)
+                revenue_places = cost_places
+            else:
+                units = u - start
+                if tier.range_end is not None:
+                    end = int(tier.range_end.scaleb(usage_places))
+                    units = np.minimum(units, end - start)
+                if tier.discontinuous:
+                    units = units + usage_scale
+                if tier.batch_rounding_type in (ROUND_UP, ROUND_DOWN, ROUND_NEAREST):
+                    batches = _round_scaled(
+                        units, usage_scale, tier.batch_rounding_type
+                    )
+                    revenue_places = cost_places
+                else:
+                    batches = units
+                    revenue_places = usage_places + cost_places
+                revenue = np.where(in_range, scaled_cost * batches, 0)
+            total += _to_revenue_scale(revenue, revenue_places)
+        return [Decimal(int(x)).scaleb(-REVENUE_DECIMAL_PLACES) for x in total]
+
+    def _rate(self, usage_qty, bulk_pricing_enabled, round_per_tier):
+        usage = convert_to_decimal(usage_qty)
+        if bulk_pricing_enabled:
+            # only the tiers that contain the usage charge anything
+            first = bisect_left(self.ends, usage)
+            last = bisect_left(self.starts, usage)
+            revenue = 0
+            for tier in self.tiers[first:last]:
+                revenue += tier.revenue(usage, bulk_pricing_enabled=True)
+            return revenue
+        # tiers ending below the usage are fully charged, tiers starting past
+        # usage + 1 can't be reached (discontinuous tiers start one unit early)
+        num_full = bisect_left(self.ends, usage)
+        last = bisect_right(self.starts, usage + 1)
+        # tiers starting at 0 always apply, even to negative usage
+        last = max(last, bisect_right(self.starts, 0))
+        if round_per_tier:
+            revenue = self.cumulative_rounded_revenue[num_full]
+        else:
+            revenue = self.cumulative_revenue[num_full]
+        for tier in self.tiers[num_full:last]:
+            tier_revenue = tier.revenue(usage)
+            if round_per_tier:
+                tier_revenue = convert_to_decimal(tier_revenue)
+            revenue += tier_revenue
+        return revenue
+
+
+def _to_revenue_decimal(value):
+    if isinstance(value, Decimal):
+        # same as convert_to_decimal, without going through a string
+        return value.quantize(REVENUE_QUANTUM, rounding=DECIMAL_ROUND_UP)
+    return convert_to_decimal(value)
+
+
+def _decimal_places(scaled_values):
+    """Decimal places needed by values scaled to REVENUE_DECIMAL_PLACES"""
+    common = 0
+    for value in scaled_values:
+        common = math.gcd(common, value)
+    places = REVENUE_DECIMAL_PLACES
+    while places > 0 and common % 10 == 0:
+        common //= 10
+        places -= 1
+    return places
+
+
+def _round_scaled(values, scale, batch_rounding_type):
+    """Round integers scaled by scale to whole units, like math.ceil/floor/round"""
+    quotient, remainder = np.divmod(values, scale)
+    if batch_rounding_type == ROUND_DOWN:
+        return quotient
+    if batch_rounding_type == ROUND_UP:
+        return quotient + (remainder > 0)
+    # round() on a Decimal rounds half to even
+    round_up = (2 * remainder > scale) | ((2 * remainder == scale) & (quotient % 2 == 1))
+    return quotient + round_up
+
+
+def _to_revenue_scale(values, places):
+    """Rescale to REVENUE_DECIMAL_PLACES, rounding away from zero like convert_to_decimal"""
+    if places <= REVENUE_DECIMAL_PLACES:
+        return values * 10 ** (REVENUE_DECIMAL_PLACES - places)
+    divisor = 10 ** (places - REVENUE_DECIMAL_PLACES)
+    return np.sign(values) * ((np.abs(values) + divisor - 1) // divisor)
+
+
+class TierTableCache:
+    """Process wide cache of compiled tier tables, keyed by plan version and component.
+
+    PriceTier invalidates the entry of its component whenever it's saved or deleted,
+    which bumps a version in the shared cache so that every other process drops its
+    tables too. Entries also expire after TIER_TABLE_CACHE_TTL seconds, for changes
+    that never go through PriceTier.save.
+    """
+
+    def __init__(self, max_size=MAX_CACHED_TIER_TABLES, ttl=TIER_TABLE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+
+    @staticmethod
+    def _key(plan_component):
+        return (plan_component.plan_version_id, plan_component.pk)
+
+    def _check_version(self):
+        """Drop everything if a tier changed anywhere, returns whether to cache"""
+        try:
+            version = cache.get(TIER_TABLE_VERSION_KEY)
+        except Exception as e:
+            # can't tell whether anything changed, so don't trust anything
+            logger.error(f"Could not check the tier table version: {e}")
+            self.clear()
+            return False
+        with self._lock:
+            if version != self._version:
+                self._tables.clear()
+                self._version = version
+        return True
+
+    def get(self, plan_component):
+        if plan_component.pk is None or not self._check_version():
+            return TierTable.from_tiers(plan_component.tiers.all())
+        key = self._key(plan_component)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._tables.get(key)
+            if entry is not None:
+                table, expires_at = entry
+                if expires_at > now:
+                    self._tables.move_to_end(key)
+                    return table
+                del self._tables[key]
+        table = TierTable.from_tiers(plan_component.tiers.all())
+        with self._lock:
+            self._tables[key] = (table, now + self.ttl)
+            if len(self._tables) > self.max_size:
+                self._tables.popitem(last=False)
+        return table
+
+    def invalidate(self, plan_component_id):
+        with self._lock:
+            for key in [k for k in self._tables if k[1] == plan_component_id]:
+                del self._tables[key]
+        _bump_version()
+        # a process could rebuild the table from the old tiers before the change
+        # commits, so bump it again once it has
+        transaction.on_commit(_bump_version)
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+
+
+def _bump_version():
+    try:
+        cache.set(TIER_TABLE_VERSION_KEY, uuid.uuid4().hex, None)
+    except Exception as e:
+        # the other processes catch up when their tables expire
+        logger.error(f"Could not bump the tier table version: {e}")
+
+
+TIER_TABLE_CACHE = TierTableCache()
+
+
+def get_tier_table(plan_component):
+    return TIER_TABLE_CACHE.get(plan_component)
+
+
+def invalidate_tier_table(plan_component_id):
+    TIER_TABLE_CACHE.invalidate(plan_component_id)
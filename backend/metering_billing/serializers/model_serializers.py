@@ -767,6 +767,7 @@ class MetricDetailSerializer(api_serializers.MetricSerializer):
         ) + (
             "usage_aggregation_type",
             "billable_aggregation_type",
+            "unique_count_method",
         )
 
 
@@ -788,6 +789,7 @@ class MetricCreateSerializer(TimezoneFieldMixin, serializers.ModelSerializer):
             "custom_sql",
             "categorical_filters",
             "numeric_filters",
+            "unique_count_method",
         )
         extra_kwargs = {
             "event_name": {"write_only": True, "required": False, "allow_blank": False},
@@ -812,6 +814,7 @@ class MetricCreateSerializer(TimezoneFieldMixin, serializers.ModelSerializer):
             },
             "categorical_filters": {"write_only": True, "required": False},
             "numeric_filters": {"write_only": True, "required": False},
+            "unique_count_method": {"write_only": True, "required": False},
         }
 
     metric_name = serializers.CharField(source="billable_metric_name")
@@ -1,12 +1,17 @@
+import itertools
 import logging
+import time
+import uuid
 from decimal import Decimal, InvalidOperation
 
 import pytz
-from celery import shared_task
+from celery import chord, shared_task
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
+from django.db import connection
 from django.db.models import Q
 
+from metering_billing.aggregation.usage_prefetch import prefetch_billable_usage
 from metering_billing.payment_processors import PAYMENT_PROCESSOR_MAP
 from metering_billing.serializers.experiment_serializers import (
     AllSubstitutionResultsSerializer,
@@ -24,11 +29,13 @@ from metering_billing.utils import (
 from metering_billing.utils.enums import (
     CUSTOMER_BALANCE_ADJUSTMENT_STATUS,
     EXPERIMENT_STATUS,
+    METRIC_TYPE,
 )
 from metering_billing.webhooks import invoice_past_due_webhook
 
 logger = logging.getLogger(__name__)
 POSTHOG_PERSON = settings.POSTHOG_PERSON
+CAGG_REBUILD_TASK_TIME_LIMIT = settings.CAGG_REBUILD_TASK_TIME_LIMIT
 
 
 @shared_task
@@ -54,7 +61,10 @@ def sync_single_organization_integrations(
         integration.perform_sync()
 
 
-@shared_task
+@shared_task(
+    time_limit=CAGG_REBUILD_TASK_TIME_LIMIT,
+    soft_time_limit=CAGG_REBUILD_TASK_TIME_LIMIT - 60,
+)
 def update_subscription_filter_settings_task(org_pk, subscription_filter_keys):
     from metering_billing.models import Organization
 
@@ -85,12 +95,8 @@ def calculate_invoice():
     calculate_invoice_inner()
 
 
-def calculate_invoice_inner():
-    # GENERAL PHILOSOPHY: this task is for periodic maintenance of ending susbcriptions. We only end and re-start subscriptions when they're scheduled to end, if for some other reason they end early then it is up to the other process to handle the invoice creationg and .
-    # get ending subs
-
-    from metering_billing.invoice import generate_invoice
-    from metering_billing.models import BillingRecord, Invoice, SubscriptionRecord
+def _get_subscription_records_to_invoice(customer_ids=None):
+    from metering_billing.models import BillingRecord, SubscriptionRecord
 
     now_minus_30 = now_utc() - relativedelta(
         minutes=30
@@ -99,6 +105,10 @@ def calculate_invoice_inner():
         Q(next_invoicing_date__lt=now_minus_30) | Q(subscription__end_date__lt=now_minus_30),
         fully_billed=False,
     )
+    if customer_ids is not None:
+        billing_records_to_bill = billing_records_to_bill.filter(
+            subscription__customer_id__in=customer_ids
+        )
     # Get a list of distinct subscription IDs from the billing records
     subscription_id_from_br = billing_records_to_bill.values_list(
         "subscription", flat=True
@@ -115,17 +125,43 @@ def calculate_invoice_inner():
         "billing_plan__plan_components__tiers",
         "billing_records",
     )
+    return billing_records_to_bill, all_sub_records
+
+
+def _invoice_customer(
+    customer_id, organization_id, customer_subscription_records, run_id=None
+):
+    """Invoice the due subscription records of a single customer.
 
-    # now generate invoices and new subs
-    cust_info = all_sub_records.values_list("customer", "organization").distinct()
-    for customer_id, organization_id in cust_info:
-        customer_subscription_records = all_sub_records.filter(customer_id=customer_id)
+    Returns a result dict for the run summary. The customer is locked for the
+    duration so that two workers never invoice the same subscription records, and
+    the invoices are tagged with the run_id so a retried run doesn't bill twice.
+    """
+    from metering_billing.invoice import generate_invoice
+    from metering_billing.locks import CUSTOMER_INVOICING_LOCK, advisory_lock
+    from metering_billing.models import Invoice
+
+    result = {
+        "customer_id": customer_id,
+        "organization_id": organization_id,
+        "status": "succeeded",
+    }
+    start = time.monotonic()
+    with advisory_lock(CUSTOMER_INVOICING_LOCK, customer_id) as acquired:
+        if not acquired:
+            logger.info(
+                f"Customer {customer_id} is already being invoiced somewhere else, skipping"
+            )
+            result["status"] = "skipped"
+            result["seconds"] = time.monotonic() - start
+            return result
         # Generate the invoice
         try:
             generate_invoice(
                 customer_subscription_records,
                 charge_next_plan=True,
                 generate_next_subscription_record=True,
+                run_id=run_id,
             )
             now = now_utc()
         except Exception as e:
@@ -134,7 +170,10 @@ def calculate_invoice_inner():
                     [str(x) for x in customer_subscription_records], e
                 )
             )
-            continue
+            result["status"] = "failed"
+            result["error"] = str(e)
+            result["seconds"] = time.monotonic() - start
+            return result
         # delete draft invoices
         Invoice.objects.filter(
             issue_date__lt=now,
@@ -142,6 +181,112 @@ def calculate_invoice_inner():
             customer_id=customer_id,
             organization_id=organization_id,
         ).delete()
+    result["seconds"] = time.monotonic() - start
+    return result
+
+
+def _invoice_customers(customer_ids=None, run_id=None):
+    billing_records_to_bill, all_sub_records = _get_subscription_records_to_invoice(
+        customer_ids
+    )
+    # The usage of every billing record we're about to bill is resolved up front,
+    # with a handful of queries per metric
+    usage_billing_records = billing_records_to_bill.filter(
+        component__isnull=False
+    ).select_related("component__billable_metric", "subscription__customer")
+    results = []
+    with prefetch_billable_usage(usage_billing_records):
+        cust_info = all_sub_records.values_list(
+            "customer", "organization"
+        ).distinct()
+        for customer_id, organization_id in cust_info:
+            customer_subscription_records = all_sub_records.filter(
+                customer_id=customer_id
+            )
+            results.append(
+                _invoice_customer(
+                    customer_id,
+                    organization_id,
+                    customer_subscription_records,
+                    run_id=run_id,
+                )
+            )
+    return results
+
+
+def calculate_invoice_inner():
+    # GENERAL PHILOSOPHY: this task is for periodic maintenance of ending susbcriptions. We only end and re-start subscriptions when they're scheduled to end, if for some other reason they end early then it is up to the other process to handle the invoice creationg and .
+    from metering_billing.models import InvoiceRun
+
+    if settings.INVOICE_FANOUT_ENABLED:
+        return calculate_invoice_fanout()
+    invoice_run = InvoiceRun.objects.create()
+    try:
+        results = _invoice_customers(run_id=invoice_run.run_id)
+    except Exception:
+        invoice_run.status = InvoiceRun.Status.FAILED
+        invoice_run.finished_at = now_utc()
+        invoice_run.save()
+        raise
+    invoice_run.record_results(results)
+    return invoice_run
+
+
+def calculate_invoice_fanout():
+    """Spread the customers that are due over a bounded number of celery tasks.
+
+    Each task invoices its share of customers one by one, and a final callback
+    writes the summary of the whole run once all of them are done.
+    """
+    from metering_billing.models import InvoiceRun
+
+    _, all_sub_records = _get_subscription_records_to_invoice()
+    customer_ids = sorted(
+        set(all_sub_records.values_list("customer", flat=True).distinct())
+    )
+    invoice_run = InvoiceRun.objects.create(fanout=True)
+    if len(customer_ids) == 0:
+        invoice_run.record_results([])
+        return invoice_run
+    num_shards = max(min(settings.INVOICE_FANOUT_MAX_PARALLELISM, len(customer_ids)), 1)
+    shards = [customer_ids[i::num_shards] for i in range(num_shards)]
+    chord(
+        calculate_invoice_shard.s(shard, invoice_run.run_id.hex) for shard in shards
+    )(finalize_invoice_run.s(invoice_run.run_id.hex))
+    return invoice_run
+
+
+@shared_task(
+    soft_time_limit=settings.INVOICE_FANOUT_TASK_TIME_LIMIT,
+    time_limit=settings.INVOICE_FANOUT_TASK_TIME_LIMIT + 60,
+)
+def calculate_invoice_shard(customer_ids, run_id):
+    logger.info(f"Invoice run {run_id}: invoicing {len(customer_ids)} customers")
+    try:
+        return _invoice_customers(customer_ids, run_id=uuid.UUID(run_id))
+    except Exception as e:
+        logger.error(f"Invoice run {run_id}: shard failed with error {e}")
+        return [
+            {
+                "customer_id": customer_id,
+                "organization_id": None,
+                "status": "failed",
+                "error": str(e),
+                "seconds": 0,
+            }
+            for customer_id in customer_ids
+        ]
+
+
+@shared_task
+def finalize_invoice_run(shard_results, run_id):
+    from metering_billing.models import InvoiceRun
+
+    invoice_run = InvoiceRun.objects.get(run_id=run_id)
+    invoice_run.record_results(itertools.chain.from_iterable(shard_results))
+    logger.info(
+        f"Invoice run {run_id} finished: {invoice_run.num_succeeded} succeeded, {invoice_run.num_failed} failed, {invoice_run.num_skipped} skipped"
+    )
 
 
 def refresh_alerts_inner():
@@ -162,6 +307,128 @@ def refresh_alerts():
     refresh_alerts_inner()
 
 
+# claimed and cleared in one statement, so marks made while the alerts are being
+# evaluated stay around for the next run
+CLAIM_PENDING_ALERT_REFRESHES = """
+DELETE FROM
+    metering_billing_pendingusagealertrefresh
+RETURNING
+    organization_id,
+    cust_id,
+    event_name
+"""
+
+
+def refresh_pending_alerts_inner():
+    """Evaluate the usage alerts of the customers that got new events.
+
+    Only looks at the (customer, event name) pairs the event consumer marked since
+    the last run, and calculates the usage of all the billing records involved one
+    metric at a time. Returns the number of alert results refreshed.
+    """
+    from metering_billing.locks import USAGE_ALERT_REFRESH_LOCK, advisory_lock
+    from metering_billing.models import PendingUsageAlertRefresh
+
+    with advisory_lock(USAGE_ALERT_REFRESH_LOCK, "pending") as acquired:
+        if not acquired:
+            # a previous run is still going, anything it doesn't pick up is left
+            # for the next one
+            return 0
+        with connection.cursor() as cursor:
+            cursor.execute(CLAIM_PENDING_ALERT_REFRESHES)
+            pending = set(cursor.fetchall())
+        if len(pending) == 0:
+            return 0
+        try:
+            num_refreshed = _refresh_alerts_for_pending(pending)
+        except Exception:
+            # put the marks back so these alerts aren't skipped until the customer
+            # sends more events
+            PendingUsageAlertRefresh.objects.bulk_create(
+                [
+                    PendingUsageAlertRefresh(
+                        organization_id=organization_pk,
+                        cust_id=cust_id,
+                        event_name=event_name,
+                    )
+                    for organization_pk, cust_id, event_name in pending
+                ],
+                ignore_conflicts=True,
+            )
+            raise
+    logger.info(
+        f"Refreshed {num_refreshed} alert results for {len(pending)} customer events"
+    )
+    return num_refreshed
+
+
+def _refresh_alerts_for_pending(pending):
+    from metering_billing.models import BillingRecord, UsageAlertResult
+
+    now = now_utc()
+    alert_results = UsageAlertResult.objects.filter(
+        organization_id__in={x[0] for x in pending},
+        subscription_record__customer__customer_id__in={x[1] for x in pending},
+        alert__metric__event_name__in={x[2] for x in pending},
+        subscription_record__end_date__gte=now,
+    ).select_related(
+        "organization",
+        "alert",
+        "alert__metric",
+        "subscription_record",
+        "subscription_record__customer",
+    )
+    alert_results_by_metric = {}
+    for alert_result in alert_results:
+        key = (
+            alert_result.organization_id,
+            alert_result.subscription_record.customer.customer_id,
+            alert_result.alert.metric.event_name,
+        )
+        if key in pending:
+            alert_results_by_metric.setdefault(
+                alert_result.alert.metric_id, []
+            ).append(alert_result)
+    num_refreshed = 0
+    for metric_alert_results in alert_results_by_metric.values():
+        metric = metric_alert_results[0].alert.metric
+        billing_records = {}
+        for billing_record in BillingRecord.objects.filter(
+            subscription__in={x.subscription_record_id for x in metric_alert_results},
+            component__billable_metric=metric,
+            start_date__lte=now,
+            end_date__gt=now,
+        ).select_related("subscription", "subscription__customer", "component"):
+            billing_records.setdefault(billing_record.subscription_id, billing_record)
+        if len(billing_records) == 0:
+            continue
+        if metric.metric_type == METRIC_TYPE.COUNTER:
+            # same as UsageAlertResult.refresh, the running total from the usage
+            # counter when there is one
+            usage = {
+                billing_record.pk: metric.get_billing_record_current_usage(
+                    billing_record
+                )
+                for billing_record in billing_records.values()
+            }
+        else:
+            usage = metric.get_total_billable_usage_bulk(
+                list(billing_records.values())
+            )
+        for alert_result in metric_alert_results:
+            billing_record = billing_records.get(alert_result.subscription_record_id)
+            if billing_record is None or billing_record.pk not in usage:
+                continue
+            alert_result.record_value(usage[billing_record.pk], now)
+            num_refreshed += 1
+    return num_refreshed
+
+
+@shared_task
+def refresh_pending_alerts():
+    refresh_pending_alerts_inner()
+
+
 def prune_guard_table_inner():
     from metering_billing.models import IdempotenceCheck
 
@@ -175,6 +442,40 @@ def prune_guard_table():
     prune_guard_table_inner()
 
 
+@shared_task
+def write_gauge_checkpoints():
+    from metering_billing.aggregation.gauge_checkpoints import (
+        write_all_gauge_checkpoints,
+    )
+
+    write_all_gauge_checkpoints()
+
+
+@shared_task
+def run_event_backfill(backfill_pk):
+    from metering_billing.backfill import import_event_backfill
+
+    import_event_backfill(backfill_pk)
+
+
+@shared_task
+def reconcile_usage_counters():
+    from metering_billing.aggregation.usage_counters import (
+        reconcile_all_usage_counters,
+    )
+
+    reconcile_all_usage_counters()
+
+
+@shared_task
+def clear_materialized_late_events():
+    from metering_billing.aggregation.usage_results import (
+        clear_materialized_late_events,
+    )
+
+    clear_materialized_late_events()
+
+
 @shared_task
 def zero_out_expired_balance_adjustments():
     from metering_billing.models import CustomerBalanceAdjustment
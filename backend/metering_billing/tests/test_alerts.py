@@ -1,6 +1,8 @@
 import itertools
 import json
 from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
 import pytest
 from django.urls import reverse
@@ -8,15 +10,17 @@ from metering_billing.aggregation.billable_metrics import METRIC_HANDLER_MAP
 from metering_billing.models import (
     Event,
     Metric,
+    PendingUsageAlertRefresh,
     PlanComponent,
     PlanVersion,
     PriceTier,
     SubscriptionRecord,
     UsageAlert,
     UsageAlertResult,
+    UsageCounter,
 )
 from metering_billing.serializers.serializer_utils import DjangoJSONEncoder
-from metering_billing.tasks import refresh_alerts_inner
+from metering_billing.tasks import refresh_alerts_inner, refresh_pending_alerts_inner
 from metering_billing.utils import now_utc
 from model_bakery import baker
 from rest_framework import status
@@ -261,3 +265,105 @@ class TestUsageAlerts:
         alert_result = UsageAlertResult.objects.all().first()
         assert alert_result.triggered_count == 1
         assert alert_result.triggered_count == 1
+
+    def test_pending_alert_refresh_triggers_on_new_events(
+        self, alerts_test_common_setup
+    ):
+        from metering_billing.kafka.consumer import write_batch_events_to_db
+
+        setup_dict = alerts_test_common_setup(
+            num_subscriptions=0, auth_method="session_auth"
+        )
+        response = setup_dict["client"].post(
+            reverse("subscription-list"),
+            data=json.dumps(setup_dict["payload_sr"], cls=DjangoJSONEncoder),
+            content_type="application/json",
+        )
+        assert response.status_code == status.HTTP_201_CREATED
+        response = setup_dict["client"].post(
+            reverse("usage_alert-list"),
+            data=json.dumps(setup_dict["payload"], cls=DjangoJSONEncoder),
+            content_type="application/json",
+        )
+        assert response.status_code == status.HTTP_201_CREATED
+
+        # nothing was marked, so there's nothing to evaluate
+        assert refresh_pending_alerts_inner() == 0
+
+        event = {
+            "cust_id": setup_dict["customer"].customer_id,
+            "event_name": "email_sent",
+            "idempotency_id": "pending_alert_refresh_test",
+            "properties": {"num_characters": 70},
+            "time_created": now_utc(),
+        }
+        assert write_batch_events_to_db({setup_dict["org"].pk: [event]}) == 1
+        assert PendingUsageAlertRefresh.objects.count() == 1
+
+        assert refresh_pending_alerts_inner() == 1
+        assert PendingUsageAlertRefresh.objects.count() == 0
+        alert_result = UsageAlertResult.objects.all().first()
+        assert alert_result.triggered_count == 1
+
+        # events nobody has an alert for don't get marked
+        event = {
+            "cust_id": setup_dict["customer"].customer_id,
+            "event_name": "not_alerted_on",
+            "idempotency_id": "pending_alert_refresh_test_2",
+            "properties": {},
+            "time_created": now_utc(),
+        }
+        assert write_batch_events_to_db({setup_dict["org"].pk: [event]}) == 1
+        assert PendingUsageAlertRefresh.objects.count() == 0
+
+    def test_pending_alert_refresh_reads_counter_metrics_like_full_refresh(
+        self, alerts_test_common_setup
+    ):
+        from metering_billing.aggregation.usage_counters import (
+            reconcile_all_usage_counters,
+        )
+        from metering_billing.kafka.consumer import write_batch_events_to_db
+
+        setup_dict = alerts_test_common_setup(
+            num_subscriptions=0, auth_method="session_auth"
+        )
+        response = setup_dict["client"].post(
+            reverse("subscription-list"),
+            data=json.dumps(setup_dict["payload_sr"], cls=DjangoJSONEncoder),
+            content_type="application/json",
+        )
+        assert response.status_code == status.HTTP_201_CREATED
+        response = setup_dict["client"].post(
+            reverse("usage_alert-list"),
+            data=json.dumps(setup_dict["payload"], cls=DjangoJSONEncoder),
+            content_type="application/json",
+        )
+        assert response.status_code == status.HTTP_201_CREATED
+
+        with mock.patch(
+            "metering_billing.aggregation.usage_counters.USAGE_COUNTERS_ENABLED",
+            True,
+        ):
+            reconcile_all_usage_counters()
+            # off from the caggs, to tell which one the alert value came from
+            UsageCounter.objects.filter(metric=setup_dict["metrics"][0]).update(
+                value=Decimal(120)
+            )
+            event = {
+                "cust_id": setup_dict["customer"].customer_id,
+                "event_name": "email_sent",
+                "idempotency_id": "pending_alert_counter_test",
+                "properties": {"num_characters": 1},
+                "time_created": now_utc(),
+            }
+            assert write_batch_events_to_db({setup_dict["org"].pk: [event]}) == 1
+
+            assert refresh_pending_alerts_inner() == 1
+            alert_result = UsageAlertResult.objects.all().first()
+            assert alert_result.last_run_value == Decimal(121)
+            assert alert_result.triggered_count == 1
+
+            refresh_alerts_inner()
+            alert_result.refresh_from_db()
+            assert alert_result.last_run_value == Decimal(121)
+            assert alert_result.triggered_count == 1
@@ -0,0 +1,182 @@
+import csv
+import gzip
+import io
+import json
+from unittest import mock
+
+import pytest
+from dateutil.relativedelta import relativedelta
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.urls import reverse
+from model_bakery import baker
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from metering_billing.aggregation.billable_metrics import METRIC_HANDLER_MAP
+from metering_billing.backfill import backfill_events, event_file_format
+from metering_billing.models import (
+    Event,
+    EventBackfill,
+    IdempotenceCheck,
+    Metric,
+    User,
+)
+from metering_billing.tasks import run_event_backfill
+from metering_billing.utils import now_utc
+from metering_billing.utils.enums import METRIC_AGGREGATION, METRIC_TYPE
+
+
+def test_event_file_format():
+    assert event_file_format("events.ndjson.gz") == ("ndjson", True)
+    assert event_file_format("Events.CSV") == ("csv", False)
+    assert event_file_format("events.parquet") == ("parquet", False)
+    assert event_file_format("events.txt") == (None, False)
+
+
+def make_events(n, time_created, prefix="backfill"):
+    return [
+        {
+            "customer_id": "customer",
+            "event_name": "test_event",
+            "idempotency_id": f"{prefix}_{i}",
+            "time_created": (time_created + relativedelta(hours=i)).isoformat(),
+            "properties": {"test_property": i},
+        }
+        for i in range(n)
+    ]
+
+
+@pytest.mark.django_db(transaction=True)
+class TestBackfillEvents:
+    def test_command_imports_old_events_once(self, generate_org_and_api_key, tmp_path):
+        organization, _ = generate_org_and_api_key()
+        metric = Metric.objects.create(
+            organization=organization,
+            property_name="test_property",
+            event_name="test_event",
+            usage_aggregation_type=METRIC_AGGREGATION.SUM,
+            metric_type=METRIC_TYPE.COUNTER,
+        )
+        metric.provision_materialized_views()
+        # far older than the track endpoint and the refresh policies accept
+        events = make_events(5, now_utc() - relativedelta(days=90))
+        lines = [json.dumps(event) for event in events]
+        lines.append(lines[0])
+        lines.append(json.dumps({"idempotency_id": "no_customer"}))
+        path = tmp_path / "events.ndjson.gz"
+        path.write_bytes(gzip.compress("\n".join(lines).encode("utf-8")))
+        out = io.StringIO()
+
+        call_command(
+            "backfill_events",
+            organization.organization_id.hex,
+            str(path),
+            "--chunk-size=2",
+            stdout=out,
+        )
+
+        assert "5 imported, 1 duplicates, 1 invalid" in out.getvalue()
+        assert Event.objects.filter(organization=organization).count() == 5
+        assert IdempotenceCheck.objects.filter(organization=organization).count() == 5
+        refreshed = METRIC_HANDLER_MAP[metric.metric_type].continuous_aggregate_names(
+            metric
+        )
+        assert f"Refreshed {len(refreshed)} aggregates" in out.getvalue()
+
+        # once the guard table has been pruned, the hypertable still catches repeats
+        IdempotenceCheck.objects.filter(organization=organization).delete()
+        out = io.StringIO()
+        call_command(
+            "backfill_events", organization.organization_id.hex, str(path), stdout=out
+        )
+
+        assert "0 imported, 6 duplicates, 1 invalid" in out.getvalue()
+        assert Event.objects.filter(organization=organization).count() == 5
+
+    def test_usage_is_invalidated_after_the_aggregates_catch_up(
+        self, generate_org_and_api_key
+    ):
+        organization, _ = generate_org_and_api_key()
+        events = make_events(2, now_utc() - relativedelta(days=90))
+        content = "\n".join(json.dumps(event) for event in events).encode("utf-8")
+        calls = []
+
+        with (
+            mock.patch(
+                "metering_billing.backfill.refresh_backfilled_aggregates",
+                side_effect=lambda *args: calls.append("refresh"),
+            ),
+            mock.patch(
+                "metering_billing.backfill.invalidate_usage_results",
+                side_effect=lambda *args: calls.append("invalidate"),
+            ),
+        ):
+            backfill_events(organization, io.BytesIO(content), "ndjson")
+
+        assert calls == ["refresh", "invalidate"]
+
+    def test_view_is_admin_only(self, generate_org_and_api_key, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+        organization, _ = generate_org_and_api_key()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(
+            ["customer_id", "event_name", "idempotency_id", "time_created", "region"]
+        )
+        for event in make_events(3, now_utc() - relativedelta(days=60), "csv"):
+            writer.writerow(
+                [
+                    event["customer_id"],
+                    event["event_name"],
+                    event["idempotency_id"],
+                    event["time_created"],
+                    "eu",
+                ]
+            )
+        content = buffer.getvalue().encode("utf-8")
+        user = baker.make(User, organization=organization, is_staff=False)
+        client = APIClient()
+        client.force_authenticate(user=user)
+
+        response = client.post(
+            reverse("backfill_events"),
+            {"file": SimpleUploadedFile("events.csv", content)},
+            format="multipart",
+        )
+
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+        assert Event.objects.filter(organization=organization).count() == 0
+
+        user.is_staff = True
+        user.save()
+        with mock.patch.object(run_event_backfill, "delay") as delay:
+            response = client.post(
+                reverse("backfill_events"),
+                {"file": SimpleUploadedFile("events.csv", content)},
+                format="multipart",
+            )
+
+        # the import is left to a worker
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        backfill_id = response.json()["backfill_id"]
+        assert response.json()["status"] == EventBackfill.Status.PENDING
+        assert Event.objects.filter(organization=organization).count() == 0
+        event_backfill = EventBackfill.objects.get(backfill_id=backfill_id)
+        delay.assert_called_once_with(event_backfill.pk)
+
+        run_event_backfill(event_backfill.pk)
+        # a redelivered task doesn't import it again
+        run_event_backfill(event_backfill.pk)
+
+        response = client.get(
+            reverse("backfill_event_status", kwargs={"backfill_id": backfill_id})
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["status"] == EventBackfill.Status.SUCCEEDED
+        assert response.json()["result"]["events_inserted"] == 3
+        assert Event.objects.filter(organization=organization).count() == 3
+        assert all(
+            event.properties == {"region": "eu"}
+            for event in Event.objects.filter(organization=organization)
+        )
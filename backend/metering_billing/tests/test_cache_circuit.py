@@ -0,0 +1,41 @@
+from unittest import mock
+
+from lotus.cache_utils import CircuitBreaker
+
+
+class TestCircuitBreaker:
+    def test_opens_after_consecutive_failures_and_probes(self):
+        now = [1000.0]
+        with mock.patch(
+            "lotus.cache_utils.time.monotonic", side_effect=lambda: now[0]
+        ):
+            breaker = CircuitBreaker(failure_threshold=3, probe_interval=5)
+            for _ in range(2):
+                assert breaker.allow_request() is True
+                breaker.record_failure()
+            # a success in between resets the count
+            breaker.record_success()
+            for _ in range(3):
+                assert breaker.allow_request() is True
+                breaker.record_failure()
+            assert breaker.state == CircuitBreaker.OPEN
+            assert breaker.allow_request() is False
+
+            # a single probe gets through once the interval is up
+            now[0] += 5
+            assert breaker.allow_request() is True
+            assert breaker.state == CircuitBreaker.HALF_OPEN
+            assert breaker.allow_request() is False
+            breaker.record_failure()
+            assert breaker.state == CircuitBreaker.OPEN
+
+            now[0] += 5
+            assert breaker.allow_request() is True
+            breaker.record_success()
+            assert breaker.state == CircuitBreaker.CLOSED
+            assert breaker.allow_request() is True
+
+            stats = breaker.stats()
+            assert stats["state"] == CircuitBreaker.CLOSED
+            assert stats["seconds_in_state"][CircuitBreaker.OPEN] == 10
+            assert stats["calls"]["short_circuited"] == 2
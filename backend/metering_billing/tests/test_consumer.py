@@ -0,0 +1,114 @@
+from collections import namedtuple
+from unittest import mock
+
+import pytest
+from django.db import DataError
+
+from metering_billing.kafka import consumer
+from metering_billing.kafka.consumer import Consumer, write_batch_events_to_db
+from metering_billing.models import DeadLetterEvent, Event
+from metering_billing.utils import now_utc
+
+Message = namedtuple("Message", ["topic", "partition", "offset", "key", "value"])
+
+
+class FakeKafkaConnection:
+    def __init__(self, messages):
+        self.messages = messages
+        self.commits = 0
+        self.seeks = []
+
+    def poll(self, timeout_ms, max_records):
+        messages, self.messages = self.messages, []
+        if len(messages) == 0:
+            return {}
+        return {("events", 0): messages}
+
+    def commit(self):
+        self.commits += 1
+
+    def seek(self, tp, offset):
+        self.seeks.append((tp, offset))
+
+
+def make_event(idempotency_id, **kwargs):
+    return {
+        "cust_id": "customer",
+        "event_name": "api_call",
+        "idempotency_id": idempotency_id,
+        "properties": {"amount": 1},
+        "time_created": now_utc().isoformat(),
+        **kwargs,
+    }
+
+
+@pytest.mark.django_db(transaction=True)
+class TestPoisonEvents:
+    def test_invalid_event_in_the_middle_of_a_batch(self, generate_org_and_api_key):
+        org, _ = generate_org_and_api_key()
+        events = [
+            make_event("before"),
+            make_event("poison", properties={"amount": float("nan")}),
+            make_event("after"),
+        ]
+
+        assert write_batch_events_to_db({org.pk: events}) == 2
+
+        assert set(Event.objects.values_list("idempotency_id", flat=True)) == {
+            "before",
+            "after",
+        }
+        (dead_letter,) = DeadLetterEvent.objects.all()
+        assert "poison" in dead_letter.record
+
+    def test_batch_is_retried_one_event_at_a_time(self, generate_org_and_api_key):
+        org, _ = generate_org_and_api_key()
+        events = [make_event("before"), make_event("poison"), make_event("after")]
+        insert_rows = consumer._insert_rows
+
+        def failing_insert_rows(cursor, rows):
+            # something only the database notices
+            if any(row[5] == "poison" for row in rows):
+                raise DataError("value out of range")
+            return insert_rows(cursor, rows)
+
+        with mock.patch(
+            "metering_billing.kafka.consumer._insert_rows",
+            side_effect=failing_insert_rows,
+        ):
+            assert write_batch_events_to_db({org.pk: events}) == 2
+
+        assert set(Event.objects.values_list("idempotency_id", flat=True)) == {
+            "before",
+            "after",
+        }
+        (dead_letter,) = DeadLetterEvent.objects.all()
+        assert "poison" in dead_letter.record
+        assert "value out of range" in dead_letter.error
+
+    def test_poison_record_does_not_hold_up_the_partition(
+        self, generate_org_and_api_key
+    ):
+        org, _ = generate_org_and_api_key()
+        values = [
+            {"organization_id": org.pk, "event": make_event("before")},
+            {"organization_id": org.pk, "event": make_event("poison", event_name=1)},
+            {"not_an_event": True},
+            {"organization_id": org.pk, "event": make_event("after")},
+        ]
+        connection = FakeKafkaConnection(
+            [
+                Message("events", 0, offset, "customer", value)
+                for offset, value in enumerate(values)
+            ]
+        )
+        kafka_consumer = Consumer(
+            max_batch_size=10, max_linger_ms=50, connection=connection
+        )
+
+        assert kafka_consumer.consume_batch() == 4
+
+        assert connection.commits == 1
+        assert connection.seeks == []
+        assert Event.objects.count() == 2
+        assert DeadLetterEvent.objects.count() == 2
@@ -1,9 +1,14 @@
 import itertools
 
 import pytest
+from api.views import FeatureAccessBatchView
 from dateutil.relativedelta import relativedelta
 from django.urls import reverse
 from metering_billing.aggregation.billable_metrics import METRIC_HANDLER_MAP
+from metering_billing.entitlements import (
+    get_entitlement_snapshots,
+    invalidate_customer_entitlements,
+)
 from metering_billing.models import (
     Event,
     Feature,
@@ -282,6 +287,137 @@ class TestGetAccess:
         )
         assert feature["access"] is False
 
+    def test_get_access_feature_cache_invalidated_on_plan_change(
+        self, get_access_test_common_setup, settings
+    ):
+        settings.CACHES = {
+            "default": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                "LOCATION": "test-entitlements",
+            }
+        }
+        setup_dict = get_access_test_common_setup(auth_method="api_key")
+
+        payload = {
+            "customer_id": setup_dict["customer"].customer_id,
+            "feature_id": setup_dict["features"][1].feature_id,
+        }
+        response = setup_dict["client"].get(reverse("feature_access"), payload)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["access"] is False
+
+        setup_dict["billing_plan"].features.add(setup_dict["features"][1])
+        response = setup_dict["client"].get(reverse("feature_access"), payload)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["access"] is True
+
+    def test_get_access_feature_cache_invalidated_on_bulk_end(
+        self, get_access_test_common_setup, settings
+    ):
+        settings.CACHES = {
+            "default": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                "LOCATION": "test-entitlements-bulk-end",
+            }
+        }
+        setup_dict = get_access_test_common_setup(auth_method="api_key")
+
+        payload = {
+            "customer_id": setup_dict["customer"].customer_id,
+            "feature_id": setup_dict["features"][0].feature_id,
+        }
+        response = setup_dict["client"].get(reverse("feature_access"), payload)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["access"] is True
+
+        SubscriptionRecord.objects.filter(customer=setup_dict["customer"]).update(
+            end_date=now_utc() - relativedelta(seconds=1)
+        )
+        response = setup_dict["client"].get(reverse("feature_access"), payload)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["access"] is False
+
+    def test_get_access_snapshot_expires_when_next_subscription_starts(
+        self, get_access_test_common_setup, add_subscription_record_to_org
+    ):
+        setup_dict = get_access_test_common_setup(auth_method="api_key")
+        start_date = now_utc() + relativedelta(days=1)
+        add_subscription_record_to_org(
+            organization=setup_dict["org"],
+            customer=setup_dict["customer"],
+            billing_plan=setup_dict["billing_plan"],
+            start_date=start_date,
+        )
+
+        _, valid_until = FeatureAccessBatchView.build_customer_plans(
+            setup_dict["org"].pk, setup_dict["customer"].pk
+        )
+        assert valid_until == start_date
+
+    def test_entitlement_snapshots_only_build_misses(self, settings):
+        settings.CACHES = {
+            "default": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                "LOCATION": "test-entitlements-many",
+            }
+        }
+        built = []
+
+        def build(customer_pk):
+            built.append(customer_pk)
+            return [customer_pk], None
+
+        snapshots = get_entitlement_snapshots("test", 1, [1, 2], None, None, build)
+        assert snapshots == {1: [1], 2: [2]}
+        assert built == [1, 2]
+
+        invalidate_customer_entitlements(2)
+        snapshots = get_entitlement_snapshots("test", 1, [1, 2], None, None, build)
+        assert snapshots == {1: [1], 2: [2]}
+        assert built == [1, 2, 2]
+
+    def test_get_access_feature_batch(self, get_access_test_common_setup, settings):
+        settings.CACHES = {
+            "default": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                "LOCATION": "test-entitlements-batch",
+            }
+        }
+        setup_dict = get_access_test_common_setup(auth_method="api_key")
+        features = setup_dict["features"]
+        payload = {
+            "checks": [
+                {
+                    "customer_id": setup_dict["customer"].customer_id,
+                    "feature_id": "feature_" + feature.feature_id.hex,
+                }
+                for feature in features[:2]
+            ]
+        }
+
+        response = setup_dict["client"].post(
+            reverse("feature_access_batch"), payload, format="json"
+        )
+        assert response.status_code == status.HTTP_200_OK
+        results = response.json()["results"]
+        assert [x["feature_id"] for x in results] == [
+            "feature_" + feature.feature_id.hex for feature in features[:2]
+        ]
+        assert [x["access"] for x in results] == [True, False]
+
+        setup_dict["billing_plan"].features.add(features[1])
+        response = setup_dict["client"].post(
+            reverse("feature_access_batch"), payload, format="json"
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert [x["access"] for x in response.json()["results"]] == [True, True]
+
+        payload["checks"][0]["customer_id"] = "not_a_customer"
+        response = setup_dict["client"].post(
+            reverse("feature_access_batch"), payload, format="json"
+        )
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
     def test_get_access_gauge_with_max_reached_previously(
         self, get_access_test_common_setup, add_product_to_org, add_plan_to_product
     ):
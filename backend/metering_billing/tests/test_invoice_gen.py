@@ -1,6 +1,7 @@
 import itertools
 import json
 import unittest.mock as mock
+import uuid
 from datetime import timedelta
 from decimal import Decimal
 
@@ -11,6 +12,7 @@ from metering_billing.models import (
     BillingRecord,
     Event,
     Invoice,
+    InvoiceRun,
     Metric,
     PlanComponent,
     PriceAdjustment,
@@ -18,6 +20,7 @@ from metering_billing.models import (
     SubscriptionRecord,
 )
 from metering_billing.serializers.serializer_utils import DjangoJSONEncoder
+from metering_billing.invoice import generate_invoice
 from metering_billing.tasks import calculate_invoice_inner
 from metering_billing.utils import now_utc
 from metering_billing.utils.enums import PRICE_ADJUSTMENT_TYPE
@@ -173,6 +176,43 @@ class TestGenerateInvoice:
 
         assert new_invoices_len == prev_invoices_len  # don't generate from drafts
 
+    def test_generate_invoice_is_idempotent_per_run(self, invoice_test_common_setup):
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+        run_id = uuid.uuid4()
+
+        first = generate_invoice(setup_dict["subscription_record"], run_id=run_id)
+        invoices_before = Invoice.objects.filter(
+            customer=setup_dict["customer"]
+        ).count()
+        second = generate_invoice(setup_dict["subscription_record"], run_id=run_id)
+
+        assert {x.pk for x in first} == {x.pk for x in second}
+        assert (
+            Invoice.objects.filter(customer=setup_dict["customer"]).count()
+            == invoices_before
+        )
+        assert all(x.run_id == run_id for x in second)
+
+    def test_external_payment_object_is_created_after_commit(
+        self, invoice_test_common_setup
+    ):
+        from django.db import connection
+
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+
+        def create_payment_object(invoice):
+            # a rollback after this point would leave the processor's invoice behind
+            assert not connection.in_atomic_block
+            assert Invoice.objects.filter(pk=invoice.pk).exists()
+
+        with mock.patch(
+            "metering_billing.invoice.generate_external_payment_obj",
+            side_effect=create_payment_object,
+        ) as generate_external_payment_obj:
+            invoices = generate_invoice(setup_dict["subscription_record"])
+
+        assert generate_external_payment_obj.call_count == len(invoices)
+
     def test_generate_invoice_with_price_adjustments(self, invoice_test_common_setup):
         # deleting inv objects because it marks it as already paid and we get 0s everywhere
 
@@ -397,6 +437,91 @@ class TestInvoiceTask:
         invoices_after = len(Invoice.objects.all())
         assert invoices_after == invoices_before + 1
 
+    def test_invoice_run_summary_is_recorded(self, invoice_test_common_setup):
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+        mock_date = setup_dict["subscription_record"].end_date + relativedelta(
+            minutes=30, seconds=1
+        )
+        with (
+            mock.patch(
+                "metering_billing.tasks.now_utc",
+                return_value=mock_date,
+            ),
+            mock.patch(
+                "metering_billing.invoice.now_utc",
+                return_value=mock_date,
+            ),
+        ):
+            invoice_run = calculate_invoice_inner()
+        invoice_run = InvoiceRun.objects.get(run_id=invoice_run.run_id)
+        assert invoice_run.status == InvoiceRun.Status.COMPLETED
+        assert invoice_run.num_customers == 1
+        assert invoice_run.num_succeeded == 1
+        assert invoice_run.num_failed == 0
+        assert invoice_run.failures == []
+        assert invoice_run.finished_at is not None
+        assert invoice_run.timings["slowest_customers"][0]["customer_id"] == (
+            setup_dict["customer"].pk
+        )
+
+    def test_fanout_invoices_every_customer_once(
+        self,
+        invoice_test_common_setup,
+        add_customers_to_org,
+        add_subscription_record_to_org,
+        settings,
+    ):
+        from celery import current_app
+
+        from metering_billing import tasks
+
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+        subscription_record = setup_dict["subscription_record"]
+        customers = [setup_dict["customer"]]
+        for customer in add_customers_to_org(setup_dict["org"], n=2):
+            add_subscription_record_to_org(
+                setup_dict["org"],
+                setup_dict["billing_plan"],
+                customer,
+                subscription_record.start_date,
+            )
+            customers.append(customer)
+        settings.INVOICE_FANOUT_ENABLED = True
+        settings.INVOICE_FANOUT_MAX_PARALLELISM = 2
+        mock_date = subscription_record.end_date + relativedelta(minutes=30, seconds=1)
+        with (
+            mock.patch("metering_billing.tasks.now_utc", return_value=mock_date),
+            mock.patch("metering_billing.invoice.now_utc", return_value=mock_date),
+            mock.patch.object(current_app.conf, "task_always_eager", True),
+            mock.patch(
+                "metering_billing.tasks._invoice_customers",
+                wraps=tasks._invoice_customers,
+            ) as invoice_customers,
+            mock.patch(
+                "metering_billing.tasks.finalize_invoice_run.run",
+                wraps=tasks.finalize_invoice_run.run,
+            ) as finalize_invoice_run,
+        ):
+            invoice_run = calculate_invoice_inner()
+
+        shards = [call.args[0] for call in invoice_customers.call_args_list]
+        assert len(shards) == 2
+        invoiced_customers = [customer_id for shard in shards for customer_id in shard]
+        assert sorted(invoiced_customers) == sorted(x.pk for x in customers)
+        for customer in customers:
+            assert (
+                Invoice.objects.filter(
+                    customer=customer, run_id=invoice_run.run_id
+                ).count()
+                == 1
+            )
+        assert finalize_invoice_run.call_count == 1
+        invoice_run = InvoiceRun.objects.get(run_id=invoice_run.run_id)
+        assert invoice_run.fanout
+        assert invoice_run.status == InvoiceRun.Status.COMPLETED
+        assert invoice_run.num_customers == 3
+        assert invoice_run.num_succeeded == 3
+
     def test_call_invoice_on_intermediate_billing_record(
         self, invoice_test_common_setup
     ):
@@ -14,11 +14,13 @@ from metering_billing.aggregation.billable_metrics import METRIC_HANDLER_MAP
 from metering_billing.models import (
     CategoricalFilter,
     Event,
+    GaugeCheckpoint,
     Metric,
     NumericFilter,
     PlanComponent,
     PlanVersion,
     PriceTier,
+    UsageResult,
 )
 from metering_billing.serializers.serializer_utils import DjangoJSONEncoder
 from metering_billing.utils import now_utc
@@ -31,6 +33,7 @@ from metering_billing.utils.enums import (
     METRIC_TYPE,
     NUMERIC_FILTER_OPERATORS,
     PLAN_DURATION,
+    UNIQUE_COUNT_METHOD,
 )
 
 
@@ -2309,3 +2312,1151 @@ class TestRegressions:
         assert usage_revenue_dict["revenue"] <= Decimal(8700) / (
             Decimal(60) * Decimal(24) * Decimal(28)
         ) * Decimal(100)
+
+
+@pytest.mark.django_db(transaction=True)
+class TestBulkUsage:
+    @pytest.mark.parametrize(
+        "usage_aggregation_type",
+        [METRIC_AGGREGATION.SUM, METRIC_AGGREGATION.COUNT, METRIC_AGGREGATION.UNIQUE],
+    )
+    def test_bulk_usage_matches_single_record_usage(
+        self,
+        billable_metric_test_common_setup,
+        add_subscription_record_to_org,
+        add_customers_to_org,
+        usage_aggregation_type,
+    ):
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="session_auth",
+            user_org_and_api_key_org_different=False,
+        )
+        billable_metric = Metric.objects.create(
+            organization=setup_dict["org"],
+            property_name="test_property",
+            event_name="test_event",
+            usage_aggregation_type=usage_aggregation_type,
+            metric_type=METRIC_TYPE.COUNTER,
+        )
+        billable_metric.provision_materialized_views()
+        (second_customer,) = add_customers_to_org(setup_dict["org"], n=1)
+        customers = [setup_dict["customer"], second_customer]
+        time_created = now_utc()
+        for i, customer in enumerate(customers):
+            baker.make(
+                Event,
+                event_name="test_event",
+                properties=itertools.cycle(
+                    [{"test_property": j + 1} for j in range(i + 2)]
+                ),
+                organization=setup_dict["org"],
+                time_created=time_created,
+                cust_id=customer.customer_id,
+                _quantity=3 * (i + 1),
+            )
+        billing_plan = PlanVersion.objects.create(
+            organization=setup_dict["org"],
+            plan=setup_dict["plan"],
+        )
+        PlanComponent.objects.create(
+            billable_metric=billable_metric,
+            plan_version=billing_plan,
+        )
+        now = now_utc()
+        billing_records = []
+        for customer in customers:
+            with (
+                mock.patch(
+                    "metering_billing.models.now_utc",
+                    return_value=now - relativedelta(days=1),
+                ),
+                mock.patch(
+                    "metering_billing.tests.test_metrics.now_utc",
+                    return_value=now - relativedelta(days=1),
+                ),
+            ):
+                subscription_record = add_subscription_record_to_org(
+                    setup_dict["org"],
+                    billing_plan,
+                    customer,
+                    now - relativedelta(days=1),
+                )
+            billing_records.append(subscription_record.billing_records.first())
+
+        bulk_usage = billable_metric.get_total_billable_usage_bulk(billing_records)
+
+        assert len(bulk_usage) == len(billing_records)
+        for billing_record in billing_records:
+            single_usage = billable_metric.get_billing_record_total_billable_usage(
+                billing_record
+            )
+            assert bulk_usage[billing_record.pk] == single_usage
+        assert bulk_usage[billing_records[0].pk] != bulk_usage[billing_records[1].pk]
+
+
+@pytest.mark.django_db(transaction=True)
+class TestUsageCounters:
+    def test_consumer_increments_usage_counter(
+        self,
+        billable_metric_test_common_setup,
+        add_subscription_record_to_org,
+        add_customers_to_org,
+    ):
+        from metering_billing.aggregation.usage_counters import (
+            reconcile_all_usage_counters,
+        )
+        from metering_billing.kafka.consumer import write_batch_events_to_db
+        from metering_billing.models import UsageCounter
+
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="session_auth",
+            user_org_and_api_key_org_different=False,
+        )
+        billable_metric = Metric.objects.create(
+            organization=setup_dict["org"],
+            property_name="test_property",
+            event_name="test_event",
+            usage_aggregation_type=METRIC_AGGREGATION.SUM,
+            metric_type=METRIC_TYPE.COUNTER,
+        )
+        billable_metric.provision_materialized_views()
+        (other_customer,) = add_customers_to_org(setup_dict["org"], n=1)
+        now = now_utc()
+        baker.make(
+            Event,
+            event_name="test_event",
+            properties={"test_property": 3},
+            organization=setup_dict["org"],
+            time_created=now - relativedelta(hours=1),
+            cust_id=setup_dict["customer"].customer_id,
+            _quantity=2,
+        )
+        billing_plan = PlanVersion.objects.create(
+            organization=setup_dict["org"],
+            plan=setup_dict["plan"],
+        )
+        PlanComponent.objects.create(
+            billable_metric=billable_metric,
+            plan_version=billing_plan,
+        )
+        with (
+            mock.patch(
+                "metering_billing.models.now_utc",
+                return_value=now - relativedelta(days=1),
+            ),
+            mock.patch(
+                "metering_billing.tests.test_metrics.now_utc",
+                return_value=now - relativedelta(days=1),
+            ),
+        ):
+            subscription_record = add_subscription_record_to_org(
+                setup_dict["org"],
+                billing_plan,
+                setup_dict["customer"],
+                now - relativedelta(days=1),
+            )
+        billing_record = subscription_record.billing_records.first()
+
+        with mock.patch(
+            "metering_billing.aggregation.usage_counters.USAGE_COUNTERS_ENABLED",
+            True,
+        ):
+            # reads calculate the usage from the caggs until the counter exists
+            assert billable_metric.get_billing_record_current_usage(
+                billing_record
+            ) == Decimal(6)
+            assert not UsageCounter.objects.exists()
+            assert reconcile_all_usage_counters() == 1
+            assert UsageCounter.objects.get(
+                billing_record=billing_record
+            ).value == Decimal(6)
+            # and then it's only reconciled once it's due
+            assert reconcile_all_usage_counters() == 0
+
+            events = [
+                {
+                    "cust_id": setup_dict["customer"].customer_id,
+                    "event_name": "test_event",
+                    "idempotency_id": f"counter_test_{i}",
+                    "properties": {"test_property": 5},
+                    "time_created": now - relativedelta(minutes=1),
+                }
+                for i in range(2)
+            ]
+            # neither of these count towards the billing record
+            events.append(
+                {
+                    "cust_id": other_customer.customer_id,
+                    "event_name": "test_event",
+                    "idempotency_id": "counter_test_other_customer",
+                    "properties": {"test_property": 5},
+                    "time_created": now - relativedelta(minutes=1),
+                }
+            )
+            events.append(
+                {
+                    "cust_id": setup_dict["customer"].customer_id,
+                    "event_name": "other_event",
+                    "idempotency_id": "counter_test_other_event",
+                    "properties": {"test_property": 5},
+                    "time_created": now - relativedelta(minutes=1),
+                }
+            )
+            assert write_batch_events_to_db({setup_dict["org"].pk: events}) == 4
+            # replaying the batch inserts nothing, and counts nothing
+            assert write_batch_events_to_db({setup_dict["org"].pk: events}) == 0
+
+            assert UsageCounter.objects.get(
+                billing_record=billing_record
+            ).value == Decimal(16)
+            assert billable_metric.get_billing_record_current_usage(
+                billing_record
+            ) == Decimal(16)
+
+
+@pytest.mark.django_db(transaction=True)
+class TestRateWindows:
+    def test_consumer_feeds_rate_window(
+        self,
+        billable_metric_test_common_setup,
+        add_subscription_record_to_org,
+    ):
+        from metering_billing.aggregation.usage_counters import (
+            reconcile_all_usage_counters,
+        )
+        from metering_billing.kafka.consumer import write_batch_events_to_db
+        from metering_billing.models import RateWindow
+
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="session_auth",
+            user_org_and_api_key_org_different=False,
+        )
+        billable_metric = Metric.objects.create(
+            organization=setup_dict["org"],
+            event_name="rows_inserted",
+            property_name="num_rows",
+            usage_aggregation_type=METRIC_AGGREGATION.SUM,
+            billable_aggregation_type=METRIC_AGGREGATION.MAX,
+            metric_type=METRIC_TYPE.RATE,
+            granularity=METRIC_GRANULARITY.HOUR,
+        )
+        billable_metric.provision_materialized_views()
+        now = now_utc()
+        # an old burst sets the highest rate, the recent events the current one
+        for time_created, num_rows in [
+            (now - relativedelta(hours=10), 40),
+            (now - relativedelta(minutes=10), 3),
+        ]:
+            baker.make(
+                Event,
+                event_name="rows_inserted",
+                properties={"num_rows": num_rows},
+                organization=setup_dict["org"],
+                time_created=time_created,
+                cust_id=setup_dict["customer"].customer_id,
+                _quantity=2,
+            )
+        billing_plan = PlanVersion.objects.create(
+            organization=setup_dict["org"],
+            plan=setup_dict["plan"],
+        )
+        PlanComponent.objects.create(
+            billable_metric=billable_metric,
+            plan_version=billing_plan,
+        )
+        start = now - relativedelta(days=1)
+        with (
+            mock.patch("metering_billing.models.now_utc", return_value=start),
+            mock.patch(
+                "metering_billing.tests.test_metrics.now_utc", return_value=start
+            ),
+        ):
+            subscription_record = add_subscription_record_to_org(
+                setup_dict["org"], billing_plan, setup_dict["customer"], start
+            )
+        billing_record = subscription_record.billing_records.first()
+
+        with mock.patch(
+            "metering_billing.aggregation.usage_counters.RATE_WINDOWS_ENABLED",
+            True,
+        ):
+            # reads don't build the window, the periodic task does
+            assert billable_metric.get_billing_record_current_usage(
+                billing_record
+            ) == Decimal(6)
+            assert not RateWindow.objects.exists()
+            assert reconcile_all_usage_counters() == 1
+            assert billable_metric.get_billing_record_current_usage(
+                billing_record
+            ) == Decimal(6)
+            assert billable_metric.get_billing_record_total_billable_usage(
+                billing_record
+            ) == Decimal(80)
+            window = RateWindow.objects.get(billing_record=billing_record)
+            assert window.bucket_seconds == 60
+            assert len(window.buckets) == 61
+
+            events = [
+                {
+                    "cust_id": setup_dict["customer"].customer_id,
+                    "event_name": "rows_inserted",
+                    "idempotency_id": f"rate_window_test_{i}",
+                    "properties": {"num_rows": 50},
+                    "time_created": now - relativedelta(minutes=1),
+                }
+                for i in range(2)
+            ]
+            assert write_batch_events_to_db({setup_dict["org"].pk: events}) == 2
+
+            window.refresh_from_db()
+            assert window.max_usage == Decimal(106)
+            assert billable_metric.get_billing_record_current_usage(
+                billing_record
+            ) == Decimal(106)
+            assert billable_metric.get_billing_record_total_billable_usage(
+                billing_record
+            ) == Decimal(106)
+
+        # same as calculating it from the events and the cagg
+        assert billable_metric.get_billing_record_current_usage(
+            billing_record
+        ) == Decimal(106)
+        assert billable_metric.get_billing_record_total_billable_usage(
+            billing_record
+        ) == Decimal(106)
+
+
+@pytest.mark.django_db(transaction=True)
+class TestContinuousAggregateRebuild:
+    def test_filter_key_change_swaps_in_rebuilt_caggs(
+        self,
+        billable_metric_test_common_setup,
+    ):
+        from django.db import connection
+
+        from metering_billing.models import ContinuousAggregateRebuild
+        from metering_billing.utils.enums import CAGG_REBUILD_STATUS
+
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="session_auth",
+            user_org_and_api_key_org_different=False,
+        )
+        organization = setup_dict["org"]
+        billable_metric = Metric.objects.create(
+            organization=organization,
+            property_name="test_property",
+            event_name="test_event",
+            usage_aggregation_type=METRIC_AGGREGATION.SUM,
+            metric_type=METRIC_TYPE.COUNTER,
+        )
+        billable_metric.provision_materialized_views()
+        baker.make(
+            Event,
+            event_name="test_event",
+            properties={"test_property": 3, "shard": "a"},
+            organization=organization,
+            time_created=now_utc() - relativedelta(days=40),
+            cust_id=setup_dict["customer"].customer_id,
+            _quantity=2,
+        )
+        cagg_names = METRIC_HANDLER_MAP[
+            billable_metric.metric_type
+        ].continuous_aggregate_names(billable_metric)
+        with connection.cursor() as cursor:
+            # left behind by a rebuild that couldn't drop it
+            cursor.execute(
+                f"CREATE MATERIALIZED VIEW {cagg_names[-1]}_old AS SELECT 1 AS x"
+            )
+
+        organization.subscription_filter_keys = ["shard"]
+        organization.save()
+
+        organization.refresh_from_db()
+        assert organization.subscription_filter_keys == ["shard"]
+        rebuild = ContinuousAggregateRebuild.objects.get(metric=billable_metric)
+        assert rebuild.status == CAGG_REBUILD_STATUS.COMPLETED
+        assert rebuild.chunks_total > 0
+        assert rebuild.chunks_done == rebuild.chunks_total
+        with connection.cursor() as cursor:
+            # no shadow or retired aggregates left behind
+            cursor.execute(
+                "SELECT relname FROM pg_class WHERE relkind IN ('v', 'm') AND relname LIKE %s",
+                [cagg_names[0].rsplit("___", 1)[0] + "%"],
+            )
+            assert {row[0] for row in cursor.fetchall()} == set(cagg_names)
+            for cagg_name in cagg_names:
+                cursor.execute(
+                    "SELECT column_name FROM information_schema.columns WHERE table_name = %s",
+                    [cagg_name],
+                )
+                assert "shard" in {row[0] for row in cursor.fetchall()}
+
+    def test_filter_keys_are_not_written_if_the_rebuild_fails(
+        self,
+        billable_metric_test_common_setup,
+    ):
+        from metering_billing.models import ContinuousAggregateRebuild, Organization
+        from metering_billing.utils.enums import CAGG_REBUILD_STATUS
+
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="session_auth",
+            user_org_and_api_key_org_different=False,
+        )
+        organization = setup_dict["org"]
+        billable_metric = Metric.objects.create(
+            organization=organization,
+            property_name="test_property",
+            event_name="test_event",
+            usage_aggregation_type=METRIC_AGGREGATION.SUM,
+            metric_type=METRIC_TYPE.COUNTER,
+        )
+        billable_metric.provision_materialized_views()
+
+        organization.subscription_filter_keys = ["shard"]
+        with (
+            mock.patch(
+                "metering_billing.aggregation.cagg_rebuild._build_shadows",
+                side_effect=Exception("out of disk"),
+            ),
+            pytest.raises(Exception, match="out of disk"),
+        ):
+            organization.save()
+
+        # the live caggs still don't have the column, so queries mustn't use it
+        organization.refresh_from_db()
+        assert organization.subscription_filter_keys == []
+        rebuild = ContinuousAggregateRebuild.objects.get(metric=billable_metric)
+        assert rebuild.status == CAGG_REBUILD_STATUS.FAILED
+        # a stale copy saving something else doesn't write old keys back either
+        stale = Organization.objects.get(pk=organization.pk)
+        Organization.objects.filter(pk=organization.pk).update(
+            subscription_filter_keys=["region"]
+        )
+        with mock.patch(
+            "metering_billing.aggregation.cagg_rebuild._build_shadows"
+        ) as build_shadows:
+            stale.payment_grace_period = 3
+            stale.save()
+        build_shadows.assert_not_called()
+        organization.refresh_from_db()
+        assert organization.subscription_filter_keys == ["region"]
+        assert organization.payment_grace_period == 3
+
+
+@pytest.mark.django_db(transaction=True)
+class TestContinuousAggregatePolicies:
+    def test_policy_changes_are_applied_to_existing_caggs(
+        self,
+        billable_metric_test_common_setup,
+    ):
+        import datetime
+
+        from django.core.exceptions import ValidationError
+        from django.db import connection
+
+        from metering_billing.aggregation.cagg_policies import (
+            CAGG_POLICY_JOBS,
+            DEFAULT_CAGG_POLICY,
+            get_cagg_policy,
+            reconcile_cagg_policies,
+        )
+        from metering_billing.models import ContinuousAggregatePolicy
+
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="session_auth",
+            user_org_and_api_key_org_different=False,
+        )
+        organization = setup_dict["org"]
+        billable_metric = Metric.objects.create(
+            organization=organization,
+            property_name="test_property",
+            event_name="test_event",
+            usage_aggregation_type=METRIC_AGGREGATION.SUM,
+            metric_type=METRIC_TYPE.COUNTER,
+        )
+        billable_metric.provision_materialized_views()
+        assert get_cagg_policy(organization.id, billable_metric.id) == (
+            DEFAULT_CAGG_POLICY
+        )
+
+        organization_policy = ContinuousAggregatePolicy.objects.create(
+            organization=organization,
+            refresh_schedule_interval=datetime.timedelta(minutes=5),
+        )
+        metric_policy = ContinuousAggregatePolicy.objects.create(
+            organization=organization,
+            metric=billable_metric,
+            refresh_start_offset=datetime.timedelta(days=40),
+            compress_after=datetime.timedelta(days=41),
+        )
+
+        policy = get_cagg_policy(organization.id, billable_metric.id)
+        assert policy.refresh_schedule_interval == datetime.timedelta(minutes=5)
+        assert policy.refresh_start_offset == datetime.timedelta(days=40)
+        assert policy.refresh_end_offset == DEFAULT_CAGG_POLICY.refresh_end_offset
+        for definition in METRIC_HANDLER_MAP[
+            billable_metric.metric_type
+        ].continuous_aggregate_definitions(billable_metric):
+            with connection.cursor() as cursor:
+                cursor.execute(CAGG_POLICY_JOBS, [definition.name])
+                jobs = {row[1]: row for row in cursor.fetchall()}
+            refresh_job = jobs["policy_refresh_continuous_aggregate"]
+            assert refresh_job[2] == datetime.timedelta(minutes=5)
+            assert refresh_job[3] == datetime.timedelta(days=40)
+            if definition.compress:
+                assert jobs["policy_compression"][5] == datetime.timedelta(days=41)
+        assert reconcile_cagg_policies(billable_metric, dry_run=True) == []
+
+        # saving validates it too, late events would never be materialized
+        metric_policy.refresh_start_offset = datetime.timedelta(days=10)
+        with pytest.raises(ValidationError):
+            metric_policy.save()
+        # fine for the organization, but not for the metric that inherits from it
+        organization_policy.refresh_start_offset = datetime.timedelta(days=50)
+        organization_policy.refresh_end_offset = datetime.timedelta(days=15)
+        organization_policy.compress_after = datetime.timedelta(days=60)
+        with pytest.raises(ValidationError, match="metric"):
+            organization_policy.save()
+        assert get_cagg_policy(organization.id, billable_metric.id) == policy
+
+        with pytest.raises(ValidationError):
+            ContinuousAggregatePolicy(
+                organization=organization,
+                metric=billable_metric,
+                compress_after=datetime.timedelta(days=5),
+            ).clean()
+
+
+def test_counter_cagg_windows_cover_period_with_coarsest_buckets():
+    import datetime
+
+    import pytz
+
+    start = datetime.datetime(2023, 1, 1, 5, 30, 12, 500, tzinfo=pytz.UTC)
+    end = datetime.datetime(2023, 1, 3, 7, 10, 59, tzinfo=pytz.UTC)
+
+    windows = METRIC_HANDLER_MAP[METRIC_TYPE.COUNTER]._cagg_windows(start, end)
+
+    assert [bucket_size for bucket_size, _, _ in windows] == [
+        "raw",
+        "minute",
+        "hour",
+        "day",
+        "hour",
+        "minute",
+        "raw",
+    ]
+    assert windows[0][1] == start
+    assert windows[-1][2] == end
+    assert windows[3][1:] == (
+        datetime.datetime(2023, 1, 2, tzinfo=pytz.UTC),
+        datetime.datetime(2023, 1, 2, tzinfo=pytz.UTC),
+    )
+    full_month = METRIC_HANDLER_MAP[METRIC_TYPE.COUNTER]._cagg_windows(
+        datetime.datetime(2023, 1, 1, tzinfo=pytz.UTC),
+        datetime.datetime(2023, 1, 31, 23, 59, 59, 999999, tzinfo=pytz.UTC),
+    )
+    assert [bucket_size for bucket_size, _, _ in full_month] == ["day"]
+
+
+def test_usage_counter_property_text_matches_postgres():
+    from metering_billing.aggregation.usage_counters import _property_text
+
+    properties = {
+        "text": "a",
+        "int": 5,
+        "float": 1.5,
+        "big_float": 1e20,
+        "decimal": Decimal("2.50"),
+        "true": True,
+        "false": False,
+        "null": None,
+        "list": [1, "a"],
+    }
+    # properties ->> name for each of them
+    assert _property_text(properties, "text") == "a"
+    assert _property_text(properties, "int") == "5"
+    assert _property_text(properties, "float") == "1.5"
+    assert _property_text(properties, "big_float") == "100000000000000000000"
+    assert _property_text(properties, "decimal") == "2.50"
+    assert _property_text(properties, "true") == "true"
+    assert _property_text(properties, "false") == "false"
+    assert _property_text(properties, "null") is None
+    assert _property_text(properties, "missing") is None
+    assert _property_text(properties, "list") == '[1, "a"]'
+
+
+@pytest.mark.django_db(transaction=True)
+class TestCounterCaggHierarchy:
+    def test_partial_periods_only_count_events_inside_them(
+        self,
+        billable_metric_test_common_setup,
+        add_subscription_record_to_org,
+    ):
+        from django.db import connection
+
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="session_auth",
+            user_org_and_api_key_org_different=False,
+        )
+        billable_metric = Metric.objects.create(
+            organization=setup_dict["org"],
+            property_name="test_property",
+            event_name="test_event",
+            usage_aggregation_type=METRIC_AGGREGATION.SUM,
+            metric_type=METRIC_TYPE.COUNTER,
+        )
+        billable_metric.provision_materialized_views()
+        cagg_names = METRIC_HANDLER_MAP[
+            billable_metric.metric_type
+        ].continuous_aggregate_names(billable_metric)
+        assert [name.rsplit("___", 1)[1] for name in cagg_names] == [
+            "minute",
+            "hour",
+            "day",
+        ]
+        billing_plan = PlanVersion.objects.create(
+            organization=setup_dict["org"],
+            plan=setup_dict["plan"],
+        )
+        PlanComponent.objects.create(
+            billable_metric=billable_metric,
+            plan_version=billing_plan,
+        )
+        now = now_utc()
+        start = now - relativedelta(days=1, seconds=30)
+        with (
+            mock.patch("metering_billing.models.now_utc", return_value=start),
+            mock.patch(
+                "metering_billing.tests.test_metrics.now_utc", return_value=start
+            ),
+        ):
+            subscription_record = add_subscription_record_to_org(
+                setup_dict["org"], billing_plan, setup_dict["customer"], start
+            )
+        billing_record = subscription_record.billing_records.first()
+        # one event just before the period, the rest inside it with sub-minute edges
+        for time_created, value, quantity in [
+            (start - relativedelta(microseconds=1), 100, 1),
+            (start, 1, 2),
+            (start + relativedelta(hours=2), 5, 3),
+        ]:
+            baker.make(
+                Event,
+                event_name="test_event",
+                properties={"test_property": value},
+                organization=setup_dict["org"],
+                time_created=time_created,
+                cust_id=setup_dict["customer"].customer_id,
+                _quantity=quantity,
+            )
+
+        usage = billable_metric.get_billing_record_total_billable_usage(billing_record)
+        bulk_usage = billable_metric.get_total_billable_usage_bulk([billing_record])
+
+        assert usage == 2 * 1 + 3 * 5
+        assert bulk_usage[billing_record.pk] == usage
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT relname FROM pg_class WHERE relkind = 'v' AND relname LIKE %s",
+                [cagg_names[0].rsplit("___", 1)[0] + "%second"],
+            )
+            assert cursor.fetchall() == []
+
+
+@pytest.mark.django_db(transaction=True)
+class TestUniqueSketches:
+    @pytest.mark.parametrize(
+        "unique_count_method",
+        [UNIQUE_COUNT_METHOD.HYPERLOGLOG, UNIQUE_COUNT_METHOD.BITMAP],
+    )
+    def test_sketched_unique_usage_matches_exact(
+        self,
+        billable_metric_test_common_setup,
+        add_subscription_record_to_org,
+        unique_count_method,
+    ):
+        from metering_billing.aggregation.billable_metrics import (
+            UNIQUE_SKETCH_EXTENSIONS,
+        )
+
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="session_auth",
+            user_org_and_api_key_org_different=False,
+        )
+        payload = {
+            "event_name": "test_event",
+            "property_name": "test_property",
+            "usage_aggregation_type": METRIC_AGGREGATION.UNIQUE,
+            "metric_type": METRIC_TYPE.COUNTER,
+            "metric_name": "unique_sketch",
+            "unique_count_method": unique_count_method,
+        }
+        response = setup_dict["client"].post(
+            reverse("metric-list"),
+            data=json.dumps(payload, cls=DjangoJSONEncoder),
+            content_type="application/json",
+        )
+        if not METRIC_HANDLER_MAP[METRIC_TYPE.COUNTER]._extension_installed(
+            UNIQUE_SKETCH_EXTENSIONS[unique_count_method]
+        ):
+            assert response.status_code == status.HTTP_400_BAD_REQUEST
+            pytest.skip(
+                f"{UNIQUE_SKETCH_EXTENSIONS[unique_count_method]} not installed"
+            )
+        assert response.status_code == status.HTTP_201_CREATED
+        sketched_metric = Metric.objects.get(
+            organization=setup_dict["org"], billable_metric_name="unique_sketch"
+        )
+        exact_metric = Metric.objects.create(
+            organization=setup_dict["org"],
+            property_name="test_property",
+            event_name="test_event",
+            usage_aggregation_type=METRIC_AGGREGATION.UNIQUE,
+            metric_type=METRIC_TYPE.COUNTER,
+        )
+        exact_metric.provision_materialized_views()
+        billing_plan = PlanVersion.objects.create(
+            organization=setup_dict["org"],
+            plan=setup_dict["plan"],
+        )
+        PlanComponent.objects.create(
+            billable_metric=sketched_metric,
+            plan_version=billing_plan,
+        )
+        now = now_utc()
+        start = now - relativedelta(days=3, hours=5)
+        with (
+            mock.patch("metering_billing.models.now_utc", return_value=start),
+            mock.patch(
+                "metering_billing.tests.test_metrics.now_utc", return_value=start
+            ),
+        ):
+            subscription_record = add_subscription_record_to_org(
+                setup_dict["org"], billing_plan, setup_dict["customer"], start
+            )
+        billing_record = subscription_record.billing_records.first()
+        # the same values show up again on later days, and only count once
+        for days_ago in range(3):
+            baker.make(
+                Event,
+                event_name="test_event",
+                properties=itertools.cycle(
+                    [{"test_property": f"user_{i}"} for i in range(5 + days_ago)]
+                ),
+                organization=setup_dict["org"],
+                time_created=now - relativedelta(days=days_ago, minutes=1),
+                cust_id=setup_dict["customer"].customer_id,
+                _quantity=5 + days_ago,
+            )
+
+        usage = sketched_metric.get_billing_record_total_billable_usage(billing_record)
+        daily_usage = sketched_metric.get_billing_record_daily_billable_usage(
+            billing_record
+        )
+
+        assert usage == 7
+        assert usage == exact_metric.get_billing_record_total_billable_usage(
+            billing_record
+        )
+        assert sum(daily_usage.values()) == 7
+
+    @pytest.mark.parametrize(
+        "unique_count_method,build,merge",
+        [
+            (
+                UNIQUE_COUNT_METHOD.HYPERLOGLOG,
+                "hyperloglog(",
+                "distinct_count(rollup(parts.sketch))",
+            ),
+            (
+                UNIQUE_COUNT_METHOD.BITMAP,
+                "rb_build_agg(",
+                "rb_cardinality(rb_or_agg(parts.sketch))",
+            ),
+        ],
+    )
+    def test_sketch_queries(self, unique_count_method, build, merge):
+        # the images CI runs on don't have the extensions, so the test above skips
+        # itself there. This at least checks the SQL we'd send them
+        import datetime
+        import re
+        import uuid
+
+        import pytz
+
+        from metering_billing.aggregation.billable_metrics import (
+            COUNTER_CAGG_BUCKETS,
+        )
+        from metering_billing.aggregation.counter_query_templates import (
+            COUNTER_CAGG_QUERY,
+            COUNTER_UNIQUE_SKETCH_CUMULATIVE_PER_DAY,
+            COUNTER_UNIQUE_SKETCH_TOTAL,
+        )
+        from metering_billing.aggregation.template_registry import (
+            render_query,
+            render_template,
+        )
+
+        injection_data = {
+            "cagg_name": "org_abc___metric_def___day",
+            "query_type": METRIC_AGGREGATION.UNIQUE,
+            "property_name": "user_id",
+            "uuidv5_event_name": uuid.uuid4(),
+            "uuidv5_customer_id": uuid.uuid4(),
+            "organization_id": 1,
+            "filter_properties": {"region": ["us"]},
+            "numeric_filters": [],
+            "categorical_filters": [],
+            "group_by": ["region"],
+            "unique_sketch": unique_count_method,
+            "hyperloglog_buckets": 1024,
+        }
+
+        cagg = render_template(COUNTER_CAGG_QUERY, bucket_size="day", **injection_data)
+        assert build in cagg
+        assert re.search(r"\) AS sketch\n", cagg)
+        assert "sketch" not in cagg.split("GROUP BY")[-1]
+
+        # a partial day on either side of the full days the cagg has
+        windows = METRIC_HANDLER_MAP[METRIC_TYPE.COUNTER]._cagg_windows(
+            datetime.datetime(2023, 1, 1, 5, 30, tzinfo=pytz.UTC),
+            datetime.datetime(2023, 1, 10, 12, tzinfo=pytz.UTC),
+            COUNTER_CAGG_BUCKETS[:1],
+        )
+        assert [bucket_size for bucket_size, _, _ in windows] == ["raw", "day", "raw"]
+        for template in [
+            COUNTER_UNIQUE_SKETCH_TOTAL,
+            COUNTER_UNIQUE_SKETCH_CUMULATIVE_PER_DAY,
+        ]:
+            query, params = render_query(template, windows=windows, **injection_data)
+            parts = query.split("UNION ALL")
+            assert len(parts) == len(windows)
+            # every part has the same columns, sketched the same way
+            for part in parts:
+                assert "region" in part
+                assert "sketch" in part
+            assert sum(part.count(build) for part in parts) == 2
+            assert (
+                sum(
+                    part.count("FROM\n        org_abc___metric_def___day")
+                    for part in parts
+                )
+                == 1
+            )
+            assert query.count("(") == query.count(")")
+            assert set(re.findall(r"%\((p\d+)\)s::", query)) == set(params)
+            assert "us" in params.values()
+        total, _ = render_query(
+            COUNTER_UNIQUE_SKETCH_TOTAL, windows=windows, **injection_data
+        )
+        assert merge in total
+        cumulative, _ = render_query(
+            COUNTER_UNIQUE_SKETCH_CUMULATIVE_PER_DAY, windows=windows, **injection_data
+        )
+        assert "OVER running" in cumulative
+        assert "PARTITION BY\n        region" in cumulative
+
+
+@pytest.mark.django_db(transaction=True)
+class TestGaugeCheckpoints:
+    @pytest.mark.parametrize("event_type", [EVENT_TYPE.DELTA, EVENT_TYPE.TOTAL])
+    def test_usage_is_the_same_from_checkpoints(
+        self,
+        event_type,
+        billable_metric_test_common_setup,
+        add_subscription_record_to_org,
+    ):
+        from metering_billing.aggregation.gauge_checkpoints import (
+            invalidate_gauge_checkpoints,
+            write_gauge_checkpoint,
+        )
+
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="session_auth",
+            user_org_and_api_key_org_different=False,
+        )
+        billable_metric = Metric.objects.create(
+            organization=setup_dict["org"],
+            event_name="number_of_users",
+            property_name="number",
+            usage_aggregation_type=METRIC_AGGREGATION.MAX,
+            metric_type=METRIC_TYPE.GAUGE,
+            event_type=event_type,
+        )
+        billable_metric.provision_materialized_views()
+        billing_plan = PlanVersion.objects.create(
+            organization=setup_dict["org"],
+            plan=setup_dict["plan"],
+        )
+        PlanComponent.objects.create(
+            billable_metric=billable_metric,
+            plan_version=billing_plan,
+        )
+        now = now_utc()
+        start = now - relativedelta(days=5)
+        with (
+            mock.patch("metering_billing.models.now_utc", return_value=start),
+            mock.patch(
+                "metering_billing.tests.test_metrics.now_utc", return_value=start
+            ),
+        ):
+            subscription_record = add_subscription_record_to_org(
+                setup_dict["org"], billing_plan, setup_dict["customer"], start
+            )
+        billing_record = subscription_record.billing_records.first()
+        # most of the history is long before the period and the checkpoint
+        baker.make(
+            Event,
+            event_name="number_of_users",
+            properties=itertools.cycle(
+                [{"number": 3}, {"number": -1}, {"number": 2}, {"number": -2}]
+            ),
+            organization=setup_dict["org"],
+            time_created=iter(now - relativedelta(days=90 - i) for i in range(90)),
+            cust_id=setup_dict["customer"].customer_id,
+            _quantity=90,
+        )
+
+        def usage():
+            return (
+                billable_metric.get_billing_record_total_billable_usage(billing_record),
+                billable_metric.get_billing_record_current_usage(billing_record),
+                billable_metric.get_billing_record_daily_billable_usage(billing_record),
+            )
+
+        before = usage()
+        state_at = write_gauge_checkpoint(billable_metric, now)
+
+        assert state_at is not None
+        assert state_at < start
+        assert GaugeCheckpoint.objects.filter(metric=billable_metric).count() == 1
+        assert usage() == before
+        # the next one is only due after GAUGE_CHECKPOINT_INTERVAL_DAYS
+        assert write_gauge_checkpoint(billable_metric, now) is None
+        later = write_gauge_checkpoint(billable_metric, now + relativedelta(days=10))
+        assert later == state_at + relativedelta(days=10)
+        assert GaugeCheckpoint.objects.filter(metric=billable_metric).count() == 2
+        assert usage() == before
+
+        invalidate_gauge_checkpoints(billable_metric, state_at)
+
+        assert list(
+            GaugeCheckpoint.objects.filter(metric=billable_metric).values_list(
+                "state_at", flat=True
+            )
+        ) == [state_at]
+        assert usage() == before
+
+
+@pytest.mark.django_db(transaction=True)
+class TestUsageResults:
+    def test_usage_of_closed_periods_is_stored(
+        self,
+        billable_metric_test_common_setup,
+        add_subscription_record_to_org,
+    ):
+        from metering_billing.aggregation.usage_results import (
+            USAGE_RESULT_VERSION,
+            clear_materialized_late_events,
+            invalidate_usage_results,
+        )
+        from metering_billing.kafka.consumer import write_batch_events_to_db
+        from metering_billing.models import PendingLateEvents
+
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="session_auth",
+            user_org_and_api_key_org_different=False,
+        )
+        billable_metric = Metric.objects.create(
+            organization=setup_dict["org"],
+            property_name="test_property",
+            event_name="test_event",
+            usage_aggregation_type=METRIC_AGGREGATION.SUM,
+            metric_type=METRIC_TYPE.COUNTER,
+        )
+        billable_metric.provision_materialized_views()
+        billing_plan = PlanVersion.objects.create(
+            organization=setup_dict["org"],
+            plan=setup_dict["plan"],
+        )
+        PlanComponent.objects.create(
+            billable_metric=billable_metric,
+            plan_version=billing_plan,
+        )
+        now = now_utc()
+        start = now - relativedelta(days=45)
+        with (
+            mock.patch("metering_billing.models.now_utc", return_value=start),
+            mock.patch(
+                "metering_billing.tests.test_metrics.now_utc", return_value=start
+            ),
+        ):
+            subscription_record = add_subscription_record_to_org(
+                setup_dict["org"], billing_plan, setup_dict["customer"], start
+            )
+        billing_record = subscription_record.billing_records.first()
+        assert billing_record.end_date < now - relativedelta(days=1)
+        baker.make(
+            Event,
+            event_name="test_event",
+            properties={"test_property": 3},
+            organization=setup_dict["org"],
+            time_created=start + relativedelta(days=2),
+            cust_id=setup_dict["customer"].customer_id,
+            _quantity=2,
+        )
+
+        total = billable_metric.get_billing_record_total_billable_usage(billing_record)
+        daily = billable_metric.get_billing_record_daily_billable_usage(billing_record)
+
+        assert total == Decimal(6)
+        assert sum(daily.values()) == Decimal(6)
+        usage_result = UsageResult.objects.get(
+            billing_record=billing_record, metric=billable_metric
+        )
+        assert usage_result.computation_version == USAGE_RESULT_VERSION
+        assert usage_result.usage_qty == Decimal(6)
+
+        # the stored result is what gets read from now on, even in bulk
+        UsageResult.objects.filter(pk=usage_result.pk).update(usage_qty=Decimal(7))
+        assert billable_metric.get_billing_record_total_billable_usage(
+            billing_record
+        ) == Decimal(7)
+        assert billable_metric.get_total_billable_usage_bulk([billing_record]) == {
+            billing_record.pk: Decimal(7)
+        }
+        assert (
+            billable_metric.get_billing_record_daily_billable_usage(billing_record)
+            == daily
+        )
+
+        # events landing in a later period leave it alone
+        assert (
+            invalidate_usage_results(
+                setup_dict["org"],
+                "test_event",
+                billing_record.end_date + relativedelta(days=1),
+                now,
+            )
+            == 0
+        )
+        assert (
+            invalidate_usage_results(
+                setup_dict["org"],
+                "test_event",
+                start + relativedelta(days=1),
+                start + relativedelta(days=3),
+            )
+            == 1
+        )
+        assert billable_metric.get_billing_record_total_billable_usage(
+            billing_record
+        ) == Decimal(6)
+
+        # late events from the track endpoint drop it too
+        assert UsageResult.objects.filter(billing_record=billing_record).exists()
+        late_event = {
+            "cust_id": setup_dict["customer"].customer_id,
+            "event_name": "test_event",
+            "idempotency_id": "usage_result_late_event",
+            "properties": {"test_property": 5},
+            "time_created": start + relativedelta(days=3),
+        }
+        assert write_batch_events_to_db({setup_dict["org"].pk: [late_event]}) == 1
+        assert not UsageResult.objects.filter(billing_record=billing_record).exists()
+        assert billable_metric.get_billing_record_total_billable_usage(
+            billing_record
+        ) == Decimal(11)
+
+        # and it isn't stored again until the caggs have been refreshed since
+        assert not UsageResult.objects.filter(billing_record=billing_record).exists()
+        (pending,) = PendingLateEvents.objects.all()
+        cagg_names = METRIC_HANDLER_MAP[
+            billable_metric.metric_type
+        ].continuous_aggregate_names(billable_metric)
+
+        def last_refreshes(refreshed_at):
+            return mock.patch(
+                "metering_billing.aggregation.usage_results._last_refreshes",
+                return_value={name: refreshed_at for name in cagg_names},
+            )
+
+        with last_refreshes(pending.marked_at):
+            assert clear_materialized_late_events() == 0
+        billable_metric.get_billing_record_total_billable_usage(billing_record)
+        assert not UsageResult.objects.filter(billing_record=billing_record).exists()
+        with last_refreshes(pending.marked_at + relativedelta(minutes=5)):
+            assert clear_materialized_late_events() == 1
+        assert billable_metric.get_billing_record_total_billable_usage(
+            billing_record
+        ) == Decimal(11)
+        assert UsageResult.objects.get(
+            billing_record=billing_record, metric=billable_metric
+        ).usage_qty == Decimal(11)
+
+    def test_usage_of_open_periods_is_not_stored(
+        self,
+        billable_metric_test_common_setup,
+        add_subscription_record_to_org,
+    ):
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="session_auth",
+            user_org_and_api_key_org_different=False,
+        )
+        billable_metric = Metric.objects.create(
+            organization=setup_dict["org"],
+            property_name="test_property",
+            event_name="test_event",
+            usage_aggregation_type=METRIC_AGGREGATION.SUM,
+            metric_type=METRIC_TYPE.COUNTER,
+        )
+        billable_metric.provision_materialized_views()
+        billing_plan = PlanVersion.objects.create(
+            organization=setup_dict["org"],
+            plan=setup_dict["plan"],
+        )
+        PlanComponent.objects.create(
+            billable_metric=billable_metric,
+            plan_version=billing_plan,
+        )
+        now = now_utc()
+        start = now - relativedelta(days=5)
+        with (
+            mock.patch("metering_billing.models.now_utc", return_value=start),
+            mock.patch(
+                "metering_billing.tests.test_metrics.now_utc", return_value=start
+            ),
+        ):
+            subscription_record = add_subscription_record_to_org(
+                setup_dict["org"], billing_plan, setup_dict["customer"], start
+            )
+        billing_record = subscription_record.billing_records.first()
+        baker.make(
+            Event,
+            event_name="test_event",
+            properties={"test_property": 3},
+            organization=setup_dict["org"],
+            time_created=now - relativedelta(days=1),
+            cust_id=setup_dict["customer"].customer_id,
+            _quantity=2,
+        )
+
+        assert billable_metric.get_billing_record_total_billable_usage(
+            billing_record
+        ) == Decimal(6)
+        assert billable_metric.get_total_billable_usage_bulk([billing_record]) == {
+            billing_record.pk: Decimal(6)
+        }
+        assert not UsageResult.objects.filter(billing_record=billing_record).exists()
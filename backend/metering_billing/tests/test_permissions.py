@@ -1,13 +1,17 @@
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 import pytest
+from dateutil.relativedelta import relativedelta
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APIClient
 
+from metering_billing.api_keys import LOCAL_API_KEY_CACHE
 from metering_billing.exceptions import NoAPIKeyProvided
+from metering_billing.models import APIToken
 from metering_billing.permissions import ValidOrganization, HasUserAPIKey
 from metering_billing.serializers.serializer_utils import OrganizationUUIDField
+from metering_billing.utils import now_utc
 
 
 @pytest.fixture
@@ -202,3 +206,41 @@ class TestHasAPIKey:
         setup_dict["request"].META = {"HTTP_X_API_KEY": "HTTP_X_API_KEY"}
         assert HasUserAPIKey().get_key(setup_dict["request"]) == "HTTP_X_API_KEY"
         assert HasUserAPIKey().has_permission(setup_dict["request"], setup_dict["view"]) is False
+
+
+@pytest.mark.django_db(transaction=True)
+class TestAPIKeyCache:
+    def test_invalid_key_is_only_checked_once(self, permission_test_common_setup):
+        setup_dict = permission_test_common_setup()
+        LOCAL_API_KEY_CACHE.clear()
+        setup_dict["request"].META = {"HTTP_X_API_KEY": "notakey.not_a_real_key"}
+        with patch.object(
+            APIToken.objects, "get_from_key", wraps=APIToken.objects.get_from_key
+        ) as get_from_key:
+            for _ in range(3):
+                assert HasUserAPIKey().has_permission(setup_dict["request"], setup_dict["view"]) is False
+        assert get_from_key.call_count == 1
+
+    def test_deleted_key_stops_working(self, permission_test_common_setup):
+        setup_dict = permission_test_common_setup()
+        setup_dict["request"].META = {"HTTP_X_API_KEY": setup_dict["key"]}
+        assert HasUserAPIKey().has_permission(setup_dict["request"], setup_dict["view"]) is True
+
+        APIToken.objects.get(prefix=setup_dict["key"].split(".")[0]).delete()
+        assert HasUserAPIKey().has_permission(setup_dict["request"], setup_dict["view"]) is False
+
+    def test_expired_key_is_rejected(self, permission_test_common_setup):
+        setup_dict = permission_test_common_setup()
+        LOCAL_API_KEY_CACHE.clear()
+        _, key = APIToken.objects.create_key(
+            name="expired-api-key",
+            organization=setup_dict["org"],
+            expiry_date=now_utc() - relativedelta(days=1),
+        )
+        setup_dict["request"].META = {"HTTP_X_API_KEY": key}
+        with patch.object(
+            APIToken.objects, "get_from_key", wraps=APIToken.objects.get_from_key
+        ) as get_from_key:
+            for _ in range(3):
+                assert HasUserAPIKey().has_permission(setup_dict["request"], setup_dict["view"]) is False
+        assert get_from_key.call_count == 1
@@ -0,0 +1,144 @@
+from decimal import Decimal
+from unittest import mock
+
+import pytest
+from metering_billing.models import PriceTier
+from metering_billing.pricing import TierTable, TierTableCache
+
+
+def make_tiers():
+    return [
+        PriceTier(
+            type=PriceTier.PriceTierType.FREE,
+            range_start=Decimal(0),
+            range_end=Decimal(10),
+        ),
+        PriceTier(
+            type=PriceTier.PriceTierType.PER_UNIT,
+            range_start=Decimal(11),
+            range_end=Decimal(50),
+            cost_per_batch=Decimal(2),
+            metric_units_per_batch=Decimal(5),
+            batch_rounding_type=PriceTier.BatchRoundingType.ROUND_UP,
+        ),
+        PriceTier(
+            type=PriceTier.PriceTierType.FLAT,
+            range_start=Decimal(50),
+            range_end=Decimal(100),
+            cost_per_batch=Decimal(7),
+        ),
+        PriceTier(
+            type=PriceTier.PriceTierType.PER_UNIT,
+            range_start=Decimal(100),
+            cost_per_batch=Decimal("0.5"),
+            metric_units_per_batch=Decimal(1),
+        ),
+    ]
+
+
+def rate_tier_by_tier(tiers, usage_qty, bulk_pricing_enabled=False):
+    revenue = 0
+    for i, tier in enumerate(tiers):
+        prev_tier_end = tiers[i - 1].range_end if i > 0 else False
+        revenue += tier.calculate_revenue(
+            usage_qty,
+            prev_tier_end=prev_tier_end,
+            bulk_pricing_enabled=bulk_pricing_enabled,
+        )
+    return revenue
+
+
+class TestTierTable:
+    @pytest.mark.parametrize("bulk_pricing_enabled", [False, True])
+    def test_matches_rating_tier_by_tier(self, bulk_pricing_enabled):
+        tiers = make_tiers()
+        # tiers are sorted when the table is built
+        table = TierTable.from_tiers(reversed(tiers))
+
+        for usage_qty in [0, 5, 10, 11, 12, "30.5", 50, 51, 99, 100, 101, 1000]:
+            expected = rate_tier_by_tier(
+                tiers, Decimal(usage_qty), bulk_pricing_enabled
+            )
+            assert table.rate(
+                usage_qty, bulk_pricing_enabled=bulk_pricing_enabled
+            ) == Decimal(expected)
+
+    def test_tier_starting_at_zero_applies_to_negative_usage(self):
+        tiers = [
+            PriceTier(
+                type=PriceTier.PriceTierType.FLAT,
+                range_start=Decimal(0),
+                range_end=Decimal(10),
+                cost_per_batch=Decimal(3),
+            ),
+            *make_tiers()[1:],
+        ]
+        table = TierTable.from_tiers(tiers)
+
+        for usage_qty in [-5, -1, 0]:
+            expected = rate_tier_by_tier(tiers, Decimal(usage_qty))
+            assert expected == Decimal(3)
+            assert table.rate(usage_qty) == expected
+
+    def test_no_tiers(self):
+        assert TierTable.from_tiers([]).rate(100) == Decimal(0)
+
+    def test_is_immutable(self):
+        table = TierTable.from_tiers(make_tiers())
+        with pytest.raises(AttributeError):
+            table.tiers = ()
+        with pytest.raises(AttributeError):
+            table.tiers[0].range_start = Decimal(1)
+
+    @pytest.mark.parametrize("metric_units_per_batch", [Decimal(1), Decimal(3)])
+    def test_rate_cumulative_matches_rating_each_day(self, metric_units_per_batch):
+        tiers = make_tiers()
+        tiers[3].metric_units_per_batch = metric_units_per_batch
+        table = TierTable.from_tiers(tiers)
+        cumulative_usage = []
+        running_total = Decimal(0)
+        for usage_qty in [0, 4, "2.5", 0, 30, 13, 0, 0, "0.25", 150, 1]:
+            running_total += Decimal(usage_qty)
+            cumulative_usage.append(running_total)
+
+        assert table.rate_cumulative(cumulative_usage) == [
+            table.rate_rounded_per_tier(x) for x in cumulative_usage
+        ]
+
+
+class FakePlanComponent:
+    def __init__(self, tiers):
+        self.pk = 1
+        self.plan_version_id = 1
+        self.tiers = mock.Mock()
+        self.tiers.all.return_value = tiers
+
+
+class TestTierTableCache:
+    def test_invalidation_reaches_other_processes(self):
+        plan_component = FakePlanComponent(make_tiers())
+        # two caches stand in for two processes sharing the main cache
+        web_worker, celery_worker = TierTableCache(), TierTableCache()
+        assert celery_worker.get(plan_component).rate(1000) == Decimal(
+            rate_tier_by_tier(make_tiers(), Decimal(1000))
+        )
+
+        new_tiers = make_tiers()
+        new_tiers[3].cost_per_batch = Decimal(1)
+        plan_component.tiers.all.return_value = new_tiers
+        web_worker.invalidate(plan_component.pk)
+
+        assert celery_worker.get(plan_component).rate(1000) == Decimal(
+            rate_tier_by_tier(new_tiers, Decimal(1000))
+        )
+
+    def test_tables_expire(self):
+        plan_component = FakePlanComponent(make_tiers())
+        tier_table_cache = TierTableCache(ttl=60)
+        first = tier_table_cache.get(plan_component)
+        assert tier_table_cache.get(plan_component) is first
+
+        with mock.patch(
+            "metering_billing.pricing.time.monotonic", return_value=10**12
+        ):
+            assert tier_table_cache.get(plan_component) is not first
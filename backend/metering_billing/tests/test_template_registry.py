@@ -0,0 +1,70 @@
+import datetime
+import uuid
+
+from metering_billing.aggregation.common_query_templates import CAGG_DROP
+from metering_billing.aggregation.counter_query_templates import COUNTER_CAGG_TOTAL
+from metering_billing.aggregation.template_registry import TemplateRegistry
+
+
+class TestTemplateRegistry:
+    def test_compiles_each_template_once(self):
+        registry = TemplateRegistry()
+        registry.render(CAGG_DROP, cagg_name="a")
+        registry.render(CAGG_DROP, cagg_name="b")
+        registry.render(CAGG_DROP, cagg_name="c")
+
+        stats = registry.stats()
+        assert stats["compilations"] == 1
+        assert stats["hits"] == 2
+        assert stats["compiled_templates"] == 1
+
+    def test_values_are_bound_on_every_call(self):
+        registry = TemplateRegistry()
+        params = {
+            "cagg_name": "org_abc___metric_def___day",
+            "start_date": datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc),
+            "end_date": datetime.datetime(2023, 2, 1, tzinfo=datetime.timezone.utc),
+            "query_type": "sum",
+            "filter_properties": {"region": ["us"]},
+            "group_by": ["region"],
+        }
+        first_customer, second_customer = uuid.uuid4(), uuid.uuid4()
+        registry.render_query(
+            COUNTER_CAGG_TOTAL, uuidv5_customer_id=first_customer, **params
+        )
+        _, second_params = registry.render_query(
+            COUNTER_CAGG_TOTAL, uuidv5_customer_id=second_customer, **params
+        )
+
+        assert str(second_customer) in second_params.values()
+        assert str(first_customer) not in second_params.values()
+        assert registry.stats()["compilations"] == 1
+
+    def test_compiled_templates_are_bounded(self):
+        registry = TemplateRegistry(max_compiled=2)
+        for name in ["a", "b", "c"]:
+            registry.render(f"DROP MATERIALIZED VIEW IF EXISTS {name}")
+        assert registry.stats()["compiled_templates"] == 2
+
+    def test_bound_queries_only_depend_on_the_query_shape(self):
+        registry = TemplateRegistry()
+        params = {
+            "cagg_name": "org_abc___metric_def___day",
+            "start_date": datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc),
+            "end_date": datetime.datetime(2023, 2, 1, tzinfo=datetime.timezone.utc),
+            "query_type": "sum",
+            "filter_properties": {},
+            "group_by": [],
+        }
+        first_customer, second_customer = uuid.uuid4(), uuid.uuid4()
+        first_query, first_params = registry.render_query(
+            COUNTER_CAGG_TOTAL, uuidv5_customer_id=first_customer, **params
+        )
+        second_query, second_params = registry.render_query(
+            COUNTER_CAGG_TOTAL, uuidv5_customer_id=second_customer, **params
+        )
+
+        assert first_query == second_query
+        assert str(first_customer) not in first_query
+        assert str(first_customer) in first_params.values()
+        assert str(second_customer) in second_params.values()
@@ -0,0 +1,85 @@
+import gzip
+import json
+
+import pytest
+from dateutil.relativedelta import relativedelta
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from api.ingestion import parse_time_created
+from metering_billing.utils import now_utc
+
+
+def test_parse_time_created():
+    assert parse_time_created("2023-01-01T10:00:00Z") == parse_time_created(
+        "2023-01-01T12:00:00+02:00"
+    )
+    # not RFC 3339, but still understood
+    assert parse_time_created("Jan 1 2023 10:00") == parse_time_created(
+        "2023-01-01T10:00:00.000Z"
+    )
+
+
+@pytest.mark.django_db(transaction=True)
+class TestTrackEventStream:
+    def test_ndjson_gzip_body(self, generate_org_and_api_key):
+        _, key = generate_org_and_api_key()
+        client = APIClient()
+        client.credentials(HTTP_X_API_KEY=key)
+        now = now_utc()
+        events = [
+            {
+                "customer_id": "customer",
+                "event_name": "api_call",
+                "idempotency_id": f"stream_{i}",
+                "time_created": now.isoformat(),
+                "properties": {"i": i},
+            }
+            for i in range(3)
+        ]
+        events[1]["time_created"] = (now - relativedelta(days=60)).isoformat()
+        lines = [json.dumps(event) for event in events]
+        lines.insert(2, "{not json")
+        body = gzip.compress(("\n".join(lines) + "\n").encode("utf-8"))
+
+        response = client.generic(
+            "POST",
+            reverse("track_event_stream"),
+            body,
+            content_type="application/x-ndjson",
+            HTTP_CONTENT_ENCODING="gzip",
+        )
+
+        assert response.status_code == status.HTTP_201_CREATED
+        data = response.json()
+        assert data["success"] == "some"
+        assert set(data["failed_events"]) == {"stream_1", "line_3"}
+
+    def test_rejects_other_content_types(self, generate_org_and_api_key):
+        _, key = generate_org_and_api_key()
+        client = APIClient()
+        client.credentials(HTTP_X_API_KEY=key)
+
+        response = client.post(
+            reverse("track_event_stream"), {"batch": []}, format="json"
+        )
+
+        assert response.status_code == status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+
+        # parameters of the media type don't matter
+        event = {
+            "customer_id": "customer",
+            "event_name": "api_call",
+            "idempotency_id": "stream_charset",
+            "time_created": now_utc().isoformat(),
+            "properties": {},
+        }
+        response = client.generic(
+            "POST",
+            reverse("track_event_stream"),
+            (json.dumps(event) + "\n").encode("utf-8"),
+            content_type="application/x-ndjson; charset=utf-8",
+        )
+
+        assert response.status_code == status.HTTP_201_CREATED
@@ -170,6 +170,18 @@ class METRIC_STATUS(models.TextChoices):
     ARCHIVED = ("archived", _("Archived"))
 
 
+class UNIQUE_COUNT_METHOD(models.TextChoices):
+    EXACT = ("exact", _("Exact"))
+    HYPERLOGLOG = ("hyperloglog", _("HyperLogLog"))
+    BITMAP = ("bitmap", _("Bitmap"))
+
+
+class CAGG_REBUILD_STATUS(models.TextChoices):
+    RUNNING = ("running", _("Running"))
+    COMPLETED = ("completed", _("Completed"))
+    FAILED = ("failed", _("Failed"))
+
+
 class MAKE_PLAN_VERSION_ACTIVE_TYPE(models.TextChoices):
     REPLACE_ON_RENEWAL = (
         "replace_on_renewal",
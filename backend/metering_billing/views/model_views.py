@@ -2,10 +2,8 @@
 import logging
 
 import posthog
-import sentry_sdk
 from actstream.models import Action
 from django.conf import settings
-from django.core.cache import cache
 from django.core.validators import MinValueValidator
 from django.db import transaction
 from django.db.models import Max, Func
@@ -43,6 +41,7 @@ from api.serializers.webhook_serializers import (
     SubscriptionExpiredSerializer,
     SubscriptionUpdatedSerializer, DashboardAccessSerializer
 )
+from metering_billing.api_keys import cache_api_key
 from metering_billing.exceptions import (
     DuplicateWebhookEndpoint,
     InvalidOperation,
@@ -209,13 +208,7 @@ class APITokenViewSet(
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         api_key, key = self.perform_create(serializer)
-        expiry_date = api_key.expiry_date
-        timeout = (
-            60 * 60 * 24
-            if expiry_date is None
-            else (expiry_date - now_utc()).total_seconds()
-        )
-        cache.set(key, api_key.organization.pk, timeout)
+        cache_api_key(key, api_key)
         headers = self.get_success_headers(serializer.data)
         return Response(
             {"api_key": serializer.data, "key": key},
@@ -224,15 +217,7 @@ class APITokenViewSet(
         )
 
     def perform_destroy(self, instance):
-        try:
-            cache.delete_pattern(f"{instance.prefix}*")
-        except Exception as e:
-            logger.error("Error deleting cache using delete pattern")
-            sentry_sdk.capture_exception(e)
-            keys_to_delete = []
-            for key in cache.keys(f"{instance.prefix}*"):
-                keys_to_delete.append(key)
-            cache.delete_many(keys_to_delete)
+        # the cached key is cleared by the APIToken post_delete signal
         return super().perform_destroy(instance)
 
     @extend_schema(
@@ -255,13 +240,7 @@ class APITokenViewSet(
         api_key.created = api_token.created
         api_key.save()
         self.perform_destroy(api_token)
-        expiry_date = api_key.expiry_date
-        timeout = (
-            60 * 60 * 24
-            if expiry_date is None
-            else (expiry_date - now_utc()).total_seconds()
-        )
-        cache.set(api_key.prefix, api_key.organization.pk, timeout)
+        cache_api_key(key, api_key)
         headers = self.get_success_headers(serializer.data)
         return Response(
             {"api_key": serializer.data, "key": key},
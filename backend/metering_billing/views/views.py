@@ -3,13 +3,24 @@ from decimal import Decimal
 
 import pytz
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Count, F, Q, Sum
 from drf_spectacular.utils import extend_schema, inline_serializer
+from metering_billing.backfill import BACKFILL_FORMATS, event_file_format
 from metering_billing.exceptions import (
     ExternalConnectionFailure,
     ExternalConnectionInvalid,
+    InvalidEventFile,
+    InvalidRequest,
+    NotFoundException,
+)
+from metering_billing.models import (
+    Event,
+    EventBackfill,
+    Invoice,
+    Organization,
+    SubscriptionRecord,
 )
-from metering_billing.models import Event, Invoice, Organization, SubscriptionRecord
 from metering_billing.netsuite_csv import get_invoices_csv_presigned_url
 from metering_billing.payment_processors import PAYMENT_PROCESSOR_MAP
 from metering_billing.permissions import HasUserAPIKey, ValidOrganization
@@ -28,7 +39,10 @@ from metering_billing.serializers.response_serializers import (
     PeriodSubscriptionsResponseSerializer,
 )
 from metering_billing.serializers.serializer_utils import OrganizationUUIDField
-from metering_billing.tasks import import_customers_from_payment_processor
+from metering_billing.tasks import (
+    import_customers_from_payment_processor,
+    run_event_backfill,
+)
 from metering_billing.utils import (
     convert_to_date,
     convert_to_datetime,
@@ -42,7 +56,8 @@ from metering_billing.utils import (
 from metering_billing.utils.enums import METRIC_STATUS, METRIC_TYPE, PAYMENT_PROCESSORS
 from rest_framework import mixins, serializers, status, viewsets
 from rest_framework.exceptions import ValidationError
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.parsers import MultiPartParser
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
@@ -387,6 +402,99 @@ class ImportCustomersView(APIView):
         )
 
 
+BackfillEventStatusSerializer = inline_serializer(
+    name="BackfillEventStatus",
+    fields={
+        "backfill_id": serializers.UUIDField(),
+        "status": serializers.ChoiceField(choices=EventBackfill.Status.choices),
+        "error": serializers.CharField(allow_null=True),
+        "result": inline_serializer(
+            name="BackfillEventsResult",
+            fields={
+                "events_read": serializers.IntegerField(),
+                "events_inserted": serializers.IntegerField(),
+                "duplicate_events": serializers.IntegerField(),
+                "invalid_events": serializers.IntegerField(),
+                "invalid_event_details": serializers.ListField(
+                    child=serializers.DictField()
+                ),
+                "refreshed_aggregates": serializers.ListField(
+                    child=serializers.CharField()
+                ),
+                "failed_aggregates": serializers.ListField(
+                    child=serializers.CharField()
+                ),
+            },
+            allow_null=True,
+        ),
+    },
+)
+
+
+def _event_backfill_status(event_backfill):
+    return {
+        "backfill_id": event_backfill.backfill_id,
+        "status": event_backfill.status,
+        "error": event_backfill.error,
+        "result": event_backfill.result,
+    }
+
+
+class BackfillEventsView(APIView):
+    permission_classes = [IsAuthenticated, IsAdminUser, ValidOrganization]
+    parser_classes = [MultiPartParser]
+
+    @extend_schema(
+        request=inline_serializer(
+            name="BackfillEventsRequest",
+            fields={
+                "file": serializers.FileField(),
+                "file_format": serializers.ChoiceField(
+                    choices=BACKFILL_FORMATS, required=False
+                ),
+            },
+        ),
+        responses={202: BackfillEventStatusSerializer},
+    )
+    def post(self, request, format=None):
+        organization = request.organization
+        upload = request.FILES.get("file")
+        if upload is None:
+            raise InvalidRequest("No file provided")
+        file_format, gzipped = event_file_format(upload.name)
+        file_format = request.data.get("file_format") or file_format
+        if file_format not in BACKFILL_FORMATS:
+            raise InvalidEventFile(
+                "Could not tell the format of the file, provide a file_format"
+            )
+        # imported by a worker, poll the status endpoint for the result
+        event_backfill = EventBackfill.objects.create(
+            organization=organization,
+            file=upload,
+            file_format=file_format,
+            gzipped=gzipped,
+        )
+        transaction.on_commit(lambda: run_event_backfill.delay(event_backfill.pk))
+        return Response(
+            _event_backfill_status(event_backfill), status=status.HTTP_202_ACCEPTED
+        )
+
+
+class BackfillEventStatusView(APIView):
+    permission_classes = [IsAuthenticated, IsAdminUser, ValidOrganization]
+
+    @extend_schema(responses={200: BackfillEventStatusSerializer})
+    def get(self, request, backfill_id, format=None):
+        event_backfill = EventBackfill.objects.filter(
+            organization=request.organization, backfill_id=backfill_id
+        ).first()
+        if event_backfill is None:
+            raise NotFoundException(f"No event backfill {backfill_id}")
+        return Response(
+            _event_backfill_status(event_backfill), status=status.HTTP_200_OK
+        )
+
+
 class ImportPaymentObjectsView(APIView):
     permission_classes = [IsAuthenticated, ValidOrganization]
 